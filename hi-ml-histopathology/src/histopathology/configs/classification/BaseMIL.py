@@ -8,7 +8,7 @@ It is responsible for instantiating the encoder and full DeepMIL model. Subclass
 their datamodules and configure experiment-specific parameters.
 """
 from pathlib import Path
-from typing import Optional, Sequence, Tuple
+from typing import Any, Dict, Optional, Sequence, Tuple
 
 import param
 from torch import nn
@@ -22,6 +22,8 @@ from histopathology.datasets.base_dataset import SlidesDataset
 from histopathology.models.deepmil import DeepMILModule
 from histopathology.models.encoders import (HistoSSLEncoder, IdentityEncoder, ImageNetEncoder, ImageNetSimCLREncoder,
                                             SSLEncoder, TileEncoder)
+from histopathology.preprocessing.slide_cache import SlideMetadataCache
+from histopathology.preprocessing.wsi_readers import WSIBackend
 from histopathology.utils.output_utils import DeepMILOutputsHandler
 from histopathology.utils.naming import MetricsKey
 
@@ -48,6 +50,10 @@ class BaseMIL(LightningContainer):
     encoder_type: str = param.String(doc="Name of the encoder class to use.")
     tile_size: int = param.Integer(224, bounds=(1, None), doc="Tile width/height, in pixels.")
     n_channels: int = param.Integer(3, bounds=(1, None), doc="Number of channels in the tile.")
+    wsi_backend: WSIBackend = param.ClassSelector(default=WSIBackend.CUCIM, class_=WSIBackend,
+                                                  doc="The library with which to read whole slides, e.g. for "
+                                                      "plotting thumbnails and heatmaps: 'cucim' (default), "
+                                                      "'openslide', or 'tifffile'.")
 
     # Data module parameters:
     batch_size: int = param.Integer(16, bounds=(1, None), doc="Number of slides to load per batch.")
@@ -64,13 +70,47 @@ class BaseMIL(LightningContainer):
                                           "random subsets of instances.")
     cache_mode: CacheMode = param.ClassSelector(default=CacheMode.MEMORY, class_=CacheMode,
                                                 doc="The type of caching to perform: "
-                                                    "'memory' (default), 'disk', or 'none'.")
+                                                    "'memory' (default), 'disk', 'memmap', or 'none'.")
     precache_location: str = param.ClassSelector(default=CacheLocation.NONE, class_=CacheLocation,
                                                  doc="Whether to pre-cache the entire transformed dataset upfront "
                                                  "and save it to disk and if re-load in cpu or gpu. Options:"
                                                  "`none` (default),`cpu`, `gpu`")
-    encoding_chunk_size: int = param.Integer(0, doc="If > 0 performs encoding in chunks, by loading"
-                                                    "enconding_chunk_size tiles per chunk")
+    max_cache_size_gb: float = param.Number(0.0, bounds=(0, None),
+                                            doc="If > 0, the least recently used cached datasets are evicted from "
+                                                "the cache directory to keep its size within this many GB.")
+    cache_eviction_grace_hours: float = param.Number(24.0, bounds=(0, None),
+                                                     doc="Cached datasets used within this many hours are never "
+                                                         "evicted, as other experiments sharing the cache directory "
+                                                         "may still be reading them.")
+    subsample_after_caching: bool = param.Boolean(False, doc="If True, caches all tiles of each slide and subsamples "
+                                                             "bags to `max_bag_size` after loading them from the "
+                                                             "cache, giving different subsets at every epoch. If "
+                                                             "False (default), the cached subsets are fixed.")
+    num_cache_workers: int = param.Integer(0, bounds=(0, None),
+                                           doc="Number of worker processes loading bags when populating a 'memory' "
+                                               "or 'memmap' cache, with tiles from several slides encoded in full "
+                                               "batches. If 0 (default), slides are loaded and encoded serially.")
+    cpu_thread_budget: int = param.Integer(0, bounds=(0, None),
+                                           doc="Total number of CPU threads shared by the cache loading workers and "
+                                               "the encoder when populating the cache in parallel. If 0 (default), "
+                                               "uses all CPUs.")
+    max_tiles_per_batch: int = param.Integer(0, bounds=(0, None),
+                                             doc="If > 0, batches slides of similar sizes with at most this many "
+                                                 "tiles in total per batch, instead of `batch_size` slides. If 0 "
+                                                 "(default), uses batches of `batch_size` slides.")
+    balance_tiles_across_ranks: bool = param.Boolean(False, doc="If True, partitions slides across processes in "
+                                                                "distributed training to balance their numbers of "
+                                                                "tiles, instead of their numbers of slides.")
+    encoding_chunk_size: int = param.Integer(0, bounds=(-1, None),
+                                             doc="If > 0 performs encoding in chunks, by loading"
+                                                 "enconding_chunk_size tiles per chunk. If -1, chooses the chunk "
+                                                 "size automatically from the free GPU memory.")
+    encoding_threads: int = param.Integer(0, bounds=(0, None),
+                                          doc="Number of intra-op threads with which to encode tiles on CPU. If 0 "
+                                              "(default), uses the current PyTorch setting.")
+    tile_loading_threads: int = param.Integer(0, bounds=(0, None),
+                                              doc="Number of threads with which to decode the tiles of each bag "
+                                                  "before encoding. If 0 (default), decodes them serially.")
     # local_dataset (used as data module root_path) is declared in DatasetParams superclass
 
     @property
@@ -143,14 +183,19 @@ class BaseMIL(LightningContainer):
         # Construct pooling layer
         pooling_layer, num_features = self.get_pooling_layer()
 
+        slides_dataset = self.get_slides_dataset()
+        slide_metadata_cache = (SlideMetadataCache(self.cache_dir / "slide_metadata")
+                                if slides_dataset is not None else None)
         outputs_handler = DeepMILOutputsHandler(outputs_root=self.outputs_folder,
                                                 n_classes=self.data_module.train_dataset.N_CLASSES,
                                                 tile_size=self.tile_size,
                                                 level=1,
-                                                slides_dataset=self.get_slides_dataset(),
+                                                slides_dataset=slides_dataset,
                                                 class_names=self.class_names,
                                                 primary_val_metric=MetricsKey.AUROC,
-                                                maximise=True)
+                                                maximise=True,
+                                                slide_metadata_cache=slide_metadata_cache,
+                                                wsi_backend=self.wsi_backend)
 
         return DeepMILModule(encoder=self.model_encoder,
                              label_column=self.data_module.train_dataset.LABEL_COLUMN,
@@ -169,5 +214,11 @@ class BaseMIL(LightningContainer):
     def get_data_module(self) -> TilesDataModule:
         raise NotImplementedError
 
+    def get_trainer_arguments(self) -> Dict[str, Any]:
+        if self.max_tiles_per_batch > 0:
+            # The tile budget batch sampler partitions batches across ranks, and cannot be replaced by the trainer
+            return dict(replace_sampler_ddp=False)
+        return super().get_trainer_arguments()
+
     def get_slides_dataset(self) -> Optional[SlidesDataset]:
         return None
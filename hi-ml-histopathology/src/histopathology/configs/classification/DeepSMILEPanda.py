@@ -83,9 +83,9 @@ class DeepSMILEPanda(BaseMIL):
 
     @property
     def cache_dir(self) -> Path:
-        return Path(
-            f"/tmp/innereye_cache1/{self.__class__.__name__}-{self.encoder_type}/"
-        )
+        # Cache entries are keyed by the content of the dataset, transforms and encoder weights, so the cache
+        # directory is shared by all experiments
+        return Path("/tmp/innereye_cache1/")
 
     def setup(self) -> None:
         if self.encoder_type == SSLEncoder.__name__:
@@ -109,8 +109,10 @@ class DeepSMILEPanda(BaseMIL):
             transform = Compose([LoadTilesBatchd(image_key, progress=True)])
         else:
             transform = Compose([
-                                LoadTilesBatchd(image_key, progress=True),
-                                EncodeTilesBatchd(image_key, self.encoder, chunk_size=self.encoding_chunk_size)
+                                LoadTilesBatchd(image_key, progress=True, as_uint8=True,
+                                                num_threads=self.tile_loading_threads),
+                                EncodeTilesBatchd(image_key, self.encoder, chunk_size=self.encoding_chunk_size,
+                                                  num_threads=self.encoding_threads)
                                 ])
 
         return PandaTilesDataModule(
@@ -124,6 +126,13 @@ class DeepSMILEPanda(BaseMIL):
             cache_dir=self.cache_dir,
             crossval_count=self.crossval_count,
             crossval_index=self.crossval_index,
+            max_cache_size_gb=self.max_cache_size_gb,
+            cache_eviction_grace_hours=self.cache_eviction_grace_hours,
+            subsample_after_caching=self.subsample_after_caching,
+            num_cache_workers=self.num_cache_workers,
+            cpu_thread_budget=self.cpu_thread_budget,
+            max_tiles_per_batch=self.max_tiles_per_batch,
+            balance_tiles_across_ranks=self.balance_tiles_across_ranks,
         )
 
     def get_slides_dataset(self) -> PandaDataset:
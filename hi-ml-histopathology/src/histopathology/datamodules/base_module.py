@@ -3,26 +3,41 @@
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
 
+import numpy as np
+import pandas as pd
 import torch
 from enum import Enum
 from pathlib import Path
-from typing import Any, Callable, Optional, Sequence, Tuple, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple, Union
 
 from monai.data.dataset import CacheDataset, Dataset, PersistentDataset
+from monai.data.utils import worker_init_fn
 from pytorch_lightning import LightningDataModule
 from torch.utils.data import DataLoader
 
-from health_ml.utils.bag_utils import BagDataset, multibag_collate
+from health_ml.utils.bag_utils import (BagDataset, TileBalancedDistributedSampler, TileBudgetBatchSampler,
+                                       multibag_collate)
 from health_ml.utils.common_utils import _create_generator
 
+from histopathology.datamodules.cache_population import (PrecomputedCacheDataset, iterate_transformed_bags,
+                                                         split_transform)
 from histopathology.datasets.base_dataset import TilesDataset
-from histopathology.models.transforms import LoadTilesBatchd
+from histopathology.datasets.feature_store import FeatureStoreDataset, FeatureStoreWriter, write_feature_store
+from histopathology.models.transforms import LoadPackedTilesBatchd, LoadTilesBatchd, Subsampled
+from histopathology.utils.cache_utils import (evict_least_recently_used, get_dataframe_fingerprint, get_fingerprint,
+                                              touch_cache_entry)
+
+# Increment when the format of cached datasets changes, to invalidate existing cache entries
+DATASET_CACHE_VERSION = 1
+# Name prefixes of the cache entries written by `TilesDataModule`, which may be evicted to respect the cache quota
+CACHE_ENTRY_PREFIXES = ('bags_', 'samples_', 'features_')
 
 
 class CacheMode(Enum):
     NONE = 'none'
     MEMORY = 'memory'
     DISK = 'disk'
+    MEMMAP = 'memmap'
 
 
 class CacheLocation(Enum):
@@ -41,7 +56,14 @@ class TilesDataModule(LightningDataModule):
                  precache_location: CacheLocation = CacheLocation.NONE,
                  cache_dir: Optional[Path] = None,
                  crossval_count: int = 0,
-                 crossval_index: int = 0) -> None:
+                 crossval_index: int = 0,
+                 max_cache_size_gb: float = 0,
+                 cache_eviction_grace_hours: float = 24,
+                 subsample_after_caching: bool = False,
+                 num_cache_workers: int = 0,
+                 cpu_thread_budget: int = 0,
+                 max_tiles_per_batch: int = 0,
+                 balance_tiles_across_ranks: bool = False) -> None:
         """
         :param root_path: Root directory of the source dataset.
         :param max_bag_size: Upper bound on number of tiles in each loaded bag during training stage. If 0 (default),
@@ -54,12 +76,17 @@ class TilesDataModule(LightningDataModule):
         :param seed: pseudorandom number generator seed to use for shuffling instances and bags. Note that randomness in
         train/val/test splits is handled independently in `get_splits()`. (default: `None`)
         :param transform: A transform to apply to the source tiles dataset, or a composition of
-        transforms using `monai.transforms.Compose`. By default (`None`), applies `LoadTilesBatchd`.
+        transforms using `monai.transforms.Compose`. By default (`None`), applies `LoadTilesBatchd`, or
+        `LoadPackedTilesBatchd` if the tiles dataset was created with packed tiles.
         :param cache_mode: The type of caching to perform, i.e. whether the results of all
         transforms up to the first randomised one should be computed only once and reused in
         subsequent iterations:
           - `MEMORY`: MONAI CacheDataset is used, the entire transformed dataset is kept in memory for fastest access;
           - `DISK`: MONAI PersistentDataset is used, each transformed sample is saved to disk and loaded on-demand;
+          - `MEMMAP`: the transformed bags of each split are written slide by slide into a feature store, with one
+          flat memory-mapped array per key (e.g. tile features) and an index of per-slide offsets and metadata. It is
+          always pre-cached in `prepare_data()`, can resume after an interruption, and is shared by all processes
+          through the OS page cache (see `FeatureStoreDataset`);
           - `NONE` (default): standard MONAI dataset is used, no caching is performed.
         :param precache_location: Whether to pre-cache the entire transformed dataset upfront and save
         it to disk. This is done once in `prepare_data()` only on the local rank-0 process, so
@@ -69,17 +96,44 @@ class TilesDataModule(LightningDataModule):
           - `CPU`: each transformed sample is saved to disk and, if cache_mode is `MEMORY`, reloaded into CPU;
           - `SAME`: each transformed sample is saved to disk and, if cache_mode is `MEMORY`, reloaded on the same
           device it was saved from;
-        If cache_mode is `DISK` precache_location `CPU` and `GPU` are equivalent.
-        :param cache_dir: The directory onto which to cache data if caching is enabled.
+        If cache_mode is `DISK` precache_location `CPU` and `GPU` are equivalent. If cache_mode is `MEMMAP`, the
+        feature store is always pre-cached and read into CPU memory.
+        :param cache_dir: The directory onto which to cache data if caching is enabled. Cache entries are named after
+        a content hash of the tiles dataset, the transform (including e.g. the encoder weights), and the bag sampling
+        parameters, so a cache directory can safely be shared across experiments and cross-validation folds.
         :param crossval_count: Number of folds to perform.
         :param crossval_index: Index of the cross validation split to be performed.
+        :param max_cache_size_gb: If > 0, the least recently used entries of `cache_dir` are evicted in
+        `prepare_data()` until their total size is at most this many GB. Entries used by this data module are kept.
+        :param cache_eviction_grace_hours: Entries of `cache_dir` used within this many hours are never evicted, as
+        they may be in use by another experiment sharing the cache directory. Entries are marked as used whenever a
+        data module loads them, so this should exceed the duration of the experiments sharing the cache.
+        :param subsample_after_caching: If `True` and caching is enabled, all tiles of each bag are cached, and bags
+        larger than `max_bag_size` (or `max_bag_size_inf`) are randomly subsampled with `Subsampled` after retrieval
+        from the cache, so that a different subset is loaded at every epoch. If `False` (default), bags are subsampled
+        before caching, so the same subset of each bag is loaded at every epoch.
+        :param num_cache_workers: If > 0 and `cache_mode` is `MEMORY` or `MEMMAP`, the cache is populated in parallel:
+        bags are loaded by this number of worker processes, and tiles from several bags are encoded together in full
+        batches (see `iterate_transformed_bags()`). If 0 (default), bags are loaded and encoded one at a time. This
+        is not supported for `DISK` caching or for transforms containing random transforms.
+        :param cpu_thread_budget: Total number of CPU threads to use when populating the cache in parallel, shared
+        between the loading workers and the intra-op threads of the encoder. If 0 (default), uses all CPUs.
+        :param max_tiles_per_batch: If > 0, batches are formed by a `TileBudgetBatchSampler` from slides of similar
+        sizes, with at most this many tiles in total (or a single larger slide), instead of `batch_size` slides.
+        In distributed training, the batches are partitioned across processes by the batch sampler, so the trainer
+        must be created with `replace_sampler_ddp=False` (see `BaseMIL.get_trainer_arguments()`).
+        :param balance_tiles_across_ranks: If `True` and training is distributed, slides are partitioned across
+        processes with a `TileBalancedDistributedSampler` to balance their total numbers of tiles, instead of only
+        their numbers of slides. This is not supported with `max_tiles_per_batch`.
         """
         if precache_location is not CacheLocation.NONE and cache_mode is CacheMode.NONE:
             raise ValueError("Can only pre-cache if caching is enabled")
         if precache_location is not CacheLocation.NONE and cache_dir is None:
             raise ValueError("A cache directory is required for pre-caching")
-        if cache_mode is CacheMode.DISK and cache_dir is None:
+        if cache_mode in [CacheMode.DISK, CacheMode.MEMMAP] and cache_dir is None:
             raise ValueError("A cache directory is required for on-disk caching")
+        if max_tiles_per_batch > 0 and balance_tiles_across_ranks:
+            raise ValueError("Cannot balance tiles across ranks with a tile budget per batch")
         super().__init__()
 
         self.root_path = root_path
@@ -92,6 +146,15 @@ class TilesDataModule(LightningDataModule):
         self.batch_size = batch_size
         self.crossval_count = crossval_count
         self.crossval_index = crossval_index
+        self.max_cache_size_gb = max_cache_size_gb
+        self.cache_eviction_grace_hours = cache_eviction_grace_hours
+        self.subsample_after_caching = subsample_after_caching
+        self.num_cache_workers = num_cache_workers
+        self.cpu_thread_budget = cpu_thread_budget
+        self.max_tiles_per_batch = max_tiles_per_batch
+        self.balance_tiles_across_ranks = balance_tiles_across_ranks
+        self._transform_fingerprints: Dict[int, str] = {}
+        self._dataset_fingerprints: Dict[int, Tuple[pd.DataFrame, str]] = {}
         self.train_dataset, self.val_dataset, self.test_dataset = self.get_splits()
         self.class_weights = self.train_dataset.get_class_weights()
         self.seed = seed
@@ -101,18 +164,94 @@ class TilesDataModule(LightningDataModule):
         raise NotImplementedError
 
     def prepare_data(self) -> None:
-        if self.precache_location != CacheLocation.NONE:
+        if self.precache_location != CacheLocation.NONE or self.cache_mode is CacheMode.MEMMAP:
             self._load_dataset(self.train_dataset, stage='train', shuffle=True)
             self._load_dataset(self.val_dataset, stage='val', shuffle=True)
             self._load_dataset(self.test_dataset, stage='test', shuffle=True)
+        if self.cache_dir is not None and self.max_cache_size_gb > 0:
+            used_entries: Set[Path] = set()
+            for tiles_dataset, stage in [(self.train_dataset, 'train'), (self.val_dataset, 'val'),
+                                         (self.test_dataset, 'test')]:
+                used_entries.update(self._get_cache_entries(tiles_dataset, stage, shuffle=True))
+            evict_least_recently_used(self.cache_dir, max_size=int(self.max_cache_size_gb * 2**30),
+                                      prefixes=CACHE_ENTRY_PREFIXES, keep=used_entries,
+                                      min_age=self.cache_eviction_grace_hours * 3600)
+
+    def _get_transform(self, tiles_dataset: TilesDataset) -> Callable:
+        if self.transform:
+            return self.transform
+        elif tiles_dataset.is_packed:
+            return LoadPackedTilesBatchd(tiles_dataset.IMAGE_COLUMN, index_key=tiles_dataset.TILE_INDEX_COLUMN)
+        else:
+            return LoadTilesBatchd(tiles_dataset.IMAGE_COLUMN)
+
+    def _get_transform_fingerprint(self, transform: Union[Sequence[Callable], Callable]) -> str:
+        # Memoised for the user-provided transform, as hashing e.g. the weights of an encoder is not free
+        if transform is not self.transform:
+            return get_fingerprint(transform)
+        if id(transform) not in self._transform_fingerprints:
+            self._transform_fingerprints[id(transform)] = get_fingerprint(transform)
+        return self._transform_fingerprints[id(transform)]
+
+    def _get_dataset_fingerprint(self, tiles_dataset: TilesDataset) -> str:
+        # Memoised per dataframe, as hashing a large tiles index is not free and is needed several times per stage
+        dataset_df = tiles_dataset.dataset_df
+        cached_df, fingerprint = self._dataset_fingerprints.get(id(dataset_df), (None, ""))
+        if cached_df is not dataset_df:
+            fingerprint = get_dataframe_fingerprint(dataset_df)
+            self._dataset_fingerprints[id(dataset_df)] = (dataset_df, fingerprint)
+        return fingerprint
+
+    def _get_max_bag_size(self, stage: str) -> int:
+        return self.max_bag_size_inf if stage in ['val', 'test'] else self.max_bag_size
+
+    def _is_subsampled_after_caching(self, stage: str) -> bool:
+        return self.subsample_after_caching and self.cache_mode is not CacheMode.NONE \
+            and self._get_max_bag_size(stage) > 0
+
+    def _get_cached_max_bag_size(self, stage: str) -> int:
+        return 0 if self._is_subsampled_after_caching(stage) else self._get_max_bag_size(stage)
+
+    def _get_cache_key(self, tiles_dataset: TilesDataset, stage: str, shuffle: bool) -> str:
+        """Hash the content of the transformed bags of a dataset: the tiles of each slide, how they are sampled into
+        bags, and how they are transformed."""
+        return get_fingerprint(DATASET_CACHE_VERSION,
+                               str(tiles_dataset.root_dir),
+                               self._get_dataset_fingerprint(tiles_dataset),
+                               self._get_transform_fingerprint(self._get_transform(tiles_dataset)),
+                               self._get_cached_max_bag_size(stage), shuffle, self.seed, self.cache_mode)
 
-    def _dataset_pickle_path(self, stage: str) -> Optional[Path]:
-        if self.cache_dir is None or self.cache_mode == CacheMode.NONE:
+    def _dataset_pickle_path(self, cache_key: str) -> Optional[Path]:
+        if self.cache_dir is None or self.cache_mode in [CacheMode.NONE, CacheMode.MEMMAP]:
             return None
-        return self.cache_dir / f"{stage}_dataset.pt"
+        return self.cache_dir / f"bags_{cache_key[:16]}.pt"
+
+    def _persistent_dataset_dir(self, transform: Union[Sequence[Callable], Callable]) -> Path:
+        # Samples are keyed by MONAI based on their content, so they are shared by all splits with the same transform
+        assert self.cache_dir is not None
+        return self.cache_dir / f"samples_{self._get_transform_fingerprint(transform)[:16]}"
+
+    def _feature_store_dir(self, cache_key: str) -> Path:
+        assert self.cache_dir is not None
+        return self.cache_dir / f"features_{cache_key[:16]}"
+
+    def _get_cache_entries(self, tiles_dataset: TilesDataset, stage: str, shuffle: bool) -> List[Path]:
+        """Get the paths of the entries of `cache_dir` used for the given dataset."""
+        if self.cache_dir is None or self.cache_mode is CacheMode.NONE:
+            return []
+        cache_key = self._get_cache_key(tiles_dataset, stage, shuffle)
+        if self.cache_mode is CacheMode.MEMMAP:
+            return [self._feature_store_dir(cache_key)]
+        entries = [self._dataset_pickle_path(cache_key)]
+        if self.cache_mode is CacheMode.DISK:
+            entries.append(self._persistent_dataset_dir(self._get_transform(tiles_dataset)))
+        return [entry for entry in entries if entry is not None]
 
     def _load_dataset(self, tiles_dataset: TilesDataset, stage: str, shuffle: bool) -> Dataset:
-        dataset_pickle_path = self._dataset_pickle_path(stage)
+        cache_key = self._get_cache_key(tiles_dataset, stage, shuffle) if self.cache_dir is not None else ""
+        for cache_entry in self._get_cache_entries(tiles_dataset, stage, shuffle):
+            touch_cache_entry(cache_entry)
+        dataset_pickle_path = self._dataset_pickle_path(cache_key)
 
         if dataset_pickle_path and dataset_pickle_path.is_file():
             if self.precache_location == CacheLocation.CPU:
@@ -127,20 +266,29 @@ class TilesDataModule(LightningDataModule):
 
         generator = _create_generator(self.seed)
 
-        if stage in ['val', 'test']:
-            eff_max_bag_size = self.max_bag_size_inf
-        else:
-            eff_max_bag_size = self.max_bag_size
-
         bag_dataset = BagDataset(tiles_dataset,  # type: ignore
                                  bag_ids=tiles_dataset.slide_ids,
-                                 max_bag_size=eff_max_bag_size,
+                                 max_bag_size=self._get_cached_max_bag_size(stage),
                                  shuffle_samples=shuffle,
                                  generator=generator)
-        transform = self.transform or LoadTilesBatchd(tiles_dataset.IMAGE_COLUMN)
+        transform = self._get_transform(tiles_dataset)
 
         # Save and restore PRNG state for consistency across (pre-)caching options
         generator_state = generator.get_state()
+        if self.cache_mode is CacheMode.MEMMAP:
+            store_dir = self._feature_store_dir(cache_key)
+            if self._populates_cache_in_parallel(transform):
+                with FeatureStoreWriter(store_dir, fingerprint=cache_key, n_bags=len(bag_dataset),
+                                        features_key=tiles_dataset.IMAGE_COLUMN) as writer:
+                    if not writer.is_complete:
+                        for bag in self._iterate_transformed_bags(bag_dataset, transform, writer.n_written):
+                            writer.write(bag)
+            else:
+                write_feature_store(Dataset(bag_dataset, transform), store_dir,  # type: ignore
+                                    fingerprint=cache_key, features_key=tiles_dataset.IMAGE_COLUMN, progress=True,
+                                    skip_bag=bag_dataset.bag_sampler.get_bag)
+            generator.set_state(generator_state)
+            return FeatureStoreDataset(store_dir, data=bag_dataset)
         transformed_bag_dataset = self._get_transformed_dataset(bag_dataset, transform)  # type: ignore
         generator.set_state(generator_state)
 
@@ -152,12 +300,24 @@ class TilesDataModule(LightningDataModule):
 
         return transformed_bag_dataset
 
+    def _populates_cache_in_parallel(self, transform: Union[Sequence[Callable], Callable]) -> bool:
+        return self.num_cache_workers > 0 and split_transform(transform) is not None
+
+    def _iterate_transformed_bags(self, bag_dataset: BagDataset, transform: Union[Sequence[Callable], Callable],
+                                  start_index: int = 0) -> Iterator[Dict[str, Any]]:
+        return iterate_transformed_bags(bag_dataset, transform, num_workers=self.num_cache_workers,
+                                        start_index=start_index, cpu_threads=self.cpu_thread_budget)
+
     def _get_transformed_dataset(self, base_dataset: BagDataset,
                                  transform: Union[Sequence[Callable], Callable]) -> Dataset:
-        if self.cache_mode is CacheMode.MEMORY:
+        if self.cache_mode is CacheMode.MEMORY and self._populates_cache_in_parallel(transform):
+            cache = list(self._iterate_transformed_bags(base_dataset, transform))
+            dataset = PrecomputedCacheDataset(base_dataset, transform, cache)
+        elif self.cache_mode is CacheMode.MEMORY:
             dataset = CacheDataset(base_dataset, transform, num_workers=1)  # type: ignore
         elif self.cache_mode is CacheMode.DISK:
-            dataset = PersistentDataset(base_dataset, transform, cache_dir=self.cache_dir)  # type: ignore
+            dataset = PersistentDataset(base_dataset, transform,  # type: ignore
+                                        cache_dir=self._persistent_dataset_dir(transform))
             if self.precache_location != CacheLocation.NONE:
                 import tqdm  # TODO: Make optional
 
@@ -167,11 +327,43 @@ class TilesDataModule(LightningDataModule):
             dataset = Dataset(base_dataset, transform)  # type: ignore
         return dataset
 
+    def _get_bag_sizes(self, bag_dataset: BagDataset, stage: str) -> np.ndarray:
+        bag_sizes = bag_dataset.bag_sampler.get_bag_sizes()
+        if self._is_subsampled_after_caching(stage):
+            bag_sizes = np.minimum(bag_sizes, self._get_max_bag_size(stage))
+        return bag_sizes
+
     def _get_dataloader(self, tiles_dataset: TilesDataset, stage: str, shuffle: bool,
                         **dataloader_kwargs: Any) -> DataLoader:
         transformed_bag_dataset = self._load_dataset(tiles_dataset, stage=stage, shuffle=shuffle)
         bag_dataset: BagDataset = transformed_bag_dataset.data  # type: ignore
         generator = bag_dataset.bag_sampler.generator
+        if self._is_subsampled_after_caching(stage):
+            # All keys of a bag are per-tile values, with the image (or features) first to define the bag length
+            tile_keys = [tiles_dataset.IMAGE_COLUMN] + [key for key in tiles_dataset[0]
+                                                        if key != tiles_dataset.IMAGE_COLUMN]
+            subsampling = Subsampled(tile_keys, max_size=self._get_max_bag_size(stage), allow_missing_keys=True)
+            if self.seed is not None:
+                subsampling.set_random_state(seed=self.seed)
+            transformed_bag_dataset = Dataset(transformed_bag_dataset, transform=subsampling)  # type: ignore
+            # Reseeds the subsampling in each worker process, differently at every epoch
+            dataloader_kwargs.setdefault('worker_init_fn', worker_init_fn)
+        if self.max_tiles_per_batch > 0:
+            batch_sampler = TileBudgetBatchSampler(self._get_bag_sizes(bag_dataset, stage),
+                                                   max_instances_per_batch=self.max_tiles_per_batch,
+                                                   shuffle=shuffle, seed=self.seed or 0)
+            # Partitioned across ranks by the batch sampler itself, which PyTorch Lightning cannot replace
+            return DataLoader(transformed_bag_dataset, batch_sampler=batch_sampler, collate_fn=multibag_collate,
+                              generator=generator, pin_memory=False, **dataloader_kwargs)
+        if self.balance_tiles_across_ranks and torch.distributed.is_available() and torch.distributed.is_initialized() \
+                and torch.distributed.get_world_size() > 1:
+            # Used as is by PyTorch Lightning, instead of the DistributedSampler it would otherwise inject
+            sampler = TileBalancedDistributedSampler(transformed_bag_dataset,  # type: ignore
+                                                     self._get_bag_sizes(bag_dataset, stage), shuffle=shuffle,
+                                                     seed=self.seed or 0)
+            return DataLoader(transformed_bag_dataset, batch_size=self.batch_size, sampler=sampler,
+                              collate_fn=multibag_collate, generator=generator, pin_memory=False,
+                              **dataloader_kwargs)
         return DataLoader(transformed_bag_dataset, batch_size=self.batch_size,
                           collate_fn=multibag_collate, shuffle=shuffle, generator=generator,
                           pin_memory=False,  # disable pinning as loaded data may already be on GPU
@@ -0,0 +1,187 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union, cast
+
+import torch
+from monai.data.dataset import CacheDataset
+from monai.transforms import Compose, Randomizable
+from torch.utils.data import DataLoader, Dataset
+
+from health_ml.utils.bag_utils import BagDataset
+
+from histopathology.models.transforms import EncodeTilesBatchd
+
+# Default number of tiles from consecutive bags to accumulate before encoding them together
+DEFAULT_TILES_PER_BATCH = 256
+
+
+def split_transform(transform: Union[Sequence[Callable], Callable]
+                    ) -> Optional[Tuple[List[Callable], Optional[EncodeTilesBatchd], List[Callable]]]:
+    """Split a transform into the parts before, at, and after its tile encoding step.
+
+    :param transform: A single transform, a sequence of transforms, or a MONAI `Compose`.
+    :return: A tuple with the list of transforms before the first `EncodeTilesBatchd` (e.g. tile loading), the
+    `EncodeTilesBatchd` transform itself, or `None` if there is none, and the list of transforms after it. Returns
+    `None` if the transform contains any random transform, whose results should not be cached.
+    """
+    if isinstance(transform, Compose):
+        transforms = list(transform.transforms)
+    elif isinstance(transform, Sequence):
+        transforms = list(transform)
+    else:
+        transforms = [transform]
+    if any(isinstance(t, Randomizable) for t in transforms):
+        return None
+    for index, t in enumerate(transforms):
+        if isinstance(t, EncodeTilesBatchd):
+            return transforms[:index], t, transforms[index + 1:]
+    return transforms, None, []
+
+
+def _identity(x: Any) -> Any:
+    return x
+
+
+def _limit_worker_threads(worker_id: int) -> None:
+    # Each decoding worker uses a single intra-op thread, as parallelism comes from the number of workers
+    torch.set_num_threads(1)
+
+
+class _BagLoadingDataset(Dataset):
+    """Dataset loading bags whose tile indices were sampled upfront, so that random sampling does not depend on the
+    worker process in which a bag is loaded."""
+
+    def __init__(self, base_dataset: Sequence, bags: Sequence[Sequence[int]], collate_fn: Callable,
+                 transforms: Sequence[Callable]) -> None:
+        self.base_dataset = base_dataset
+        self.bags = bags
+        self.collate_fn = collate_fn
+        self.transforms = transforms
+
+    def __len__(self) -> int:
+        return len(self.bags)
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        bag = self.collate_fn([self.base_dataset[i] for i in self.bags[index]])
+        return Compose(self.transforms)(bag) if self.transforms else bag
+
+
+def iterate_transformed_bags(bag_dataset: BagDataset, transform: Union[Sequence[Callable], Callable], num_workers: int,
+                             start_index: int = 0, tiles_per_batch: int = 0, cpu_threads: int = 0,
+                             progress: bool = True) -> Iterator[Dict[str, Any]]:
+    """Transform all bags of a dataset in parallel, for populating a cache, and yield them in order.
+
+    Bags are loaded (e.g. their tiles decoded) by a pool of `DataLoader` worker processes. If the transform
+    contains an `EncodeTilesBatchd` step, tiles from consecutive bags are then concatenated into batches of at least
+    `tiles_per_batch` tiles and encoded together in the main process, so that the encoder runs on full batches even
+    for small slides, while the workers keep loading the next bags. Each bag is yielded as soon as it is complete.
+
+    The results are identical to `[transform(bag_dataset[i]) for i in range(len(bag_dataset))]`,
+    including the random subsampling of tiles by the bag sampler.
+
+    :param bag_dataset: The dataset of bags to transform.
+    :param transform: The transform to apply to each bag, which must not contain random transforms (see
+    `split_transform()`).
+    :param num_workers: Number of worker processes loading the bags.
+    :param start_index: Index of the first bag to yield, e.g. to resume populating a cache.
+    :param tiles_per_batch: Minimum number of tiles to accumulate before encoding. If 0 (default), uses the
+    `chunk_size` of the `EncodeTilesBatchd` transform, or `DEFAULT_TILES_PER_BATCH` if that is not set.
+    :param cpu_threads: Total number of CPU threads to use. The encoder uses the threads left over by the loading
+    workers, each of which uses a single intra-op thread. If 0 (default), uses all available CPUs.
+    :param progress: Whether to display a tqdm progress bar with the throughput in tiles/s.
+    :return: An iterator over the transformed bags, from `start_index` onwards.
+    """
+    transform_parts = split_transform(transform)
+    if transform_parts is None:
+        raise ValueError("Cannot populate a cache with random transforms")
+    load_transforms, encode_transform, post_transforms = transform_parts
+    if encode_transform is not None and len(encode_transform.keys) != 1:
+        raise ValueError(f"Expected a single key to encode, got {encode_transform.keys}")
+    if tiles_per_batch <= 0:
+        tiles_per_batch = encode_transform.chunk_size if encode_transform and encode_transform.chunk_size > 0 \
+            else DEFAULT_TILES_PER_BATCH
+
+    # Sample the tiles of all bags upfront and in order, to consume the bag sampler's random generator exactly as
+    # when loading the bags sequentially
+    bag_sampler = bag_dataset.bag_sampler
+    bags = [bag_sampler.get_bag(index) for index in range(len(bag_dataset))][start_index:]
+    loading_dataset = _BagLoadingDataset(bag_dataset.base_dataset, bags, bag_dataset.collate_fn, load_transforms)
+    worker_kwargs = dict(worker_init_fn=_limit_worker_threads, prefetch_factor=4) if num_workers > 0 else {}
+    loader = DataLoader(loading_dataset, batch_size=None, collate_fn=_identity, num_workers=num_workers,
+                        **worker_kwargs)  # type: ignore
+
+    cpu_threads = cpu_threads or os.cpu_count() or 1
+    previous_num_threads = torch.get_num_threads()
+    torch.set_num_threads(max(1, cpu_threads - num_workers))
+
+    loaded_bags = iter(loader)
+    if progress:
+        from tqdm import tqdm
+        loaded_bags = tqdm(loaded_bags, desc="Populating cache", total=len(bags))
+    start_time = time.perf_counter()
+    n_tiles = 0
+    try:
+        pending_bags: List[Dict[str, Any]] = []
+        n_pending_tiles = 0
+        for index, bag in enumerate(loaded_bags):
+            n_tiles += len(bags[index])
+            if encode_transform is not None:
+                pending_bags.append(bag)
+                n_pending_tiles += len(bag[encode_transform.keys[0]])
+                if n_pending_tiles < tiles_per_batch and index < len(bags) - 1:
+                    continue
+                completed_bags = _encode_bags(pending_bags, encode_transform)
+                pending_bags, n_pending_tiles = [], 0
+            else:
+                completed_bags = [bag]
+            for completed_bag in completed_bags:
+                yield Compose(post_transforms)(completed_bag) if post_transforms else completed_bag
+            if progress:
+                tiles_per_s = n_tiles / (time.perf_counter() - start_time)
+                loaded_bags.set_postfix(tiles_per_s=f"{tiles_per_s:.0f}")  # type: ignore
+    finally:
+        torch.set_num_threads(previous_num_threads)
+    elapsed = time.perf_counter() - start_time
+    logging.info(f"Populated cache with {len(bags)} bags and {n_tiles} tiles in {elapsed:.1f} s "
+                 f"({n_tiles / max(elapsed, 1e-9):.0f} tiles/s) using {num_workers} loading workers")
+
+
+def _encode_bags(bags: List[Dict[str, Any]], encode_transform: EncodeTilesBatchd) -> List[Dict[str, Any]]:
+    """Encode the tiles of several bags together, as a single batch split into chunks by the encoder."""
+    key = str(encode_transform.keys[0])
+    lengths = [len(bag[key]) for bag in bags]
+    features = encode_transform._encode_tiles(torch.cat([bag[key] for bag in bags]))
+    encoded_bags = []
+    for bag, bag_features in zip(bags, torch.split(features, lengths)):
+        encoded_bag = dict(bag)
+        encoded_bag[key] = bag_features
+        encoded_bags.append(encoded_bag)
+    return encoded_bags
+
+
+class PrecomputedCacheDataset(CacheDataset):
+    """MONAI `CacheDataset` whose cache is filled with precomputed items, e.g. from `iterate_transformed_bags()`,
+    instead of applying the transform to each item in `__init__`."""
+
+    def __init__(self, data: Union[Sequence, BagDataset], transform: Union[Sequence[Callable], Callable],
+                 cache: List[Any]) -> None:
+        """
+        :param data: The source dataset, e.g. a `BagDataset`.
+        :param transform: The transform with which the cached items were computed. Random transforms are applied to
+        the cached items when accessed, as with `CacheDataset`.
+        :param cache: The transformed items, up to the first random transform, for all items of `data`.
+        """
+        if len(cache) != len(data):
+            raise ValueError(f"Expected {len(data)} cached items, got {len(cache)}")
+        self._precomputed_cache = cache
+        super().__init__(cast(Sequence, data), transform, progress=False)
+
+    def _fill_cache(self) -> List:
+        cache, self._precomputed_cache = self._precomputed_cache, []
+        return cache
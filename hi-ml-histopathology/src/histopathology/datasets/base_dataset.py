@@ -3,18 +3,148 @@
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
 
+import logging
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple, Union
+from typing import Any, Collection, Dict, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import pandas as pd
 import torch
-from sklearn.utils.class_weight import compute_class_weight
 from torch.utils.data import Dataset
 
 from histopathology.utils.naming import SlideKey
 
 
+def read_dataset_table(path: Union[str, Path], columns: Optional[Collection[str]] = None) -> pd.DataFrame:
+    """Read a dataset table from a CSV or Parquet file, optionally loading only a subset of columns.
+
+    :param path: Path to a `.csv` or `.parquet` file.
+    :param columns: If given, only the columns in this collection that exist in the file are loaded.
+    By default (`None`), all columns are loaded.
+    :return: The loaded dataframe.
+    """
+    path = Path(path)
+    if path.suffix == '.parquet':
+        if columns is not None:
+            import pyarrow.parquet as pq
+            available_columns = pq.read_schema(path).names
+            columns = [column for column in available_columns if column in columns]
+        return pd.read_parquet(path, columns=columns)
+    usecols = None if columns is None else (lambda column: column in columns)  # type: ignore
+    return pd.read_csv(path, usecols=usecols)
+
+
+def _find_default_dataset_table(root_dir: Path, index_filename: str, csv_filename: str) -> Path:
+    """Prefer the typed columnar index, if present, to the dataset CSV at the dataset root.
+
+    The index is only used if it is at least as recent as the CSV, so that later edits to the CSV (e.g. filtering
+    out some slides) are not silently ignored.
+    """
+    index_path = root_dir / index_filename
+    csv_path = root_dir / csv_filename
+    if not index_path.is_file():
+        return csv_path
+    if csv_path.is_file() and csv_path.stat().st_mtime_ns > index_path.stat().st_mtime_ns:
+        logging.warning(f"Ignoring {index_path}, as {csv_path} was modified after it. Loading {csv_path} instead; "
+                        f"rewrite the index to load it again.")
+        return csv_path
+    logging.info(f"Loading dataset index {index_path}")
+    return index_path
+
+
+class ColumnArray:
+    """A dataframe column (or index) stored as a numpy array, for fast positional access to its values.
+
+    String, categorical, and other object columns are stored as integer codes into an array of their unique values,
+    so rows do not each hold a Python object. This also avoids touching the reference counts of millions of objects,
+    and thus copying their memory pages, when the dataset is accessed in forked dataloader workers.
+    """
+
+    def __init__(self, values: Union[pd.Series, pd.Index]) -> None:
+        """
+        :param values: The column or index to store.
+        """
+        self.categories: Optional[np.ndarray]
+        if isinstance(values.dtype, np.dtype) and values.dtype.kind in 'biuf':
+            self.values = values.to_numpy()
+            self.categories = None
+        elif values.dtype.kind == 'O' or isinstance(values.dtype, pd.CategoricalDtype):
+            codes, uniques = pd.factorize(values)
+            self.values = codes.astype(np.int32)
+            # Missing values are coded as -1, which indexes the trailing NaN
+            self.categories = np.append(np.asarray(uniques, dtype=object), np.nan)
+        else:
+            self.values = values.to_numpy(dtype=object)
+            self.categories = None
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __getitem__(self, index: int) -> Any:
+        value = self.values[index]
+        if self.categories is not None:
+            return self.categories[value]
+        # Numeric values are returned as Python scalars, as from `pd.Series.to_dict()`
+        return value.item() if isinstance(value, np.generic) else value
+
+
+class ColumnarTable:
+    """Per-column numpy arrays of a dataframe, serving its rows by integer position in constant time.
+
+    This is much faster than label-based lookups like `df.loc[row_id].to_dict()`, which construct a new
+    `pd.Series` for every row.
+    """
+
+    def __init__(self, df: pd.DataFrame) -> None:
+        """
+        :param df: The dataframe to store. Later changes to it are not reflected in the table.
+        """
+        self.source = df
+        self.index = ColumnArray(df.index)
+        self.columns = {column: ColumnArray(df[column]) for column in df.columns}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get_row(self, index: int, columns: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+        """Get a row of the dataframe.
+
+        :param index: Integer position of the row.
+        :param columns: Columns to return. By default (`None`), all columns are returned.
+        :return: A dictionary mapping column names to the row's values.
+        """
+        columns = self.columns.keys() if columns is None else columns  # type: ignore
+        return {column: self.columns[column][index] for column in columns}  # type: ignore
+
+
+def get_slide_labels(slide_ids: pd.Series, labels: pd.Series) -> pd.Series:
+    """Get the most frequent label of each slide, from the labels of its tiles.
+
+    :param slide_ids: Slide ID of each tile.
+    :param labels: Label of each tile.
+    :return: A series of the most frequent label of each slide, indexed by slide ID and sorted as by
+    `groupby(slide_ids)`. Ties are broken in favour of the smallest label.
+    """
+    slide_codes, unique_slide_ids = pd.factorize(slide_ids, sort=True)
+    label_codes, unique_labels = pd.factorize(labels, sort=True)
+    counts = np.bincount(slide_codes * len(unique_labels) + label_codes,
+                         minlength=len(unique_slide_ids) * len(unique_labels))
+    mode_codes = counts.reshape(len(unique_slide_ids), len(unique_labels)).argmax(axis=1)
+    return pd.Series(np.asarray(unique_labels)[mode_codes], name=labels.name,
+                     index=pd.Index(unique_slide_ids, name=slide_ids.name))
+
+
+def get_balanced_class_weights(labels: np.ndarray) -> torch.Tensor:
+    """Compute class weights inversely proportional to class frequencies, as `class_weight='balanced'` in
+    scikit-learn's `compute_class_weight()`.
+
+    :param labels: The label of each sample.
+    :return: The weight of each class present in `labels`, in sorted order of the classes.
+    """
+    _, class_counts = np.unique(labels, return_counts=True)
+    return torch.as_tensor(len(labels) / (len(class_counts) * class_counts))
+
+
 class TilesDataset(Dataset):
     """Base class for datasets of WSI tiles, iterating dictionaries of image paths and metadata.
 
@@ -26,10 +156,17 @@ class TilesDataset(Dataset):
     :param SPLIT_COLUMN: CSV column name for train/test split (optional).
     :param TILE_X_COLUMN: CSV column name for horizontal tile coordinate (optional).
     :param TILE_Y_COLUMN: CSV column name for vertical tile coordinate (optional).
+    :param TILE_INDEX_COLUMN: CSV column name for the index of a tile in its slide's packed tiles file. Only present
+    if the dataset was created with packed tiles (see `preprocessing.packed_tiles.PackedTilesWriter`).
     :param TRAIN_SPLIT_LABEL: Value used to indicate the training split in `SPLIT_COLUMN`.
     :param TEST_SPLIT_LABEL: Value used to indicate the test split in `SPLIT_COLUMN`.
     :param DEFAULT_CSV_FILENAME: Default name of the dataset CSV at the dataset rood directory.
+    :param DEFAULT_INDEX_FILENAME: Default name of the typed columnar (Parquet) dataset index at the dataset root
+    directory. If present, it is loaded instead of the dataset CSV.
     :param N_CLASSES: Number of classes indexed in `LABEL_COLUMN`.
+
+    Items are served from per-column arrays of `dataset_df` (see `ColumnarTable`), built on first access and rebuilt
+    whenever `dataset_df` is reassigned. Subclasses modifying `dataset_df` in place should do so in their constructor.
     """
     TILE_ID_COLUMN: str = 'tile_id'
     SLIDE_ID_COLUMN: str = 'slide_id'
@@ -39,11 +176,13 @@ class TilesDataset(Dataset):
     SPLIT_COLUMN: Optional[str] = 'split'
     TILE_X_COLUMN: Optional[str] = 'tile_x'
     TILE_Y_COLUMN: Optional[str] = 'tile_y'
+    TILE_INDEX_COLUMN: str = 'tile_index'
 
     TRAIN_SPLIT_LABEL: str = 'train'
     TEST_SPLIT_LABEL: str = 'test'
 
     DEFAULT_CSV_FILENAME: str = "dataset.csv"
+    DEFAULT_INDEX_FILENAME: str = "dataset.parquet"
 
     N_CLASSES: int = 1  # binary classification by default
 
@@ -51,31 +190,41 @@ class TilesDataset(Dataset):
                  root: Union[str, Path],
                  dataset_csv: Optional[Union[str, Path]] = None,
                  dataset_df: Optional[pd.DataFrame] = None,
-                 train: Optional[bool] = None) -> None:
+                 train: Optional[bool] = None,
+                 columns: Optional[Sequence[str]] = None) -> None:
         """
         :param root: Root directory of the dataset.
-        :param dataset_csv: Full path to a dataset CSV file, containing at least
-        `TILE_ID_COLUMN`, `SLIDE_ID_COLUMN`, and `IMAGE_COLUMN`. If omitted, the CSV will be read
-        from `"{root}/{DEFAULT_CSV_FILENAME}"`.
+        :param dataset_csv: Full path to a dataset CSV (or Parquet) file, containing at least
+        `TILE_ID_COLUMN`, `SLIDE_ID_COLUMN`, and `IMAGE_COLUMN`. If omitted, the dataset will be read
+        from `"{root}/{DEFAULT_INDEX_FILENAME}"` if it exists, or else from `"{root}/{DEFAULT_CSV_FILENAME}"`.
         :param dataset_df: A potentially pre-processed dataframe in the same format as would be read
         from the dataset CSV file, e.g. after some filtering. If given, overrides `dataset_csv`.
         :param train: If `True`, loads only the training split (resp. `False` for test split). By
         default (`None`), loads the entire dataset as-is.
+        :param columns: If given, only these columns are loaded from the dataset file, in addition to the
+        tile ID, slide ID, image, label, split, tile coordinates, and tile index columns. By default (`None`),
+        all columns are loaded.
         """
         if self.SPLIT_COLUMN is None and train is not None:
             raise ValueError("Train/test split was specified but dataset has no split column")
 
         self.root_dir = Path(root)
+        self._table: Optional[ColumnarTable] = None
 
+        columns_to_validate = [self.SLIDE_ID_COLUMN, self.IMAGE_COLUMN, self.LABEL_COLUMN,
+                               self.SPLIT_COLUMN, self.TILE_X_COLUMN, self.TILE_Y_COLUMN]
         if dataset_df is not None:
             self.dataset_csv = None
         else:
-            self.dataset_csv = dataset_csv or self.root_dir / self.DEFAULT_CSV_FILENAME
-            dataset_df = pd.read_csv(self.dataset_csv)
-
-        columns = [self.SLIDE_ID_COLUMN, self.IMAGE_COLUMN, self.LABEL_COLUMN,
-                   self.SPLIT_COLUMN, self.TILE_X_COLUMN, self.TILE_Y_COLUMN]
-        for column in columns:
+            self.dataset_csv = dataset_csv or _find_default_dataset_table(self.root_dir, self.DEFAULT_INDEX_FILENAME,
+                                                                          self.DEFAULT_CSV_FILENAME)
+            columns_to_load = None
+            if columns is not None:
+                columns_to_load = {self.TILE_ID_COLUMN, self.TILE_INDEX_COLUMN, *columns,
+                                   *(column for column in columns_to_validate if column is not None)}
+            dataset_df = read_dataset_table(self.dataset_csv, columns_to_load)
+
+        for column in columns_to_validate:
             if column is not None and column not in dataset_df.columns:
                 raise ValueError(f"Expected column '{column}' not found in the dataframe")
 
@@ -89,11 +238,18 @@ class TilesDataset(Dataset):
     def __len__(self) -> int:
         return self.dataset_df.shape[0]
 
+    @property
+    def table(self) -> ColumnarTable:
+        """Per-column arrays of `dataset_df`, for fast positional access to its rows."""
+        if self._table is None or self._table.source is not self.dataset_df:
+            self._table = ColumnarTable(self.dataset_df)
+        return self._table
+
     def __getitem__(self, index: int) -> Dict[str, Any]:
-        tile_id = self.dataset_df.index[index]
+        table = self.table
         sample = {
-            self.TILE_ID_COLUMN: tile_id,
-            **self.dataset_df.loc[tile_id].to_dict()
+            self.TILE_ID_COLUMN: table.index[index],
+            **table.get_row(index)
         }
         sample[self.IMAGE_COLUMN] = str(self.root_dir / sample.pop(self.IMAGE_COLUMN))
         # we're replicating this column because we want to propagate the path to the batch
@@ -104,14 +260,18 @@ class TilesDataset(Dataset):
     def slide_ids(self) -> pd.Series:
         return self.dataset_df[self.SLIDE_ID_COLUMN]
 
+    @property
+    def is_packed(self) -> bool:
+        """Whether the tiles of each slide are stored in a single packed file, indexed by `TILE_INDEX_COLUMN`."""
+        return self.TILE_INDEX_COLUMN in self.dataset_df.columns
+
     def get_slide_labels(self) -> pd.Series:
-        return self.dataset_df.groupby(self.SLIDE_ID_COLUMN)[self.LABEL_COLUMN].agg(pd.Series.mode)
+        """Get the label of each slide, as the most frequent label of its tiles."""
+        return get_slide_labels(self.dataset_df[self.SLIDE_ID_COLUMN], self.dataset_df[self.LABEL_COLUMN])
 
     def get_class_weights(self) -> torch.Tensor:
-        slide_labels = self.get_slide_labels()
-        classes = np.unique(slide_labels)
-        class_weights = compute_class_weight(class_weight='balanced', classes=classes, y=slide_labels)
-        return torch.as_tensor(class_weights)
+        """Get balanced class weights, inversely proportional to the number of slides with each label."""
+        return get_balanced_class_weights(self.get_slide_labels().to_numpy())
 
 
 class SlidesDataset(Dataset):
@@ -126,7 +286,11 @@ class SlidesDataset(Dataset):
     :param TRAIN_SPLIT_LABEL: Value used to indicate the training split in `SPLIT_COLUMN`.
     :param TEST_SPLIT_LABEL: Value used to indicate the test split in `SPLIT_COLUMN`.
     :param DEFAULT_CSV_FILENAME: Default name of the dataset CSV at the dataset rood directory.
+    :param DEFAULT_INDEX_FILENAME: Default name of the typed columnar (Parquet) dataset index at the dataset root
+    directory. If present, it is loaded instead of the dataset CSV.
     :param N_CLASSES: Number of classes indexed in `LABEL_COLUMN`.
+
+    As in `TilesDataset`, items are served from per-column arrays of `dataset_df`, built on first access.
     """
     SLIDE_ID_COLUMN: str = 'slide_id'
     IMAGE_COLUMN: str = 'image'
@@ -140,6 +304,7 @@ class SlidesDataset(Dataset):
     METADATA_COLUMNS: Tuple[str, ...] = ()
 
     DEFAULT_CSV_FILENAME: str = "dataset.csv"
+    DEFAULT_INDEX_FILENAME: str = "dataset.parquet"
 
     N_CLASSES: int = 1  # binary classification by default
 
@@ -148,28 +313,38 @@ class SlidesDataset(Dataset):
                  dataset_csv: Optional[Union[str, Path]] = None,
                  dataset_df: Optional[pd.DataFrame] = None,
                  train: Optional[bool] = None,
-                 validate_columns: bool = True) -> None:
+                 validate_columns: bool = True,
+                 columns: Optional[Sequence[str]] = None) -> None:
         """
         :param root: Root directory of the dataset.
-        :param dataset_csv: Full path to a dataset CSV file, containing at least
-        `TILE_ID_COLUMN`, `SLIDE_ID_COLUMN`, and `IMAGE_COLUMN`. If omitted, the CSV will be read
-        from `"{root}/{DEFAULT_CSV_FILENAME}"`.
+        :param dataset_csv: Full path to a dataset CSV (or Parquet) file, containing at least
+        `TILE_ID_COLUMN`, `SLIDE_ID_COLUMN`, and `IMAGE_COLUMN`. If omitted, the dataset will be read
+        from `"{root}/{DEFAULT_INDEX_FILENAME}"` if it exists, or else from `"{root}/{DEFAULT_CSV_FILENAME}"`.
         :param dataset_df: A potentially pre-processed dataframe in the same format as would be read
         from the dataset CSV file, e.g. after some filtering. If given, overrides `dataset_csv`.
         :param train: If `True`, loads only the training split (resp. `False` for test split). By
         default (`None`), loads the entire dataset as-is.
         :param validate_columns: Whether to call `validate_columns()` at the end of `__init__()`.
+        :param columns: If given, only these columns are loaded from the dataset file, in addition to the
+        slide ID, image, label, mask, split, and metadata columns. By default (`None`), all columns are loaded.
         """
         if self.SPLIT_COLUMN is None and train is not None:
             raise ValueError("Train/test split was specified but dataset has no split column")
 
         self.root_dir = Path(root)
+        self._table: Optional[ColumnarTable] = None
 
         if dataset_df is not None:
             self.dataset_csv = None
         else:
-            self.dataset_csv = dataset_csv or self.root_dir / self.DEFAULT_CSV_FILENAME
-            dataset_df = pd.read_csv(self.dataset_csv)
+            self.dataset_csv = dataset_csv or _find_default_dataset_table(self.root_dir, self.DEFAULT_INDEX_FILENAME,
+                                                                          self.DEFAULT_CSV_FILENAME)
+            columns_to_load = None
+            if columns is not None:
+                default_columns = [self.SLIDE_ID_COLUMN, self.IMAGE_COLUMN, self.LABEL_COLUMN, self.MASK_COLUMN,
+                                   self.SPLIT_COLUMN, *self.METADATA_COLUMNS]
+                columns_to_load = {*columns, *(column for column in default_columns if column is not None)}
+            dataset_df = read_dataset_table(self.dataset_csv, columns_to_load)
 
         dataset_df = dataset_df.set_index(self.SLIDE_ID_COLUMN)
         if train is None:
@@ -196,23 +371,29 @@ class SlidesDataset(Dataset):
     def __len__(self) -> int:
         return self.dataset_df.shape[0]
 
+    @property
+    def table(self) -> ColumnarTable:
+        """Per-column arrays of `dataset_df`, for fast positional access to its rows."""
+        if self._table is None or self._table.source is not self.dataset_df:
+            self._table = ColumnarTable(self.dataset_df)
+        return self._table
+
     def __getitem__(self, index: int) -> Dict[SlideKey, Any]:
-        slide_id = self.dataset_df.index[index]
-        slide_row = self.dataset_df.loc[slide_id]
-        sample = {SlideKey.SLIDE_ID: slide_id}
+        table = self.table
+        sample = {SlideKey.SLIDE_ID: table.index[index]}
 
-        rel_image_path = slide_row[self.IMAGE_COLUMN]
+        rel_image_path = table.columns[self.IMAGE_COLUMN][index]
         sample[SlideKey.IMAGE] = str(self.root_dir / rel_image_path)
         # we're replicating this column because we want to propagate the path to the batch
         sample[SlideKey.IMAGE_PATH] = sample[SlideKey.IMAGE]
 
         if self.MASK_COLUMN:
-            rel_mask_path = slide_row[self.MASK_COLUMN]
+            rel_mask_path = table.columns[self.MASK_COLUMN][index]
             sample[SlideKey.MASK] = str(self.root_dir / rel_mask_path)
             sample[SlideKey.MASK_PATH] = sample[SlideKey.MASK]
 
-        sample[SlideKey.LABEL] = slide_row[self.LABEL_COLUMN]
-        sample[SlideKey.METADATA] = {col: slide_row[col] for col in self.METADATA_COLUMNS}
+        sample[SlideKey.LABEL] = table.columns[self.LABEL_COLUMN][index]
+        sample[SlideKey.METADATA] = table.get_row(index, self.METADATA_COLUMNS)
         return sample
 
     @classmethod
@@ -0,0 +1,286 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+import json
+import logging
+import os
+import pickle
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Union, cast
+
+import numpy as np
+import torch
+from monai.data.dataset import Dataset
+
+from health_ml.utils.bag_utils import BagDataset
+
+# Increment when the layout of the feature store changes, to invalidate existing stores
+FEATURE_STORE_VERSION = 1
+
+MANIFEST_FILENAME = "manifest.json"
+INDEX_FILENAME = "index.pkl"
+
+
+def _get_array_path(store_dir: Path, key: str) -> Path:
+    return store_dir / f"{key}.bin"
+
+
+def _get_row_nbytes(array_info: Dict[str, Any]) -> int:
+    return int(np.dtype(array_info['dtype']).itemsize * np.prod(array_info['row_shape'], dtype=np.int64))
+
+
+def _is_bag_array(value: Any, bag_length: int) -> bool:
+    return isinstance(value, (torch.Tensor, np.ndarray)) and value.ndim >= 1 and value.shape[0] == bag_length
+
+
+def _read_manifest(store_dir: Path) -> Optional[Dict[str, Any]]:
+    try:
+        manifest = json.loads((store_dir / MANIFEST_FILENAME).read_text())
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != FEATURE_STORE_VERSION:
+        return None
+    return manifest
+
+
+def _read_index(store_dir: Path) -> List[Dict[str, Any]]:
+    """Read the records of an index file, discarding any trailing record truncated by an interrupted write."""
+    records: List[Dict[str, Any]] = []
+    index_path = store_dir / INDEX_FILENAME
+    if not index_path.is_file():
+        return records
+    with index_path.open('rb') as f:
+        while True:
+            position = f.tell()
+            try:
+                record = pickle.load(f)
+            except EOFError:
+                break
+            except (pickle.UnpicklingError, ValueError, AttributeError) as e:
+                logging.warning(f"Discarding truncated feature store index record at byte {position}: {e}")
+                break
+            record['end'] = f.tell()
+            records.append(record)
+    return records
+
+
+class FeatureStoreWriter:
+    """Incrementally write transformed bags into a feature store, one bag at a time.
+
+    All arrays of a bag whose first dimension is the number of tiles (e.g. tile features, coordinates, or labels)
+    are appended to one flat binary file per key, so that each key of a whole split is a single contiguous array.
+    The remaining values (e.g. lists of slide IDs or image paths) are appended to a pickled index, together with the
+    offset of the bag in the flat arrays. The index record of a bag is only written once its arrays are flushed, so
+    writing can resume after the last complete bag if it was interrupted.
+
+    Example:
+        >>> with FeatureStoreWriter(store_dir, fingerprint, n_bags=len(dataset), features_key='image') as writer:
+        ...     for index in range(writer.n_written, len(dataset)):
+        ...         writer.write(dataset[index])
+    """
+
+    def __init__(self, store_dir: Union[str, Path], fingerprint: str, n_bags: int, features_key: str) -> None:
+        """
+        :param store_dir: Directory of the feature store. Created if it does not exist. An existing store with the
+        same fingerprint is resumed, and any other existing store is overwritten.
+        :param fingerprint: A hash identifying the content of the store, e.g. of the source dataset and transforms.
+        :param n_bags: Total number of bags to be written, after which the store is marked as complete.
+        :param features_key: Key of the tile features in each bag, whose length is the number of tiles.
+        """
+        self.store_dir = Path(store_dir)
+        self.fingerprint = fingerprint
+        self.n_bags = n_bags
+        self.features_key = features_key
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+
+        manifest = _read_manifest(self.store_dir)
+        records: List[Dict[str, Any]] = []
+        if manifest is not None and manifest['fingerprint'] == fingerprint and manifest['n_bags'] == n_bags:
+            self.arrays: Dict[str, Dict[str, Any]] = manifest['arrays']
+            records = _read_index(self.store_dir)
+        else:
+            self.arrays = {}
+            for path in self.store_dir.glob("*.bin"):
+                path.unlink()
+        self.n_written = len(records)
+        self.n_tiles = records[-1]['offset'] + records[-1]['length'] if records else 0
+
+        # Discard anything written after the last complete bag
+        self._index_file = (self.store_dir / INDEX_FILENAME).open('ab')
+        self._index_file.truncate(records[-1]['end'] if records else 0)
+        self._array_files = {}
+        for key, array_info in self.arrays.items():
+            self._array_files[key] = _get_array_path(self.store_dir, key).open('ab')
+            self._array_files[key].truncate(self.n_tiles * _get_row_nbytes(array_info))
+        self._write_manifest()
+
+    @property
+    def is_complete(self) -> bool:
+        return self.n_written == self.n_bags
+
+    def _write_manifest(self) -> None:
+        manifest = {'version': FEATURE_STORE_VERSION, 'fingerprint': self.fingerprint, 'n_bags': self.n_bags,
+                    'features_key': self.features_key, 'arrays': self.arrays, 'complete': self.is_complete}
+        manifest_path = self.store_dir / MANIFEST_FILENAME
+        tmp_manifest_path = manifest_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_manifest_path.write_text(json.dumps(manifest, indent=2))
+        os.replace(tmp_manifest_path, manifest_path)
+
+    def write(self, bag: Mapping) -> None:
+        """Append a transformed bag to the store.
+
+        :param bag: A dictionary of tile features and metadata, e.g. a sample of a `BagDataset` after encoding.
+        """
+        if self.is_complete:
+            raise RuntimeError(f"All {self.n_bags} bags have already been written to {self.store_dir}")
+        length = len(bag[self.features_key])
+        values = {}
+        arrays = {}
+        new_array_infos = {}
+        # Validate the whole bag before writing anything, to keep the flat arrays aligned
+        for key, value in bag.items():
+            if not _is_bag_array(value, length):
+                values[key] = value
+                continue
+            arrays[key] = value.detach().cpu().numpy() if isinstance(value, torch.Tensor) else value
+            array_info = {'dtype': arrays[key].dtype.str, 'row_shape': list(arrays[key].shape[1:]),
+                          'is_tensor': isinstance(value, torch.Tensor)}
+            if self.n_written == 0 and key not in self.arrays:
+                new_array_infos[key] = array_info
+            elif self.arrays.get(key) != array_info:
+                raise ValueError(f"Inconsistent array for key '{key}' in bag {self.n_written}: "
+                                 f"expected {self.arrays.get(key)}, got {array_info}")
+        missing_keys = self.arrays.keys() - arrays.keys()
+        if missing_keys:
+            raise ValueError(f"Expected arrays for keys {missing_keys} in bag {self.n_written}")
+        if new_array_infos:
+            self.arrays.update(new_array_infos)
+            self._write_manifest()
+
+        for key, array in arrays.items():
+            if key not in self._array_files:
+                self._array_files[key] = _get_array_path(self.store_dir, key).open('ab')
+            self._array_files[key].write(np.ascontiguousarray(array).tobytes())
+        for array_file in self._array_files.values():
+            array_file.flush()
+        record = {'offset': self.n_tiles, 'length': length, 'keys': list(bag.keys()), 'values': values}
+        pickle.dump(record, self._index_file)
+        self._index_file.flush()
+        self.n_written += 1
+        self.n_tiles += length
+        if self.is_complete:
+            self._write_manifest()
+
+    def close(self) -> None:
+        for array_file in self._array_files.values():
+            array_file.close()
+        self._index_file.close()
+
+    def __enter__(self) -> 'FeatureStoreWriter':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+def is_feature_store_complete(store_dir: Union[str, Path], fingerprint: str) -> bool:
+    """Check whether a feature store has been completely written with the given fingerprint.
+
+    :param store_dir: Directory of the feature store.
+    :param fingerprint: The expected fingerprint of the store.
+    :return: Whether all bags of the store have been written.
+    """
+    manifest = _read_manifest(Path(store_dir))
+    return manifest is not None and manifest['fingerprint'] == fingerprint and manifest['complete']
+
+
+def write_feature_store(dataset: Sequence[Mapping], store_dir: Union[str, Path], fingerprint: str,
+                        features_key: str, progress: bool = False,
+                        skip_bag: Optional[Callable[[int], Any]] = None) -> None:
+    """Write all transformed bags of a dataset into a feature store, resuming a previously interrupted write.
+
+    :param dataset: The dataset of transformed bags, e.g. a MONAI `Dataset` wrapping a `BagDataset`.
+    :param store_dir: Directory of the feature store.
+    :param fingerprint: A hash identifying the content of the store, e.g. of the source dataset and transforms.
+    :param features_key: Key of the tile features in each bag, whose length is the number of tiles.
+    :param progress: Whether to display a tqdm progress bar.
+    :param skip_bag: Function called with the index of each bag already in the store when resuming, e.g. to
+    advance a random number generator as if the bag had been loaded again.
+    """
+    with FeatureStoreWriter(store_dir, fingerprint, n_bags=len(dataset), features_key=features_key) as writer:
+        if writer.is_complete:
+            return
+        if writer.n_written > 0:
+            logging.info(f"Resuming feature store {store_dir} from bag {writer.n_written}/{len(dataset)}")
+            if skip_bag is not None:
+                for index in range(writer.n_written):
+                    skip_bag(index)
+        indices: Iterable[int] = range(writer.n_written, len(dataset))
+        if progress:
+            from tqdm import tqdm
+            indices = tqdm(indices, desc="Writing feature store", initial=writer.n_written, total=len(dataset))
+        for index in indices:
+            writer.write(dataset[index])
+
+
+class FeatureStoreDataset(Dataset):
+    """Dataset of transformed bags read from a feature store written by `FeatureStoreWriter`.
+
+    The flat arrays of the store are memory-mapped, so reading a bag only loads its own slice, and all processes
+    reading the same store (e.g. DDP ranks and dataloader workers) share its pages through the OS page cache instead
+    of each holding a private copy. The arrays are mapped lazily in each process.
+    """
+
+    def __init__(self, store_dir: Union[str, Path], data: Optional[Union[Sequence, BagDataset]] = None) -> None:
+        """
+        :param store_dir: Directory of a complete feature store.
+        :param data: The source dataset from which the store was written, e.g. a `BagDataset`, if available. It is
+        exposed as the `data` attribute, as for other MONAI datasets, but its samples are never loaded.
+        """
+        self.store_dir = Path(store_dir)
+        manifest = _read_manifest(self.store_dir)
+        if manifest is None or not manifest['complete']:
+            raise ValueError(f"No complete feature store found in {self.store_dir}")
+        self.array_infos: Dict[str, Dict[str, Any]] = manifest['arrays']
+        self.records = _read_index(self.store_dir)
+        if len(self.records) != manifest['n_bags'] or (data is not None and len(data) != len(self.records)):
+            raise ValueError(f"Unexpected number of bags in {self.store_dir}: {len(self.records)}")
+        super().__init__(data=cast(Sequence, data) if data is not None else self.records, transform=None)
+        lengths = [record['length'] for record in self.records]
+        self.offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        self._arrays: Optional[Dict[str, np.ndarray]] = None
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def _open_arrays(self) -> Dict[str, np.ndarray]:
+        n_tiles = int(self.offsets[-1])
+        arrays = {}
+        for key, array_info in self.array_infos.items():
+            dtype, shape = np.dtype(array_info['dtype']), (n_tiles, *array_info['row_shape'])
+            # np.memmap cannot map empty files
+            arrays[key] = np.memmap(_get_array_path(self.store_dir, key), mode='r', dtype=dtype, shape=shape) \
+                if n_tiles > 0 else np.empty(shape, dtype=dtype)
+        return arrays
+
+    def _transform(self, index: int) -> Dict[str, Any]:
+        if self._arrays is None:
+            self._arrays = self._open_arrays()
+        record = self.records[index]
+        start, stop = self.offsets[index], self.offsets[index + 1]
+        bag = {}
+        for key in record['keys']:
+            if key in record['values']:
+                bag[key] = record['values'][key]
+            else:
+                array = np.array(self._arrays[key][start:stop])  # copy out of the shared read-only mapping
+                bag[key] = torch.from_numpy(array) if self.array_infos[key]['is_tensor'] else array
+        return bag
+
+    def __getstate__(self) -> Dict:
+        # Memory maps are recreated in each process instead of being pickled with their content
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
@@ -8,12 +8,14 @@ from typing import Any, Dict, Union, Optional
 
 import pandas as pd
 from monai.config import KeysCollection
-from monai.data.image_reader import ImageReader, WSIReader
+from monai.data.image_reader import ImageReader
 from monai.transforms import MapTransform
 
 from health_ml.utils import box_utils
 
 from histopathology.datasets.base_dataset import SlidesDataset
+from histopathology.preprocessing.slide_cache import SlideMetadata, SlideMetadataCache, get_level_metadata
+from histopathology.preprocessing.wsi_readers import WSIReaderType
 
 try:
     from cucim import CuImage
@@ -76,16 +78,25 @@ class LoadPandaROId(MapTransform):
     - `'size'` (tuple): width and height of the bounding box
     - `'level'` (int): chosen magnification level
     - `'scale'` (float): corresponding scale, loaded from the file
+    - `'mask_scale'` (float): scale at which the mask was loaded, if `mask_level` is specified
+
+    If a `SlideMetadataCache` is given, the mask bounding box of each slide is only estimated the first time it
+    is loaded, so the lowest-resolution mask is not read again in later epochs or runs.
     """
 
-    def __init__(self, reader: WSIReader, image_key: str = 'image', mask_key: str = 'mask',
-                 level: int = 0, margin: int = 0, **kwargs: Any) -> None:
+    def __init__(self, reader: WSIReaderType, image_key: str = 'image', mask_key: str = 'mask',
+                 level: int = 0, margin: int = 0, mask_level: Optional[int] = None,
+                 metadata_cache: Optional[SlideMetadataCache] = None, **kwargs: Any) -> None:
         """
-        :param reader: And instance of MONAI's `WSIReader`.
+        :param reader: A `SlideReader` (see `get_slide_reader()`), or an instance of MONAI's `WSIReader`.
         :param image_key: Image key in the input and output dictionaries.
         :param mask_key: Mask key in the input and output dictionaries.
         :param level: Magnification level to load from the raw multi-scale files.
         :param margin: Amount in pixels by which to enlarge the estimated bounding box for cropping.
+        :param mask_level: Magnification level at which to load the mask, e.g. a coarser level than `level`
+        when the mask is only needed to estimate tile occupancies. By default (`None`), equal to `level`.
+        :param metadata_cache: Optional cache in which to persist the mask bounding box and level downsampling
+        factors of each slide.
         """
         super().__init__([image_key, mask_key], allow_missing_keys=False)
         self.reader = reader
@@ -93,6 +104,8 @@ class LoadPandaROId(MapTransform):
         self.mask_key = mask_key
         self.level = level
         self.margin = margin
+        self.mask_level = mask_level
+        self.metadata_cache = metadata_cache
         self.kwargs = kwargs
 
     def _get_bounding_box(self, mask_obj: 'CuImage') -> box_utils.Box:
@@ -105,20 +118,46 @@ class LoadPandaROId(MapTransform):
         bbox = scale * box_utils.get_bounding_box(foreground_mask).add_margin(self.margin)
         return bbox
 
+    def get_metadata(self, mask_obj: 'CuImage', data: Dict) -> SlideMetadata:
+        """Get the mask bounding box and level downsampling factors of a slide, from the cache if available.
+
+        :param mask_obj: The cuCIM mask object returned by `reader.read(<mask_file>)`.
+        :param data: The input dictionary, from which the image and mask paths are used as cache key.
+        :return: The slide metadata, including the mask bounding box in the level-0 reference frame.
+        """
+        def compute_metadata() -> SlideMetadata:
+            metadata = get_level_metadata(mask_obj)
+            metadata.bbox = self._get_bounding_box(mask_obj)
+            return metadata
+
+        if self.metadata_cache is None:
+            return compute_metadata()
+        return self.metadata_cache.get_or_compute([data[self.image_key], data[self.mask_key]], compute_metadata,
+                                                  margin=self.margin)
+
     def __call__(self, data: Dict) -> Dict:
         mask_obj: CuImage = self.reader.read(data[self.mask_key])
         image_obj: CuImage = self.reader.read(data[self.image_key])
 
-        level0_bbox = self._get_bounding_box(mask_obj)
+        metadata = self.get_metadata(mask_obj, data)
+        assert metadata.bbox is not None
+        level0_bbox = metadata.bbox
 
         # cuCIM/OpenSlide take absolute location coordinates in the level 0 reference frame,
         # but relative region size in pixels at the chosen level
-        scale = mask_obj.resolutions['level_downsamples'][self.level]
+        scale = metadata.level_downsamples[self.level]
         scaled_bbox = level0_bbox / scale
         get_data_kwargs = dict(location=(level0_bbox.x, level0_bbox.y),
                                size=(scaled_bbox.w, scaled_bbox.h),
                                level=self.level)
-        mask, _ = self.reader.get_data(mask_obj, **get_data_kwargs)  # type: ignore
+        if self.mask_level is None or self.mask_level == self.level:
+            mask, _ = self.reader.get_data(mask_obj, **get_data_kwargs)  # type: ignore
+        else:
+            mask_scale = metadata.level_downsamples[self.mask_level]
+            scaled_mask_bbox = level0_bbox / mask_scale
+            mask, _ = self.reader.get_data(mask_obj, location=(level0_bbox.x, level0_bbox.y),
+                                           size=(scaled_mask_bbox.w, scaled_mask_bbox.h), level=self.mask_level)
+            data['mask_scale'] = mask_scale
         data[self.mask_key] = mask[:1]  # PANDA segmentation mask is in 'R' channel
         data[self.image_key], _ = self.reader.get_data(image_obj, **get_data_kwargs)  # type: ignore
         data.update(get_data_kwargs)
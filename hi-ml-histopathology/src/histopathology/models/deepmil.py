@@ -12,7 +12,9 @@ from torch import Tensor, argmax, mode, nn, optim, round, set_grad_enabled
 from torchmetrics import AUROC, F1, Accuracy, ConfusionMatrix, Precision, Recall
 
 from health_azure.utils import is_global_rank_zero
+from health_ml.networks.layers.attention_layers import PACKED_POOLING_LAYERS, get_bag_lengths
 from health_ml.utils import log_on_epoch
+from health_ml.utils.bag_utils import pack_bags
 from histopathology.datasets.base_dataset import TilesDataset
 from histopathology.models.encoders import TileEncoder
 from histopathology.utils.naming import MetricsKey, ResultsKey
@@ -168,14 +170,45 @@ class DeepMILModule(LightningModule):
             else:
                 log_on_epoch(self, f'{stage}/{metric_name}', metric_object)
 
-    def forward(self, instances: Tensor) -> Tuple[Tensor, Tensor]:  # type: ignore
+    def forward(self, instances: Tensor, bag_offsets: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:  # type: ignore
+        """
+        :param instances: The instances of one bag, or of a packed batch of bags (see `pack_bags()`).
+        :param bag_offsets: If given, offsets of the bags in the packed `instances`, of length `B + 1`. The pooling
+        layer must then be one of `PACKED_POOLING_LAYERS`.
+        :return: The bag logits (B x n_classes, with B = 1 for a single bag) and the attention weights (K x N).
+        """
         with set_grad_enabled(self.is_finetune):
             instance_features = self.encoder(instances)                    # N X L x 1 x 1
-        attentions, bag_features = self.aggregation_fn(instance_features)  # K x N | K x L
-        bag_features = bag_features.view(1, -1)
+        if bag_offsets is None:
+            attentions, bag_features = self.aggregation_fn(instance_features)  # K x N | K x L
+        else:
+            attentions, bag_features = self.aggregation_fn(instance_features, bag_offsets)  # type: ignore
+        bag_features = bag_features.view(1 if bag_offsets is None else len(bag_offsets) - 1, -1)
         bag_logit = self.classifier_fn(bag_features)
         return bag_logit, attentions
 
+    def _forward_bags(self, bags: List[Tensor]) -> Tuple[Tensor, List[Tensor]]:
+        """Compute the logits and attention weights of a batch of bags.
+
+        If the pooling layer supports it, the bags are packed and processed in a single forward pass, with the
+        encoder running once over all instances of the batch. Otherwise, they are processed one at a time. Note that
+        an encoder with batch normalisation in training mode then uses the statistics of the whole batch.
+
+        :param bags: The instances of each bag in the batch.
+        :return: The bag logits (B x n_classes) and the list of attention weights (K x N_b) of each bag.
+        """
+        if isinstance(self.aggregation_fn, PACKED_POOLING_LAYERS):
+            instances, bag_offsets = pack_bags(bags)
+            bag_logits, attentions = self(instances, bag_offsets)
+            return bag_logits, list(attentions.split(get_bag_lengths(bag_offsets).tolist(), dim=1))
+        bag_logits_list = []
+        bag_attn_list = []
+        for images in bags:
+            logit, attn = self(images)
+            bag_logits_list.append(logit.view(-1))
+            bag_attn_list.append(attn)
+        return torch.stack(bag_logits_list), bag_attn_list
+
     def configure_optimizers(self) -> optim.Optimizer:
         return optim.Adam(self.parameters(), lr=self.l_rate, weight_decay=self.weight_decay,
                           betas=self.adam_betas)
@@ -185,20 +218,10 @@ class DeepMILModule(LightningModule):
 
     def _shared_step(self, batch: Dict, batch_idx: int, stage: str) -> BatchResultsType:
         # The batch dict contains lists of tensors of different sizes, for all bags in the batch.
-        # This means we can't stack them along a new axis without padding to the same length.
-        # We could alternatively concatenate them, but this would require other changes (e.g. in
-        # the attention layers) to correctly split the tensors by bag/slide ID.
-        bag_labels_list = []
-        bag_logits_list = []
-        bag_attn_list = []
-        for bag_idx in range(len(batch[self.label_column])):
-            images = batch[TilesDataset.IMAGE_COLUMN][bag_idx]
-            labels = batch[self.label_column][bag_idx]
-            bag_labels_list.append(self.get_bag_label(labels))
-            logit, attn = self(images)
-            bag_logits_list.append(logit.view(-1))
-            bag_attn_list.append(attn)
-        bag_logits = torch.stack(bag_logits_list)
+        # This means we can't stack them along a new axis without padding to the same length, so
+        # they are concatenated instead, and the pooling layer splits them by bag (see `_forward_bags()`).
+        bag_labels_list = [self.get_bag_label(labels) for labels in batch[self.label_column]]
+        bag_logits, bag_attn_list = self._forward_bags(batch[TilesDataset.IMAGE_COLUMN])
         bag_labels = torch.stack(bag_labels_list).view(-1)
 
         if self.n_classes > 1:
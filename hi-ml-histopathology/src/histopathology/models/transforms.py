@@ -3,8 +3,10 @@
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
 
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Mapping, Sequence, Union, Callable, Dict
+from typing import Iterable, List, Mapping, Sequence, Union, Callable, Dict
 
 import torch
 import numpy as np
@@ -14,12 +16,16 @@ from monai.transforms.transform import MapTransform, Randomizable
 from torchvision.transforms.functional import to_tensor
 
 from histopathology.models.encoders import TileEncoder
+from histopathology.preprocessing.packed_tiles import load_packed_tiles
 
 PathOrString = Union[Path, str]
 
 
-def load_pil_image(image_path: PathOrString) -> PIL.Image.Image:
-    """Load a PIL image in RGB format from the given path"""
+def load_pil_image(image_path: PathOrString) -> np.ndarray:
+    """Load an image in RGB format from the given path, as an array in (H, W, C) format"""
+    if Path(image_path).suffix.lower() != '.png':  # e.g. WebP or JPEG tiles
+        with PIL.Image.open(image_path) as pil_image:
+            return np.asarray(pil_image.convert('RGB'))
     with PIL.PngImagePlugin.PngImageFile(image_path) as pil_png:
         image = np.asarray(pil_png)
     return image
@@ -43,6 +49,52 @@ def load_image_stack_as_tensor(image_paths: Sequence[PathOrString],
     return torch.stack(image_tensors, dim=0)
 
 
+def load_image_stack_as_uint8_tensor(image_paths: Sequence[PathOrString], num_threads: int = 0,
+                                     progress: bool = False) -> torch.Tensor:
+    """Load a batch of 8-bit images of the same size into a single preallocated `uint8` tensor.
+
+    Each image is decoded and written directly into its slot of the output tensor, without intermediate
+    floating-point tensors or stacking. With `num_threads > 0`, images are decoded concurrently in a thread pool,
+    as PIL releases the GIL while decoding. The result can be converted with `images.float().div(255)` once on the
+    target device, giving the same values as `load_image_stack_as_tensor()`.
+
+    :param image_paths: Paths of the images to load.
+    :param num_threads: Number of threads with which to decode the images. If 0 (default), images are decoded
+    serially in the calling thread.
+    :param progress: Whether to display a tqdm progress bar.
+    :return: The images as a `uint8` tensor in (N, C, H, W) format.
+    """
+    first_image = np.asarray(load_pil_image(image_paths[0]))
+    if first_image.dtype != np.uint8:
+        raise ValueError(f"Expected 8-bit images, got {first_image.dtype} in {image_paths[0]}")
+    height, width = first_image.shape[:2]
+    n_channels = first_image.shape[2] if first_image.ndim == 3 else 1
+    images = torch.empty((len(image_paths), n_channels, height, width), dtype=torch.uint8)
+    images_array = images.numpy()  # shares memory with the tensor
+
+    def load_into(index: int) -> None:
+        image = first_image if index == 0 else np.asarray(load_pil_image(image_paths[index]))
+        if image.shape[:2] != (height, width) or image.dtype != np.uint8:
+            raise ValueError(f"Expected 8-bit images of size {(height, width)}, got {image.dtype} image of size "
+                             f"{image.shape[:2]} in {image_paths[index]}")
+        images_array[index] = image.reshape(height, width, n_channels).transpose(2, 0, 1)
+
+    def run(loading_iterator: Iterable) -> None:
+        if progress:
+            from tqdm import tqdm
+            loading_iterator = tqdm(loading_iterator, desc="Loading image stack",
+                                    total=len(image_paths), leave=False)
+        for _ in loading_iterator:  # also propagates any exception raised while loading
+            pass
+
+    if num_threads > 0:
+        with ThreadPoolExecutor(num_threads) as executor:
+            run(executor.map(load_into, range(len(image_paths))))
+    else:
+        run(map(load_into, range(len(image_paths))))
+    return images
+
+
 def transform_dict_adaptor(function: Callable, k_input: str = None, k_output: str = None) -> Callable:
     """Adapt transformations to work with an input dictionary (rather than a tensor).
        We can't reuse monai.transforms.adaptors because it is only compatible with transformations that accept
@@ -77,18 +129,24 @@ def transform_dict_adaptor(function: Callable, k_input: str = None, k_output: st
 class LoadTiled(MapTransform):
     """Dictionary transform to load an individual image tile as a tensor from an input path"""
 
-    def __init__(self, keys: KeysCollection, allow_missing_keys: bool = False) -> None:
+    def __init__(self, keys: KeysCollection, allow_missing_keys: bool = False, as_uint8: bool = False) -> None:
         """
         :param keys: Key(s) for the image path(s) in the input dictionary.
         :param allow_missing_keys: If `False` (default), raises an exception when an input
         dictionary is missing any of the specified keys.
+        :param as_uint8: If `True`, loads the tile as a `uint8` tensor, deferring the conversion to floating point
+        e.g. until it reaches the GPU (see `EncodeTilesBatchd`). If `False` (default), loads a float tensor in [0, 1].
         """
         super().__init__(keys, allow_missing_keys)
+        self.as_uint8 = as_uint8
 
     def __call__(self, data: Mapping) -> Mapping:
         out_data = dict(data)  # create shallow copy
         for key in self.key_iterator(out_data):
-            out_data[key] = load_image_as_tensor(data[key])
+            if self.as_uint8:
+                out_data[key] = load_image_stack_as_uint8_tensor([data[key]])[0]
+            else:
+                out_data[key] = load_image_as_tensor(data[key])
         return out_data
 
 
@@ -97,62 +155,189 @@ class LoadTilesBatchd(MapTransform):
 
     # Cannot reuse MONAI readers because they support stacking only images with no channels
     def __init__(self, keys: KeysCollection, allow_missing_keys: bool = False,
-                 progress: bool = False) -> None:
+                 progress: bool = False, as_uint8: bool = False, num_threads: int = 0) -> None:
         """
         :param keys: Key(s) for the image path(s) in the input dictionary.
         :param allow_missing_keys: If `False` (default), raises an exception when an input
         dictionary is missing any of the specified keys.
         :param progress: Whether to display a tqdm progress bar.
+        :param as_uint8: If `True`, decodes the tiles directly into a preallocated `uint8` tensor, deferring the
+        conversion to floating point e.g. until it reaches the GPU (see `EncodeTilesBatchd`). If `False` (default),
+        loads a float tensor in [0, 1].
+        :param num_threads: If > 0, decodes the tiles concurrently with this number of threads, into a `uint8`
+        tensor as with `as_uint8=True`, then converted to floating point unless `as_uint8=True`.
         """
         super().__init__(keys, allow_missing_keys)
         self.progress = progress
+        self.as_uint8 = as_uint8
+        self.num_threads = num_threads
 
     def __call__(self, data: Mapping) -> Mapping:
         out_data = dict(data)  # create shallow copy
         for key in self.key_iterator(out_data):
-            out_data[key] = load_image_stack_as_tensor(data[key], progress=self.progress)
+            if self.as_uint8 or self.num_threads > 0:
+                images = load_image_stack_as_uint8_tensor(data[key], num_threads=self.num_threads,
+                                                          progress=self.progress)
+                out_data[key] = images if self.as_uint8 else images.float().div_(255)  # same scaling as `to_tensor()`
+            else:
+                out_data[key] = load_image_stack_as_tensor(data[key], progress=self.progress)
         return out_data
 
 
+class LoadPackedTilesBatchd(MapTransform):
+    """Dictionary transform to load a batch of image tiles as a tensor from packed tiles files.
+
+    Tiles stored in the same packed file (i.e. belonging to the same slide) are fetched with a single file
+    open and a vectorized memory-mapped read, instead of opening one PNG file per tile.
+    """
+
+    def __init__(self, keys: KeysCollection, index_key: str, allow_missing_keys: bool = False,
+                 as_uint8: bool = False) -> None:
+        """
+        :param keys: Key(s) for the packed file path(s) in the input dictionary.
+        :param index_key: Key for the indices of the tiles in their packed files.
+        :param allow_missing_keys: If `False` (default), raises an exception when an input
+        dictionary is missing any of the specified keys.
+        :param as_uint8: If `True`, returns the tiles as a `uint8` tensor, as with `LoadTilesBatchd`.
+        """
+        super().__init__(keys, allow_missing_keys)
+        self.index_key = index_key
+        self.as_uint8 = as_uint8
+
+    def _load_tiles(self, paths: Sequence[PathOrString], indices: Sequence[int]) -> torch.Tensor:
+        paths_array = np.asarray([str(path) for path in paths])
+        indices_array = np.asarray(indices, dtype=np.int64)
+        unique_paths, path_ids = np.unique(paths_array, return_inverse=True)
+        tiles_per_file = [load_packed_tiles(path, indices_array[path_ids == i])  # usually a single slide per bag
+                          for i, path in enumerate(unique_paths)]
+        tiles = np.empty((len(paths_array), *tiles_per_file[0].shape[1:]), dtype=np.uint8)
+        for i, file_tiles in enumerate(tiles_per_file):
+            tiles[path_ids == i] = file_tiles
+        if self.as_uint8:
+            return torch.from_numpy(tiles)
+        return torch.from_numpy(tiles).float().div(255)  # same scaling as `to_tensor()`
+
+    def __call__(self, data: Mapping) -> Mapping:
+        out_data = dict(data)  # create shallow copy
+        for key in self.key_iterator(out_data):
+            out_data[key] = self._load_tiles(data[key], data[self.index_key])
+        return out_data
+
+
+# Value of `EncodeTilesBatchd.chunk_size` to choose the chunk size automatically from a memory probe
+AUTO_CHUNK_SIZE = -1
+# Chunk size chosen automatically on CPU, where memory usage cannot be probed
+DEFAULT_CPU_CHUNK_SIZE = 64
+# Number of tiles encoded to probe the GPU memory usage per tile
+MEMORY_PROBE_SIZE = 4
+# Fraction of the free GPU memory to use for encoding, leaving room for the prefetched chunk and fragmentation
+AUTO_CHUNK_MEMORY_FRACTION = 0.5
+
+
 class EncodeTilesBatchd(MapTransform):
-    """Dictionary transform to extract features from a batch tensor of image tiles"""
+    """Dictionary transform to extract features from a batch tensor of image tiles.
+
+    Tiles are encoded in chunks in inference mode. On GPU, the encoding is pipelined: while a chunk is being encoded,
+    the next one is copied to pinned memory and transferred to the device on a separate CUDA stream.
+    """
 
     def __init__(self,
                  keys: KeysCollection,
                  encoder: TileEncoder,
                  allow_missing_keys: bool = False,
-                 chunk_size: int = 0) -> None:
+                 chunk_size: int = 0,
+                 num_threads: int = 0) -> None:
         """
         :param keys: Key(s) for the image tensor(s) in the input dictionary.
         :param encoder: The tile encoder to use for feature extraction.
         :param allow_missing_keys: If `False` (default), raises an exception when an input
         dictionary is missing any of the specified keys.
-        :param chunk_size: if > 0, extracts features in chunks of size chunk_size.
+        :param chunk_size: if > 0, extracts features in chunks of size chunk_size. If `AUTO_CHUNK_SIZE` (-1), chooses
+        the largest chunk size fitting in the free GPU memory, by probing the memory used to encode a few tiles, or
+        `DEFAULT_CPU_CHUNK_SIZE` on CPU. If 0 (default), encodes all tiles at once.
+        :param num_threads: If > 0, number of intra-op threads with which to encode tiles on CPU. If 0 (default), uses
+        the current PyTorch setting.
         """
         super().__init__(keys, allow_missing_keys)
         self.encoder = encoder
         self.chunk_size = chunk_size
+        self.num_threads = num_threads
+        self._auto_chunk_sizes: Dict[tuple, int] = {}
+
+    def _get_chunk_size(self, images: torch.Tensor, device: torch.device) -> int:
+        if self.chunk_size != AUTO_CHUNK_SIZE:
+            return self.chunk_size
+        if device.type != 'cuda':
+            return DEFAULT_CPU_CHUNK_SIZE
+        probe_key = (device, images.shape[1:], images.dtype)
+        if probe_key not in self._auto_chunk_sizes:
+            self._auto_chunk_sizes[probe_key] = self._probe_chunk_size(images[:MEMORY_PROBE_SIZE], device)
+        return self._auto_chunk_sizes[probe_key]
+
+    def _probe_chunk_size(self, probe_images: torch.Tensor, device: torch.device) -> int:
+        probe_images = probe_images.to(device)
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        allocated = torch.cuda.memory_allocated(device)
+        with torch.inference_mode():
+            self._encode_images(probe_images, device)
+        bytes_per_tile = (torch.cuda.max_memory_allocated(device) - allocated) / len(probe_images)
+        if hasattr(torch.cuda, 'mem_get_info'):
+            free_bytes = torch.cuda.mem_get_info(device)[0] \
+                + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+        else:
+            free_bytes = torch.cuda.get_device_properties(device).total_memory - torch.cuda.memory_allocated(device)
+        chunk_size = max(1, int(AUTO_CHUNK_MEMORY_FRACTION * free_bytes / max(bytes_per_tile, 1)))
+        logging.info(f"Encoding tiles in chunks of {chunk_size} on {device}, "
+                     f"probed {bytes_per_tile / 2**20:.1f} MiB per tile and {free_bytes / 2**30:.1f} GiB free")
+        return chunk_size
 
-    @torch.no_grad()
     def _encode_tiles(self, images: torch.Tensor) -> torch.Tensor:
         device = next(self.encoder.parameters()).device
-        if self.chunk_size > 0:
-            embeddings = []
-            chunks = torch.split(images, self.chunk_size)
-            # TODO parallelize encoding - keep metadata and images aligned
-            for chunk in chunks:
-                chunk_embeddings = self._encode_images(chunk, device)
-                embeddings.append(chunk_embeddings)
-            return torch.cat(embeddings)
-        else:
-            return self._encode_images(images, device)
+        chunk_size = self._get_chunk_size(images, device)
+        chunks = torch.split(images, chunk_size) if chunk_size > 0 else [images]
+        previous_num_threads = torch.get_num_threads()
+        if self.num_threads > 0 and device.type == 'cpu':
+            torch.set_num_threads(self.num_threads)
+        try:
+            with torch.inference_mode():
+                if device.type == 'cuda' and len(chunks) > 1:
+                    embeddings = self._encode_chunks_pipelined(chunks, device)
+                else:
+                    embeddings = [self._encode_images(chunk.to(device), device) for chunk in chunks]
+        finally:
+            torch.set_num_threads(previous_num_threads)
+        # Concatenating outside of inference mode returns a normal tensor, which can be used in autograd operations
+        # (e.g. as the input of a trainable pooling layer) after caching
+        return torch.cat(embeddings)
+
+    def _encode_chunks_pipelined(self, chunks: Sequence[torch.Tensor], device: torch.device) -> List[torch.Tensor]:
+        compute_stream = torch.cuda.current_stream(device)
+        copy_stream = torch.cuda.Stream(device)
+
+        def prefetch(chunk: torch.Tensor) -> torch.Tensor:
+            if not chunk.is_cuda and not chunk.is_pinned():
+                chunk = chunk.pin_memory()
+            with torch.cuda.stream(copy_stream):
+                return chunk.to(device, non_blocking=True)
+
+        embeddings = []
+        next_chunk = prefetch(chunks[0])
+        for index in range(len(chunks)):
+            compute_stream.wait_stream(copy_stream)
+            chunk = next_chunk
+            chunk.record_stream(compute_stream)  # do not reuse its memory before it has been encoded
+            embeddings.append(self._encode_images(chunk, device))
+            if index + 1 < len(chunks):
+                # Pinning and transferring the next chunk overlaps with the asynchronous encoding of this one
+                next_chunk = prefetch(chunks[index + 1])
+        return embeddings
 
     def _encode_images(self, images: torch.Tensor, device: torch.device) -> torch.Tensor:
         images = images.to(device)
-        embeddings = self.encoder(images)
-        del images
-        torch.cuda.empty_cache()
-        return embeddings
+        if images.dtype == torch.uint8:  # e.g. loaded with `LoadTilesBatchd(..., as_uint8=True)`
+            images = images.float().div_(255)  # same scaling as `to_tensor()`
+        return self.encoder(images)
 
     def __call__(self, data: Mapping) -> Mapping:
         out_data = dict(data)  # create shallow copy
@@ -189,7 +374,7 @@ class Subsampled(MapTransform, Randomizable):
 
     def randomize(self, total_size: int) -> None:
         subsample_size = min(self.max_size, total_size)
-        self._indices = self.R.choice(total_size, size=subsample_size)
+        self._indices = self.R.choice(total_size, size=subsample_size, replace=False)
 
     def __call__(self, data: Mapping) -> Mapping:
         out_data = dict(data)  # create shallow copy
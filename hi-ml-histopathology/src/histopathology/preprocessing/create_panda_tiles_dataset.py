@@ -13,16 +13,17 @@ import shutil
 import traceback
 import warnings
 from pathlib import Path
-from typing import Sequence, Tuple, Union
+from typing import Any, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import PIL
 from monai.data import Dataset
-from monai.data.image_reader import WSIReader
 from tqdm import tqdm
 
 from histopathology.preprocessing import tiling
 from histopathology.datasets.panda_dataset import PandaDataset, LoadPandaROId
+from histopathology.preprocessing.slide_cache import SlideMetadataCache
+from histopathology.preprocessing.wsi_readers import WSIBackend, WSIReaderType, get_slide_reader
 
 
 CSV_COLUMNS = ['slide_id', 'tile_id', 'image', 'mask', 'tile_x', 'tile_y', 'occupancy',
@@ -81,17 +82,143 @@ def generate_tiles(sample: dict, tile_size: int, occupancy_threshold: float) \
     return image_tiles, mask_tiles, abs_tile_locations, occupancies, n_discarded
 
 
+def _get_overlaps_1d(tile_starts: np.ndarray, tile_size: int, length: int, coarse_length: int,
+                     ratio: float, margin: int = 0) -> np.ndarray:
+    """Compute the overlap between each tile and each coarse mask pixel along one axis, in target-level pixels.
+
+    :param tile_starts: Start coordinates of the tiles, relative to the ROI (shape: [N]).
+    :param tile_size: Tile size, in target-level pixels.
+    :param length: Length of the ROI, in target-level pixels. Tiles are clipped to the ROI.
+    :param coarse_length: Length of the coarse mask covering the ROI, in mask pixels.
+    :param ratio: Size of a mask pixel, in target-level pixels.
+    :param margin: Number of mask pixels by which to enlarge each tile.
+    :return: A matrix of overlap lengths of shape (N, coarse_length).
+    """
+    tile_start = np.clip(tile_starts, 0, length)[:, None] - margin * ratio
+    tile_end = np.clip(tile_starts + tile_size, 0, length)[:, None] + margin * ratio
+    pixel_start = ratio * np.arange(coarse_length)[None, :]
+    pixel_end = np.minimum(pixel_start + ratio, length)
+    return np.maximum(np.minimum(tile_end, pixel_end) - np.maximum(tile_start, pixel_start), 0)
+
+
+def get_coarse_mask_occupancies(coarse_mask: np.ndarray, ratio: float, roi_shape: Tuple[int, int],
+                                tile_size: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Estimate the mask occupancy of every tile of the ROI grid by block-reducing a low-resolution mask.
+
+    Each tile's occupancy is the area-weighted fraction of foreground mask pixels it overlaps, computed for all
+    tiles at once as a product of separable overlap matrices. Parts of a tile outside the ROI count as background,
+    as with the zero padding in `generate_tiles()`.
+
+    :param coarse_mask: Boolean foreground mask covering the ROI at a coarser level, in (H, W) format.
+    :param ratio: Size of a mask pixel, in target-level pixels.
+    :param roi_shape: The (height, width) of the ROI at the target level.
+    :param tile_size: Tile size, in target-level pixels.
+    :return: A tuple containing the tile coordinates (N, 2), estimated occupancies (N,), and whether each tile
+    is near a mask boundary (N,), i.e. overlaps both foreground and background mask pixels within a margin of
+    one mask pixel. The estimate is exact for tiles not near a boundary, as long as the coarse mask is a
+    faithful downsampling of the full-resolution mask.
+    """
+    height, width = roi_shape
+    tile_locations = tiling.get_tile_coords_2d(height, width, tile_size)
+    starts_x = np.unique(tile_locations[:, 0])
+    starts_y = np.unique(tile_locations[:, 1])
+    foreground = coarse_mask.astype(float)
+
+    overlaps_y = _get_overlaps_1d(starts_y, tile_size, height, coarse_mask.shape[0], ratio)
+    overlaps_x = _get_overlaps_1d(starts_x, tile_size, width, coarse_mask.shape[1], ratio)
+    occupancies = (overlaps_y @ foreground @ overlaps_x.T) / tile_size ** 2
+
+    near_y = _get_overlaps_1d(starts_y, tile_size, height, coarse_mask.shape[0], ratio, margin=1) > 0
+    near_x = _get_overlaps_1d(starts_x, tile_size, width, coarse_mask.shape[1], ratio, margin=1) > 0
+    foreground_count = near_y.astype(float) @ foreground @ near_x.T.astype(float)
+    total_count = near_y.sum(1)[:, None] * near_x.sum(1)[None, :]
+    # Tiles partly beyond the extent of the coarse mask (due to rounding) are also treated as near a boundary
+    uncovered_y = np.minimum(starts_y + tile_size, height) > coarse_mask.shape[0] * ratio
+    uncovered_x = np.minimum(starts_x + tile_size, width) > coarse_mask.shape[1] * ratio
+    uncovered = uncovered_y[:, None] | uncovered_x[None, :]
+    near_boundary = (foreground_count > 0) & ((foreground_count < total_count) | uncovered)
+    return tile_locations, occupancies.ravel(), near_boundary.ravel()
+
+
+def read_mask_tiles(reader: WSIReaderType, mask_obj: Any, sample: dict, tile_locations: np.ndarray,
+                    tile_size: int) -> np.ndarray:
+    """Read individual full-resolution mask tiles, zero-padded outside the ROI as in `generate_tiles()`.
+
+    :param reader: The slide reader with which the mask was opened.
+    :param mask_obj: The cuCIM mask object returned by `reader.read(<mask_file>)`.
+    :param sample: Slide dictionary returned by `LoadPandaROId`, containing the ROI `'location'`, `'size'`,
+    `'level'`, and `'scale'`.
+    :param tile_locations: XY tile coordinates relative to the ROI (shape: [N, 2]).
+    :param tile_size: Tile size, in pixels at the target level.
+    :return: The mask tiles in (N, 1, H, W) format.
+    """
+    height, width = sample['size']  # ROI array shape, following the `LoadPandaROId` convention
+    scale = sample['scale']
+    mask_tiles = np.zeros((len(tile_locations), 1, tile_size, tile_size), dtype=np.uint8)
+    for i, (x, y) in enumerate(tile_locations):
+        rows = (max(y, 0), min(y + tile_size, height))
+        cols = (max(x, 0), min(x + tile_size, width))
+        location = (sample['location'][0] + int(rows[0] * scale), sample['location'][1] + int(cols[0] * scale))
+        mask, _ = reader.get_data(mask_obj, location=location, size=(rows[1] - rows[0], cols[1] - cols[0]),
+                                  level=sample['level'])
+        mask_tiles[i, :, rows[0] - y:rows[1] - y, cols[0] - x:cols[1] - x] = mask[:1]
+    return mask_tiles
+
+
+def generate_tiles_coarse_mask(sample: dict, tile_size: int, occupancy_threshold: float, reader: WSIReaderType,
+                               mask_obj: Any, save_masks: bool = True) \
+        -> Tuple[np.ndarray, Optional[np.ndarray], np.ndarray, np.ndarray, int]:
+    """Split the ROI of a slide into tiles, selecting them based on a low-resolution mask.
+
+    Occupancies are estimated with `get_coarse_mask_occupancies()`. Only tiles near a mask boundary are read from
+    the full-resolution mask to compute their occupancies exactly, and full-resolution mask tiles are otherwise
+    read only for the selected tiles, if they are to be saved. The outputs are the same as `generate_tiles()`.
+
+    :param sample: Slide dictionary returned by `LoadPandaROId` with `mask_level` coarser than `level`.
+    :param tile_size: Tile size, in pixels at the target level.
+    :param occupancy_threshold: Threshold (between 0 and 1) to determine empty tiles to discard.
+    :param reader: The slide reader with which the mask was opened.
+    :param mask_obj: The cuCIM mask object returned by `reader.read(<mask_file>)`.
+    :param save_masks: Whether to return the full-resolution mask tiles. If `False`, `None` is returned instead.
+    :return: A tuple containing the image tiles (N, C, H, W), mask tiles (N, 1, H, W) or `None`, absolute tile
+    coordinates (N, 2), occupancies (N,), and number of discarded tiles.
+    """
+    if occupancy_threshold < 0. or occupancy_threshold > 1.:
+        raise ValueError("Tile occupancy threshold must be between 0 and 1")
+    image = sample['image']
+    coarse_mask = sample['mask'][0] > 0
+    ratio = sample['mask_scale'] / sample['scale']
+    tile_locations, occupancies, near_boundary = get_coarse_mask_occupancies(coarse_mask, ratio, image.shape[1:],
+                                                                             tile_size)
+    if near_boundary.any():
+        boundary_mask_tiles = read_mask_tiles(reader, mask_obj, sample, tile_locations[near_boundary], tile_size)
+        _, occupancies[near_boundary] = select_tile(boundary_mask_tiles, occupancy_threshold)
+    selected = occupancies > occupancy_threshold
+    n_discarded = (~selected).sum()
+    logging.info(f"Percentage tiles discarded: {round(n_discarded / max(len(selected), 1) * 100, 2)}")
+
+    tile_locations = tile_locations[selected]
+    occupancies = occupancies[selected]
+    image_tiles = tiling.extract_tiles_2d(image, tile_locations, tile_size, fill_value=255)
+    mask_tiles = read_mask_tiles(reader, mask_obj, sample, tile_locations, tile_size) if save_masks else None
+
+    abs_tile_locations = (sample['scale'] * tile_locations + sample['location']).astype(int)
+
+    return image_tiles, mask_tiles, abs_tile_locations, occupancies, n_discarded
+
+
 # TODO refactor this to separate metadata identification from saving. We might want the metadata
 # even if the saving fails
-def save_tile(sample: dict, image_tile: np.ndarray, mask_tile: np.ndarray,
+def save_tile(sample: dict, image_tile: np.ndarray, mask_tile: Optional[np.ndarray],
               tile_location: Sequence[int], output_dir: Path) -> dict:
     slide_id = sample['image_id']
     descriptor = get_tile_descriptor(tile_location)
     image_tile_filename = f"train_images/{descriptor}.png"
-    mask_tile_filename = f"train_label_masks/{descriptor}_mask.png"
+    mask_tile_filename = f"train_label_masks/{descriptor}_mask.png" if mask_tile is not None else ""
 
     save_image(image_tile, output_dir / image_tile_filename)
-    save_image(mask_tile, output_dir / mask_tile_filename)
+    if mask_tile is not None:
+        save_image(mask_tile, output_dir / mask_tile_filename)
 
     tile_metadata = {
         'slide_id': slide_id,
@@ -109,7 +236,20 @@ def save_tile(sample: dict, image_tile: np.ndarray, mask_tile: np.ndarray,
 
 
 def process_slide(sample: dict, level: int, margin: int, tile_size: int, occupancy_threshold: int,
-                  output_dir: Path, tile_progress: bool = False) -> None:
+                  output_dir: Path, tile_progress: bool = False, mask_level: Optional[int] = None,
+                  save_masks: bool = True, reader: Optional[WSIReaderType] = None,
+                  wsi_backend: WSIBackend = WSIBackend.OPENSLIDE,
+                  metadata_cache: Optional[SlideMetadataCache] = None) -> None:
+    """Load and process a PANDA slide, saving tile images, masks, and information to a CSV file.
+
+    :param mask_level: If given, coarser magnification level at which to read the mask to select tiles (see
+    `generate_tiles_coarse_mask()`), instead of reading and tiling the full-resolution mask.
+    :param save_masks: Whether to save mask tiles. If `False`, the `'mask'` column is left empty.
+    :param reader: The reader with which to read the slide and mask. If `None` (default), a new one is created.
+    :param wsi_backend: The library with which to read the slide and mask, if `reader` is not given.
+    :param metadata_cache: Optional cache of the mask bounding box and level downsampling factors of each slide
+    (see `LoadPandaROId`), so that the lowest-resolution mask is only read the first time a slide is processed.
+    """
     slide_id = sample['image_id']
     slide_dir: Path = output_dir / (slide_id + "/")
     logging.info(f">>> Slide dir {slide_dir}")
@@ -130,21 +270,36 @@ def process_slide(sample: dict, level: int, margin: int, tile_size: int, occupan
             failed_tiles_file.write('tile_id' + '\n')
 
             logging.info(f"Loading slide {slide_id} ...")
-            loader = LoadPandaROId(WSIReader(), level=level, margin=margin)
+            reader = reader or get_slide_reader(wsi_backend)
+            mask_path = sample['mask']
+            use_coarse_mask = mask_level is not None and mask_level != level
+            loader = LoadPandaROId(reader, level=level, margin=margin, mask_level=mask_level,
+                                   metadata_cache=metadata_cache)
             sample = loader(sample)  # load 'image' and 'mask' from disk
 
             logging.info(f"Tiling slide {slide_id} ...")
-            image_tiles, mask_tiles, tile_locations, occupancies, _ = \
-                generate_tiles(sample, tile_size, occupancy_threshold)
+            mask_tiles: Optional[np.ndarray]
+            if use_coarse_mask:
+                mask_obj = reader.read(mask_path)
+                image_tiles, mask_tiles, tile_locations, occupancies, _ = \
+                    generate_tiles_coarse_mask(sample, tile_size, occupancy_threshold, reader, mask_obj,
+                                               save_masks=save_masks)
+                mask_obj.close()
+            else:
+                image_tiles, mask_tiles, tile_locations, occupancies, _ = \
+                    generate_tiles(sample, tile_size, occupancy_threshold)
+                if not save_masks:
+                    mask_tiles = None
             n_tiles = image_tiles.shape[0]
 
             for i in tqdm(range(n_tiles), f"Tiles ({slide_id[:6]}…)", unit="img", disable=not tile_progress):
                 try:
-                    tile_metadata = save_tile(sample, image_tiles[i], mask_tiles[i], tile_locations[i],
-                                              slide_dir)
+                    tile_metadata = save_tile(sample, image_tiles[i], None if mask_tiles is None else mask_tiles[i],
+                                              tile_locations[i], slide_dir)
                     tile_metadata['occupancy'] = occupancies[i]
                     tile_metadata['image'] = os.path.join(slide_dir.name, tile_metadata['image'])
-                    tile_metadata['mask'] = os.path.join(slide_dir.name, tile_metadata['mask'])
+                    if mask_tiles is not None:
+                        tile_metadata['mask'] = os.path.join(slide_dir.name, tile_metadata['mask'])
                     dataset_row = ','.join(str(tile_metadata[column]) for column in CSV_COLUMNS)
                     dataset_csv_file.write(dataset_row + '\n')
                 except Exception as e:
@@ -185,7 +340,10 @@ def merge_dataset_csv_files(dataset_dir: Path) -> Path:
 
 
 def main(panda_dir: Union[str, Path], root_output_dir: Union[str, Path], level: int, tile_size: int,
-         margin: int, occupancy_threshold: float, parallel: bool = False, overwrite: bool = False) -> None:
+         margin: int, occupancy_threshold: float, parallel: bool = False, overwrite: bool = False,
+         mask_level: Optional[int] = None, save_masks: bool = True,
+         wsi_backend: WSIBackend = WSIBackend.OPENSLIDE,
+         metadata_cache_dir: Optional[Union[str, Path]] = None) -> None:
 
     # Ignoring some types here because mypy is getting confused with the MONAI Dataset class
     # to select a subsample use keyword n_slides
@@ -200,7 +358,9 @@ def main(panda_dir: Union[str, Path], root_output_dir: Union[str, Path], level:
 
     func = functools.partial(process_slide, level=level, margin=margin, tile_size=tile_size,
                              occupancy_threshold=occupancy_threshold, output_dir=output_dir,
-                             tile_progress=not parallel)
+                             tile_progress=not parallel, mask_level=mask_level, save_masks=save_masks,
+                             wsi_backend=wsi_backend,
+                             metadata_cache=SlideMetadataCache(metadata_cache_dir) if metadata_cache_dir else None)
 
     if parallel:
         import multiprocessing
@@ -6,20 +6,32 @@
 import functools
 import logging
 import shutil
+import time
 import traceback
 import warnings
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum
 from pathlib import Path
-from typing import Any, Dict, Iterable, Optional, Sequence, Tuple, Union
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
+import pandas as pd
 import PIL
+from cucim import CuImage
+from health_ml.utils import box_utils
 from monai.data import Dataset
-from monai.data.image_reader import WSIReader
 from tqdm import tqdm
 
 from histopathology.datasets.base_dataset import SlidesDataset
 from histopathology.preprocessing import tiling
-from histopathology.preprocessing.loading import LoadROId, segment_foreground
+from histopathology.preprocessing.loading import (LoadROId, get_channel_sum, get_luminance, segment_foreground,
+                                                  threshold_otsu_from_histogram)
+from histopathology.preprocessing.packed_tiles import PACKED_TILES_FILENAME, PackedTilesWriter
+from histopathology.preprocessing.slide_cache import SlideMetadataCache
+from histopathology.preprocessing.slide_scheduler import (SlideManifest, estimate_slide_memory, get_num_workers,
+                                                          get_slide_dimensions, order_largest_first)
+from histopathology.preprocessing.wsi_readers import WSIBackend, WSIReaderType, get_slide_reader
 from histopathology.utils.naming import SlideKey, TileKey
 
 logging.basicConfig(format='%(asctime)s %(message)s', filemode='w')
@@ -38,7 +50,8 @@ def select_tiles(foreground_mask: np.ndarray, occupancy_threshold: float) \
     """
     if occupancy_threshold < 0. or occupancy_threshold > 1.:
         raise ValueError("Tile occupancy threshold must be between 0 and 1")
-    occupancy = foreground_mask.mean(axis=(-2, -1))
+    height, width = foreground_mask.shape[-2:]
+    occupancy = np.count_nonzero(foreground_mask, axis=(-2, -1)) / (height * width)
     return (occupancy > occupancy_threshold).squeeze(), occupancy.squeeze()  # type: ignore
 
 
@@ -52,54 +65,389 @@ def get_tile_id(slide_id: str, tile_location: Sequence[int]) -> str:
     return f"{slide_id}.{get_tile_descriptor(tile_location)}"
 
 
-def save_image(array_chw: np.ndarray, path: Path) -> PIL.Image:
-    """Save an image array in (C, H, W) format to disk."""
+class TileCodec(Enum):
+    PNG = 'png'
+    WEBP = 'webp'  # lossless
+    JPEG = 'jpeg'
+
+
+def get_tile_save_kwargs(codec: TileCodec, quality: Optional[int] = None) -> Dict[str, Any]:
+    """Get the PIL encoder options for saving tiles with the given codec.
+
+    :param codec: The image codec to use.
+    :param quality: Codec-specific compression setting: PNG compression level (0 to 9, default 6), lossless WebP
+    compression effort (0 to 100, default 80), or JPEG quality (1 to 95, default 75). If `None`, PIL defaults are used.
+    :return: A dictionary of keyword arguments for `PIL.Image.Image.save()`.
+    """
+    if codec == TileCodec.PNG:
+        return {} if quality is None else {'compress_level': quality}
+    elif codec == TileCodec.WEBP:
+        return {'lossless': True} if quality is None else {'lossless': True, 'quality': quality}
+    elif codec == TileCodec.JPEG:
+        return {} if quality is None else {'quality': quality}
+    raise ValueError(f"Unsupported tile codec: {codec}")
+
+
+def save_image(array_chw: np.ndarray, path: Path, **save_kwargs: Any) -> PIL.Image:
+    """Save an image array in (C, H, W) format to disk.
+
+    :param array_chw: The image array in (C, H, W) format.
+    :param path: Output file path. The image format is determined from the file extension.
+    :param save_kwargs: Keyword arguments for `PIL.Image.Image.save()`, e.g. from `get_tile_save_kwargs()`.
+    :return: The saved PIL image.
+    """
     path.parent.mkdir(parents=True, exist_ok=True)
-    array_hwc = np.moveaxis(array_chw, 0, -1).astype(np.uint8).squeeze()
+    array_hwc = np.moveaxis(np.asarray(array_chw, dtype=np.uint8), 0, -1).squeeze()
     pil_image = PIL.Image.fromarray(array_hwc)
-    pil_image.convert('RGB').save(path)
+    rgb_image = pil_image if pil_image.mode == 'RGB' else pil_image.convert('RGB')
+    rgb_image.save(path, **save_kwargs)
     return pil_image
 
 
+class AsyncTileWriter:
+    """Encode and save image tiles in a pool of background threads.
+
+    PIL releases the GIL while encoding, so several tiles can be encoded in parallel and overlapped with
+    reading and segmenting the slide in the main thread. At most `max_pending` tiles are queued at a time,
+    to bound memory usage. Completion callbacks are always called from the main thread, in submission order.
+
+    Example:
+        >>> with AsyncTileWriter(TileCodec.PNG, num_threads=4) as writer:
+        ...     writer.submit(tile_chw, output_dir / "tile.png", on_done=lambda error: ...)
+    """
+
+    def __init__(self, codec: TileCodec = TileCodec.PNG, quality: Optional[int] = None, num_threads: int = 4,
+                 max_pending: int = 256) -> None:
+        """
+        :param codec: The image codec with which to save the tiles.
+        :param quality: Codec-specific compression setting (see `get_tile_save_kwargs()`).
+        :param num_threads: Number of encoding threads. If 0, tiles are saved synchronously in `submit()`.
+        :param max_pending: Maximum number of tiles submitted but not yet completed.
+        """
+        if max_pending < 1:
+            raise ValueError(f"Maximum number of pending tiles must be positive, got {max_pending}")
+        self.codec = codec
+        self.save_kwargs = get_tile_save_kwargs(codec, quality)
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(num_threads) if num_threads > 0 else None
+        self._pending: Deque[Tuple[Future, Callable[[Optional[BaseException]], None]]] = deque()
+
+    @property
+    def extension(self) -> str:
+        """File extension for the tiles saved with the chosen codec."""
+        return '.jpg' if self.codec == TileCodec.JPEG else f'.{self.codec.value}'
+
+    def submit(self, array_chw: np.ndarray, path: Path, on_done: Callable[[Optional[BaseException]], None]) -> None:
+        """Queue a tile to be saved, blocking while `max_pending` tiles are already in flight.
+
+        :param array_chw: The tile array in (C, H, W) format.
+        :param path: Output file path.
+        :param on_done: Function called once the tile has been saved, with the raised exception if saving
+        failed, or `None` otherwise.
+        """
+        if self._executor is None:
+            try:
+                save_image(array_chw, path, **self.save_kwargs)
+            except Exception as e:
+                on_done(e)
+            else:
+                on_done(None)
+            return
+        future = self._executor.submit(save_image, array_chw, path, **self.save_kwargs)
+        self._pending.append((future, on_done))
+        while len(self._pending) >= self.max_pending:
+            self._complete_oldest()
+
+    def _complete_oldest(self) -> None:
+        future, on_done = self._pending.popleft()
+        on_done(future.exception())
+
+    def close(self) -> None:
+        """Wait for all pending tiles to be saved and shut down the encoding threads."""
+        while self._pending:
+            self._complete_oldest()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def __enter__(self) -> 'AsyncTileWriter':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+def get_padded_otsu_threshold(slide_image: np.ndarray, tile_size: int, fill_value: int = 255) -> float:
+    """Estimate Otsu's luminance threshold of a slide image padded to a whole number of tiles.
+
+    This is the threshold that `segment_foreground()` would estimate on all tiles of the image padded with
+    `fill_value`, computed from a histogram of the unpadded image and the number of padding pixels, without
+    padding the image.
+
+    :param slide_image: The RGB image array in (C, H, W) format.
+    :param tile_size: Lateral dimensions of each tile, in pixels.
+    :param fill_value: Value of all channels of the padding pixels.
+    :return: The estimated threshold.
+    """
+    n_channels, height, width = slide_image.shape
+    n_padding = -(-height // tile_size) * -(-width // tile_size) * tile_size ** 2 - height * width
+    if slide_image.dtype in (np.uint8, np.uint16):
+        # Luminance for every possible channel sum, as in `segment_foreground()`
+        values = np.arange(np.iinfo(slide_image.dtype).max * n_channels + 1) / n_channels
+        counts = np.bincount(get_channel_sum(slide_image).ravel(), minlength=len(values))
+        counts[fill_value * n_channels] += n_padding
+    else:
+        values, counts = np.unique(get_luminance(slide_image), return_counts=True)
+        values, counts = np.append(values, float(fill_value)), np.append(counts, n_padding)
+        order = np.argsort(values, kind='stable')
+        values, counts = values[order], counts[order]
+    return threshold_otsu_from_histogram(counts, values)
+
+
 def generate_tiles(slide_image: np.ndarray, tile_size: int, foreground_threshold: float,
                    occupancy_threshold: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
     """Split the foreground of an input slide image into tiles.
 
+    Tiles are read from strided views of the image, which is never padded or copied as a whole, so peak memory
+    is about the size of the image plus the selected tiles.
+
     :param slide_image: The RGB image array in (C, H, W) format.
     :param tile_size: Lateral dimensions of each tile, in pixels.
     :param foreground_threshold: Luminance threshold (0 to 255) to determine tile occupancy.
+    If `None`, Otsu's threshold is estimated on all tiles, including the white padding of edge tiles.
     :param occupancy_threshold: Threshold (between 0 and 1) to determine empty tiles to discard.
     :return: A tuple containing the image tiles (N, C, H, W), tile coordinates (N, 2), occupancies
     (N,), and total number of discarded empty tiles.
     """
-    image_tiles, tile_locations = tiling.tile_array_2d(slide_image, tile_size=tile_size,
-                                                       constant_values=255)
-    foreground_mask, _ = segment_foreground(image_tiles, foreground_threshold)
-
-    selected, occupancies = select_tiles(foreground_mask, occupancy_threshold)
+    if foreground_threshold is None:
+        # Estimate a single threshold for the whole slide, rather than one per row of tiles
+        foreground_threshold = get_padded_otsu_threshold(slide_image, tile_size)
+    _, height, width = slide_image.shape
+    tile_locations = tiling.get_tile_coords_2d(height, width, tile_size)
+    n_tiles_w = -(-width // tile_size)
+
+    # Segment one row of tiles at a time, so that only the selected tiles are ever copied in full
+    selected_rows, occupancy_rows = [], []
+    for row_locations in np.split(tile_locations, len(tile_locations) // n_tiles_w):
+        row_tiles = tiling.extract_tiles_2d(slide_image, row_locations, tile_size, fill_value=255)
+        foreground_mask, _ = segment_foreground(row_tiles, foreground_threshold)
+        row_selected, row_occupancies = select_tiles(foreground_mask, occupancy_threshold)
+        selected_rows.append(np.atleast_1d(row_selected))
+        occupancy_rows.append(np.atleast_1d(row_occupancies))
+    selected = np.concatenate(selected_rows)
+    occupancies = np.concatenate(occupancy_rows)
     n_discarded = (~selected).sum()
     logging.info(f"Percentage tiles discarded: {n_discarded / len(selected) * 100:.2f}")
 
-    image_tiles = image_tiles[selected]
     tile_locations = tile_locations[selected]
+    image_tiles = tiling.extract_tiles_2d(slide_image, tile_locations, tile_size, fill_value=255)
     occupancies = occupancies[selected]
 
     return image_tiles, tile_locations, occupancies, n_discarded
 
 
+def generate_tiles_streaming(reader: WSIReaderType, slide_obj: CuImage, level: int, level0_bbox: box_utils.Box,
+                             tile_size: int, foreground_threshold: float, occupancy_threshold: float,
+                             strip_height: int = 1) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray, int]]:
+    """Split the foreground of a slide into tiles, reading the ROI in horizontal strips.
+
+    This produces exactly the same tiles as loading the whole ROI with `LoadROId` and calling
+    `generate_tiles()`, in the same order, but peak memory is bounded by the size of a strip rather
+    than of the ROI.
+
+    :param reader: The slide reader with which `slide_obj` was opened.
+    :param slide_obj: The cuCIM image object returned by `reader.read(<image_file>)`.
+    :param level: Magnification level at which to process the slide.
+    :param level0_bbox: Bounding box of the ROI in the level-0 reference frame, as returned by `LoadROId.get_roi()`.
+    :param tile_size: Lateral dimensions of each tile, in pixels.
+    :param foreground_threshold: Luminance threshold (0 to 255) to determine tile occupancy.
+    :param occupancy_threshold: Threshold (between 0 and 1) to determine empty tiles to discard.
+    :param strip_height: Number of rows of tiles to read at once.
+    :return: A generator of tuples containing, for each strip, the selected image tiles (N, C, H, W),
+    tile coordinates relative to the ROI origin (N, 2), occupancies (N,), and number of discarded tiles.
+    """
+    if strip_height < 1:
+        raise ValueError(f"Strip height must be at least one row of tiles, got {strip_height}")
+    scale = slide_obj.resolutions['level_downsamples'][level]
+    scaled_bbox = level0_bbox / scale
+    # Location and size are ordered as in `LoadROId`, i.e. the ROI array has shape (C, bbox.w, bbox.h)
+    height, width = scaled_bbox.w, scaled_bbox.h
+    # Same symmetric padding that `tiling.tile_array_2d()` would apply to the full ROI
+    padding_h = tiling.get_1d_padding(height, tile_size)
+    padding_w = tiling.get_1d_padding(width, tile_size)
+    n_tiles_h = (height + sum(padding_h)) // tile_size
+
+    for first_row in range(0, n_tiles_h, strip_height):
+        n_rows = min(strip_height, n_tiles_h - first_row)
+        strip_start = first_row * tile_size - padding_h[0]
+        strip_end = strip_start + n_rows * tile_size
+        read_start = max(strip_start, 0)
+        read_end = min(strip_end, height)
+
+        location = (level0_bbox.x + int(read_start * scale), level0_bbox.y)
+        strip, _ = reader.get_data(slide_obj, location=location, size=(read_end - read_start, width), level=level)
+        strip_padding = [(0, 0), (read_start - strip_start, strip_end - read_end), padding_w]
+        padded_strip = np.pad(strip, strip_padding, constant_values=255)
+
+        # The padded strip is already divisible by `tile_size`, so no further padding is applied
+        image_tiles, tile_locations = tiling.tile_array_2d(padded_strip, tile_size=tile_size)
+        tile_locations += np.array([-padding_w[0], strip_start])
+
+        foreground_mask, _ = segment_foreground(image_tiles, foreground_threshold)
+        selected, occupancies = select_tiles(foreground_mask, occupancy_threshold)
+        selected = np.atleast_1d(selected)
+        occupancies = np.atleast_1d(occupancies)
+        n_discarded = int((~selected).sum())
+
+        yield image_tiles[selected], tile_locations[selected], occupancies[selected], n_discarded
+
+
+def get_coarse_occupancies(coarse_mask: np.ndarray, coarse_scale: float, level0_bbox: box_utils.Box, scale: float,
+                           tile_size: int, margin: int = 1) -> np.ndarray:
+    """Estimate the occupancy of every candidate tile of a slide ROI from a low-resolution foreground mask.
+
+    Candidate tiles follow the same grid (including symmetric padding) as `generate_tiles()` on the ROI
+    loaded by `LoadROId`. Each tile's footprint is mapped onto the mask, rounding outwards and enlarged by
+    `margin`, and parts of the footprint outside the ROI are counted as background.
+
+    :param coarse_mask: Boolean foreground mask of the whole slide in (H, W) format, as returned by
+    `LoadROId.get_foreground_mask()`.
+    :param coarse_scale: Downsampling factor of `coarse_mask` relative to level 0.
+    :param level0_bbox: Bounding box of the ROI in the level-0 reference frame, as returned by `LoadROId.get_roi()`.
+    :param scale: Downsampling factor of the target level relative to level 0.
+    :param tile_size: Lateral dimensions of each tile, in pixels at the target level.
+    :param margin: Number of mask pixels by which to enlarge each footprint, so that foreground blurred out
+    at low resolution near tissue boundaries is not missed.
+    :return: Estimated occupancies (between 0 and 1) in (n_tiles_h, n_tiles_w) format.
+    """
+    scaled_bbox = level0_bbox / scale
+    height, width = scaled_bbox.w, scaled_bbox.h  # ROI array shape, following the `LoadROId` convention
+    padding_h = tiling.get_1d_padding(height, tile_size)
+    padding_w = tiling.get_1d_padding(width, tile_size)
+    n_tiles_h = (height + sum(padding_h)) // tile_size
+    n_tiles_w = (width + sum(padding_w)) // tile_size
+    ratio = scale / coarse_scale  # size of a target-level pixel in mask pixels
+
+    def get_coarse_bounds(n_tiles: int, padding: Tuple[int, int], length: int, origin: int) -> np.ndarray:
+        starts = tile_size * np.arange(n_tiles) - padding[0]
+        bounds = np.clip(np.stack([starts, starts + tile_size]), 0, length)  # clip to the ROI
+        coarse_bounds = np.stack([np.floor((origin / scale + bounds[0]) * ratio) - margin,
+                                  np.ceil((origin / scale + bounds[1]) * ratio) + margin])
+        return coarse_bounds.astype(int)
+
+    # The mask is indexed with the same (row, column) ordering as the ROI box
+    rows = np.clip(get_coarse_bounds(n_tiles_h, padding_h, height, level0_bbox.x), 0, coarse_mask.shape[0])
+    cols = np.clip(get_coarse_bounds(n_tiles_w, padding_w, width, level0_bbox.y), 0, coarse_mask.shape[1])
+
+    # Summed-area table, so that the mask sum over every tile footprint is computed in constant time
+    integral = np.zeros((coarse_mask.shape[0] + 1, coarse_mask.shape[1] + 1), dtype=np.int64)
+    integral[1:, 1:] = coarse_mask.cumsum(0).cumsum(1)
+    row_start, row_end = rows[0][:, None], rows[1][:, None]
+    col_start, col_end = cols[0][None, :], cols[1][None, :]
+    foreground_sum = (integral[row_end, col_end] - integral[row_start, col_end]
+                      - integral[row_end, col_start] + integral[row_start, col_start])  # noqa: W503
+    footprint_area = (tile_size * ratio) ** 2
+    return np.minimum(foreground_sum / footprint_area, 1.)
+
+
+def _get_runs(selected: np.ndarray) -> Iterator[Tuple[int, int]]:
+    """Find the (start, end) index ranges of consecutive `True` elements in a boolean 1D array."""
+    padded = np.concatenate([[False], selected, [False]]).astype(int)
+    edges = np.diff(padded)
+    return zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))
+
+
+def generate_tiles_preselected(reader: WSIReaderType, slide_obj: CuImage, level: int, level0_bbox: box_utils.Box,
+                               tile_size: int, foreground_threshold: float, occupancy_threshold: float,
+                               coarse_mask: np.ndarray, coarse_scale: float, coarse_occupancy_threshold: float = 0.) \
+        -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray, int]]:
+    """Split the foreground of a slide into tiles, reading only candidate tiles that contain foreground.
+
+    Tile occupancies are first estimated on a low-resolution foreground mask (see `get_coarse_occupancies()`).
+    Only tiles whose estimated occupancy exceeds `coarse_occupancy_threshold` are read at the target level,
+    one run of consecutive tiles at a time, and then selected exactly as in `generate_tiles()`.
+    The selected tiles are therefore identical to those of `generate_tiles()`, except for tiles whose
+    foreground is entirely missed by the low-resolution mask.
+
+    :param reader: The slide reader with which `slide_obj` was opened.
+    :param slide_obj: The cuCIM image object returned by `reader.read(<image_file>)`.
+    :param level: Magnification level at which to process the slide.
+    :param level0_bbox: Bounding box of the ROI in the level-0 reference frame, as returned by `LoadROId.get_roi()`.
+    :param tile_size: Lateral dimensions of each tile, in pixels.
+    :param foreground_threshold: Luminance threshold (0 to 255) to determine tile occupancy.
+    :param occupancy_threshold: Threshold (between 0 and 1) to determine empty tiles to discard.
+    :param coarse_mask: Boolean foreground mask of the whole slide in (H, W) format, as returned by
+    `LoadROId.get_foreground_mask()`.
+    :param coarse_scale: Downsampling factor of `coarse_mask` relative to level 0.
+    :param coarse_occupancy_threshold: Tiles with lower estimated occupancy (between 0 and 1) are not read.
+    The default (0) only skips tiles with no foreground at all in the low-resolution mask.
+    :return: A generator of tuples containing, for each row of tiles, the selected image tiles (N, C, H, W),
+    tile coordinates relative to the ROI origin (N, 2), occupancies (N,), and number of discarded tiles.
+    """
+    scale = slide_obj.resolutions['level_downsamples'][level]
+    coarse_occupancies = get_coarse_occupancies(coarse_mask, coarse_scale, level0_bbox, scale, tile_size)
+    candidates = coarse_occupancies > coarse_occupancy_threshold
+
+    scaled_bbox = level0_bbox / scale
+    height, width = scaled_bbox.w, scaled_bbox.h  # ROI array shape, following the `LoadROId` convention
+    padding_h = tiling.get_1d_padding(height, tile_size)
+    padding_w = tiling.get_1d_padding(width, tile_size)
+
+    for row, row_candidates in enumerate(candidates):
+        n_discarded = int((~row_candidates).sum())
+        if not row_candidates.any():
+            yield (np.empty((0, 3, tile_size, tile_size), dtype=np.uint8), np.empty((0, 2), dtype=int),
+                   np.empty(0), n_discarded)
+            continue
+        row_start = row * tile_size - padding_h[0]
+        read_rows = (max(row_start, 0), min(row_start + tile_size, height))
+
+        row_tiles, row_locations = [], []
+        for first_col, last_col in _get_runs(row_candidates):
+            run_start = first_col * tile_size - padding_w[0]
+            run_end = last_col * tile_size - padding_w[0]
+            read_cols = (max(run_start, 0), min(run_end, width))
+
+            location = (level0_bbox.x + int(read_rows[0] * scale), level0_bbox.y + int(read_cols[0] * scale))
+            size = (read_rows[1] - read_rows[0], read_cols[1] - read_cols[0])
+            run, _ = reader.get_data(slide_obj, location=location, size=size, level=level)
+            run_padding = [(0, 0), (read_rows[0] - row_start, row_start + tile_size - read_rows[1]),
+                           (read_cols[0] - run_start, run_end - read_cols[1])]
+            padded_run = np.pad(run, run_padding, constant_values=255)
+
+            run_tiles, run_locations = tiling.tile_array_2d(padded_run, tile_size=tile_size)
+            row_tiles.append(run_tiles)
+            row_locations.append(run_locations + np.array([run_start, row_start]))
+
+        image_tiles = np.concatenate(row_tiles)
+        tile_locations = np.concatenate(row_locations)
+        foreground_mask, _ = segment_foreground(image_tiles, foreground_threshold)
+        selected, occupancies = select_tiles(foreground_mask, occupancy_threshold)
+        selected = np.atleast_1d(selected)
+        occupancies = np.atleast_1d(occupancies)
+        n_discarded += int((~selected).sum())
+
+        yield image_tiles[selected], tile_locations[selected], occupancies[selected], n_discarded
+
+
 def get_tile_info(sample: Dict[SlideKey, Any], occupancy: float, tile_location: Sequence[int],
-                  rel_slide_dir: Path) -> Dict[TileKey, Any]:
+                  rel_slide_dir: Path, tile_index: Optional[int] = None, extension: str = '.png') -> Dict[TileKey, Any]:
     """Map slide information and tiling outputs into tile-specific information dictionary.
 
     :param sample: Slide dictionary.
     :param occupancy: Estimated tile foreground occuppancy.
     :param tile_location: Tile XY coordinates.
     :param rel_slide_dir: Directory where tiles are saved, relative to dataset root.
+    :param tile_index: Index of the tile in the slide's packed tiles file, if tiles are packed
+    (see `PackedTilesWriter`). By default (`None`), each tile is assumed to be saved as an image file.
+    :param extension: File extension of the tile image file, if tiles are not packed.
     :return: Tile information dictionary.
     """
     slide_id = sample[SlideKey.SLIDE_ID]
-    descriptor = get_tile_descriptor(tile_location)
-    rel_image_path = f"{rel_slide_dir}/{descriptor}.png"
+    if tile_index is None:
+        descriptor = get_tile_descriptor(tile_location)
+        rel_image_path = f"{rel_slide_dir}/{descriptor}{extension}"
+    else:
+        rel_image_path = f"{rel_slide_dir}/{PACKED_TILES_FILENAME}"
 
     tile_info = {
         TileKey.SLIDE_ID: slide_id,
@@ -112,6 +460,8 @@ def get_tile_info(sample: Dict[SlideKey, Any], occupancy: float, tile_location:
         TileKey.SLIDE_METADATA: {TileKey.from_slide_metadata_key(key): value
                                  for key, value in sample[SlideKey.METADATA].items()}
     }
+    if tile_index is not None:
+        tile_info[TileKey.TILE_INDEX] = tile_index
 
     return tile_info
 
@@ -134,7 +484,11 @@ def format_csv_row(tile_info: Dict[TileKey, Any], keys_to_save: Iterable[TileKey
 
 def process_slide(sample: Dict[SlideKey, Any], level: int, margin: int, tile_size: int,
                   foreground_threshold: Optional[float], occupancy_threshold: float, output_dir: Path,
-                  tile_progress: bool = False) -> None:
+                  tile_progress: bool = False, streaming: bool = False, strip_height: int = 1,
+                  packed: bool = False, coarse_preselection: bool = False,
+                  tile_codec: TileCodec = TileCodec.PNG, tile_quality: Optional[int] = None,
+                  num_writer_threads: int = 4, reader: Optional[WSIReaderType] = None,
+                  metadata_cache: Optional[SlideMetadataCache] = None) -> Optional[Dict[str, Any]]:
     """Load and process a slide, saving tile images and information to a CSV file.
 
     :param sample: Slide information dictionary, returned by the input slide dataset.
@@ -147,10 +501,28 @@ def process_slide(sample: Dict[SlideKey, Any], level: int, margin: int, tile_siz
     :param output_dir: Root directory for the output dataset; outputs for a single slide will be
     saved inside `output_dir/slide_id/`.
     :param tile_progress: Whether to display a progress bar in the terminal.
+    :param streaming: Whether to read and tile the slide in horizontal strips (see `generate_tiles_streaming()`),
+    instead of loading the entire ROI into memory at once.
+    :param strip_height: Number of rows of tiles to read at once, if `streaming=True`.
+    :param packed: Whether to save all tiles of the slide into a single packed file (see `PackedTilesWriter`)
+    instead of one PNG file per tile.
+    :param coarse_preselection: Whether to read at the target level only the tiles that contain foreground in
+    the lowest-resolution mask (see `generate_tiles_preselected()`). Takes precedence over `streaming`.
+    :param tile_codec: The image codec with which to save the tiles, if not `packed`.
+    :param tile_quality: Codec-specific compression setting (see `get_tile_save_kwargs()`).
+    :param num_writer_threads: Number of background threads encoding and saving tiles, overlapped with
+    reading and tiling the slide (see `AsyncTileWriter`). If 0, tiles are saved synchronously.
+    :param reader: The reader with which to read the slide. If `None` (default), a new cuCIM reader is created.
+    :param metadata_cache: Optional cache of the foreground threshold, ROI, and lowest-resolution image of each
+    slide (see `LoadROId`), so that they are only estimated the first time a slide is processed.
+    :return: A dictionary summarising the processed slide, to be recorded in the `SlideManifest`, or `None` if
+    the slide was skipped or an error occurred.
     """
     slide_metadata: Dict[str, Any] = sample[SlideKey.METADATA]
-    keys_to_save = (TileKey.SLIDE_ID, TileKey.TILE_ID, TileKey.IMAGE, TileKey.LABEL,
-                    TileKey.TILE_X, TileKey.TILE_Y, TileKey.OCCUPANCY)
+    keys_to_save: Tuple[TileKey, ...] = (TileKey.SLIDE_ID, TileKey.TILE_ID, TileKey.IMAGE, TileKey.LABEL,
+                                         TileKey.TILE_X, TileKey.TILE_Y, TileKey.OCCUPANCY)
+    if packed:
+        keys_to_save += (TileKey.TILE_INDEX,)
     metadata_keys = tuple(TileKey.from_slide_metadata_key(key) for key in slide_metadata)
     csv_columns: Tuple[str, ...] = (*keys_to_save, *metadata_keys)
 
@@ -160,73 +532,190 @@ def process_slide(sample: Dict[SlideKey, Any], level: int, margin: int, tile_siz
     logging.info(f">>> Slide dir {slide_dir}")
     if slide_dir.exists():  # already processed slide - skip
         logging.info(f">>> Skipping {slide_dir} - already processed")
-        return
+        return None
     else:
         try:
             slide_dir.mkdir(parents=True)
 
-            dataset_csv_path = slide_dir / "dataset.csv"
-            dataset_csv_file = dataset_csv_path.open('w')
-            dataset_csv_file.write(','.join(csv_columns) + '\n')  # write CSV header
-
-            n_failed_tiles = 0
-            failed_tiles_csv_path = slide_dir / "failed_tiles.csv"
-            failed_tiles_file = failed_tiles_csv_path.open('w')
-            failed_tiles_file.write('tile_id' + '\n')
-
             logging.info(f"Loading slide {slide_id} ...")
-            loader = LoadROId(WSIReader('cuCIM'), level=level, margin=margin,
-                              foreground_threshold=foreground_threshold)
-            sample = loader(sample)  # load 'image' from disk
-
-            logging.info(f"Tiling slide {slide_id} ...")
-            image_tiles, rel_tile_locations, occupancies, _ = \
-                generate_tiles(sample[SlideKey.IMAGE], tile_size,
-                               sample[SlideKey.FOREGROUND_THRESHOLD],
-                               occupancy_threshold)
-
-            tile_locations = (sample[SlideKey.SCALE] * rel_tile_locations
-                              + sample[SlideKey.ORIGIN]).astype(int)  # noqa: W503
-
-            n_tiles = image_tiles.shape[0]
-
-            logging.info(f"Saving tiles for slide {slide_id} ...")
-            for i in tqdm(range(n_tiles), f"Tiles ({slide_id[:6]}…)", unit="img", disable=not tile_progress):
-                try:
-                    tile_info = get_tile_info(sample, occupancies[i], tile_locations[i], rel_slide_dir)
-                    save_image(image_tiles[i], output_dir / tile_info[TileKey.IMAGE])
-                    dataset_row = format_csv_row(tile_info, keys_to_save, metadata_keys)
-                    dataset_csv_file.write(dataset_row + '\n')
-                except Exception as e:
-                    n_failed_tiles += 1
-                    descriptor = get_tile_descriptor(tile_locations[i])
-                    failed_tiles_file.write(descriptor + '\n')
-                    traceback.print_exc()
-                    warnings.warn(f"An error occurred while saving tile "
-                                  f"{get_tile_id(slide_id, tile_locations[i])}: {e}")
-
-            dataset_csv_file.close()
-            failed_tiles_file.close()
+            loader = LoadROId(reader or get_slide_reader(WSIBackend.CUCIM), level=level, margin=margin,
+                              foreground_threshold=foreground_threshold, metadata_cache=metadata_cache)
+            image_obj: Optional[CuImage] = None
+            try:
+                tiles_generator: Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray, int]]
+                if streaming or coarse_preselection:
+                    image_obj = loader.reader.read(sample[SlideKey.IMAGE])
+                    metadata = loader.get_metadata(image_obj, sample[SlideKey.IMAGE])
+                    assert metadata.bbox is not None
+                    coarse_mask, threshold, coarse_scale = loader.get_foreground_mask_from_metadata(metadata)
+                    level0_bbox = metadata.bbox
+                    sample[SlideKey.ORIGIN] = (level0_bbox.x, level0_bbox.y)
+                    sample[SlideKey.SCALE] = metadata.level_downsamples[level]
+                    sample[SlideKey.FOREGROUND_THRESHOLD] = threshold
+
+                    if coarse_preselection:
+                        logging.info(f"Tiling foreground candidates of slide {slide_id} ...")
+                        tiles_generator = generate_tiles_preselected(loader.reader, image_obj, level, level0_bbox,
+                                                                     tile_size, threshold, occupancy_threshold,
+                                                                     coarse_mask=coarse_mask,
+                                                                     coarse_scale=coarse_scale)
+                    else:
+                        logging.info(f"Tiling slide {slide_id} in strips of {strip_height} tile(s) ...")
+                        tiles_generator = generate_tiles_streaming(loader.reader, image_obj, level, level0_bbox,
+                                                                   tile_size, threshold, occupancy_threshold,
+                                                                   strip_height=strip_height)
+                else:
+                    sample = loader(sample)  # load 'image' from disk
+
+                    logging.info(f"Tiling slide {slide_id} ...")
+                    tiles_generator = [generate_tiles(sample[SlideKey.IMAGE], tile_size,
+                                                      sample[SlideKey.FOREGROUND_THRESHOLD],
+                                                      occupancy_threshold)]
+
+                logging.info(f"Saving tiles for slide {slide_id} ...")
+                n_failed_tiles = 0
+                with (slide_dir / "dataset.csv").open('w') as dataset_csv_file, \
+                        (slide_dir / "failed_tiles.csv").open('w') as failed_tiles_file:
+                    dataset_csv_file.write(','.join(csv_columns) + '\n')  # write CSV header
+                    failed_tiles_file.write('tile_id' + '\n')
+
+                    def on_tile_saved(tile_info: Dict[TileKey, Any], tile_location: Sequence[int],
+                                      error: Optional[BaseException]) -> None:
+                        nonlocal n_failed_tiles
+                        if error is None:
+                            dataset_row = format_csv_row(tile_info, keys_to_save, metadata_keys)
+                            dataset_csv_file.write(dataset_row + '\n')
+                        else:
+                            n_failed_tiles += 1
+                            descriptor = get_tile_descriptor(tile_location)
+                            failed_tiles_file.write(descriptor + '\n')
+                            traceback.print_exception(type(error), error, error.__traceback__)
+                            warnings.warn(f"An error occurred while saving tile "
+                                          f"{get_tile_id(slide_id, tile_location)}: {error}")
+                        tiles_progress.update(1)
+
+                    start_time = time.time()
+                    n_tiles_total = 0
+                    packed_writer = PackedTilesWriter(slide_dir / PACKED_TILES_FILENAME,
+                                                      tile_shape=(3, tile_size, tile_size)) if packed else None
+                    try:
+                        with AsyncTileWriter(tile_codec, quality=tile_quality, num_threads=num_writer_threads) \
+                                as tile_writer, \
+                                tqdm(desc=f"Tiles ({slide_id[:6]}…)", unit="img",
+                                     disable=not tile_progress) as tiles_progress:
+                            for image_tiles, rel_tile_locations, occupancies, _ in tiles_generator:
+                                tile_locations = (sample[SlideKey.SCALE] * rel_tile_locations
+                                                  + sample[SlideKey.ORIGIN]).astype(int)  # noqa: W503
+
+                                n_tiles = image_tiles.shape[0]
+                                n_tiles_total += n_tiles
+                                tile_indices = packed_writer.write(image_tiles) if packed_writer else None
+                                for i in range(n_tiles):
+                                    try:
+                                        tile_index = int(tile_indices[i]) if tile_indices is not None else None
+                                        tile_info = get_tile_info(sample, occupancies[i], tile_locations[i],
+                                                                  rel_slide_dir, tile_index=tile_index,
+                                                                  extension=tile_writer.extension)
+                                        on_done = functools.partial(on_tile_saved, tile_info, tile_locations[i])
+                                        if tile_index is None:
+                                            tile_writer.submit(image_tiles[i], output_dir / tile_info[TileKey.IMAGE],
+                                                               on_done)
+                                        else:
+                                            on_done(None)
+                                    except Exception as e:
+                                        on_tile_saved({}, tile_locations[i], e)
+                    finally:
+                        if packed_writer:
+                            packed_writer.close()
+            finally:
+                if image_obj is not None:
+                    image_obj.close()
+            elapsed_time = time.time() - start_time
+            logging.info(f"Saved {n_tiles_total} tiles for slide {slide_id} in {elapsed_time:.1f}s "
+                         f"({n_tiles_total / max(elapsed_time, 1e-6):.1f} tiles/s)")
+
             if n_failed_tiles > 0:
                 # TODO what we want to do with slides that have some failed tiles?
                 logging.warning(f"{slide_id} is incomplete. {n_failed_tiles} tiles failed.")
             logging.info(f"Finished processing slide {slide_id}")
+            return {SlideKey.SLIDE_ID.value: slide_id,
+                    'dataset_csv': str(rel_slide_dir / "dataset.csv"),
+                    'n_tiles': n_tiles_total - n_failed_tiles,
+                    'n_failed_tiles': n_failed_tiles}
         except Exception as e:
             traceback.print_exc()
             warnings.warn(f"An error occurred while processing slide {slide_id}: {e}")
+            return None
+
+
+# One reader per worker process, reused across all the slides processed by that worker
+_worker_reader: Optional[WSIReaderType] = None
+
+
+def _init_worker_reader(wsi_backend: WSIBackend = WSIBackend.CUCIM) -> None:
+    global _worker_reader
+    _worker_reader = get_slide_reader(wsi_backend)
+
+
+def _process_slide_with_worker_reader(sample: Dict[SlideKey, Any], **kwargs: Any) -> Optional[Dict[str, Any]]:
+    return process_slide(sample, reader=_worker_reader, **kwargs)
+
+
+def get_pending_slides(samples: Sequence[Dict[SlideKey, Any]], output_dir: Path,
+                       manifest: SlideManifest) -> List[Dict[SlideKey, Any]]:
+    """Select the slides that still need to be processed, cleaning up any partially processed slides.
+
+    A slide is only considered complete if it is recorded in the manifest. Slide directories not recorded
+    in the manifest were left behind by an interrupted run and are deleted. For backward compatibility, if
+    no manifest exists yet but a merged "dataset.csv" does, i.e. the dataset was completed by a version
+    without manifests, any existing slide directories are assumed complete and added to the manifest.
+
+    :param samples: Slide information dictionaries.
+    :param output_dir: Root directory of the output tiles dataset.
+    :param manifest: The slide-completion manifest of the output dataset.
+    :return: The list of slides still to be processed, in the original order.
+    """
+    if not manifest.exists() and (output_dir / "dataset.csv").exists():
+        legacy_slide_ids = [sample[SlideKey.SLIDE_ID] for sample in samples
+                            if (output_dir / sample[SlideKey.SLIDE_ID]).exists()]
+        if legacy_slide_ids:
+            logging.warning(f"No manifest found in legacy dataset {output_dir}, assuming the "
+                            f"{len(legacy_slide_ids)} existing slide directories are complete")
+        for slide_id in legacy_slide_ids:
+            manifest.mark_complete({SlideKey.SLIDE_ID.value: slide_id,
+                                    'dataset_csv': str(Path(slide_id) / "dataset.csv")})
+
+    pending_samples = []
+    for sample in samples:
+        slide_id = sample[SlideKey.SLIDE_ID]
+        if manifest.is_complete(slide_id):
+            continue
+        slide_dir = output_dir / slide_id
+        if slide_dir.exists():
+            logging.warning(f"Deleting incomplete outputs of slide {slide_id} from an interrupted run")
+            shutil.rmtree(slide_dir)
+        pending_samples.append(sample)
+    return pending_samples
 
 
 def merge_dataset_csv_files(dataset_dir: Path) -> Path:
-    """Combines all "*/dataset.csv" files into a single "dataset.csv" file in the given directory."""
+    """Combines all per-slide "dataset.csv" files into a single "dataset.csv" file in the given directory.
+
+    The slide files are listed from the dataset's manifest of completed slides, which avoids a slow directory
+    glob on mounted storage and excludes partial outputs of interrupted slides. Datasets without a manifest
+    fall back to globbing for "*/dataset.csv".
+    """
     full_csv = dataset_dir / "dataset.csv"
-    # TODO change how we retrieve these filenames, probably because mounted, the operation is slow
-    #  and it seems to find many more files
-    # print("List of files")
-    # print([str(file) + '\n' for file in dataset_dir.glob("*/dataset.csv")])
+    manifest = SlideManifest(dataset_dir)
+    slide_csvs: Iterable[Path]
+    if manifest.exists():
+        slide_csvs = [dataset_dir / record.get('dataset_csv', f"{slide_id}/dataset.csv")
+                      for slide_id, record in manifest.records.items()]
+    else:
+        slide_csvs = dataset_dir.glob("*/dataset.csv")
     with full_csv.open('w') as full_csv_file:
-        # full_csv_file.write(','.join(CSV_COLUMNS) + '\n')  # write CSV header
         first_file = True
-        for slide_csv in tqdm(dataset_dir.glob("*/dataset.csv"), desc="Merging dataset.csv", unit='file'):
+        for slide_csv in tqdm(slide_csvs, desc="Merging dataset.csv", unit='file'):
             logging.info(f"Merging slide {slide_csv}")
             content = slide_csv.read_text()
             if not first_file:
@@ -236,12 +725,39 @@ def merge_dataset_csv_files(dataset_dir: Path) -> Path:
     return full_csv
 
 
+def write_dataset_index(dataset_csv: Path) -> Path:
+    """Converts a merged tiles dataset CSV into a typed columnar index, saved as "dataset.parquet" alongside it.
+
+    Slide IDs are stored as categoricals and tile coordinates and indices as `int32`, which makes the index
+    much smaller and faster to load than the CSV, and allows loading only a subset of columns.
+
+    :param dataset_csv: Path to the merged dataset CSV.
+    :return: Path to the Parquet index.
+    """
+    dataset_df = pd.read_csv(dataset_csv)
+    dataset_df[TileKey.SLIDE_ID] = dataset_df[TileKey.SLIDE_ID].astype('category')
+    for column in [TileKey.TILE_X, TileKey.TILE_Y, TileKey.TILE_INDEX]:
+        if column in dataset_df:
+            dataset_df[column] = dataset_df[column].astype(np.int32)
+    index_path = dataset_csv.with_suffix('.parquet')
+    dataset_df.to_parquet(index_path, index=False)
+    return index_path
+
+
 def main(slides_dataset: SlidesDataset, root_output_dir: Union[str, Path],
          level: int, tile_size: int, margin: int, foreground_threshold: Optional[float],
          occupancy_threshold: float, parallel: bool = False, overwrite: bool = False,
-         n_slides: Optional[int] = None) -> None:
+         n_slides: Optional[int] = None, streaming: bool = False, strip_height: int = 1,
+         packed: bool = False, coarse_preselection: bool = False,
+         tile_codec: TileCodec = TileCodec.PNG, tile_quality: Optional[int] = None,
+         num_writer_threads: int = 4, num_workers: Optional[int] = None,
+         memory_budget_gb: Optional[float] = None, wsi_backend: WSIBackend = WSIBackend.CUCIM,
+         metadata_cache_dir: Optional[Union[str, Path]] = None) -> None:
     """Process a slides dataset to produce a tiles dataset.
 
+    Slides are processed largest-first, and each completed slide is recorded in a `SlideManifest` in
+    `root_output_dir`, so that an interrupted run resumes exactly where it stopped.
+
     :param slides_dataset: Input tiles dataset object.
     :param root_output_dir: The root directory of the output tiles dataset.
     :param level: Magnification level at which to process the slide.
@@ -254,6 +770,24 @@ def main(slides_dataset: SlidesDataset, root_output_dir: Union[str, Path],
     :param overwrite: Whether to overwrite an existing output tiles dataset. If `True`, will delete
     and recreate `root_output_dir`, otherwise will resume by skipping already processed slides.
     :param n_slides: If given, limit the total number of slides for debugging.
+    :param streaming: Whether to read and tile each slide in horizontal strips, bounding peak memory
+    by the strip size instead of the ROI size.
+    :param strip_height: Number of rows of tiles to read at once, if `streaming=True`.
+    :param packed: Whether to save all tiles of each slide into a single packed `.npy` file with a
+    `TileKey.TILE_INDEX` column in the dataset CSV, instead of one PNG file per tile.
+    :param coarse_preselection: Whether to skip reading tiles that contain no foreground in the
+    lowest-resolution mask, instead of reading and segmenting the entire ROI at the target level.
+    :param tile_codec: The image codec with which to save the tiles: PNG (default), lossless WebP, or JPEG.
+    :param tile_quality: Codec-specific compression setting (see `get_tile_save_kwargs()`).
+    :param num_writer_threads: Number of background threads encoding and saving tiles for each slide.
+    :param num_workers: Maximum number of worker processes if `parallel=True`. Defaults to the number of CPUs.
+    :param memory_budget_gb: Total memory available to all worker processes, in GB. If given, the number of
+    workers is capped so that the largest slides can be processed simultaneously within this budget.
+    :param wsi_backend: The library with which to read the slides. The fastest one for a given slide format and
+    tiling mode can be found with `testhisto/benchmarks/benchmark_wsi_readers.py`.
+    :param metadata_cache_dir: If given, directory of a `SlideMetadataCache` in which to persist the foreground
+    threshold, ROI, and lowest-resolution image of each slide, so that later runs (e.g. tiling at another level or
+    tile size) do not estimate them again.
     """
 
     # Ignoring some types here because mypy is getting confused with the MONAI Dataset class
@@ -268,26 +802,51 @@ def main(slides_dataset: SlidesDataset, root_output_dir: Union[str, Path],
         shutil.rmtree(output_dir)
     output_dir.mkdir(parents=True, exist_ok=not overwrite)
 
-    func = functools.partial(process_slide, level=level, margin=margin, tile_size=tile_size,
+    manifest = SlideManifest(output_dir)
+    samples = get_pending_slides(list(dataset), output_dir, manifest)
+    # From now on, slide directories are only complete if recorded, even if the run crashes before the first one
+    manifest.create()
+    logging.info(f"{len(samples)} slides to process, {len(manifest.slide_ids)} already complete")
+
+    slide_dimensions = [get_slide_dimensions(sample[SlideKey.IMAGE], level, wsi_backend) for sample in samples]
+    samples = order_largest_first(samples, sizes=[width * height for width, height in slide_dimensions])
+
+    func = functools.partial(_process_slide_with_worker_reader, level=level, margin=margin, tile_size=tile_size,
                              foreground_threshold=foreground_threshold,
                              occupancy_threshold=occupancy_threshold, output_dir=output_dir,
-                             tile_progress=not parallel)
+                             tile_progress=not parallel, streaming=streaming, strip_height=strip_height,
+                             packed=packed, coarse_preselection=coarse_preselection, tile_codec=tile_codec,
+                             tile_quality=tile_quality, num_writer_threads=num_writer_threads,
+                             metadata_cache=SlideMetadataCache(metadata_cache_dir) if metadata_cache_dir else None)
 
     if parallel:
         import multiprocessing
 
-        pool = multiprocessing.Pool()
-        map_func = pool.imap_unordered  # type: ignore
+        # Coarse pre-selection reads one row of tiles at a time
+        rows_per_read = 1 if coarse_preselection else strip_height if streaming else None
+        memory_estimates = [estimate_slide_memory(dimensions, tile_size, strip_height=rows_per_read)
+                            for dimensions in slide_dimensions]
+        memory_budget = memory_budget_gb * 2**30 if memory_budget_gb is not None else None
+        n_processes = get_num_workers(memory_estimates, memory_budget, max_workers=num_workers)
+        logging.info(f"Processing slides with {n_processes} worker processes")
+
+        pool = multiprocessing.Pool(n_processes, initializer=_init_worker_reader, initargs=(wsi_backend,))
+        map_func = functools.partial(pool.imap_unordered, chunksize=1)  # type: ignore
     else:
+        _init_worker_reader(wsi_backend)
         map_func = map  # type: ignore
 
-    list(tqdm(map_func(func, dataset), desc="Slides", unit="img", total=len(dataset)))  # type: ignore
+    for record in tqdm(map_func(func, samples), desc="Slides", unit="img", total=len(samples)):  # type: ignore
+        if record is not None:
+            manifest.mark_complete(record)
 
     if parallel:
         pool.close()
 
     logging.info("Merging slide files in a single file")
-    merge_dataset_csv_files(output_dir)
+    dataset_csv = merge_dataset_csv_files(output_dir)
+    logging.info("Writing typed dataset index")
+    write_dataset_index(dataset_csv)
 
 
 if __name__ == '__main__':
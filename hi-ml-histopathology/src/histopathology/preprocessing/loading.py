@@ -9,9 +9,10 @@ import numpy as np
 import skimage.filters
 from cucim import CuImage
 from health_ml.utils import box_utils
-from monai.data.image_reader import WSIReader
 from monai.transforms import MapTransform
 
+from histopathology.preprocessing.slide_cache import SlideMetadata, SlideMetadataCache, get_level_metadata
+from histopathology.preprocessing.wsi_readers import WSIReaderType
 from histopathology.utils.naming import SlideKey
 
 
@@ -25,28 +26,84 @@ def get_luminance(slide: np.ndarray) -> np.ndarray:
     return slide.mean(axis=-3)  # type: ignore
 
 
-def segment_foreground(slide: np.ndarray, threshold: Optional[float] = None) \
+def get_channel_sum(slide: np.ndarray) -> np.ndarray:
+    """Compute the exact sum over channels of an integer image, without converting it to floating point.
+
+    The luminance returned by `get_luminance()` is this sum divided by the number of channels.
+
+    :param slide: The RGB image array in (*, C, H, W) format, of type `uint8` or `uint16`.
+    :return: The channel sum array as (*, H, W), of type `uint16` for `uint8` inputs (resp. `uint32` for `uint16`).
+    """
+    sum_dtype = np.uint16 if slide.dtype == np.uint8 else np.uint32
+    return slide.sum(axis=-3, dtype=sum_dtype)
+
+
+def threshold_otsu_from_histogram(counts: np.ndarray, values: np.ndarray, nbins: int = 256) -> float:
+    """Compute Otsu's threshold from the number of pixels taking each of a sorted set of values.
+
+    This gives the same result as `skimage.filters.threshold_otsu(image, nbins)` on the full image, whose
+    histogram is rebinned from `counts` instead of from every pixel.
+
+    :param counts: Number of pixels taking each value, of shape (K,).
+    :param values: Sorted pixel values corresponding to `counts`, of shape (K,).
+    :param nbins: Number of histogram bins.
+    :return: The estimated threshold.
+    """
+    present = counts > 0
+    values, counts = values[present], counts[present]
+    if len(values) == 1:
+        return values[0]
+    hist, bin_edges = np.histogram(values, bins=nbins, range=(values[0], values[-1]), weights=counts)
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+
+    # Same computation as `skimage.filters.threshold_otsu()`
+    weight1 = np.cumsum(hist)
+    weight2 = np.cumsum(hist[::-1])[::-1]
+    mean1 = np.cumsum(hist * bin_centers) / weight1
+    mean2 = (np.cumsum((hist * bin_centers)[::-1]) / weight2[::-1])[::-1]
+    variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    return bin_centers[np.argmax(variance12)]
+
+
+def segment_foreground(slide: np.ndarray, threshold: Optional[float] = None, otsu_subsample: int = 1) \
         -> Tuple[np.ndarray, float]:
     """Segment the given slide by thresholding its luminance.
 
+    For `uint8` and `uint16` images, the luminance is never computed in floating point: the channel sum is
+    thresholded via a lookup table over all its possible values, and Otsu's threshold is computed from its
+    histogram. The results are identical to thresholding the output of `get_luminance()`.
+
     :param slide: The RGB image array in (*, C, H, W) format.
     :param threshold: Pixels with luminance below this value will be considered foreground.
     If `None` (default), an optimal threshold will be estimated automatically using Otsu's method.
+    :param otsu_subsample: Stride with which pixels are subsampled along each spatial axis to estimate Otsu's
+    threshold. By default (1), all pixels are used.
     :return: A tuple containing the boolean output array in (*, H, W) format and the threshold used.
     """
+    if slide.dtype in (np.uint8, np.uint16):
+        channel_sum = get_channel_sum(slide)
+        n_channels = slide.shape[-3]
+        # Luminance for every possible channel sum, computed as in `get_luminance()`
+        luminance_values = np.arange(np.iinfo(slide.dtype).max * n_channels + 1) / n_channels
+        if threshold is None:
+            sampled_sum = channel_sum[..., ::otsu_subsample, ::otsu_subsample]
+            counts = np.bincount(sampled_sum.ravel(), minlength=len(luminance_values))
+            threshold = threshold_otsu_from_histogram(counts, luminance_values)
+        return (luminance_values < threshold)[channel_sum], threshold
+
     luminance = get_luminance(slide)
     if threshold is None:
-        threshold = skimage.filters.threshold_otsu(luminance)
+        threshold = skimage.filters.threshold_otsu(luminance[..., ::otsu_subsample, ::otsu_subsample])
     return luminance < threshold, threshold
 
 
-def load_slide_at_level(reader: WSIReader, slide_obj: CuImage, level: int) -> np.ndarray:
+def load_slide_at_level(reader: WSIReaderType, slide_obj: CuImage, level: int) -> np.ndarray:
     """Load full slide array at the given magnification level.
 
     This is a manual workaround for a MONAI bug (https://github.com/Project-MONAI/MONAI/issues/3415)
     fixed in a currently unreleased PR (https://github.com/Project-MONAI/MONAI/pull/3417).
 
-    :param reader: A MONAI `WSIReader` using cuCIM backend.
+    :param reader: A `SlideReader` or a MONAI `WSIReader` using cuCIM backend.
     :param slide_obj: The cuCIM image object returned by `reader.read(<image_file>)`.
     :param level: Index of the desired magnification level as defined in the `slide_obj` headers.
     :return: The loaded image array in (C, H, W) format.
@@ -64,16 +121,22 @@ class LoadROId(MapTransform):
     - `SlideKey.ORIGIN` (tuple): top-right coordinates of the bounding box
     - `SlideKey.SCALE` (float): corresponding scale, loaded from the file
     - `SlideKey.FOREGROUND_THRESHOLD` (float): threshold used to segment the foreground
+
+    If a `SlideMetadataCache` is given, the bounding box and foreground threshold of each slide are only estimated
+    the first time it is loaded, so the lowest-resolution image is not read again in later epochs or runs.
     """
-    def __init__(self, reader: WSIReader, image_key: str = SlideKey.IMAGE, level: int = 0,
-                 margin: int = 0, foreground_threshold: Optional[float] = None) -> None:
+    def __init__(self, reader: WSIReaderType, image_key: str = SlideKey.IMAGE, level: int = 0,
+                 margin: int = 0, foreground_threshold: Optional[float] = None,
+                 metadata_cache: Optional[SlideMetadataCache] = None) -> None:
         """
-        :param reader: And instance of MONAI's `WSIReader`.
+        :param reader: A `SlideReader` (see `get_slide_reader()`), or an instance of MONAI's `WSIReader`.
         :param image_key: Image key in the input and output dictionaries.
         :param level: Magnification level to load from the raw multi-scale file.
         :param margin: Amount in pixels by which to enlarge the estimated bounding box for cropping.
         :param foreground_threshold: Pixels with luminance below this value will be considered foreground.
         If `None` (default), an optimal threshold will be estimated automatically using Otsu's method.
+        :param metadata_cache: Optional cache in which to persist the estimated bounding box and foreground
+        threshold of each slide, along with its lowest-resolution image as thumbnail.
         """
         super().__init__([image_key], allow_missing_keys=False)
         self.reader = reader
@@ -81,26 +144,102 @@ class LoadROId(MapTransform):
         self.level = level
         self.margin = margin
         self.foreground_threshold = foreground_threshold
+        self.metadata_cache = metadata_cache
 
-    def _get_bounding_box(self, slide_obj: CuImage) -> Tuple[box_utils.Box, float]:
-        # Estimate bounding box at the lowest resolution (i.e. highest level)
+    def get_foreground_mask(self, slide_obj: CuImage) -> Tuple[np.ndarray, float, float]:
+        """Segment the foreground of a slide at the lowest resolution (i.e. highest level).
+
+        :param slide_obj: The cuCIM image object returned by `reader.read(<image_file>)`.
+        :return: A tuple containing the boolean foreground mask in (H, W) format, the threshold used to
+        segment it, and the downsampling factor of the mask relative to level 0.
+        """
+        slide, scale = self._load_lowest_resolution(slide_obj)
+        foreground_mask, threshold = segment_foreground(slide, self.foreground_threshold)
+        return foreground_mask, threshold, scale
+
+    def _load_lowest_resolution(self, slide_obj: CuImage) -> Tuple[np.ndarray, float]:
         highest_level = slide_obj.resolutions['level_count'] - 1
         scale = slide_obj.resolutions['level_downsamples'][highest_level]
         slide = load_slide_at_level(self.reader, slide_obj, level=highest_level)
+        return slide, scale
 
-        foreground_mask, threshold = segment_foreground(slide, self.foreground_threshold)
-        bbox = scale * box_utils.get_bounding_box(foreground_mask).add_margin(self.margin)
+    def get_foreground_mask_from_metadata(self, metadata: SlideMetadata) -> Tuple[np.ndarray, float, float]:
+        """Segment the foreground of a slide from the lowest-resolution image stored in its metadata, without
+        reading the slide.
+
+        :param metadata: The slide metadata, as returned by `get_metadata()`.
+        :return: A tuple containing the boolean foreground mask in (H, W) format, the threshold used to
+        segment it, and the downsampling factor of the mask relative to level 0, as from `get_foreground_mask()`.
+        """
+        assert metadata.thumbnail is not None and metadata.foreground_threshold is not None
+        foreground_mask, threshold = segment_foreground(metadata.thumbnail, metadata.foreground_threshold)
+        return foreground_mask, threshold, metadata.level_downsamples[-1]
+
+    def get_roi_from_mask(self, foreground_mask: np.ndarray, scale: float) -> box_utils.Box:
+        """Compute the region of interest from a foreground mask returned by `get_foreground_mask()`.
+
+        :param foreground_mask: Boolean foreground mask in (H, W) format.
+        :param scale: Downsampling factor of the mask relative to level 0.
+        :return: The bounding box, including the margin, in the level-0 reference frame.
+        """
+        return scale * box_utils.get_bounding_box(foreground_mask).add_margin(self.margin)
+
+    def _get_bounding_box(self, slide_obj: CuImage) -> Tuple[box_utils.Box, float]:
+        # Estimate bounding box at the lowest resolution (i.e. highest level)
+        foreground_mask, threshold, scale = self.get_foreground_mask(slide_obj)
+        bbox = self.get_roi_from_mask(foreground_mask, scale)
         return bbox, threshold
 
+    def get_roi(self, image_obj: CuImage) -> Tuple[box_utils.Box, float]:
+        """Estimate the region of interest of a slide without loading it at the target level.
+
+        :param image_obj: The cuCIM image object returned by `reader.read(<image_file>)`.
+        :return: A tuple containing the bounding box in the level-0 reference frame and the
+        foreground threshold used to estimate it.
+        """
+        return self._get_bounding_box(image_obj)
+
+    def compute_metadata(self, image_obj: CuImage) -> SlideMetadata:
+        """Estimate the region of interest of a slide, reading its lowest-resolution image only once.
+
+        :param image_obj: The cuCIM image object returned by `reader.read(<image_file>)`.
+        :return: The slide metadata, including the bounding box in the level-0 reference frame, the foreground
+        threshold used to estimate it, and the lowest-resolution image as thumbnail.
+        """
+        metadata = get_level_metadata(image_obj)
+        slide, scale = self._load_lowest_resolution(image_obj)
+        foreground_mask, metadata.foreground_threshold = segment_foreground(slide, self.foreground_threshold)
+        metadata.bbox = self.get_roi_from_mask(foreground_mask, scale)
+        metadata.thumbnail = slide
+        return metadata
+
+    def get_metadata(self, image_obj: CuImage, image_path: str) -> SlideMetadata:
+        """Get the slide metadata from the cache if available, otherwise compute them with `compute_metadata()`.
+
+        :param image_obj: The cuCIM image object returned by `reader.read(<image_file>)`.
+        :param image_path: Path of the slide file, used as part of the cache key.
+        :return: The slide metadata.
+        """
+        if self.metadata_cache is None:
+            return self.compute_metadata(image_obj)
+        return self.metadata_cache.get_or_compute([image_path], lambda: self.compute_metadata(image_obj),
+                                                  margin=self.margin, foreground_threshold=self.foreground_threshold)
+
     def __call__(self, data: Dict) -> Dict:
         image_obj: CuImage = self.reader.read(data[self.image_key])
 
-        level0_bbox, threshold = self._get_bounding_box(image_obj)
+        if self.metadata_cache is None:
+            level0_bbox, threshold = self.get_roi(image_obj)
+            scale = image_obj.resolutions['level_downsamples'][self.level]
+        else:
+            metadata = self.get_metadata(image_obj, data[self.image_key])
+            assert metadata.bbox is not None and metadata.foreground_threshold is not None
+            level0_bbox, threshold = metadata.bbox, metadata.foreground_threshold
+            scale = metadata.level_downsamples[self.level]
 
         # cuCIM/OpenSlide takes absolute location coordinates in the level 0 reference frame,
         # but relative region size in pixels at the chosen level
         origin = (level0_bbox.x, level0_bbox.y)
-        scale = image_obj.resolutions['level_downsamples'][self.level]
         scaled_bbox = level0_bbox / scale
 
         data[self.image_key], _ = self.reader.get_data(image_obj, location=origin, level=self.level,
@@ -0,0 +1,99 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+import io
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+PACKED_TILES_FILENAME = "tiles.npy"
+
+# Fixed size reserved for the `.npy` header, so that it can be rewritten in place once the final number
+# of tiles is known. 128 bytes comfortably fit the header of any 4D `uint8` array.
+_HEADER_SIZE = 128
+
+
+def _get_npy_header(shape: Tuple[int, ...]) -> bytes:
+    header_dict: Dict[str, Any] = {'descr': np.lib.format.dtype_to_descr(np.dtype(np.uint8)),
+                                   'fortran_order': False,
+                                   'shape': shape}
+    buffer = io.BytesIO()
+    np.lib.format.write_array_header_1_0(buffer, header_dict)
+    header = buffer.getvalue()
+    if len(header) != _HEADER_SIZE:
+        raise ValueError(f"Unexpected .npy header size for shape {shape}: {len(header)} bytes")
+    return header
+
+
+class PackedTilesWriter:
+    """Incrementally write all the tiles of a slide into a single contiguous `.npy` file.
+
+    The output is a standard uncompressed `uint8` array of shape (N, C, H, W), which can be opened with
+    `np.load(path, mmap_mode='r')`. Tiles are appended as they are written, so the full stack of tiles
+    never needs to be held in memory.
+
+    Example:
+        >>> with PackedTilesWriter(slide_dir / PACKED_TILES_FILENAME, tile_shape=(3, 224, 224)) as writer:
+        ...     tile_indices = writer.write(image_tiles)
+    """
+
+    def __init__(self, path: Union[str, Path], tile_shape: Tuple[int, int, int]) -> None:
+        """
+        :param path: Output `.npy` file path.
+        :param tile_shape: Shape of each tile, in (C, H, W) format.
+        """
+        self.path = Path(path)
+        self.tile_shape = tuple(tile_shape)
+        self.n_tiles = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = self.path.open('wb')
+        self._file.write(_get_npy_header((0, *self.tile_shape)))  # placeholder, rewritten in `close()`
+
+    def write(self, tiles: np.ndarray) -> np.ndarray:
+        """Append a batch of tiles to the file.
+
+        :param tiles: A `uint8`-compatible array of tiles of shape (N, C, H, W).
+        :return: The indices of the written tiles in the packed array, of shape (N,).
+        """
+        if tiles.shape[1:] != self.tile_shape:
+            raise ValueError(f"Expected tiles of shape {self.tile_shape}, got {tiles.shape[1:]}")
+        self._file.write(np.ascontiguousarray(tiles, dtype=np.uint8).tobytes())
+        indices = np.arange(self.n_tiles, self.n_tiles + tiles.shape[0])
+        self.n_tiles += tiles.shape[0]
+        return indices
+
+    def close(self) -> None:
+        """Finalise the `.npy` header with the total number of tiles and close the file."""
+        if self._file.closed:
+            return
+        self._file.seek(0)
+        self._file.write(_get_npy_header((self.n_tiles, *self.tile_shape)))
+        self._file.close()
+
+    def __enter__(self) -> 'PackedTilesWriter':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+def load_packed_tiles(path: Union[str, Path], indices: Optional[Sequence[int]] = None) -> np.ndarray:
+    """Load a subset of tiles from a packed tiles file with a single memory-mapped read.
+
+    :param path: Path to a `.npy` file written by `PackedTilesWriter`.
+    :param indices: Indices of the tiles to load, in the desired output order. If `None` (default),
+    all tiles are loaded.
+    :return: A `uint8` array of tiles of shape (N, C, H, W).
+    """
+    packed_tiles = np.load(path, mmap_mode='r')
+    if indices is None:
+        return np.array(packed_tiles)
+    indices_array = np.asarray(indices, dtype=np.int64)
+    # Read in file order to favour sequential access, then restore the requested order
+    order = np.argsort(indices_array, kind='stable')
+    tiles = np.empty((len(indices_array), *packed_tiles.shape[1:]), dtype=packed_tiles.dtype)
+    tiles[order] = packed_tiles[indices_array[order]]
+    return tiles
@@ -0,0 +1,150 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+import hashlib
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from health_ml.utils import box_utils
+
+# Increment when the content or format of the cached metadata changes, to invalidate existing entries
+SLIDE_METADATA_CACHE_VERSION = 1
+
+
+@dataclass
+class SlideMetadata:
+    """Metadata of a slide that is expensive to recompute, e.g. because it requires reading the slide.
+
+    :param level_dimensions: The (width, height) of the slide at each magnification level.
+    :param level_downsamples: The downsampling factor of each magnification level relative to level 0.
+    :param foreground_threshold: Luminance threshold used to segment the slide's foreground, if any.
+    :param bbox: Bounding box of the region of interest in the level-0 reference frame, if any.
+    :param thumbnail: A small image of the slide, e.g. at the lowest resolution, in (C, H, W) format.
+    """
+    level_dimensions: List[Tuple[int, int]]
+    level_downsamples: List[float]
+    foreground_threshold: Optional[float] = None
+    bbox: Optional[box_utils.Box] = None
+    thumbnail: Optional[np.ndarray] = None
+
+
+def get_level_metadata(slide_obj: Any) -> SlideMetadata:
+    """Read the level dimensions and downsampling factors from the header of an open slide.
+
+    :param slide_obj: The cuCIM image object returned by `reader.read(<image_file>)`.
+    :return: The slide metadata, without foreground threshold, bounding box, or thumbnail.
+    """
+    resolutions = slide_obj.resolutions
+    return SlideMetadata(level_dimensions=[tuple(dims) for dims in resolutions['level_dimensions']],
+                         level_downsamples=[float(factor) for factor in resolutions['level_downsamples']])
+
+
+class SlideMetadataCache:
+    """Persistent on-disk cache of per-slide metadata and thumbnails.
+
+    Entries are keyed by the content of the slide files (path, size, and modification time) and by the parameters
+    used to compute them, so they are invalidated whenever a slide file changes. Each entry is stored as a JSON
+    file, alongside a `.npy` file for the thumbnail. Entries are written atomically, so the cache can be shared by
+    concurrent processes.
+
+    Example:
+        >>> cache = SlideMetadataCache("/tmp/slide_metadata")
+        >>> metadata = cache.get_or_compute([slide_path], compute_metadata, margin=64)
+    """
+
+    def __init__(self, cache_dir: Union[str, Path]) -> None:
+        """
+        :param cache_dir: Directory in which to store the cache entries. Created if it does not exist.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def get_key(paths: Sequence[Union[str, Path]], **params: Any) -> str:
+        """Compute the cache key of a slide.
+
+        :param paths: Paths of the files from which the metadata are computed, e.g. a slide and its mask. Each path
+        may also be wrapped in a single-element list, as in a sample collated into a batch of size 1.
+        :param params: JSON-serializable parameters with which the metadata are computed.
+        :return: A hexadecimal hash of the files' paths, sizes, and modification times, and of the parameters.
+        """
+        files = []
+        for path in paths:
+            if isinstance(path, (list, tuple)):
+                path, = path
+            stat = os.stat(path)
+            files.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+        content = json.dumps({'version': SLIDE_METADATA_CACHE_VERSION, 'files': files, 'params': params},
+                             sort_keys=True, default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def _get_paths(self, key: str) -> Tuple[Path, Path]:
+        return self.cache_dir / f"{key}.json", self.cache_dir / f"{key}.npy"
+
+    def load(self, key: str) -> Optional[SlideMetadata]:
+        """Load a cache entry.
+
+        :param key: Cache key, as returned by `get_key()`.
+        :return: The cached metadata, or `None` if there is no valid entry for this key.
+        """
+        json_path, thumbnail_path = self._get_paths(key)
+        try:
+            entry = json.loads(json_path.read_text())
+            thumbnail = np.load(thumbnail_path) if entry['has_thumbnail'] else None
+        except (OSError, ValueError, KeyError) as e:
+            if json_path.exists():
+                logging.warning(f"Ignoring invalid slide metadata cache entry {json_path}: {e}")
+            return None
+        bbox = box_utils.Box(**entry['bbox']) if entry['bbox'] is not None else None
+        return SlideMetadata(level_dimensions=[tuple(dims) for dims in entry['level_dimensions']],
+                             level_downsamples=entry['level_downsamples'],
+                             foreground_threshold=entry['foreground_threshold'],
+                             bbox=bbox,
+                             thumbnail=thumbnail)
+
+    def save(self, key: str, metadata: SlideMetadata) -> None:
+        """Save a cache entry, overwriting any existing entry with the same key.
+
+        :param key: Cache key, as returned by `get_key()`.
+        :param metadata: The metadata to save.
+        """
+        json_path, thumbnail_path = self._get_paths(key)
+        # The thumbnail is written first, so that an entry is only visible once complete
+        if metadata.thumbnail is not None:
+            tmp_thumbnail_path = thumbnail_path.with_suffix(f".{os.getpid()}.tmp.npy")
+            np.save(tmp_thumbnail_path, metadata.thumbnail)
+            os.replace(tmp_thumbnail_path, thumbnail_path)
+        threshold, bbox = metadata.foreground_threshold, metadata.bbox
+        entry: Dict[str, Any] = {
+            'level_dimensions': [list(map(int, dims)) for dims in metadata.level_dimensions],
+            'level_downsamples': [float(factor) for factor in metadata.level_downsamples],
+            'foreground_threshold': float(threshold) if threshold is not None else None,
+            'bbox': {key: int(value) for key, value in asdict(bbox).items()} if bbox is not None else None,
+            'has_thumbnail': metadata.thumbnail is not None,
+        }
+        tmp_json_path = json_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_json_path.write_text(json.dumps(entry))
+        os.replace(tmp_json_path, json_path)
+
+    def get_or_compute(self, paths: Sequence[Union[str, Path]], compute: Callable[[], SlideMetadata],
+                       **params: Any) -> SlideMetadata:
+        """Load the metadata of a slide from the cache, or compute and cache them if missing.
+
+        :param paths: Paths of the files from which the metadata are computed, e.g. a slide and its mask.
+        :param compute: Function computing the metadata, called only if there is no valid cache entry.
+        :param params: JSON-serializable parameters with which the metadata are computed.
+        :return: The slide metadata.
+        """
+        key = self.get_key(paths, **params)
+        metadata = self.load(key)
+        if metadata is None:
+            metadata = compute()
+            self.save(key, metadata)
+        return metadata
@@ -0,0 +1,149 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from histopathology.preprocessing.wsi_readers import WSIBackend, get_slide_reader
+from histopathology.utils.naming import SlideKey
+
+MANIFEST_FILENAME = "manifest.jsonl"
+
+
+class SlideManifest:
+    """Append-only record of the slides that have been completely processed in a tiles dataset.
+
+    Each completed slide is recorded as one JSON line, appended with a single write and flushed to disk
+    before returning. A line can only be partially written if the process is killed mid-write, in which
+    case it is ignored when loading, so a slide is considered complete if and only if its record is intact.
+    Records should only be added from a single process (e.g. the main process of a multiprocessing pool).
+    """
+
+    def __init__(self, dataset_dir: Union[str, Path]) -> None:
+        """
+        :param dataset_dir: Root directory of the tiles dataset, where the manifest file is stored.
+        """
+        self.path = Path(dataset_dir) / MANIFEST_FILENAME
+        self.records: Dict[str, Dict[str, Any]] = {}
+        if self.path.exists():
+            self._load()
+
+    def _load(self) -> None:
+        with self.path.open('r') as manifest_file:
+            for line in manifest_file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f"Ignoring incomplete manifest record in {self.path}: {line!r}")
+                    continue
+                self.records[record[SlideKey.SLIDE_ID]] = record
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def create(self) -> None:
+        """Create an empty manifest file if none exists yet, so that the outputs of an interrupted run are never
+        mistaken for a legacy dataset without a manifest."""
+        if self.path.exists():
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open('a') as manifest_file:
+            os.fsync(manifest_file.fileno())
+
+    def is_complete(self, slide_id: str) -> bool:
+        return slide_id in self.records
+
+    @property
+    def slide_ids(self) -> List[str]:
+        """IDs of all completed slides, in order of completion."""
+        return list(self.records)
+
+    def mark_complete(self, record: Dict[str, Any]) -> None:
+        """Record a slide as complete.
+
+        :param record: JSON-serializable dictionary describing the processed slide, containing at least
+        `SlideKey.SLIDE_ID`.
+        """
+        line = json.dumps(record) + '\n'
+        if '\n' in line[:-1]:
+            raise ValueError(f"Manifest record must fit in a single line: {record}")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open('a') as manifest_file:
+            manifest_file.write(line)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        self.records[record[SlideKey.SLIDE_ID]] = record
+
+
+def get_slide_dimensions(image_path: Union[str, Path], level: int,
+                         wsi_backend: WSIBackend = WSIBackend.CUCIM) -> Tuple[int, int]:
+    """Read the dimensions of a slide at a given magnification level, without loading any pixel data.
+
+    :param image_path: Path to the slide file.
+    :param level: Magnification level.
+    :param wsi_backend: The library with which to read the slide.
+    :return: The (width, height) of the slide at the given level.
+    """
+    reader = get_slide_reader(wsi_backend)
+    slide_obj = reader.read(image_path)
+    try:
+        width, height = reader.get_level_dims(slide_obj)[level]
+    finally:
+        slide_obj.close()
+    return width, height
+
+
+def estimate_slide_memory(dimensions: Tuple[int, int], tile_size: int, strip_height: Optional[int] = None,
+                          n_channels: int = 3) -> int:
+    """Estimate the peak memory needed to tile a slide, in bytes.
+
+    This counts the loaded image and the copies made while padding and rearranging it into tiles, assuming the
+    foreground ROI may cover the whole slide.
+
+    :param dimensions: The (width, height) of the slide at the target magnification level.
+    :param tile_size: Lateral dimensions of each tile, in pixels.
+    :param strip_height: Number of rows of tiles read at once, if the slide is read in strips. By default
+    (`None`), the whole ROI is assumed to be loaded at once.
+    :param n_channels: Number of image channels.
+    :return: The estimated number of bytes.
+    """
+    width, height = dimensions
+    if strip_height is not None:
+        height = min(height, strip_height * tile_size)
+    n_copies = 3  # loaded region, padded region, and rearranged tiles
+    return n_copies * n_channels * width * height
+
+
+def get_num_workers(memory_estimates: Sequence[int], memory_budget: Optional[float] = None,
+                    max_workers: Optional[int] = None) -> int:
+    """Choose how many slides can be processed in parallel within a memory budget.
+
+    :param memory_estimates: Estimated peak memory for each slide, in bytes.
+    :param memory_budget: Total memory available to all workers, in bytes. If `None` (default), no
+    memory cap is applied.
+    :param max_workers: Upper bound on the number of workers. Defaults to the number of CPUs.
+    :return: The number of workers, at least 1, assuming the largest slides may be processed simultaneously.
+    """
+    num_workers = max_workers or os.cpu_count() or 1
+    num_workers = min(num_workers, max(len(memory_estimates), 1))
+    if memory_budget is not None and len(memory_estimates) > 0:
+        num_workers = min(num_workers, int(memory_budget // max(max(memory_estimates), 1)))
+    return max(num_workers, 1)
+
+
+def order_largest_first(samples: Sequence[Dict[SlideKey, Any]], sizes: Sequence[int]) -> List[Dict[SlideKey, Any]]:
+    """Sort slides by decreasing size, so that the largest slides do not start last and become stragglers.
+
+    :param samples: Slide information dictionaries.
+    :param sizes: A size measure for each slide, e.g. number of pixels or file size.
+    :return: The reordered list of slide dictionaries. Slides of the same size keep their original order.
+    """
+    if len(samples) != len(sizes):
+        raise ValueError(f"Expected one size per slide, got {len(sizes)} sizes for {len(samples)} slides")
+    order = sorted(range(len(samples)), key=lambda i: -sizes[i])
+    return [samples[i] for i in order]
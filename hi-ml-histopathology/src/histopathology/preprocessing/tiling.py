@@ -5,7 +5,8 @@
 
 # These tiling implementations are adapted from PANDA Kaggle solutions, for example:
 # https://github.com/kentaroy47/Kaggle-PANDA-1st-place-solution/blob/master/src/data_process/a00_save_tiles.py
-from typing import Any, Optional, Tuple
+from pathlib import Path
+from typing import Any, Optional, Tuple, Union
 
 import numpy as np
 
@@ -84,29 +85,122 @@ def tile_array_2d(array: np.ndarray, tile_size: int, channels_first: Optional[bo
     return tiles, coords
 
 
-def assemble_tiles_2d(tiles: np.ndarray, coords: np.ndarray, fill_value: Optional[float] = np.nan,
-                      channels_first: Optional[bool] = True) -> Tuple[np.ndarray, np.ndarray]:
-    """Assembles a 2D array from sequences of tiles and coordinates.
+def get_tile_coords_2d(height: int, width: int, tile_size: int, stride: Optional[int] = None) -> np.ndarray:
+    """Computes the top-left coordinates of a grid of tiles covering a 2D array, without padding it.
 
-    :param tiles: Stack of tiles with batch dimension first.
-    :param coords: XY tile coordinates, assumed to be spaced by multiples of `tile_size` (shape: [N, 2]).
-    :param tile_size: Size of each tile; must be >0.
-    :param fill_value: Value to assign to empty elements (default: `NaN`).
-    :param channels_first: Whether each tile is in CHW (`True`, default) or HWC (`False`) layout.
-    :return: A tuple containing:
-        - `array`: The reassembled 2D array with the smallest dimensions to contain all given tiles.
-        - `offset`: The lowest XY coordinates.
-        - `offset`: XY offset introduced by the assembly. Add this to tile coordinates to obtain
-        indices for the assembled array.
+    The grid is centred on the array, so that tiles overhang its edges symmetrically. For `stride == tile_size`
+    (default), these are the same coordinates, in the same order, as returned by `tile_array_2d()`.
+
+    :param height: Height of the array.
+    :param width: Width of the array.
+    :param tile_size: Width/height of each tile in pixels.
+    :param stride: Distance between consecutive tiles in pixels. Values smaller than `tile_size` produce
+    overlapping tiles. By default (`None`), equal to `tile_size`.
+    :return: XY coordinates of each tile relative to the array's origin, in row-major order (shape: [N, 2]).
+    """
+    stride = stride or tile_size
+
+    def get_1d_coords(length: int) -> np.ndarray:
+        n_tiles = max(-(-(length - tile_size) // stride), 0) + 1
+        pad = (n_tiles - 1) * stride + tile_size - length
+        return stride * np.arange(n_tiles) - pad // 2
+
+    coords_h = get_1d_coords(height)
+    coords_w = get_1d_coords(width)
+    return np.stack(np.meshgrid(coords_w, coords_h), axis=-1).reshape(-1, 2)
+
+
+def get_tile_views_2d(array: np.ndarray, tile_size: int, stride: Optional[int] = None,
+                      channels_first: Optional[bool] = True) -> np.ndarray:
+    """Creates a read-only view of all the tiles fully contained in a 2D array, without copying any data.
+
+    :param array: 2D image array.
+    :param tile_size: Width/height of each tile in pixels.
+    :param stride: Distance between consecutive tiles in pixels. Values smaller than `tile_size` produce
+    overlapping tiles. By default (`None`), equal to `tile_size`.
+    :param channels_first: Whether `array` is in CHW (`True`, default) or HWC (`False`) layout.
+    :return: A strided view of shape (n_tiles_h, n_tiles_w, C, tile_size, tile_size) if `channels_first`, else
+    (n_tiles_h, n_tiles_w, tile_size, tile_size, C). The tile at grid position (i, j) has its top-left corner at
+    row `i * stride` and column `j * stride` of `array`.
+    """
+    stride = stride or tile_size
+    if channels_first:
+        channels, height, width = array.shape
+        stride_c, stride_h, stride_w = array.strides
+    else:
+        height, width, channels = array.shape
+        stride_h, stride_w, stride_c = array.strides
+    n_tiles_h = max((height - tile_size) // stride + 1, 0)
+    n_tiles_w = max((width - tile_size) // stride + 1, 0)
+    grid_shape = (n_tiles_h, n_tiles_w)
+    grid_strides = (stride * stride_h, stride * stride_w)
+    if channels_first:
+        shape = (*grid_shape, channels, tile_size, tile_size)
+        strides = (*grid_strides, stride_c, stride_h, stride_w)
+    else:
+        shape = (*grid_shape, tile_size, tile_size, channels)
+        strides = (*grid_strides, stride_h, stride_w, stride_c)
+    return np.lib.stride_tricks.as_strided(array, shape=shape, strides=strides, writeable=False)
+
+
+def extract_tiles_2d(array: np.ndarray, coords: np.ndarray, tile_size: int, channels_first: Optional[bool] = True,
+                     fill_value: Any = 0) -> np.ndarray:
+    """Copies only the requested tiles out of a 2D array, without padding the whole array.
+
+    Tiles fully inside the array are gathered from a zero-copy strided view in a single indexing operation.
+    Tiles overhanging the edges of the array are assembled individually and filled with `fill_value` outside it.
+
+    :param array: 2D image array.
+    :param coords: XY coordinates of the top-left corner of each tile, relative to the array's origin, as
+    returned e.g. by `get_tile_coords_2d()` (shape: [N, 2]).
+    :param tile_size: Width/height of each tile in pixels.
+    :param channels_first: Whether `array` is in CHW (`True`, default) or HWC (`False`) layout.
+    :param fill_value: Value assigned to tile elements outside the array (default: 0).
+    :return: A batch of tiles in NCHW layout if `channels_first`, else NHWC.
+    """
+    if channels_first:
+        channels, height, width = array.shape
+        tile_shape = (channels, tile_size, tile_size)
+    else:
+        height, width, channels = array.shape
+        tile_shape = (tile_size, tile_size, channels)
+    coords = np.asarray(coords).reshape(-1, 2)
+    tile_xs, tile_ys = coords.T
+    tiles = np.empty((len(coords), *tile_shape), dtype=array.dtype)
+
+    inside = (tile_xs >= 0) & (tile_ys >= 0) & (tile_xs + tile_size <= width) & (tile_ys + tile_size <= height)
+    if inside.any():
+        windows = get_tile_views_2d(array, tile_size, stride=1, channels_first=channels_first)
+        tiles[inside] = windows[tile_ys[inside], tile_xs[inside]]
+
+    for idx in np.flatnonzero(~inside):
+        x, y = tile_xs[idx], tile_ys[idx]
+        x_start, x_end = max(x, 0), min(x + tile_size, width)
+        y_start, y_end = max(y, 0), min(y + tile_size, height)
+        tiles[idx] = fill_value
+        if x_start >= x_end or y_start >= y_end:
+            continue
+        if channels_first:
+            tiles[idx, :, y_start - y:y_end - y, x_start - x:x_end - x] = array[:, y_start:y_end, x_start:x_end]
+        else:
+            tiles[idx, y_start - y:y_end - y, x_start - x:x_end - x, :] = array[y_start:y_end, x_start:x_end, :]
+    return tiles
+
+
+def _get_assembly_layout(tiles: np.ndarray, coords: np.ndarray, channels_first: Optional[bool] = True) \
+        -> Tuple[Tuple[int, int, int], np.ndarray, int]:
+    """Computes the shape of the array assembled from the given tiles, and the offset of the tile coordinates.
+
+    :return: A tuple containing the output shape (in CHW or HWC layout), the XY offset, and the tile size.
     """
     if coords.shape[0] != tiles.shape[0]:
         raise ValueError(f"Tile coordinates and values must have the same length, "
                          f"got {coords.shape[0]} and {tiles.shape[0]}")
 
     if channels_first:
-        n_tiles, channels, tile_size, _ = tiles.shape
+        _, channels, tile_size, _ = tiles.shape
     else:
-        n_tiles, tile_size, _, channels = tiles.shape
+        _, tile_size, _, channels = tiles.shape
     tile_xs, tile_ys = coords.T
 
     x_min, x_max = min(tile_xs), max(tile_xs + tile_size)
@@ -114,10 +208,15 @@ def assemble_tiles_2d(tiles: np.ndarray, coords: np.ndarray, fill_value: Optiona
     width = x_max - x_min
     height = y_max - y_min
     output_shape = (channels, height, width) if channels_first else (height, width, channels)
-    array = np.full(output_shape, fill_value)
-
     offset = np.array([-x_min, -y_min])
-    for idx in range(n_tiles):
+    return output_shape, offset, tile_size
+
+
+def _scatter_tiles_loop(array: np.ndarray, tiles: np.ndarray, coords: np.ndarray, offset: np.ndarray,
+                        channels_first: Optional[bool] = True) -> None:
+    """Copies each tile into `array` one at a time, at arbitrary (possibly overlapping) positions."""
+    tile_size = tiles.shape[2] if channels_first else tiles.shape[1]
+    for idx in range(tiles.shape[0]):
         row = coords[idx, 1] + offset[1]
         col = coords[idx, 0] + offset[0]
         if channels_first:
@@ -125,4 +224,85 @@ def assemble_tiles_2d(tiles: np.ndarray, coords: np.ndarray, fill_value: Optiona
         else:
             array[row:row + tile_size, col:col + tile_size, :] = tiles[idx]
 
+
+def _scatter_tiles(array: np.ndarray, tiles: np.ndarray, coords: np.ndarray, offset: np.ndarray,
+                   channels_first: Optional[bool] = True) -> None:
+    """Copies tiles into `array`, with a single fancy-indexing assignment if they lie on a regular grid.
+
+    If all shifted coordinates are multiples of the tile size, `array` is viewed as a grid of tiles (without
+    copying) and all tiles are assigned at once. Otherwise, this falls back to copying tiles one by one.
+    """
+    tile_size = tiles.shape[2] if channels_first else tiles.shape[1]
+    grid_coords = coords + offset
+    if np.any(grid_coords % tile_size != 0):
+        _scatter_tiles_loop(array, tiles, coords, offset, channels_first)
+        return
+    grid_cols, grid_rows = (grid_coords // tile_size).T
+    grid = array.view()
+    if channels_first:
+        channels, height, width = array.shape
+        grid.shape = (channels, height // tile_size, tile_size, width // tile_size, tile_size)
+        grid = grid.transpose(1, 3, 0, 2, 4)  # (n_tiles_h, n_tiles_w, channels, tile_size, tile_size)
+    else:
+        height, width, channels = array.shape
+        grid.shape = (height // tile_size, tile_size, width // tile_size, tile_size, channels)
+        grid = grid.transpose(0, 2, 1, 3, 4)  # (n_tiles_h, n_tiles_w, tile_size, tile_size, channels)
+    grid[grid_rows, grid_cols] = tiles
+
+
+def assemble_tiles_2d(tiles: np.ndarray, coords: np.ndarray, fill_value: Optional[float] = np.nan,
+                      channels_first: Optional[bool] = True) -> Tuple[np.ndarray, np.ndarray]:
+    """Assembles a 2D array from sequences of tiles and coordinates.
+
+    Tiles lying on a regular grid are copied in a single vectorized operation.
+
+    :param tiles: Stack of tiles with batch dimension first.
+    :param coords: XY tile coordinates, assumed to be spaced by multiples of `tile_size` (shape: [N, 2]).
+    :param tile_size: Size of each tile; must be >0.
+    :param fill_value: Value to assign to empty elements (default: `NaN`).
+    :param channels_first: Whether each tile is in CHW (`True`, default) or HWC (`False`) layout.
+    :return: A tuple containing:
+        - `array`: The reassembled 2D array with the smallest dimensions to contain all given tiles.
+        - `offset`: The lowest XY coordinates.
+        - `offset`: XY offset introduced by the assembly. Add this to tile coordinates to obtain
+        indices for the assembled array.
+    """
+    output_shape, offset, _ = _get_assembly_layout(tiles, coords, channels_first)
+    array = np.full(output_shape, fill_value)
+    _scatter_tiles(array, tiles, coords, offset, channels_first)
+    return array, offset
+
+
+def assemble_tiles_2d_out_of_core(tiles: np.ndarray, coords: np.ndarray, output_path: Union[str, Path],
+                                  fill_value: Optional[float] = np.nan, channels_first: Optional[bool] = True,
+                                  dtype: Any = None,
+                                  chunk_size: int = 4096) -> Tuple[np.memmap, np.ndarray]:
+    """Assembles a 2D array from sequences of tiles and coordinates into a memory-mapped `.npy` file.
+
+    This is equivalent to `assemble_tiles_2d()`, but the assembled array is backed by a file on disk, so it can
+    be larger than the available memory (e.g. for level-0 masks or heatmaps). Tiles are copied in chunks, so
+    they can themselves be memory-mapped (e.g. from a packed tiles file).
+
+    :param tiles: Stack of tiles with batch dimension first.
+    :param coords: XY tile coordinates (shape: [N, 2]).
+    :param output_path: Path of the `.npy` file to create. It can later be reopened with
+    `np.load(output_path, mmap_mode='r')`.
+    :param fill_value: Value to assign to empty elements (default: `NaN`).
+    :param channels_first: Whether each tile is in CHW (`True`, default) or HWC (`False`) layout.
+    :param dtype: Data type of the assembled array. By default (`None`), uses the same type as
+    `assemble_tiles_2d()`, i.e. that of `fill_value`.
+    :param chunk_size: Maximum number of tiles to copy at once.
+    :return: A tuple containing the memory-mapped assembled array and the XY offset, as in `assemble_tiles_2d()`.
+    """
+    if chunk_size <= 0:
+        raise ValueError(f"Chunk size must be positive, got {chunk_size}")
+    output_shape, offset, _ = _get_assembly_layout(tiles, coords, channels_first)
+    if dtype is None:
+        dtype = np.asarray(fill_value).dtype
+    array = np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype, shape=output_shape)
+    array[...] = fill_value
+    for start in range(0, tiles.shape[0], chunk_size):
+        _scatter_tiles(array, np.asarray(tiles[start:start + chunk_size]), coords[start:start + chunk_size],
+                       offset, channels_first)
+    array.flush()
     return array, offset
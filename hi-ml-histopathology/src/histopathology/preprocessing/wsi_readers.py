@@ -0,0 +1,218 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+from abc import ABC, abstractmethod
+from enum import Enum
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from monai.data.image_reader import WSIReader
+
+
+class WSIBackend(Enum):
+    """Library with which to read whole-slide images."""
+    CUCIM = 'cucim'
+    OPENSLIDE = 'openslide'
+    TIFFFILE = 'tifffile'
+
+
+class SlideHandle:
+    """An open slide, exposing its magnification levels in the same `resolutions` format as cuCIM's `CuImage`."""
+
+    def __init__(self, slide: Any, level_dimensions: Sequence[Tuple[int, int]],
+                 level_downsamples: Sequence[float]) -> None:
+        """
+        :param slide: The backend-specific slide object, which must have a `close()` method.
+        :param level_dimensions: The (width, height) of the slide at each magnification level.
+        :param level_downsamples: The downsampling factor of each magnification level relative to level 0.
+        """
+        self.slide = slide
+        self.resolutions: Dict[str, Any] = {'level_count': len(level_dimensions),
+                                            'level_dimensions': tuple(tuple(dims) for dims in level_dimensions),
+                                            'level_downsamples': tuple(level_downsamples)}
+
+    def close(self) -> None:
+        self.slide.close()
+
+
+class SlideReader(ABC):
+    """Interface for reading regions of whole-slide images with interchangeable backends.
+
+    Readers follow the conventions of MONAI's `WSIReader`: region locations are given in the level-0 reference
+    frame and region sizes in pixels at the chosen level, both ordered as (rows, columns), and regions are returned
+    as RGB arrays in (C, H, W) format. Readers also implement `WSIReader`'s `read()` and `get_data()` methods, so
+    they can be used in its place, e.g. in `LoadROId`. The objects returned by `read()` have a `close()` method and
+    a cuCIM-style `resolutions` dictionary.
+    """
+    backend: WSIBackend
+
+    @abstractmethod
+    def read(self, path: Union[str, Path]) -> Any:
+        """Open a slide, without reading any pixel data.
+
+        :param path: Path to the slide file.
+        :return: The open slide object.
+        """
+        raise NotImplementedError
+
+    def get_level_dims(self, slide_obj: Any) -> List[Tuple[int, int]]:
+        """Get the (width, height) of a slide at each magnification level.
+
+        :param slide_obj: The slide object returned by `read()`.
+        """
+        return [tuple(dims) for dims in slide_obj.resolutions['level_dimensions']]  # type: ignore
+
+    def get_level_downsamples(self, slide_obj: Any) -> List[float]:
+        """Get the downsampling factor of each magnification level of a slide relative to level 0.
+
+        :param slide_obj: The slide object returned by `read()`.
+        """
+        return [float(factor) for factor in slide_obj.resolutions['level_downsamples']]
+
+    @abstractmethod
+    def read_region(self, slide_obj: Any, location: Tuple[int, int], size: Tuple[int, int],
+                    level: int) -> np.ndarray:
+        """Read a region of a slide. Pixels outside of the slide are filled with zeros.
+
+        :param slide_obj: The slide object returned by `read()`.
+        :param location: Top-left corner of the region in the level-0 reference frame, as (row, column).
+        :param size: Size of the region in pixels at the given level, as (rows, columns).
+        :param level: Magnification level at which to read the region.
+        :return: The RGB region array in (C, H, W) format, of type `uint8`.
+        """
+        raise NotImplementedError
+
+    def get_data(self, img: Any, location: Tuple[int, int] = (0, 0), size: Optional[Tuple[int, int]] = None,
+                 level: int = 0) -> Tuple[np.ndarray, Dict]:
+        """Read a region of a slide, with the same interface as MONAI's `WSIReader.get_data()`.
+
+        :param img: The slide object returned by `read()`.
+        :param location: Top-left corner of the region in the level-0 reference frame, as (row, column).
+        :param size: Size of the region in pixels at the given level, as (rows, columns). By default (`None`),
+        the whole slide at the given level.
+        :param level: Magnification level at which to read the region.
+        :return: A tuple containing the RGB region array in (C, H, W) format and a metadata dictionary.
+        """
+        if size is None:
+            width, height = self.get_level_dims(img)[level]
+            size = (height, width)
+        region = self.read_region(img, location=location, size=size, level=level)
+        return region, {'spatial_shape': size}
+
+
+class CuCIMReader(SlideReader):
+    """Slide reader using cuCIM, which is generally fastest for reading large regions."""
+    backend = WSIBackend.CUCIM
+
+    def __init__(self) -> None:
+        from cucim import CuImage
+        self._image_class = CuImage
+
+    def read(self, path: Union[str, Path]) -> Any:
+        return self._image_class(str(path))
+
+    def read_region(self, slide_obj: Any, location: Tuple[int, int], size: Tuple[int, int],
+                    level: int) -> np.ndarray:
+        region = slide_obj.read_region(location=location[::-1], size=size[::-1], level=level)
+        return np.moveaxis(np.asarray(region, dtype=np.uint8)[..., :3], -1, 0)
+
+
+class OpenSlideReader(SlideReader):
+    """Slide reader using OpenSlide, which supports the widest range of vendor formats."""
+    backend = WSIBackend.OPENSLIDE
+
+    def __init__(self) -> None:
+        import openslide
+        self._openslide = openslide
+
+    def read(self, path: Union[str, Path]) -> SlideHandle:
+        slide = self._openslide.OpenSlide(str(path))
+        return SlideHandle(slide, slide.level_dimensions, slide.level_downsamples)
+
+    def read_region(self, slide_obj: SlideHandle, location: Tuple[int, int], size: Tuple[int, int],
+                    level: int) -> np.ndarray:
+        region = slide_obj.slide.read_region(location[::-1], level, size[::-1])  # loaded as RGBA PIL image
+        return np.moveaxis(np.asarray(region, dtype=np.uint8)[..., :3], -1, 0)
+
+
+class TiffFileReader(SlideReader):
+    """Slide reader using tifffile, for pyramidal TIFF files (e.g. PANDA).
+
+    Only the storage tiles overlapping the requested region are read and decoded, so this is well suited for
+    random reads of small regions.
+    """
+    backend = WSIBackend.TIFFFILE
+
+    def __init__(self) -> None:
+        import tifffile
+        self._tifffile = tifffile
+
+    def read(self, path: Union[str, Path]) -> SlideHandle:
+        tiff = self._tifffile.TiffFile(str(path))
+        levels = tiff.series[0].levels
+        level_dimensions = [(level.shape[1], level.shape[0]) for level in levels]
+        width, height = level_dimensions[0]
+        # Same definition of downsampling factors as cuCIM and OpenSlide
+        level_downsamples = [(width / level_width + height / level_height) / 2
+                             for level_width, level_height in level_dimensions]
+        return SlideHandle(tiff, level_dimensions, level_downsamples)
+
+    def read_region(self, slide_obj: SlideHandle, location: Tuple[int, int], size: Tuple[int, int],
+                    level: int) -> np.ndarray:
+        tiff = slide_obj.slide
+        page = tiff.series[0].levels[level].keyframe
+        scale = slide_obj.resolutions['level_downsamples'][level]
+        # Level-0 coordinates are truncated to the given level, as in cuCIM
+        top, left = int(location[0] / scale), int(location[1] / scale)
+        height, width = size
+        region = np.zeros((3, height, width), dtype=np.uint8)
+
+        page_height, page_width = page.shape[:2]
+        y_start, y_end = max(top, 0), min(top + height, page_height)
+        x_start, x_end = max(left, 0), min(left + width, page_width)
+        if y_start >= y_end or x_start >= x_end:
+            return region
+
+        if not page.is_tiled:
+            data = page.asarray()[y_start:y_end, x_start:x_end, :3]
+            region[:, y_start - top:y_end - top, x_start - left:x_end - left] = np.moveaxis(data, -1, 0)
+            return region
+
+        tile_height, tile_width = page.tilelength, page.tilewidth
+        n_tile_cols = -(-page_width // tile_width)
+        tile_rows = range(y_start // tile_height, (y_end - 1) // tile_height + 1)
+        tile_cols = range(x_start // tile_width, (x_end - 1) // tile_width + 1)
+        indices = [row * n_tile_cols + col for row in tile_rows for col in tile_cols]
+        offsets = [page.dataoffsets[index] for index in indices]
+        bytecounts = [page.databytecounts[index] for index in indices]
+        for segment, index in tiff.filehandle.read_segments(offsets, bytecounts, indices=indices):
+            tile, (_, _, tile_y, tile_x, _), _ = page.decode(segment, index)
+            # Overlap of the tile with the requested region, in page coordinates
+            y0, y1 = max(tile_y, y_start), min(tile_y + tile_height, y_end)
+            x0, x1 = max(tile_x, x_start), min(tile_x + tile_width, x_end)
+            tile_data = tile[0, y0 - tile_y:y1 - tile_y, x0 - tile_x:x1 - tile_x, :3]
+            region[:, y0 - top:y1 - top, x0 - left:x1 - left] = np.moveaxis(tile_data, -1, 0)
+        return region
+
+
+# Type of the readers accepted by the slide loading transforms
+WSIReaderType = Union[WSIReader, SlideReader]
+
+_READER_CLASSES: Dict[WSIBackend, Callable[[], SlideReader]] = {
+    WSIBackend.CUCIM: CuCIMReader,
+    WSIBackend.OPENSLIDE: OpenSlideReader,
+    WSIBackend.TIFFFILE: TiffFileReader,
+}
+
+
+def get_slide_reader(backend: Union[WSIBackend, str] = WSIBackend.CUCIM) -> SlideReader:
+    """Create a slide reader for the given backend.
+
+    :param backend: The backend library, or its name (`'cucim'`, `'openslide'`, or `'tifffile'`).
+    :return: The slide reader.
+    :raises ImportError: If the backend library is not installed.
+    """
+    return _READER_CLASSES[WSIBackend(backend)]()
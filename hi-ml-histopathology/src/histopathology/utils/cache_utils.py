@@ -0,0 +1,155 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+import functools
+import hashlib
+import logging
+import os
+import shutil
+import time
+import types
+from enum import Enum
+from pathlib import Path
+from typing import Any, Collection, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+
+# Attributes of transforms which do not affect their outputs, and are therefore excluded from cache keys
+OUTPUT_NEUTRAL_ATTRIBUTES = frozenset({'progress', 'num_threads', 'chunk_size'})
+
+
+def _update_hash(hasher: Any, obj: Any, visited: Dict[int, Any]) -> None:
+    # `visited` holds references to the visited objects, so that their IDs are not reused by temporary objects
+    def update(*values: Any) -> None:
+        for value in values:
+            hasher.update(repr(value).encode())
+            hasher.update(b'\0')
+
+    primitive_types = (bool, int, float, complex, str, bytes, Path, Enum, torch.dtype, torch.device)
+    if obj is None or isinstance(obj, primitive_types):
+        update(type(obj).__name__, obj)
+    elif isinstance(obj, (torch.Tensor, np.ndarray)):
+        array = obj.detach().cpu().numpy() if isinstance(obj, torch.Tensor) else obj
+        update(type(obj).__name__, array.dtype.str, array.shape)
+        hasher.update(np.ascontiguousarray(array).tobytes())
+    elif isinstance(obj, (np.random.RandomState, np.random.Generator, torch.Generator)):
+        update(type(obj).__name__)  # the state of a generator changes during use
+    elif id(obj) in visited:
+        update('<cycle>')
+    elif isinstance(obj, dict):
+        visited[id(obj)] = obj
+        update(type(obj).__name__, len(obj))
+        for key in sorted(obj, key=repr):
+            update(key)
+            _update_hash(hasher, obj[key], visited)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        visited[id(obj)] = obj
+        items = sorted(obj, key=repr) if isinstance(obj, (set, frozenset)) else obj
+        update(type(obj).__name__, len(items))
+        for item in items:
+            _update_hash(hasher, item, visited)
+    elif isinstance(obj, functools.partial):
+        visited[id(obj)] = obj
+        update('partial')
+        _update_hash(hasher, (obj.func, obj.args, obj.keywords), visited)
+    elif isinstance(obj, types.MethodType):
+        update(obj.__func__.__module__, obj.__func__.__qualname__)
+        _update_hash(hasher, obj.__self__, visited)
+    elif isinstance(obj, (type, types.FunctionType, types.BuiltinFunctionType)):
+        update(obj.__module__, obj.__qualname__)
+    else:
+        visited[id(obj)] = obj
+        update(type(obj).__module__, type(obj).__qualname__)
+        if isinstance(obj, nn.Module):
+            _update_hash(hasher, dict(obj.state_dict()), visited)
+        attributes = {name: value for name, value in getattr(obj, '__dict__', {}).items()
+                      if not name.startswith('_') and name not in OUTPUT_NEUTRAL_ATTRIBUTES}
+        _update_hash(hasher, attributes, visited)
+
+
+def get_fingerprint(*objects: Any) -> str:
+    """Compute a content hash of the given objects, e.g. to derive the key of cached transformed data.
+
+    The hash covers the values of primitives, containers, arrays and tensors, the module and qualified name of
+    functions and classes, the state dictionary of `torch.nn.Module`s (e.g. the weights of a `TileEncoder`), and
+    recursively the public attributes of any other object (e.g. the parameters of a MONAI transform or the
+    preprocessing of an encoder). Attributes in `OUTPUT_NEUTRAL_ATTRIBUTES` and the state of random generators are
+    ignored.
+
+    :param objects: The objects to hash.
+    :return: A hexadecimal SHA-256 hash.
+    """
+    hasher = hashlib.sha256()
+    _update_hash(hasher, objects, visited={})
+    return hasher.hexdigest()
+
+
+def get_dataframe_fingerprint(df: pd.DataFrame) -> str:
+    """Compute a content hash of a dataframe, including its index and column names.
+
+    :param df: The dataframe to hash, e.g. the index of a tiles dataset.
+    :return: A hexadecimal SHA-256 hash.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(repr((list(df.columns), df.index.name, df.shape)).encode())
+    hasher.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return hasher.hexdigest()
+
+
+def touch_cache_entry(path: Path) -> None:
+    """Mark a cache entry as used, by updating its modification time, for `evict_least_recently_used()`."""
+    if path.exists():
+        os.utime(path)
+
+
+def get_cache_entry_size(path: Path) -> int:
+    """Get the total size in bytes of a cache entry file, or of all files in a cache entry directory."""
+    if path.is_dir():
+        return sum(file_path.stat().st_size for file_path in path.rglob('*') if file_path.is_file())
+    return path.stat().st_size
+
+
+def evict_least_recently_used(cache_dir: Path, max_size: int, prefixes: Collection[str],
+                              keep: Collection[Path] = (), min_age: float = 0) -> List[Path]:
+    """Delete the least recently used entries of a cache directory until its total size is within a quota.
+
+    Entries are the files and subdirectories of `cache_dir` whose names start with any of the given prefixes. They
+    are ordered by their modification time, which should be updated with `touch_cache_entry()` whenever an entry is
+    used. As the cache directory may be shared by several processes, entries used more recently than `min_age` are
+    never evicted, since another process may still be reading them.
+
+    :param cache_dir: The cache directory.
+    :param max_size: The maximum total size of the cache entries, in bytes.
+    :param prefixes: Name prefixes of the cache entries, so that other contents of `cache_dir` are left untouched.
+    :param keep: Entries which must not be deleted, e.g. those in use. They still count towards the quota.
+    :param min_age: Minimum time since an entry was last used for it to be deleted, in seconds.
+    :return: The paths of the deleted entries.
+    """
+    if not cache_dir.is_dir():
+        return []
+    now = time.time()
+    keep_paths = {Path(path).resolve() for path in keep}
+    entries: List[Tuple[float, int, Path]] = []
+    for path in cache_dir.iterdir():
+        if any(path.name.startswith(prefix) for prefix in prefixes):
+            entries.append((path.stat().st_mtime, get_cache_entry_size(path), path))
+    total_size = sum(size for _, size, _ in entries)
+    evicted = []
+    for mtime, size, path in sorted(entries, key=lambda entry: entry[0]):
+        if total_size <= max_size:
+            break
+        if path.resolve() in keep_paths or now - mtime < min_age:
+            continue
+        logging.info(f"Evicting cache entry {path} ({size / 2**30:.2f} GB, least recently used)")
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+        total_size -= size
+        evicted.append(path)
+    return evicted
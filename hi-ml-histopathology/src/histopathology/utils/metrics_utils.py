@@ -128,7 +128,8 @@ def plot_heatmap_overlay(slide: str,
                          results: Dict[str, List[Any]],
                          location_bbox: List[int],
                          tile_size: int = 224,
-                         level: int = 1) -> plt.Figure:
+                         level: int = 1,
+                         thumbnail_factor: int = 1) -> plt.Figure:
     """Plots heatmap of selected tiles (e.g. tiles in a bag) overlay on the corresponding slide.
     :param slide: slide identifier.
     :param slide_image: Numpy array of the slide image (shape: [3, H, W]).
@@ -137,6 +138,8 @@ def plot_heatmap_overlay(slide: str,
     :param level: Magnification at which tiles are available (e.g. PANDA levels are 0 for original,
     1 for 4x downsampled, 2 for 16x downsampled). Default 1.
     :param location_bbox: Location of the bounding box of the slide.
+    :param thumbnail_factor: Factor by which `slide_image` is further downsampled from `level`, e.g. for a
+    cached thumbnail (see `load_image_dict()`). Default 1.
     :return: matplotlib figure of the heatmap of the given tiles on slide.
     """
     fig, ax = plt.subplots()
@@ -162,8 +165,9 @@ def plot_heatmap_overlay(slide: str,
     sel_coords = location_selected_tiles(tile_coords=coords, location_bbox=location_bbox, level=level)
     cmap = plt.cm.get_cmap('Reds')
 
-    tile_xs, tile_ys = sel_coords.T
-    rects = [patches.Rectangle(xy, tile_size, tile_size) for xy in zip(tile_xs, tile_ys)]
+    tile_xs, tile_ys = sel_coords.T / thumbnail_factor
+    rect_size = tile_size / thumbnail_factor
+    rects = [patches.Rectangle(xy, rect_size, rect_size) for xy in zip(tile_xs, tile_ys)]
 
     pc = collection.PatchCollection(rects, match_original=True, cmap=cmap, alpha=.5, edgecolor=None)
     pc.set_array(np.array(attentions))
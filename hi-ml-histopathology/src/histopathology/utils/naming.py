@@ -19,6 +19,7 @@ class SlideKey(str, Enum):
     FOREGROUND_THRESHOLD = 'foreground_threshold'
     METADATA = 'metadata'
     LOCATION = 'location'
+    THUMBNAIL_FACTOR = 'thumbnail_factor'
 
 
 class TileKey(str, Enum):
@@ -32,6 +33,7 @@ class TileKey(str, Enum):
     SPLIT = 'split'
     TILE_X = 'tile_x'
     TILE_Y = 'tile_y'
+    TILE_INDEX = 'tile_index'
     OCCUPANCY = 'occupancy'
     FOREGROUND_THRESHOLD = 'foreground_threshold'
     SLIDE_METADATA = 'slide_metadata'
@@ -17,6 +17,8 @@ from torchmetrics.metric import Metric
 
 from health_azure.utils import replace_directory
 from histopathology.datasets.base_dataset import SlidesDataset
+from histopathology.preprocessing.slide_cache import SlideMetadataCache
+from histopathology.preprocessing.wsi_readers import WSIBackend
 from histopathology.utils.metrics_utils import (plot_attention_tiles, plot_heatmap_overlay,
                                                 plot_normalized_confusion_matrix, plot_scores_hist, plot_slide,
                                                 select_k_tiles)
@@ -156,22 +158,28 @@ def save_top_and_bottom_tiles(results: ResultsType, n_classes: int, figures_dir:
 
 
 def save_slide_thumbnails_and_heatmaps(results: ResultsType, selected_slide_ids: Dict[str, List[str]], tile_size: int,
-                                       level: int, slides_dataset: SlidesDataset, figures_dir: Path) -> None:
+                                       level: int, slides_dataset: SlidesDataset, figures_dir: Path,
+                                       metadata_cache: Optional[SlideMetadataCache] = None,
+                                       wsi_backend: WSIBackend = WSIBackend.CUCIM) -> None:
     for key in selected_slide_ids:
         print(f"Plotting {key} (tiles, thumbnails, attention heatmaps)...")
         key_dir = figures_dir / key
         key_dir.mkdir(parents=True, exist_ok=True)
         for slide_id in selected_slide_ids[key]:
             save_slide_thumbnail_and_heatmap(results, slide_id=slide_id, tile_size=tile_size, level=level,
-                                             slides_dataset=slides_dataset, key_dir=key_dir)
+                                             slides_dataset=slides_dataset, key_dir=key_dir,
+                                             metadata_cache=metadata_cache, wsi_backend=wsi_backend)
 
 
 def save_slide_thumbnail_and_heatmap(results: ResultsType, slide_id: str, tile_size: int, level: int,
-                                     slides_dataset: SlidesDataset, key_dir: Path) -> None:
+                                     slides_dataset: SlidesDataset, key_dir: Path,
+                                     metadata_cache: Optional[SlideMetadataCache] = None,
+                                     wsi_backend: WSIBackend = WSIBackend.CUCIM) -> None:
     slide_index = slides_dataset.dataset_df.index.get_loc(slide_id)
     assert isinstance(slide_index, int), f"Got non-unique slide ID: {slide_id}"
     slide_dict = slides_dataset[slide_index]
-    slide_dict = load_image_dict(slide_dict, level=level, margin=0)
+    slide_dict = load_image_dict(slide_dict, level=level, margin=0, metadata_cache=metadata_cache,
+                                 wsi_backend=wsi_backend)
     slide_image = slide_dict[SlideKey.IMAGE]
     location_bbox = slide_dict[SlideKey.LOCATION]
 
@@ -179,7 +187,8 @@ def save_slide_thumbnail_and_heatmap(results: ResultsType, slide_id: str, tile_s
     save_figure(fig=fig, figpath=key_dir / f'{slide_id}_thumbnail.png')
 
     fig = plot_heatmap_overlay(slide=slide_id, slide_image=slide_image, results=results,
-                               location_bbox=location_bbox, tile_size=tile_size, level=level)
+                               location_bbox=location_bbox, tile_size=tile_size, level=level,
+                               thumbnail_factor=slide_dict.get(SlideKey.THUMBNAIL_FACTOR, 1))
     save_figure(fig=fig, figpath=key_dir / f'{slide_id}_heatmap.png')
 
 
@@ -275,7 +284,9 @@ class DeepMILOutputsHandler:
 
     def __init__(self, outputs_root: Path, n_classes: int, tile_size: int, level: int,
                  slides_dataset: Optional[SlidesDataset], class_names: Optional[Sequence[str]],
-                 primary_val_metric: MetricsKey, maximise: bool) -> None:
+                 primary_val_metric: MetricsKey, maximise: bool,
+                 slide_metadata_cache: Optional[SlideMetadataCache] = None,
+                 wsi_backend: WSIBackend = WSIBackend.CUCIM) -> None:
         """
         :param outputs_root: Root directory where to save all produced outputs.
         :param n_classes: Number of MIL classes (set `n_classes=1` for binary).
@@ -286,6 +297,9 @@ class DeepMILOutputsHandler:
             If `None`, will return `('0', '1', ...)`.
         :param primary_val_metric: Name of the validation metric to track for saving best epoch outputs.
         :param maximise: Whether higher is better for `primary_val_metric`.
+        :param slide_metadata_cache: Optional cache of the slide thumbnails loaded for plotting heatmaps, so that
+            slides selected in multiple epochs are only read once.
+        :param wsi_backend: The library with which to read the slides for plotting thumbnails and heatmaps.
         """
         self.outputs_root = outputs_root
 
@@ -293,6 +307,8 @@ class DeepMILOutputsHandler:
         self.tile_size = tile_size
         self.level = level
         self.slides_dataset = slides_dataset
+        self.slide_metadata_cache = slide_metadata_cache
+        self.wsi_backend = wsi_backend
         self.class_names = validate_class_names(class_names, self.n_classes)
 
         self.outputs_policy = OutputsPolicy(outputs_root=outputs_root,
@@ -340,7 +356,9 @@ class DeepMILOutputsHandler:
 
         if self.slides_dataset is not None:
             save_slide_thumbnails_and_heatmaps(results, selected_slide_ids, tile_size=self.tile_size, level=self.level,
-                                               slides_dataset=self.slides_dataset, figures_dir=figures_dir)
+                                               slides_dataset=self.slides_dataset, figures_dir=figures_dir,
+                                               metadata_cache=self.slide_metadata_cache,
+                                               wsi_backend=self.wsi_backend)
 
         save_scores_histogram(results, figures_dir=figures_dir)
 
@@ -4,18 +4,27 @@
 #  ------------------------------------------------------------------------------------------
 
 import math
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Sequence
 
 import matplotlib.pyplot as plt
+import numpy as np
 from monai.data.dataset import Dataset
-from monai.data.image_reader import WSIReader
 from torch.utils.data import DataLoader
 
 from histopathology.datasets.panda_dataset import PandaDataset, LoadPandaROId
+from histopathology.preprocessing.slide_cache import SlideMetadata, SlideMetadataCache
+from histopathology.preprocessing.wsi_readers import WSIBackend, get_slide_reader
 from histopathology.utils.naming import SlideKey
 
 
-def load_image_dict(sample: dict, level: int, margin: int) -> Dict[SlideKey, Any]:
+# Maximum width and height of the slide thumbnails persisted in a `SlideMetadataCache` by `load_image_dict()`
+MAX_THUMBNAIL_SIZE = 1024
+
+
+def load_image_dict(sample: dict, level: int, margin: int,
+                    metadata_cache: Optional[SlideMetadataCache] = None,
+                    wsi_backend: WSIBackend = WSIBackend.CUCIM,
+                    max_thumbnail_size: int = MAX_THUMBNAIL_SIZE) -> Dict[SlideKey, Any]:
     """
     Load image from metadata dictionary
     :param sample: dict describing image metadata. Example:
@@ -27,15 +36,56 @@ def load_image_dict(sample: dict, level: int, margin: int) -> Dict[SlideKey, Any
          'gleason_score': ['0+0']}
     :param level: level of resolution to be loaded
     :param margin: margin to be included
+    :param metadata_cache: optional cache in which to persist a thumbnail of the loaded image and mask, so that the
+        slide is only read the first time it is loaded at this level and margin. If given, the returned image and
+        mask are this thumbnail, downsampled from `level` by the integer factor returned as `SlideKey.THUMBNAIL_FACTOR`
+    :param wsi_backend: library with which to read the slide and mask
+    :param max_thumbnail_size: maximum width and height of the cached thumbnail, in pixels
     :return: a dict containing the image data and metadata
     """
-    loader = LoadPandaROId(WSIReader('cuCIM'), level=level, margin=margin)
-    img = loader(sample)
-    return img
+    loader = LoadPandaROId(get_slide_reader(wsi_backend), level=level, margin=margin, metadata_cache=metadata_cache)
+    if metadata_cache is None:
+        return loader(sample)
+
+    def compute_metadata() -> SlideMetadata:
+        loaded_sample = loader(dict(sample))
+        mask_obj = loader.reader.read(sample[loader.mask_key])
+        metadata = loader.get_metadata(mask_obj, sample)  # already cached when loading the sample
+        mask_obj.close()
+        # The image and mask are cached together as a single (C + 1, H, W) array
+        image_and_mask = np.concatenate([loaded_sample[loader.image_key], loaded_sample[loader.mask_key]])
+        factor = get_thumbnail_factor(image_and_mask.shape[1:], max_thumbnail_size)
+        metadata.thumbnail = np.ascontiguousarray(image_and_mask[:, ::factor, ::factor])
+        return metadata
+
+    metadata = metadata_cache.get_or_compute([sample[loader.image_key], sample[loader.mask_key]], compute_metadata,
+                                             level=level, margin=margin, roi_image=True,
+                                             max_thumbnail_size=max_thumbnail_size)
+    assert metadata.bbox is not None and metadata.thumbnail is not None
+    scale = metadata.level_downsamples[level]
+    scaled_bbox = metadata.bbox / scale
+    return {**sample,
+            loader.image_key: metadata.thumbnail[:-1],
+            loader.mask_key: metadata.thumbnail[-1:],
+            'location': (metadata.bbox.x, metadata.bbox.y),
+            'size': (scaled_bbox.w, scaled_bbox.h),
+            'level': level,
+            'scale': scale,
+            SlideKey.THUMBNAIL_FACTOR: get_thumbnail_factor((scaled_bbox.h, scaled_bbox.w), max_thumbnail_size)}
+
+
+def get_thumbnail_factor(shape: Sequence[int], max_thumbnail_size: int) -> int:
+    """Get the smallest integer downsampling factor making an image fit in a square of a given size.
+
+    :param shape: Height and width of the image.
+    :param max_thumbnail_size: Maximum height and width of the downsampled image.
+    :return: The downsampling factor, at least 1.
+    """
+    return max(1, math.ceil(max(shape) / max_thumbnail_size))
 
 
 def plot_panda_data_sample(panda_dir: str, nsamples: int, ncols: int, level: int, margin: int,
-                           title_key: str = 'data_provider') -> None:
+                           title_key: str = 'data_provider', wsi_backend: WSIBackend = WSIBackend.CUCIM) -> None:
     """
     :param panda_dir: path to the dataset, it's expected a file called "train.csv" exists at the path.
         Look at the PandaDataset for more detail
@@ -44,6 +94,7 @@ def plot_panda_data_sample(panda_dir: str, nsamples: int, ncols: int, level: int
     :param level: level of resolution to be loaded
     :param margin: margin to be included
     :param title_key: metadata key in image_dict used to label each subplot
+    :param wsi_backend: library with which to read the slides and masks
     """
     panda_dataset = Dataset(PandaDataset(root=panda_dir))[:nsamples]  # type: ignore
     loader = DataLoader(panda_dataset, batch_size=1)
@@ -55,7 +106,7 @@ def plot_panda_data_sample(panda_dir: str, nsamples: int, ncols: int, level: int
         slide_id = dict_images[SlideKey.SLIDE_ID]
         title = dict_images[SlideKey.METADATA][title_key]
         print(f">>> Slide {slide_id}")
-        img = load_image_dict(dict_images, level=level, margin=margin)
+        img = load_image_dict(dict_images, level=level, margin=margin, wsi_backend=wsi_backend)
         ax.imshow(img[SlideKey.IMAGE].transpose(1, 2, 0))
         ax.set_title(title)
     fig.tight_layout()
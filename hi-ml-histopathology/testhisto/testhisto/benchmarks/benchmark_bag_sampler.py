@@ -0,0 +1,63 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""Benchmark the scaling of `BagSampler` with the number of tiles.
+
+Compares the bag index built by `BagSampler`, where each bag's tile indices are a slice of a sorted index, with the
+previous full scan of the bag indices for every bag (`np.where(bag_indices == bag_index)`). As a full epoch with the
+previous implementation is quadratic, its time per epoch is extrapolated from a subset of bags.
+
+Example:
+    python benchmark_bag_sampler.py --n_tiles 10000000 --n_bags 10000 --max_bag_size 1000
+"""
+import argparse
+import time
+from typing import Dict
+
+import numpy as np
+import torch
+from health_ml.utils.bag_utils import BagSampler
+
+
+def benchmark(n_tiles: int, n_bags: int, max_bag_size: int, n_scanned_bags: int, seed: int) -> Dict[str, float]:
+    rng = np.random.default_rng(seed)
+    bag_ids = rng.integers(n_bags, size=n_tiles)
+
+    start = time.perf_counter()
+    sampler = BagSampler(bag_ids, shuffle_bags=True, shuffle_samples=True, max_bag_size=max_bag_size,  # type: ignore
+                         generator=torch.Generator().manual_seed(seed))
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    n_sampled = sum(len(bag) for bag in sampler)
+    epoch_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for bag_index in range(n_scanned_bags):
+        np.where(sampler.bag_indices == bag_index)
+    scan_seconds = (time.perf_counter() - start) / n_scanned_bags * len(sampler)
+
+    results = {'build_s': build_seconds, 'epoch_s': epoch_seconds, 'epoch_s_before': scan_seconds}
+    print(f"{n_tiles} tiles in {len(sampler)} bags, {n_sampled} tiles sampled per epoch")
+    print(f"Bag index built in {build_seconds:.2f} s")
+    print(f"Epoch: {epoch_seconds:.2f} s ({len(sampler) / epoch_seconds:.0f} bags/s), "
+          f"previously {scan_seconds:.1f} s for the scans alone (extrapolated from {n_scanned_bags} bags)")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n_tiles", type=int, default=10_000_000, help="Number of synthetic tile rows")
+    parser.add_argument("--n_bags", type=int, default=10_000, help="Number of bags (slides)")
+    parser.add_argument("--max_bag_size", type=int, default=1000, help="Maximum number of tiles sampled per bag")
+    parser.add_argument("--n_scanned_bags", type=int, default=20,
+                        help="Number of bags scanned to extrapolate the time of the previous implementation")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the bag IDs and sampling")
+    args = parser.parse_args()
+    benchmark(n_tiles=args.n_tiles, n_bags=args.n_bags, max_bag_size=args.max_bag_size,
+              n_scanned_bags=args.n_scanned_bags, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
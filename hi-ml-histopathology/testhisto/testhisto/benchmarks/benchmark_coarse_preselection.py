@@ -0,0 +1,103 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""Benchmark coarse-level foreground pre-selection against tiling the full ROI, on a synthetic slide.
+
+Example:
+    python benchmark_coarse_preselection.py --width 16384 --height 12288 --level 1 --tile_size 224
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, Tuple
+
+import numpy as np
+from monai.data.image_reader import WSIReader
+
+from histopathology.preprocessing.create_tiles_dataset import generate_tiles, generate_tiles_preselected
+from histopathology.preprocessing.loading import LoadROId
+from histopathology.utils.naming import SlideKey
+from testhisto.utils.synthetic_slides import create_synthetic_pyramidal_tiff
+
+
+class CountingWSIReader(WSIReader):
+    """cuCIM `WSIReader` that keeps track of the total number of bytes of image data it has read."""
+
+    def __init__(self) -> None:
+        super().__init__('cuCIM')
+        self.bytes_read = 0
+
+    def get_data(self, *args: Any, **kwargs: Any) -> Tuple[np.ndarray, Dict]:
+        data, metadata = super().get_data(*args, **kwargs)
+        self.bytes_read += data.nbytes
+        return data, metadata
+
+
+def run_full_roi(slide_path: Path, level: int, tile_size: int, occupancy_threshold: float) -> Tuple[int, int]:
+    """Load the whole ROI with `LoadROId` and tile it with `generate_tiles()`.
+
+    :return: A tuple containing the number of selected tiles and the number of bytes read.
+    """
+    reader = CountingWSIReader()
+    sample = LoadROId(reader, level=level)({SlideKey.IMAGE: str(slide_path)})
+    tiles, _, _, _ = generate_tiles(sample[SlideKey.IMAGE], tile_size, sample[SlideKey.FOREGROUND_THRESHOLD],
+                                    occupancy_threshold)
+    return len(tiles), reader.bytes_read
+
+
+def run_preselected(slide_path: Path, level: int, tile_size: int, occupancy_threshold: float) -> Tuple[int, int]:
+    """Tile the ROI with `generate_tiles_preselected()`, reading only tiles with foreground at low resolution.
+
+    :return: A tuple containing the number of selected tiles and the number of bytes read.
+    """
+    reader = CountingWSIReader()
+    loader = LoadROId(reader, level=level)
+    image_obj = reader.read(str(slide_path))
+    coarse_mask, threshold, coarse_scale = loader.get_foreground_mask(image_obj)
+    level0_bbox = loader.get_roi_from_mask(coarse_mask, coarse_scale)
+    n_tiles = sum(len(tiles) for tiles, _, _, _ in
+                  generate_tiles_preselected(reader, image_obj, level, level0_bbox, tile_size, threshold,
+                                             occupancy_threshold, coarse_mask=coarse_mask,
+                                             coarse_scale=coarse_scale))
+    image_obj.close()
+    return n_tiles, reader.bytes_read
+
+
+def benchmark(slide_path: Path, level: int, tile_size: int, occupancy_threshold: float, repeats: int) -> None:
+    results = {}
+    for name, func in [("full ROI", run_full_roi), ("coarse pre-selection", run_preselected)]:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            n_tiles, bytes_read = func(slide_path, level, tile_size, occupancy_threshold)
+            times.append(time.perf_counter() - start)
+        results[name] = (n_tiles, bytes_read, min(times))
+        print(f"{name:>22}: {n_tiles} tiles, {bytes_read / 2**20:.1f} MiB read, {min(times):.3f} s")
+
+    full_bytes, full_time = results["full ROI"][1:]
+    preselected_bytes, preselected_time = results["coarse pre-selection"][1:]
+    print(f"Bytes read reduced by {100 * (1 - preselected_bytes / full_bytes):.1f}%, "
+          f"speedup {full_time / preselected_time:.2f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--width", type=int, default=8192, help="Width of the synthetic level-0 image")
+    parser.add_argument("--height", type=int, default=6144, help="Height of the synthetic level-0 image")
+    parser.add_argument("--level", type=int, default=0, help="Magnification level at which to tile the slide")
+    parser.add_argument("--tile_size", type=int, default=224, help="Tile size, in pixels")
+    parser.add_argument("--occupancy_threshold", type=float, default=0.1, help="Tile occupancy threshold")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of timed repetitions (best is reported)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        slide_path = Path(tmp_dir) / "synthetic_slide.tiff"
+        create_synthetic_pyramidal_tiff(slide_path, width=args.width, height=args.height)
+        benchmark(slide_path, level=args.level, tile_size=args.tile_size,
+                  occupancy_threshold=args.occupancy_threshold, repeats=args.repeats)
+
+
+if __name__ == '__main__':
+    main()
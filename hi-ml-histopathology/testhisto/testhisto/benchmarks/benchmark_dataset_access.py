@@ -0,0 +1,101 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""Benchmark row access and slide label aggregation of `TilesDataset`.
+
+Compares the columnar item access of `TilesDataset.__getitem__()` with the previous label-based lookup
+(`dataset_df.loc[tile_id].to_dict()`), and the vectorized `get_slide_labels()` and `get_class_weights()` with the
+previous groupby with `pd.Series.mode` and scikit-learn's `compute_class_weight()`, on a synthetic tiles dataset.
+
+Example:
+    python benchmark_dataset_access.py --n_slides 1000 --tiles_per_slide 1000
+"""
+import argparse
+import time
+from typing import Any, Callable, Dict
+
+import numpy as np
+import pandas as pd
+import torch
+from sklearn.utils.class_weight import compute_class_weight
+
+from histopathology.datasets.base_dataset import TilesDataset
+
+
+def create_tiles_df(n_slides: int, tiles_per_slide: int, seed: int) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    n_tiles = n_slides * tiles_per_slide
+    slide_ids = np.repeat([f"slide_{i:06d}" for i in range(n_slides)], tiles_per_slide)
+    slide_labels = np.repeat(rng.integers(2, size=n_slides), tiles_per_slide)
+    tile_x = rng.integers(100_000, size=n_tiles)
+    tile_y = rng.integers(100_000, size=n_tiles)
+    return pd.DataFrame({'slide_id': slide_ids,
+                         'tile_id': [f"{slide_id}.{x}x_{y}y" for slide_id, x, y in zip(slide_ids, tile_x, tile_y)],
+                         'image': [f"{slide_id}/{x}x_{y}y.png" for slide_id, x, y in zip(slide_ids, tile_x, tile_y)],
+                         'label': slide_labels,
+                         'split': 'train',
+                         'tile_x': tile_x,
+                         'tile_y': tile_y,
+                         'occupancy': rng.random(n_tiles)})
+
+
+def get_item_with_loc(dataset: TilesDataset, index: int) -> Dict[str, Any]:
+    """Previous implementation of `TilesDataset.__getitem__()`."""
+    tile_id = dataset.dataset_df.index[index]
+    sample = {dataset.TILE_ID_COLUMN: tile_id, **dataset.dataset_df.loc[tile_id].to_dict()}
+    sample[dataset.IMAGE_COLUMN] = str(dataset.root_dir / sample.pop(dataset.IMAGE_COLUMN))
+    sample[dataset.PATH_COLUMN] = sample[dataset.IMAGE_COLUMN]
+    return sample
+
+
+def get_class_weights_with_groupby(dataset: TilesDataset) -> torch.Tensor:
+    """Previous implementation of `TilesDataset.get_class_weights()`."""
+    slide_labels = dataset.dataset_df.groupby(dataset.SLIDE_ID_COLUMN, observed=True)[dataset.LABEL_COLUMN] \
+        .agg(pd.Series.mode)
+    classes = np.unique(slide_labels)
+    return torch.as_tensor(compute_class_weight(class_weight='balanced', classes=classes, y=slide_labels))
+
+
+def time_call(function: Callable[[], Any], repeats: int = 1) -> float:
+    best_seconds = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best_seconds = min(best_seconds, time.perf_counter() - start)
+    return best_seconds
+
+
+def benchmark(n_slides: int, tiles_per_slide: int, n_items: int, seed: int) -> Dict[str, float]:
+    dataset = TilesDataset("/tmp/tiles", dataset_df=create_tiles_df(n_slides, tiles_per_slide, seed))
+    print(f"Dataset of {len(dataset)} tiles from {n_slides} slides")
+    indices = np.random.default_rng(seed).integers(len(dataset), size=n_items).tolist()
+
+    build_seconds = time_call(lambda: dataset.table)
+    print(f"Columnar table built in {build_seconds:.2f} s")
+    results = {
+        'items_per_s_before': n_items / time_call(lambda: [get_item_with_loc(dataset, i) for i in indices]),
+        'items_per_s_after': n_items / time_call(lambda: [dataset[i] for i in indices]),
+        'class_weights_s_before': time_call(lambda: get_class_weights_with_groupby(dataset)),
+        'class_weights_s_after': time_call(dataset.get_class_weights),
+    }
+    assert torch.allclose(get_class_weights_with_groupby(dataset), dataset.get_class_weights())
+    print(f"Random item access: {results['items_per_s_before']:.0f} items/s before, "
+          f"{results['items_per_s_after']:.0f} items/s after")
+    print(f"Class weights: {results['class_weights_s_before']:.3f} s before, "
+          f"{results['class_weights_s_after']:.3f} s after")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n_slides", type=int, default=1000, help="Number of slides in the synthetic dataset")
+    parser.add_argument("--tiles_per_slide", type=int, default=1000, help="Number of tiles of each slide")
+    parser.add_argument("--n_items", type=int, default=20_000, help="Number of random items to access")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic dataset and item indices")
+    args = parser.parse_args()
+    benchmark(n_slides=args.n_slides, tiles_per_slide=args.tiles_per_slide, n_items=args.n_items, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""Benchmark the straggler time of distributed training with bags of very different sizes.
+
+Compares `TileBalancedDistributedSampler`, which balances the number of tiles across ranks, with the standard
+`DistributedSampler`, which splits bags across ranks by count only. Slide sizes are drawn from a log-normal
+distribution. As every step waits for the slowest rank, the time of a step is modelled as the largest number of tiles
+processed by any rank in that step, times a constant cost per tile. The straggler time is the time ranks spend waiting
+for the slowest one, i.e. the difference with the mean number of tiles per rank and step.
+
+Example:
+    python benchmark_distributed_bag_sampler.py --n_bags 1000 --world_size 8 --batch_size 4 --ms_per_tile 2
+"""
+import argparse
+from typing import Dict, List
+
+import numpy as np
+from torch.utils.data.distributed import DistributedSampler
+
+from health_ml.utils.bag_utils import TileBalancedDistributedSampler
+
+
+def _get_step_tiles(samplers: List[DistributedSampler], bag_sizes: np.ndarray, batch_size: int) -> np.ndarray:
+    """Get the number of tiles processed by each rank (columns) at each step (rows) of an epoch."""
+    rank_bag_sizes = np.stack([bag_sizes[list(sampler)] for sampler in samplers], axis=1)
+    n_steps = int(np.ceil(len(rank_bag_sizes) / batch_size))
+    return np.stack([rank_bag_sizes[step * batch_size:(step + 1) * batch_size].sum(axis=0)
+                     for step in range(n_steps)])
+
+
+def benchmark(n_bags: int, mean_log_size: float, sigma_log_size: float, max_bag_size: int, world_size: int,
+              batch_size: int, n_epochs: int, ms_per_tile: float, seed: int) -> Dict[str, float]:
+    rng = np.random.default_rng(seed)
+    bag_sizes = np.maximum(rng.lognormal(mean_log_size, sigma_log_size, size=n_bags).astype(np.int64), 1)
+    if max_bag_size > 0:
+        bag_sizes = np.minimum(bag_sizes, max_bag_size)
+    print(f"{n_bags} bags of {bag_sizes.min()} to {bag_sizes.max()} tiles (median {np.median(bag_sizes):.0f}), "
+          f"{world_size} ranks, {batch_size} bags per rank and step, {ms_per_tile} ms per tile")
+
+    results = {}
+    for name, sampler_cls in [('standard', DistributedSampler), ('balanced', TileBalancedDistributedSampler)]:
+        epoch_seconds, straggler_seconds, rank_imbalances = [], [], []
+        for epoch in range(n_epochs):
+            samplers = []
+            for rank in range(world_size):
+                kwargs = {'bag_sizes': bag_sizes} if sampler_cls is TileBalancedDistributedSampler else {}
+                sampler = sampler_cls(range(n_bags), num_replicas=world_size, rank=rank,  # type: ignore
+                                      shuffle=True, seed=seed, **kwargs)
+                sampler.set_epoch(epoch)
+                samplers.append(sampler)
+            step_tiles = _get_step_tiles(samplers, bag_sizes, batch_size)
+            epoch_seconds.append(step_tiles.max(axis=1).sum() * ms_per_tile / 1000)
+            straggler_seconds.append((step_tiles.max(axis=1) - step_tiles.mean(axis=1)).sum() * ms_per_tile / 1000)
+            rank_tiles = step_tiles.sum(axis=0)
+            rank_imbalances.append(rank_tiles.max() / rank_tiles.mean())
+        results[f'{name}_epoch_s'] = float(np.mean(epoch_seconds))
+        results[f'{name}_straggler_s'] = float(np.mean(straggler_seconds))
+        results[f'{name}_rank_imbalance'] = float(np.mean(rank_imbalances))
+        print(f"{name:>8}: epoch {results[f'{name}_epoch_s']:.1f} s, of which waiting for stragglers "
+              f"{results[f'{name}_straggler_s']:.1f} s; busiest rank has {results[f'{name}_rank_imbalance']:.2f}x "
+              f"the mean number of tiles")
+    ideal_seconds = bag_sizes.sum() / world_size * ms_per_tile / 1000
+    print(f"Ideal epoch time with perfect balance: {ideal_seconds:.1f} s. Straggler time reduced "
+          f"{results['standard_straggler_s'] / max(results['balanced_straggler_s'], 1e-9):.1f}x, epoch time "
+          f"{results['standard_epoch_s'] / results['balanced_epoch_s']:.2f}x faster")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n_bags", type=int, default=1000, help="Number of bags (slides)")
+    parser.add_argument("--mean_log_size", type=float, default=6.5,
+                        help="Mean of the logarithm of the number of tiles per bag")
+    parser.add_argument("--sigma_log_size", type=float, default=1.0,
+                        help="Standard deviation of the logarithm of the number of tiles per bag")
+    parser.add_argument("--max_bag_size", type=int, default=0, help="Maximum number of tiles per bag, 0 for none")
+    parser.add_argument("--world_size", type=int, default=8, help="Number of distributed ranks")
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of bags per rank and step")
+    parser.add_argument("--n_epochs", type=int, default=5, help="Number of epochs to average over")
+    parser.add_argument("--ms_per_tile", type=float, default=1.0, help="Modelled processing time per tile")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the bag sizes and shuffling")
+    args = parser.parse_args()
+    benchmark(n_bags=args.n_bags, mean_log_size=args.mean_log_size, sigma_log_size=args.sigma_log_size,
+              max_bag_size=args.max_bag_size, world_size=args.world_size, batch_size=args.batch_size,
+              n_epochs=args.n_epochs, ms_per_tile=args.ms_per_tile, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""Benchmark the slide preprocessing pipeline on a deterministic synthetic pyramidal TIFF.
+
+Each stage (`LoadROId`, `tile_array_2d`, `generate_tiles`, `save_image`, `merge_dataset_csv_files`, and the full
+`process_slide` pipeline) is timed separately, reporting tiles/s, MB/s read and peak RSS. Results can be saved
+as JSON and compared against a previously saved baseline, in which case the script exits with an error if any
+stage is slower than the baseline by more than the given tolerance.
+
+Example:
+    python benchmark_preprocessing.py --width 16384 --height 12288 --output results.json
+    python benchmark_preprocessing.py --width 16384 --height 12288 --baseline results.json --tolerance 1.2
+"""
+import argparse
+import json
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from histopathology.preprocessing import tiling
+from histopathology.preprocessing.create_tiles_dataset import (generate_tiles, merge_dataset_csv_files,
+                                                               process_slide, save_image)
+from histopathology.preprocessing.loading import LoadROId
+from histopathology.preprocessing.slide_scheduler import SlideManifest
+from histopathology.utils.naming import SlideKey
+from testhisto.benchmarks.benchmark_coarse_preselection import CountingWSIReader
+from testhisto.utils.synthetic_slides import create_synthetic_pyramidal_tiff
+
+MB = 2**20
+
+
+def reset_peak_rss() -> None:
+    """Reset the peak resident set size of this process, if supported by the OS (Linux only)."""
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+    except OSError:
+        pass
+
+
+def _read_proc_status_mb(field: str) -> Optional[float]:
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) * 2**10 / MB
+    except OSError:
+        pass
+    return None
+
+
+def get_current_rss() -> Optional[float]:
+    """Get the current resident set size of this process in MB, if supported by the OS (Linux only)."""
+    return _read_proc_status_mb("VmRSS")
+
+
+def get_peak_rss() -> float:
+    """Get the peak resident set size of this process since the last reset (or since start-up), in MB."""
+    peak_rss = _read_proc_status_mb("VmHWM")
+    if peak_rss is not None:
+        return peak_rss
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / MB if sys.platform == 'darwin' else max_rss * 2**10 / MB  # bytes on macOS, KiB on Linux
+
+
+def run_stage(results: Dict[str, Dict[str, float]], name: str, func: Callable[[], Any],
+              n_tiles: Optional[Callable[[Any], int]] = None,
+              reader: Optional[CountingWSIReader] = None) -> Any:
+    """Time a single benchmark stage and record its metrics in `results`.
+
+    :param results: Dictionary of results for all stages, updated in place.
+    :param name: Name of the stage.
+    :param func: Function running the stage.
+    :param n_tiles: Function computing the number of tiles processed from the output of `func`, if applicable.
+    :param reader: The reader used by `func`, if any, to report the amount of image data read.
+    :return: The output of `func`.
+    """
+    reset_peak_rss()
+    start_rss = get_current_rss()
+    if reader is not None:
+        reader.bytes_read = 0
+    start = time.perf_counter()
+    output = func()
+    seconds = time.perf_counter() - start
+    stage_results = {'seconds': seconds, 'peak_rss_mb': get_peak_rss()}
+    if start_rss is not None:
+        stage_results['peak_rss_increase_mb'] = stage_results['peak_rss_mb'] - start_rss
+    if n_tiles is not None:
+        stage_results['n_tiles'] = n_tiles(output)
+        stage_results['tiles_per_s'] = stage_results['n_tiles'] / seconds
+    if reader is not None:
+        stage_results['mb_read'] = reader.bytes_read / MB
+        stage_results['mb_per_s'] = stage_results['mb_read'] / seconds
+    results[name] = stage_results
+    metrics = ", ".join(f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}"
+                        for key, value in stage_results.items())
+    print(f"{name:>24}: {metrics}")
+    return output
+
+
+def benchmark(slide_path: Path, work_dir: Path, level: int, tile_size: int, occupancy_threshold: float,
+              n_merge_slides: int) -> Dict[str, Dict[str, float]]:
+    results: Dict[str, Dict[str, float]] = {}
+    reader = CountingWSIReader()
+    sample = {SlideKey.SLIDE_ID: "synthetic", SlideKey.IMAGE: str(slide_path), SlideKey.LABEL: 0,
+              SlideKey.METADATA: {}}
+
+    loader = LoadROId(reader, level=level)
+    roi_sample = run_stage(results, "LoadROId", lambda: loader(dict(sample)), reader=reader)
+    image, threshold = roi_sample[SlideKey.IMAGE], roi_sample[SlideKey.FOREGROUND_THRESHOLD]
+
+    run_stage(results, "tile_array_2d",
+              lambda: tiling.tile_array_2d(image, tile_size=tile_size, constant_values=255),
+              n_tiles=lambda output: len(output[0]))
+    tiles, _, _, _ = run_stage(results, "generate_tiles",
+                               lambda: generate_tiles(image, tile_size, threshold, occupancy_threshold),
+                               n_tiles=lambda output: len(output[0]))
+
+    tiles_dir = work_dir / "save_image"
+    tiles_dir.mkdir()
+    run_stage(results, "save_image",
+              lambda: [save_image(tile, tiles_dir / f"{i}.png") for i, tile in enumerate(tiles)], n_tiles=len)
+
+    output_dir = work_dir / "process_slide"
+    record = run_stage(results, "process_slide",
+                       lambda: process_slide(dict(sample), level=level, margin=0, tile_size=tile_size,
+                                             foreground_threshold=None, occupancy_threshold=occupancy_threshold,
+                                             output_dir=output_dir, reader=reader),
+                       n_tiles=lambda output: output['n_tiles'], reader=reader)
+
+    # Replicate the slide's CSV to simulate merging a dataset of many slides
+    slide_csv = output_dir / record['dataset_csv']
+    merge_dir = work_dir / "merge"
+    manifest = SlideManifest(merge_dir)
+    for i in range(n_merge_slides):
+        slide_id = f"slide_{i}"
+        (merge_dir / slide_id).mkdir(parents=True)
+        shutil.copy(slide_csv, merge_dir / slide_id / "dataset.csv")
+        manifest.mark_complete({**record, 'slide_id': slide_id, 'dataset_csv': f"{slide_id}/dataset.csv"})
+    run_stage(results, "merge_dataset_csv_files", lambda: merge_dataset_csv_files(merge_dir),
+              n_tiles=lambda _: record['n_tiles'] * n_merge_slides)
+    return results
+
+
+def compare_to_baseline(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+                        tolerance: float) -> List[str]:
+    """Compare the timings of each stage against a baseline.
+
+    :param results: Benchmark results for each stage.
+    :param baseline: Baseline results in the same format, e.g. loaded from a previous run's JSON output.
+    :param tolerance: Maximum allowed ratio between the current and baseline times of any stage.
+    :return: A list of the names of the stages that regressed.
+    """
+    regressions = []
+    for name, stage_results in results.items():
+        if name not in baseline:
+            continue
+        ratio = stage_results['seconds'] / baseline[name]['seconds']
+        rss_key = 'peak_rss_increase_mb' if 'peak_rss_increase_mb' in baseline[name] else 'peak_rss_mb'
+        rss_change = stage_results.get(rss_key, float('nan')) - baseline[name][rss_key]
+        regressed = ratio > tolerance
+        flag = " <- REGRESSION" if regressed else ""
+        print(f"{name:>24}: {ratio:.2f}x baseline time, {rss_change:+.1f} MB {rss_key}{flag}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=8192, help="Width of the synthetic level-0 image")
+    parser.add_argument("--height", type=int, default=6144, help="Height of the synthetic level-0 image")
+    parser.add_argument("--n_levels", type=int, default=3, help="Number of pyramid levels of the synthetic slide")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for generating the synthetic slide")
+    parser.add_argument("--level", type=int, default=0, help="Magnification level at which to tile the slide")
+    parser.add_argument("--tile_size", type=int, default=224, help="Tile size, in pixels")
+    parser.add_argument("--occupancy_threshold", type=float, default=0.1, help="Tile occupancy threshold")
+    parser.add_argument("--n_merge_slides", type=int, default=100,
+                        help="Number of per-slide CSV files to merge in the merging stage")
+    parser.add_argument("--output", type=Path, help="Path of a JSON file in which to save the results")
+    parser.add_argument("--baseline", type=Path, help="Path of a JSON file of baseline results to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.2,
+                        help="Maximum allowed ratio of current to baseline time for any stage")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(tmp_dir)
+        slide_path = work_dir / "synthetic_slide.tiff"
+        create_synthetic_pyramidal_tiff(slide_path, width=args.width, height=args.height, n_levels=args.n_levels,
+                                        seed=args.seed)
+        results = benchmark(slide_path, work_dir, level=args.level, tile_size=args.tile_size,
+                            occupancy_threshold=args.occupancy_threshold, n_merge_slides=args.n_merge_slides)
+
+    config: Dict[str, Any] = {key: str(value) if isinstance(value, Path) else value
+                              for key, value in vars(args).items()}
+    config['platform'] = platform.platform()
+    if args.output:
+        args.output.write_text(json.dumps({'config': config, 'results': results}, indent=2))
+        print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        for key in ['width', 'height', 'n_levels', 'seed', 'level', 'tile_size', 'occupancy_threshold']:
+            if baseline['config'].get(key) != config[key]:
+                print(f"Warning: baseline was run with {key}={baseline['config'].get(key)}, now {config[key]}")
+        regressions = compare_to_baseline(results, baseline['results'], args.tolerance)
+        if regressions:
+            sys.exit(f"Performance regression in stages: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""Benchmark the batched stain normalization transforms against the per-image `StainNormalization`.
+
+Tiles are cut from a deterministic synthetic slide, so that they contain both tissue and white background, and are
+normalized as a single (N, C, H, W) bag, as they would be after `LoadTilesBatchd`. The batched transforms are also
+timed on GPU if one is available.
+
+Example:
+    python benchmark_stain_normalization.py --n_tiles 1000 --tile_size 224
+"""
+import argparse
+import time
+from typing import Callable, Dict
+
+import numpy as np
+import torch
+from health_ml.utils.data_augmentations import (BatchMacenkoStainNormalization, BatchStainNormalization,
+                                                StainNormalization)
+
+from testhisto.utils.synthetic_slides import create_synthetic_slide_array
+
+
+def create_tiles(n_tiles: int, tile_size: int, seed: int) -> torch.Tensor:
+    """Cut tiles at random locations of a synthetic slide, as a float (N, C, H, W) tensor in [0, 1]."""
+    image = create_synthetic_slide_array(width=8 * tile_size, height=8 * tile_size, seed=seed)
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, image.shape[0] - tile_size, size=n_tiles)
+    cols = rng.integers(0, image.shape[1] - tile_size, size=n_tiles)
+    tiles = np.stack([image[row:row + tile_size, col:col + tile_size] for row, col in zip(rows, cols)])
+    return torch.from_numpy(tiles).permute(0, 3, 1, 2).float() / 255
+
+
+def time_transform(transform: Callable[[torch.Tensor], torch.Tensor], tiles: torch.Tensor, repeats: int) -> float:
+    """Return the best wall-clock time in seconds of applying a transform to a bag of tiles."""
+    transform(tiles[:2])  # warm-up, e.g. CUDA context and kernels
+    best_seconds = float('inf')
+    for _ in range(repeats):
+        if tiles.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        transform(tiles)
+        if tiles.is_cuda:
+            torch.cuda.synchronize()
+        best_seconds = min(best_seconds, time.perf_counter() - start)
+    return best_seconds
+
+
+def benchmark(n_tiles: int, tile_size: int, repeats: int, seed: int) -> Dict[str, float]:
+    tiles = create_tiles(n_tiles, tile_size, seed)
+    per_image = StainNormalization()
+
+    def normalize_per_image(tiles: torch.Tensor) -> torch.Tensor:
+        return torch.cat([per_image(tile.unsqueeze(0)) for tile in tiles])
+
+    transforms: Dict[str, Callable[[torch.Tensor], torch.Tensor]] = {
+        'StainNormalization (per image)': normalize_per_image,
+        'BatchStainNormalization': BatchStainNormalization(),
+        'BatchMacenkoStainNormalization': BatchMacenkoStainNormalization(),
+    }
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    results = {}
+    for name, transform in transforms.items():
+        for device in devices:
+            if device == 'cuda' and transform is normalize_per_image:
+                continue
+            seconds = time_transform(transform, tiles.to(device), repeats)
+            results[f"{name} [{device}]"] = n_tiles / seconds
+            print(f"{name + ' [' + device + ']':>42}: {1000 * seconds:9.1f} ms, {n_tiles / seconds:10.1f} tiles/s")
+
+    expected = normalize_per_image(tiles)
+    error = (BatchStainNormalization()(tiles) - expected).abs()
+    print(f"BatchStainNormalization vs StainNormalization: max abs error {255 * error.max():.2f}/255, "
+          f"mean abs error {255 * error.mean():.3f}/255")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n_tiles", type=int, default=1000, help="Number of tiles in the bag")
+    parser.add_argument("--tile_size", type=int, default=224, help="Size of the square tiles, in pixels")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of timed repetitions (best is reported)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic slide and tile locations")
+    args = parser.parse_args()
+    benchmark(n_tiles=args.n_tiles, tile_size=args.tile_size, repeats=args.repeats, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
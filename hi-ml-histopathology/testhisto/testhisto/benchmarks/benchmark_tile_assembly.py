@@ -0,0 +1,74 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""Benchmark vectorized and out-of-core tile assembly against copying tiles one by one.
+
+Example:
+    python benchmark_tile_assembly.py --n_tiles 100000 --tile_size 16 --occupancy 0.5
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Tuple
+
+import numpy as np
+
+from histopathology.preprocessing.tiling import (_get_assembly_layout, _scatter_tiles_loop, assemble_tiles_2d,
+                                                 assemble_tiles_2d_out_of_core)
+
+
+def assemble_tiles_2d_loop(tiles: np.ndarray, coords: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Reference implementation, copying each tile in a Python loop."""
+    output_shape, offset, _ = _get_assembly_layout(tiles, coords)
+    array = np.full(output_shape, np.nan)
+    _scatter_tiles_loop(array, tiles, coords, offset)
+    return array, offset
+
+
+def time_best(func: Callable[[], Tuple[np.ndarray, np.ndarray]], repeats: int) -> Tuple[float, np.ndarray]:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        array, _ = func()
+        times.append(time.perf_counter() - start)
+    return min(times), array
+
+
+def benchmark(n_tiles: int, tile_size: int, channels: int, occupancy: float, repeats: int) -> None:
+    rng = np.random.default_rng(0)
+    n_grid = int(np.ceil(n_tiles / occupancy))
+    grid_w = int(np.ceil(np.sqrt(n_grid)))
+    grid_indices = rng.choice(grid_w * grid_w, size=n_tiles, replace=False)
+    coords = tile_size * np.stack([grid_indices % grid_w, grid_indices // grid_w], axis=-1)
+    tiles = rng.random((n_tiles, channels, tile_size, tile_size), dtype=np.float32)
+    print(f"{n_tiles} tiles of size {channels}x{tile_size}x{tile_size} on a {grid_w}x{grid_w} grid")
+
+    loop_time, expected = time_best(lambda: assemble_tiles_2d_loop(tiles, coords), repeats)
+    print(f"{'loop':>12}: {loop_time:.3f} s")
+    vectorized_time, array = time_best(lambda: assemble_tiles_2d(tiles, coords), repeats)
+    assert np.array_equal(array, expected, equal_nan=True)
+    print(f"{'vectorized':>12}: {vectorized_time:.3f} s ({loop_time / vectorized_time:.1f}x)")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_path = Path(tmp_dir) / "assembled.npy"
+        memmap_time, array = time_best(lambda: assemble_tiles_2d_out_of_core(tiles, coords, output_path), repeats)
+        assert np.array_equal(array, expected, equal_nan=True)
+        del array
+    print(f"{'out-of-core':>12}: {memmap_time:.3f} s ({loop_time / memmap_time:.1f}x)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n_tiles", type=int, default=20000, help="Number of tiles to assemble")
+    parser.add_argument("--tile_size", type=int, default=16, help="Tile size, in pixels")
+    parser.add_argument("--channels", type=int, default=1, help="Number of channels per tile")
+    parser.add_argument("--occupancy", type=float, default=0.5, help="Fraction of grid positions with a tile")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of timed repetitions (best is reported)")
+    args = parser.parse_args()
+    benchmark(args.n_tiles, args.tile_size, args.channels, args.occupancy, args.repeats)
+
+
+if __name__ == '__main__':
+    main()
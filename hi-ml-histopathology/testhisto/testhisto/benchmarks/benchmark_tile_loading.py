@@ -0,0 +1,66 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""Benchmark the loading of a bag of PNG tiles with `LoadTilesBatchd`.
+
+Compares the serial loading into a float tensor (default) with the decoding into a preallocated `uint8` tensor,
+serially and with a thread pool. Synthetic tiles are written to a temporary directory; real tiles compress better
+and therefore decode faster, so absolute numbers are indicative only.
+
+Example:
+    python benchmark_tile_loading.py --n_tiles 1000 --tile_size 224 --num_threads 4
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+from PIL import Image
+
+from histopathology.models.transforms import LoadTilesBatchd
+
+
+def benchmark(n_tiles: int, tile_size: int, num_threads: int, n_repeats: int, seed: int) -> Dict[str, float]:
+    rng = np.random.default_rng(seed)
+    # Smooth random tiles, which compress more like real tissue than white noise
+    tile = rng.integers(0, 256, size=(tile_size // 8, tile_size // 8, 3), dtype=np.uint8)
+    tile = np.repeat(np.repeat(tile, 8, axis=0), 8, axis=1)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = [Path(tmp_dir) / f"{i}.png" for i in range(n_tiles)]
+        for path in paths:
+            Image.fromarray(np.roll(tile, rng.integers(tile_size), axis=1)).save(path)
+        batch = {'image': paths}
+
+        loaders = {'float_serial': LoadTilesBatchd('image'),
+                   'uint8_serial': LoadTilesBatchd('image', as_uint8=True),
+                   f'uint8_{num_threads}_threads': LoadTilesBatchd('image', as_uint8=True, num_threads=num_threads)}
+        for name, loader in loaders.items():
+            loader(batch)  # warm up the file system cache
+            start = time.perf_counter()
+            for _ in range(n_repeats):
+                images = loader(batch)['image']
+            seconds = (time.perf_counter() - start) / n_repeats
+            results[name] = n_tiles / seconds
+            size_mib = images.element_size() * images.numel() / 2**20
+            print(f"{name:>20}: {n_tiles / seconds:8.0f} tiles/s, {size_mib:6.0f} MiB {images.dtype}")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n_tiles", type=int, default=1000, help="Number of tiles in the bag")
+    parser.add_argument("--tile_size", type=int, default=224, help="Tile width/height, in pixels")
+    parser.add_argument("--num_threads", type=int, default=4, help="Number of decoding threads")
+    parser.add_argument("--n_repeats", type=int, default=3, help="Number of timed repetitions per loader")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic tiles")
+    args = parser.parse_args()
+    benchmark(n_tiles=args.n_tiles, tile_size=args.tile_size, num_threads=args.num_threads,
+              n_repeats=args.n_repeats, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""Benchmark tile saving throughput for different codecs and numbers of writer threads.
+
+Example:
+    python benchmark_tile_writer.py --n_tiles 1000 --tile_size 224 --threads 0 4 8
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+from histopathology.preprocessing import tiling
+from histopathology.preprocessing.create_tiles_dataset import AsyncTileWriter, TileCodec
+from testhisto.utils.synthetic_slides import create_synthetic_slide_array
+
+CODECS: List[Tuple[TileCodec, Optional[int]]] = [(TileCodec.PNG, None), (TileCodec.PNG, 1),
+                                                 (TileCodec.WEBP, None), (TileCodec.JPEG, 90)]
+
+
+def benchmark(n_tiles: int, tile_size: int, threads: Sequence[int]) -> None:
+    n_tiles_w = 16
+    n_tiles_h = -(-n_tiles // n_tiles_w)
+    image = create_synthetic_slide_array(n_tiles_w * tile_size, n_tiles_h * tile_size, n_blobs=32)
+    tiles, _ = tiling.tile_array_2d(image, tile_size, channels_first=False)
+    tiles = tiles[:n_tiles].transpose(0, 3, 1, 2)  # (N, C, H, W)
+
+    for codec, quality in CODECS:
+        for num_threads in threads:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                start = time.perf_counter()
+                with AsyncTileWriter(codec, quality=quality, num_threads=num_threads) as writer:
+                    for i, tile in enumerate(tiles):
+                        writer.submit(tile, Path(tmp_dir) / f"{i}{writer.extension}", on_done=lambda error: None)
+                elapsed = time.perf_counter() - start
+                size = sum(path.stat().st_size for path in Path(tmp_dir).iterdir())
+            print(f"{codec.value:>5} (quality={quality}), {num_threads} thread(s): "
+                  f"{len(tiles) / elapsed:.1f} tiles/s, {size / len(tiles) / 2**10:.1f} KiB/tile")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n_tiles", type=int, default=512, help="Number of tiles to save")
+    parser.add_argument("--tile_size", type=int, default=224, help="Tile size, in pixels")
+    parser.add_argument("--threads", type=int, nargs='+', default=[0, 4], help="Numbers of writer threads to test")
+    args = parser.parse_args()
+    benchmark(args.n_tiles, args.tile_size, args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""Benchmark the whole-slide reader backends on random small-region reads and on large ROI reads.
+
+By default, a deterministic synthetic pyramidal TIFF is used. Pass `--slide` to measure the backends on a slide
+in the format of the dataset at hand, and select the fastest one with the `wsi_backend` option of the
+preprocessing and visualization functions. Backends whose library is not installed are skipped.
+
+Example:
+    python benchmark_wsi_readers.py --slide /tmp/datasets/PANDA/train_images/<slide_id>.tiff --level 1
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from histopathology.preprocessing.wsi_readers import SlideReader, WSIBackend, get_slide_reader
+from testhisto.utils.synthetic_slides import create_synthetic_pyramidal_tiff
+
+MB = 2**20
+
+
+def get_random_locations(level_dims: List[Tuple[int, int]], level: int, downsample: float, region_size: int,
+                         n_reads: int, seed: int) -> List[Tuple[int, int]]:
+    """Sample random level-0 (row, column) locations of regions lying within the slide at the given level."""
+    width, height = level_dims[level]
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, max(height - region_size, 1), size=n_reads)
+    cols = rng.integers(0, max(width - region_size, 1), size=n_reads)
+    return [(int(row * downsample), int(col * downsample)) for row, col in zip(rows, cols)]
+
+
+def benchmark_backend(reader: SlideReader, slide_path: Path, level: int, region_size: int, n_reads: int,
+                      repeats: int, seed: int) -> Dict[str, float]:
+    start = time.perf_counter()
+    slide_obj = reader.read(slide_path)
+    open_seconds = time.perf_counter() - start
+    level_dims = reader.get_level_dims(slide_obj)
+    downsample = reader.get_level_downsamples(slide_obj)[level]
+    locations = get_random_locations(level_dims, level, downsample, region_size, n_reads, seed)
+
+    random_seconds = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for location in locations:
+            reader.read_region(slide_obj, location=location, size=(region_size, region_size), level=level)
+        random_seconds = min(random_seconds, time.perf_counter() - start)
+
+    roi_seconds = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        roi, _ = reader.get_data(slide_obj, level=level)
+        roi_seconds = min(roi_seconds, time.perf_counter() - start)
+    slide_obj.close()
+
+    random_mb = n_reads * 3 * region_size**2 / MB
+    return {'open_ms': 1000 * open_seconds,
+            'random_reads_per_s': n_reads / random_seconds,
+            'random_mb_per_s': random_mb / random_seconds,
+            'roi_mb_per_s': roi.nbytes / MB / roi_seconds}
+
+
+def benchmark(slide_path: Path, level: int, region_size: int, n_reads: int, repeats: int,
+              seed: int) -> Dict[WSIBackend, Dict[str, float]]:
+    results = {}
+    for backend in WSIBackend:
+        try:
+            reader = get_slide_reader(backend)
+        except ImportError as e:
+            print(f"{backend.value:>10}: skipped ({e})")
+            continue
+        results[backend] = benchmark_backend(reader, slide_path, level=level, region_size=region_size,
+                                             n_reads=n_reads, repeats=repeats, seed=seed)
+        print(f"{backend.value:>10}: " + ", ".join(f"{key}={value:.1f}" for key, value in results[backend].items()))
+
+    if results:
+        best_random = max(results, key=lambda backend: results[backend]['random_reads_per_s'])
+        best_roi = max(results, key=lambda backend: results[backend]['roi_mb_per_s'])
+        print(f"Fastest backend for random {region_size}x{region_size} reads: {best_random.value}")
+        print(f"Fastest backend for whole-ROI reads: {best_roi.value}")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--slide", type=Path, help="Slide to benchmark on. By default, a synthetic TIFF is used")
+    parser.add_argument("--width", type=int, default=8192, help="Width of the synthetic level-0 image")
+    parser.add_argument("--height", type=int, default=6144, help="Height of the synthetic level-0 image")
+    parser.add_argument("--n_levels", type=int, default=3, help="Number of pyramid levels of the synthetic slide")
+    parser.add_argument("--level", type=int, default=0, help="Magnification level at which to read regions")
+    parser.add_argument("--region_size", type=int, default=224, help="Size of the random regions, in pixels")
+    parser.add_argument("--n_reads", type=int, default=500, help="Number of random regions to read")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of timed repetitions (best is reported)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic slide and random locations")
+    args = parser.parse_args()
+
+    kwargs = dict(level=args.level, region_size=args.region_size, n_reads=args.n_reads, repeats=args.repeats,
+                  seed=args.seed)
+    if args.slide is not None:
+        benchmark(args.slide, **kwargs)  # type: ignore
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            slide_path = Path(tmp_dir) / "synthetic_slide.tiff"
+            create_synthetic_pyramidal_tiff(slide_path, width=args.width, height=args.height,
+                                            n_levels=args.n_levels, seed=args.seed)
+            benchmark(slide_path, **kwargs)  # type: ignore
+
+
+if __name__ == '__main__':
+    main()
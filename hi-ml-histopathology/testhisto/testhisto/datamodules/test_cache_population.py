@@ -0,0 +1,87 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from pathlib import Path
+from typing import Callable, Tuple
+
+import numpy as np
+import pytest
+import torch
+from monai.data.dataset import CacheDataset, Dataset
+from monai.transforms import Compose
+from PIL import Image
+
+from health_ml.utils.bag_utils import BagDataset
+from histopathology.datamodules.cache_population import (PrecomputedCacheDataset, iterate_transformed_bags,
+                                                         split_transform)
+from histopathology.models.encoders import TileEncoder
+from histopathology.models.transforms import EncodeTilesBatchd, LoadTilesBatchd, Subsampled
+
+
+class _LinearEncoder(TileEncoder):
+    def _get_encoder(self) -> Tuple[Callable, int]:
+        return torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(int(np.prod(self.input_dim)), 4)), 4
+
+
+def _create_bag_dataset(tmp_path: Path, n_slides: int = 6, max_bag_size: int = 5) -> BagDataset:
+    rng = np.random.default_rng(0)
+    tiles = []
+    for slide_id in range(n_slides):
+        for tile_index in range(int(rng.integers(1, 10))):
+            image_path = tmp_path / f"{slide_id}_{tile_index}.png"
+            Image.fromarray(rng.integers(256, size=(8, 8, 3), dtype=np.uint8)).save(image_path)
+            tiles.append({'slide_id': slide_id, 'image': str(image_path), 'label': slide_id % 2})
+    return BagDataset(tiles, bag_ids=[tile['slide_id'] for tile in tiles], shuffle_samples=True,  # type: ignore
+                      max_bag_size=max_bag_size, generator=torch.Generator().manual_seed(0))
+
+
+def _get_transform() -> Compose:
+    torch.manual_seed(0)
+    encoder = _LinearEncoder(tile_size=8)
+    return Compose([LoadTilesBatchd('image', as_uint8=True), EncodeTilesBatchd('image', encoder, chunk_size=4)])
+
+
+def test_split_transform() -> None:
+    transform = _get_transform()
+    load_transforms, encode_transform, post_transforms = split_transform(transform)  # type: ignore
+    assert load_transforms == [transform.transforms[0]]
+    assert encode_transform is transform.transforms[1]
+    assert post_transforms == []
+    assert split_transform(Compose([transform, Subsampled('image', max_size=2)])) is None
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+@pytest.mark.parametrize('start_index', [0, 2])
+def test_iterate_transformed_bags(tmp_path: Path, num_workers: int, start_index: int) -> None:
+    transform = _get_transform()
+    expected_bag_dataset = _create_bag_dataset(tmp_path)
+    expected_bags = list(Dataset(expected_bag_dataset, transform))  # type: ignore
+
+    bag_dataset = _create_bag_dataset(tmp_path)
+    bags = list(iterate_transformed_bags(bag_dataset, transform, num_workers=num_workers, start_index=start_index,
+                                         tiles_per_batch=8, cpu_threads=3, progress=False))
+    assert len(bags) == len(expected_bags) - start_index
+    for bag, expected_bag in zip(bags, expected_bags[start_index:]):
+        assert bag.keys() == expected_bag.keys()
+        assert torch.allclose(bag['image'], expected_bag['image'], atol=1e-6)
+        assert torch.equal(bag['slide_id'], expected_bag['slide_id'])
+    # The random generator of the bag sampler is left in the same state as when loading bags sequentially
+    assert torch.equal(bag_dataset.bag_sampler.generator.get_state(),  # type: ignore
+                       expected_bag_dataset.bag_sampler.generator.get_state())  # type: ignore
+
+    with pytest.raises(ValueError, match="random transforms"):
+        next(iterate_transformed_bags(bag_dataset, Compose([Subsampled('image', max_size=2)]), num_workers=0))
+
+
+def test_precomputed_cache_dataset(tmp_path: Path) -> None:
+    transform = _get_transform()
+    expected_dataset = CacheDataset(_create_bag_dataset(tmp_path), transform, progress=False)  # type: ignore
+    bag_dataset = _create_bag_dataset(tmp_path)
+    cache = list(iterate_transformed_bags(bag_dataset, transform, num_workers=0, progress=False))
+    dataset = PrecomputedCacheDataset(bag_dataset, transform, cache)
+    assert len(dataset) == len(expected_dataset)
+    for bag, expected_bag in zip(dataset, expected_dataset):  # type: ignore
+        assert torch.allclose(bag['image'], expected_bag['image'], atol=1e-6)
+    with pytest.raises(ValueError, match="Expected 6 cached items"):
+        PrecomputedCacheDataset(bag_dataset, transform, cache[1:])
@@ -5,7 +5,7 @@
 
 import shutil
 from pathlib import Path
-from typing import Any, Tuple
+from typing import Any, Dict, List, Tuple
 
 import numpy as np
 import pandas as pd
@@ -13,6 +13,7 @@ import pytest
 import torch
 from torch.utils.data import DataLoader
 
+from histopathology.datamodules import base_module
 from histopathology.datamodules.base_module import CacheMode, CacheLocation, TilesDataModule
 from histopathology.datasets.base_dataset import TilesDataset
 
@@ -97,7 +98,7 @@ def _get_datamodule(cache_mode: CacheMode, precache_location: CacheLocation,
                     cache_dir_provided: bool, data_dir: Path,
                     max_bag_size: int = 0, max_bag_size_inf: int = 0) -> TilesDataModule:
     if (cache_mode is CacheMode.NONE and precache_location is not CacheLocation.NONE) \
-            or (cache_mode is CacheMode.DISK and not cache_dir_provided) \
+            or (cache_mode in [CacheMode.DISK, CacheMode.MEMMAP] and not cache_dir_provided) \
             or (precache_location is not CacheLocation.NONE and not cache_dir_provided):
         pytest.skip("Unsupported combination of caching arguments")
 
@@ -118,7 +119,7 @@ def _get_datamodule(cache_mode: CacheMode, precache_location: CacheLocation,
                                max_bag_size_inf=max_bag_size_inf)
 
 
-@pytest.mark.parametrize('cache_mode', [CacheMode.MEMORY, CacheMode.DISK, CacheMode.NONE])
+@pytest.mark.parametrize('cache_mode', [CacheMode.MEMORY, CacheMode.DISK, CacheMode.MEMMAP, CacheMode.NONE])
 @pytest.mark.parametrize('precache_location', [CacheLocation.NONE, CacheLocation.CPU, CacheLocation.SAME])
 @pytest.mark.parametrize('cache_dir_provided', [True, False])
 def test_caching_consistency(mock_data_dir: Path, cache_mode: CacheMode, precache_location: CacheLocation,
@@ -158,6 +159,7 @@ def test_caching_consistency(mock_data_dir: Path, cache_mode: CacheMode, precach
                           (CacheMode.MEMORY, CacheLocation.SAME, True),
                           (CacheMode.MEMORY, CacheLocation.CPU, True),
                           (CacheMode.MEMORY, CacheLocation.NONE, False),
+                          (CacheMode.MEMMAP, CacheLocation.NONE, True),
                           (CacheMode.NONE, CacheLocation.NONE, False)
                           ])
 def test_tile_id_coverage(mock_data_dir: Path, cache_mode: CacheMode, precache_location: CacheLocation,
@@ -194,6 +196,7 @@ def compare_bag_size(dl: DataLoader, bag_size: int) -> None:
                           (CacheMode.MEMORY, CacheLocation.SAME, True),
                           (CacheMode.MEMORY, CacheLocation.CPU, True),
                           (CacheMode.MEMORY, CacheLocation.NONE, False),
+                          (CacheMode.MEMMAP, CacheLocation.NONE, True),
                           (CacheMode.NONE, CacheLocation.NONE, False)
                           ])
 def test_max_bag_size(mock_data_dir: Path, cache_mode: CacheMode, precache_location: CacheLocation,
@@ -211,3 +214,138 @@ def test_max_bag_size(mock_data_dir: Path, cache_mode: CacheMode, precache_locat
     compare_bag_size(train_dataloader, 10)
     compare_bag_size(val_dataloader, 20)
     compare_bag_size(test_dataloader, 20)
+
+
+@pytest.mark.parametrize('cache_mode', [CacheMode.MEMORY, CacheMode.DISK, CacheMode.MEMMAP])
+def test_cache_keys_and_eviction(mock_data_dir: Path, cache_mode: CacheMode) -> None:
+    cache_dir = mock_data_dir / f"shared_cache_{cache_mode.value}"
+
+    def prepare_datamodule(max_bag_size: int, max_cache_size_gb: float = 0,
+                           cache_eviction_grace_hours: float = 0) -> TilesDataModule:
+        datamodule = MockTilesDataModule(root_path=mock_data_dir, transform=noop_transform, seed=0,
+                                         cache_mode=cache_mode, precache_location=CacheLocation.CPU,
+                                         cache_dir=cache_dir, max_bag_size=max_bag_size,
+                                         max_cache_size_gb=max_cache_size_gb,
+                                         cache_eviction_grace_hours=cache_eviction_grace_hours)
+        datamodule.prepare_data()
+        return datamodule
+
+    datamodule = prepare_datamodule(max_bag_size=5)
+    entries = set(cache_dir.iterdir())
+    train_entries = set(datamodule._get_cache_entries(datamodule.train_dataset, 'train', shuffle=True))
+    assert train_entries and train_entries <= entries
+    # The cache is reused by an identical data module, e.g. in another experiment
+    prepare_datamodule(max_bag_size=5)
+    assert set(cache_dir.iterdir()) == entries
+    # Different bag sampling parameters only create new cache entries for the training split
+    datamodule = prepare_datamodule(max_bag_size=10)
+    new_train_entries = set(datamodule._get_cache_entries(datamodule.train_dataset, 'train', shuffle=True))
+    assert set(cache_dir.iterdir()) == entries | new_train_entries
+    # Entries recently used, e.g. by another running experiment, are not evicted
+    prepare_datamodule(max_bag_size=10, max_cache_size_gb=1e-9, cache_eviction_grace_hours=1)
+    assert set(cache_dir.iterdir()) == entries | new_train_entries
+    # The least recently used entries are evicted to satisfy the quota, but the ones in use are kept
+    prepare_datamodule(max_bag_size=10, max_cache_size_gb=1e-9)
+    assert set(cache_dir.iterdir()) == (entries - train_entries) | new_train_entries
+
+
+def test_dataset_fingerprint_is_memoised(mock_data_dir: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    hashed_dataframes: List[pd.DataFrame] = []
+
+    def get_dataframe_fingerprint(df: pd.DataFrame) -> str:
+        hashed_dataframes.append(df)
+        return str(len(hashed_dataframes))
+
+    monkeypatch.setattr(base_module, 'get_dataframe_fingerprint', get_dataframe_fingerprint)
+    datamodule = MockTilesDataModule(root_path=mock_data_dir, transform=noop_transform, seed=0,
+                                     cache_mode=CacheMode.MEMORY, precache_location=CacheLocation.CPU,
+                                     cache_dir=mock_data_dir / "cache_fingerprint", max_cache_size_gb=1)
+    datamodule.prepare_data()
+    datamodule.train_dataloader()
+    # Each split is hashed once, although its cache key is needed several times
+    assert len(hashed_dataframes) == 3
+    key = datamodule._get_cache_key(datamodule.train_dataset, 'train', shuffle=True)
+    datamodule.train_dataset.dataset_df = datamodule.train_dataset.dataset_df.copy()
+    assert datamodule._get_cache_key(datamodule.train_dataset, 'train', shuffle=True) != key
+
+
+@pytest.mark.parametrize('cache_mode', [CacheMode.MEMORY, CacheMode.DISK, CacheMode.MEMMAP])
+def test_subsample_after_caching(mock_data_dir: Path, cache_mode: CacheMode) -> None:
+    max_bag_size = 3
+    datamodule = MockTilesDataModule(root_path=mock_data_dir, transform=noop_transform, seed=0, batch_size=2,
+                                     cache_mode=cache_mode, precache_location=CacheLocation.CPU,
+                                     cache_dir=mock_data_dir / f"cache_{cache_mode.value}", max_bag_size=max_bag_size,
+                                     subsample_after_caching=True)
+    datamodule.prepare_data()
+    train_dataloader = datamodule.train_dataloader()
+    tile_id_key = MockTilesDataset.TILE_ID_COLUMN
+
+    # All tiles of each slide are cached
+    cached_dataset = train_dataloader.dataset.data  # type: ignore
+    cached_tile_ids = set()
+    for bag in cached_dataset:
+        cached_tile_ids.update(bag[tile_id_key].tolist())
+    assert cached_tile_ids == set(datamodule.train_dataset.dataset_df.index)
+
+    def get_epoch_tile_ids() -> Dict[str, List[int]]:
+        epoch_tile_ids = {}
+        for batch in train_dataloader:
+            for slide_ids, tile_ids, labels in zip(batch[MockTilesDataset.SLIDE_ID_COLUMN], batch[tile_id_key],
+                                                   batch[MockTilesDataset.LABEL_COLUMN]):
+                assert len(slide_ids) == len(tile_ids) == len(labels) <= max_bag_size
+                assert len(set(tile_ids.tolist())) == len(tile_ids)
+                epoch_tile_ids[slide_ids[0].item()] = sorted(tile_ids.tolist())
+        return epoch_tile_ids
+
+    # Bags are subsampled differently at every epoch
+    first_epoch_tile_ids = get_epoch_tile_ids()
+    second_epoch_tile_ids = get_epoch_tile_ids()
+    assert first_epoch_tile_ids.keys() == second_epoch_tile_ids.keys()
+    assert first_epoch_tile_ids != second_epoch_tile_ids
+    for tile_ids in first_epoch_tile_ids.values():
+        assert set(tile_ids) <= cached_tile_ids
+
+    # Subsampling is reproducible given the seed
+    for batch1, batch2 in zip(datamodule.train_dataloader(), datamodule.train_dataloader()):
+        for tile_ids1, tile_ids2 in zip(batch1[tile_id_key], batch2[tile_id_key]):
+            assert torch.equal(tile_ids1, tile_ids2)
+
+
+@pytest.mark.parametrize('cache_mode', [CacheMode.MEMORY, CacheMode.MEMMAP])
+def test_parallel_cache_population(mock_data_dir: Path, cache_mode: CacheMode) -> None:
+    def get_cached_bags(num_cache_workers: int) -> List[Dict[str, Any]]:
+        datamodule = MockTilesDataModule(root_path=mock_data_dir, transform=noop_transform, seed=0, batch_size=2,
+                                         cache_mode=cache_mode, precache_location=CacheLocation.NONE,
+                                         cache_dir=mock_data_dir / f"cache_{num_cache_workers}", max_bag_size=3,
+                                         num_cache_workers=num_cache_workers, cpu_thread_budget=2)
+        datamodule.prepare_data()
+        return list(datamodule.train_dataloader().dataset)  # type: ignore
+
+    serial_bags = get_cached_bags(num_cache_workers=0)
+    parallel_bags = get_cached_bags(num_cache_workers=2)
+    assert len(parallel_bags) == len(serial_bags)
+    for parallel_bag, serial_bag in zip(parallel_bags, serial_bags):
+        assert parallel_bag.keys() == serial_bag.keys()
+        for key, value in serial_bag.items():
+            if isinstance(value, torch.Tensor):
+                assert torch.equal(parallel_bag[key], value)
+            else:
+                assert parallel_bag[key] == value
+
+
+@pytest.mark.parametrize('cache_mode', [CacheMode.MEMORY, CacheMode.NONE])
+def test_max_tiles_per_batch(mock_data_dir: Path, cache_mode: CacheMode) -> None:
+    max_tiles_per_batch = 20
+    datamodule = MockTilesDataModule(root_path=mock_data_dir, transform=noop_transform, seed=0, batch_size=2,
+                                     cache_mode=cache_mode, max_bag_size=15, max_tiles_per_batch=max_tiles_per_batch)
+    train_dataloader = datamodule.train_dataloader()
+    slide_ids: List[int] = []
+    for batch in train_dataloader:
+        bag_sizes = [len(tile_ids) for tile_ids in batch[MockTilesDataset.TILE_ID_COLUMN]]
+        assert sum(bag_sizes) <= max_tiles_per_batch or len(bag_sizes) == 1
+        assert max(bag_sizes) <= 15
+        slide_ids.extend(slide_id_list[0].item() for slide_id_list in batch[MockTilesDataset.SLIDE_ID_COLUMN])
+    assert sorted(slide_ids) == sorted(datamodule.train_dataset.dataset_df[MockTilesDataset.SLIDE_ID_COLUMN].unique())
+    with pytest.raises(ValueError, match="Cannot balance tiles across ranks"):
+        MockTilesDataModule(root_path=mock_data_dir, max_tiles_per_batch=max_tiles_per_batch,
+                            balance_tiles_across_ranks=True)
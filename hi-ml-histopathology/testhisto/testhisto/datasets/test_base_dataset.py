@@ -0,0 +1,84 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+from sklearn.utils.class_weight import compute_class_weight
+
+from histopathology.datasets.base_dataset import SlidesDataset, TilesDataset
+from histopathology.utils.naming import SlideKey
+
+
+def _create_tiles_df(n_tiles: int = 200, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    slide_ids = np.repeat([f"slide_{i}" for i in range(10)], n_tiles // 10)
+    # Slides are labelled by the majority of their tiles' labels
+    slide_labels = np.repeat(rng.integers(3, size=10), n_tiles // 10)
+    labels = np.where(rng.random(n_tiles) < 0.8, slide_labels, rng.integers(3, size=n_tiles))
+    return pd.DataFrame({'slide_id': pd.Categorical(slide_ids),
+                         'tile_id': [f"tile_{i}" for i in range(n_tiles)],
+                         'image': [f"{slide_id}/{i}.png" for i, slide_id in enumerate(slide_ids)],
+                         'label': labels,
+                         'split': np.where(rng.random(n_tiles) < 0.5, 'train', 'test'),
+                         'tile_x': rng.integers(1000, size=n_tiles),
+                         'tile_y': rng.integers(1000, size=n_tiles),
+                         'occupancy': rng.random(n_tiles),
+                         'comment': np.array(['a', 'b', None], dtype=object)[rng.integers(3, size=n_tiles)]})
+
+
+def test_tiles_dataset_items_match_dataframe_rows() -> None:
+    df = _create_tiles_df()
+    dataset = TilesDataset("/root", dataset_df=df, train=True)
+    assert len(dataset) == (df['split'] == 'train').sum()
+    for index in range(len(dataset)):
+        tile_id = dataset.dataset_df.index[index]
+        expected = {TilesDataset.TILE_ID_COLUMN: tile_id, **dataset.dataset_df.loc[tile_id].to_dict()}
+        expected[TilesDataset.IMAGE_COLUMN] = str(Path("/root") / expected[TilesDataset.IMAGE_COLUMN])
+        expected[TilesDataset.PATH_COLUMN] = expected[TilesDataset.IMAGE_COLUMN]
+        sample = dataset[index]
+        assert sample.keys() == expected.keys()
+        for key, value in expected.items():
+            assert sample[key] == value or (pd.isna(sample[key]) and pd.isna(value)), key
+
+    # Reassigning the dataframe, e.g. after filtering in a subclass, is reflected in the items
+    dataset.dataset_df = dataset.dataset_df.iloc[::-1]
+    assert dataset[0][TilesDataset.TILE_ID_COLUMN] == dataset.dataset_df.index[0]
+
+
+def test_slides_dataset_items_match_dataframe_rows() -> None:
+    class MockSlidesDataset(SlidesDataset):
+        MASK_COLUMN = 'mask'
+        METADATA_COLUMNS = ('age', 'site')
+
+    df = pd.DataFrame({'slide_id': ['a', 'b', 'c'], 'image': ['a.tiff', 'b.tiff', 'c.tiff'],
+                       'mask': ['a_mask.tiff', 'b_mask.tiff', 'c_mask.tiff'], 'label': [1, 0, 1],
+                       'age': [50, 61, 72], 'site': ['x', 'y', 'x']})
+    dataset = MockSlidesDataset("/root", dataset_df=df)
+    for index, row in enumerate(df.itertuples()):
+        sample = dataset[index]
+        assert sample[SlideKey.SLIDE_ID] == row.slide_id
+        assert sample[SlideKey.IMAGE] == sample[SlideKey.IMAGE_PATH] == str(Path("/root") / row.image)
+        assert sample[SlideKey.MASK] == sample[SlideKey.MASK_PATH] == str(Path("/root") / row.mask)
+        assert sample[SlideKey.LABEL] == row.label
+        assert sample[SlideKey.METADATA] == {'age': row.age, 'site': row.site}
+
+
+def test_get_slide_labels_and_class_weights() -> None:
+    dataset = TilesDataset("/root", dataset_df=_create_tiles_df(n_tiles=1000))
+    expected_labels = dataset.dataset_df.groupby(TilesDataset.SLIDE_ID_COLUMN, observed=True)[
+        TilesDataset.LABEL_COLUMN].agg(pd.Series.mode)
+    slide_labels = dataset.get_slide_labels()
+    pd.testing.assert_series_equal(slide_labels, expected_labels, check_index_type=False)
+
+    expected_weights = compute_class_weight(class_weight='balanced', classes=np.unique(expected_labels),
+                                            y=expected_labels)
+    assert torch.allclose(dataset.get_class_weights(), torch.as_tensor(expected_weights))
+
+    # Ties are broken in favour of the smallest label
+    tied_df = pd.DataFrame({'slide_id': ['a', 'a', 'b'], 'tile_id': ['0', '1', '2'], 'image': ['', '', ''],
+                            'label': [2, 1, 0], 'split': 'train', 'tile_x': 0, 'tile_y': 0})
+    assert TilesDataset("/root", dataset_df=tied_df).get_slide_labels().to_dict() == {'a': 1, 'b': 0}
@@ -0,0 +1,109 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import pickle
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+import pytest
+import torch
+
+from histopathology.datasets.feature_store import (INDEX_FILENAME, FeatureStoreDataset, FeatureStoreWriter,
+                                                   is_feature_store_complete, write_feature_store)
+
+
+def _create_bags(n_bags: int = 5, n_features: int = 8) -> List[Dict[str, Any]]:
+    rng = np.random.default_rng(0)
+    bags = []
+    for bag_index in range(n_bags):
+        n_tiles = int(rng.integers(1, 20))
+        bags.append({'image': torch.randn(n_tiles, n_features),
+                     'label': torch.full((n_tiles,), bag_index % 2),
+                     'coords': rng.integers(1000, size=(n_tiles, 2)),
+                     'slide_id': [f"slide_{bag_index}"] * n_tiles,
+                     'metadata': {'index': bag_index}})
+    return bags
+
+
+def _assert_bags_equal(bag: Dict[str, Any], expected_bag: Dict[str, Any]) -> None:
+    assert list(bag.keys()) == list(expected_bag.keys())
+    for key, expected_value in expected_bag.items():
+        assert type(bag[key]) is type(expected_value), key
+        if isinstance(expected_value, torch.Tensor):
+            assert bag[key].dtype == expected_value.dtype
+            assert torch.equal(bag[key], expected_value)
+        elif isinstance(expected_value, np.ndarray):
+            assert bag[key].dtype == expected_value.dtype
+            assert np.array_equal(bag[key], expected_value)
+        else:
+            assert bag[key] == expected_value
+
+
+def test_feature_store_roundtrip(tmp_path: Path) -> None:
+    bags = _create_bags()
+    assert not is_feature_store_complete(tmp_path, "abc")
+    write_feature_store(bags, tmp_path, fingerprint="abc", features_key='image')
+    assert is_feature_store_complete(tmp_path, "abc")
+    assert not is_feature_store_complete(tmp_path, "def")
+
+    dataset = FeatureStoreDataset(tmp_path)
+    assert len(dataset) == len(bags)
+    for bag, expected_bag in zip(dataset, bags):  # type: ignore
+        _assert_bags_equal(bag, expected_bag)
+
+    # Memory maps are not pickled, e.g. when sending the dataset to dataloader workers
+    dataset_bytes = pickle.dumps(dataset)
+    assert len(dataset_bytes) < sum(bag['image'].numel() * 4 for bag in bags)
+    _assert_bags_equal(pickle.loads(dataset_bytes)[3], bags[3])
+
+
+def test_feature_store_resume(tmp_path: Path) -> None:
+    bags = _create_bags()
+    with FeatureStoreWriter(tmp_path, fingerprint="abc", n_bags=len(bags), features_key='image') as writer:
+        writer.write(bags[0])
+        writer.write(bags[1])
+    # Simulate an interruption while writing the third bag
+    with (tmp_path / "image.bin").open('ab') as f:
+        f.write(bags[2]['image'].numpy().tobytes()[:10])
+    with (tmp_path / INDEX_FILENAME).open('ab') as f:
+        f.write(pickle.dumps({'offset': 0})[:5])
+    with pytest.raises(ValueError, match="No complete feature store"):
+        FeatureStoreDataset(tmp_path)
+
+    skipped_bags: List[int] = []
+    write_feature_store(bags, tmp_path, fingerprint="abc", features_key='image', skip_bag=skipped_bags.append)
+    assert skipped_bags == [0, 1]
+    dataset = FeatureStoreDataset(tmp_path, data=bags)
+    assert dataset.data is bags
+    for bag, expected_bag in zip(dataset, bags):  # type: ignore
+        _assert_bags_equal(bag, expected_bag)
+
+    # A store with a different fingerprint is overwritten
+    new_bags = _create_bags(n_bags=2, n_features=4)
+    write_feature_store(new_bags, tmp_path, fingerprint="def", features_key='image')
+    dataset = FeatureStoreDataset(tmp_path)
+    assert len(dataset) == len(new_bags)
+    for bag, expected_bag in zip(dataset, new_bags):  # type: ignore
+        _assert_bags_equal(bag, expected_bag)
+
+
+def test_feature_store_inconsistent_bags(tmp_path: Path) -> None:
+    bags = _create_bags(n_bags=3)
+    bags[1]['image'] = bags[1]['image'].double()
+    bags[2].pop('coords')
+    with FeatureStoreWriter(tmp_path, fingerprint="abc", n_bags=2, features_key='image') as writer:
+        writer.write(bags[0])
+        with pytest.raises(ValueError, match="Inconsistent array for key 'image'"):
+            writer.write(bags[1])
+        with pytest.raises(ValueError, match="Expected arrays for keys {'coords'}"):
+            writer.write(bags[2])
+        # Invalid bags are not written
+        bags[2]['coords'] = np.zeros((len(bags[2]['image']), 2), dtype=bags[0]['coords'].dtype)
+        bags[2]['metadata'] = None
+        writer.write(bags[2])
+    dataset = FeatureStoreDataset(tmp_path)
+    assert len(dataset) == 2
+    _assert_bags_equal(dataset[0], bags[0])
+    _assert_bags_equal(dataset[1], bags[2])
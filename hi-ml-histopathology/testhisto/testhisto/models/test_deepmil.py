@@ -14,7 +14,8 @@ from torch.utils.data._utils.collate import default_collate
 from torchvision.models import resnet18
 
 from health_ml.lightning_container import LightningContainer
-from health_ml.networks.layers.attention_layers import AttentionLayer
+from health_ml.networks.layers.attention_layers import (AttentionLayer, GatedAttentionLayer, MaxPoolingLayer,
+                                                        MeanPoolingLayer, TransformerPooling)
 
 
 from histopathology.configs.classification.DeepSMILECrck import DeepSMILECrck
@@ -140,6 +141,27 @@ def test_lightningmodule_attention(
                           dropout_rate=dropout_rate)
 
 
+@pytest.mark.parametrize("pooling_layer", [AttentionLayer(16, 5, 2), GatedAttentionLayer(16, 5, 2),
+                                           MeanPoolingLayer(), MaxPoolingLayer(),
+                                           TransformerPooling(num_layers=1, num_heads=2, dim_representation=16)])
+def test_packed_forward(pooling_layer: nn.Module) -> None:
+    num_features = 32 if isinstance(pooling_layer, (AttentionLayer, GatedAttentionLayer)) else 16
+    module = DeepMILModule(encoder=IdentityEncoder(input_dim=(16,)),
+                           label_column=TilesDataset.LABEL_COLUMN,
+                           n_classes=3,
+                           pooling_layer=pooling_layer,
+                           num_features=num_features).eval()
+    bags = [rand(n_instances, 16) for n_instances in [3, 1, 6]]
+    bag_logits, bag_attentions = module._forward_bags(bags)
+    assert bag_logits.shape == (len(bags), 3)
+    assert len(bag_attentions) == len(bags)
+    # Whether or not the bags are packed, the outputs are the same as when processing each bag separately
+    for bag, logits, attentions in zip(bags, bag_logits, bag_attentions):
+        expected_logits, expected_attentions = module(bag)
+        assert allclose(logits, expected_logits.view(-1), atol=1e-6)
+        assert allclose(attentions, expected_attentions, atol=1e-6)
+
+
 def validate_metric_inputs(scores: torch.Tensor, labels: torch.Tensor) -> None:
     def is_integral(x: torch.Tensor) -> bool:
         return (x == x.long()).all()  # type: ignore
@@ -342,3 +364,10 @@ def test_class_weights_multiclass() -> None:
     # TODO: the test should reflect actual weighted loss operation for the class weights after
     # batch_size > 1 is implemented.
     assert allclose(loss_weighted, loss_unweighted)
+
+
+def test_trainer_arguments_with_tile_budget() -> None:
+    assert DeepSMILECrck().get_trainer_arguments() == {}
+    # The trainer must not replace the batch sampler in distributed training
+    container = DeepSMILECrck(max_tiles_per_batch=1000)
+    assert container.get_trainer_arguments() == {'replace_sampler_ddp': False}
@@ -5,11 +5,12 @@
 
 import os
 from pathlib import Path
-from typing import Callable, Sequence, Union
+from typing import Callable, Sequence, Tuple, Union
 import numpy as np
 
 import pytest
 import torch
+from PIL import Image
 from monai.data.dataset import CacheDataset, Dataset, PersistentDataset
 from monai.transforms import Compose
 from torch.utils.data import Dataset as TorchDataset
@@ -22,9 +23,10 @@ from health_ml.utils.data_augmentations import HEDJitter
 
 from histopathology.datasets.default_paths import TCGA_CRCK_DATASET_DIR
 from histopathology.datasets.tcga_crck_tiles_dataset import TcgaCrck_TilesDataset
-from histopathology.models.encoders import ImageNetEncoder
-from histopathology.models.transforms import (EncodeTilesBatchd, LoadTiled, LoadTilesBatchd, Subsampled,
-                                              transform_dict_adaptor)
+from histopathology.models.encoders import ImageNetEncoder, TileEncoder
+from histopathology.models.transforms import (AUTO_CHUNK_SIZE, EncodeTilesBatchd, LoadPackedTilesBatchd, LoadTiled,
+                                              LoadTilesBatchd, Subsampled, load_pil_image, transform_dict_adaptor)
+from histopathology.preprocessing.packed_tiles import PackedTilesWriter
 
 from testhisto.utils.utils_testhisto import assert_dicts_equal
 
@@ -89,6 +91,110 @@ def test_load_tiles_batch() -> None:
     assert_dicts_equal(bagged_loaded_batch, loaded_bagged_batch)
 
 
+def test_load_packed_tiles_batch(tmp_path: Path) -> None:
+    tile_shape = (3, 4, 4)
+    tiles_a = np.random.randint(0, 256, size=(6, *tile_shape), dtype=np.uint8)
+    tiles_b = np.random.randint(0, 256, size=(3, *tile_shape), dtype=np.uint8)
+    path_a, path_b = tmp_path / "a.npy", tmp_path / "b.npy"
+    for path, tiles in [(path_a, tiles_a), (path_b, tiles_b)]:
+        with PackedTilesWriter(path, tile_shape) as writer:
+            writer.write(tiles)
+
+    batch = {'image': [path_a, path_b, path_a, path_a], 'tile_index': [5, 1, 0, 3], 'label': [0, 1, 0, 0]}
+    loaded_batch = LoadPackedTilesBatchd('image', index_key='tile_index')(batch)
+    assert_dicts_equal(loaded_batch, batch, exclude_keys=['image'])
+
+    expected_tiles = np.stack([tiles_a[5], tiles_b[1], tiles_a[0], tiles_a[3]])
+    assert loaded_batch['image'].dtype == torch.float32
+    assert torch.allclose(loaded_batch['image'], torch.from_numpy(expected_tiles).float() / 255)
+
+
+def test_load_tiles_as_uint8(tmp_path: Path) -> None:
+    tiles = np.random.randint(0, 256, size=(7, 8, 8, 3), dtype=np.uint8)
+    paths = [tmp_path / f"{i}.png" for i in range(len(tiles))]
+    for path, tile in zip(paths, tiles):
+        Image.fromarray(tile).save(path)
+    expected_tiles = torch.from_numpy(tiles).permute(0, 3, 1, 2)
+
+    batch = {'image': paths, 'label': [0] * len(paths)}
+    float_batch = LoadTilesBatchd('image')(batch)
+    for num_threads in [0, 3]:
+        uint8_batch = LoadTilesBatchd('image', as_uint8=True, num_threads=num_threads)(batch)
+        assert_dicts_equal(uint8_batch, batch, exclude_keys=['image'])
+        assert uint8_batch['image'].dtype == torch.uint8
+        assert torch.equal(uint8_batch['image'], expected_tiles)
+        assert torch.allclose(uint8_batch['image'].float() / 255, float_batch['image'])
+
+    threaded_float_batch = LoadTilesBatchd('image', num_threads=3)(batch)
+    assert threaded_float_batch['image'].dtype == torch.float32
+    assert torch.equal(threaded_float_batch['image'], float_batch['image'])
+
+    uint8_tile = LoadTiled('image', as_uint8=True)({'image': paths[0]})['image']
+    assert uint8_tile.dtype == torch.uint8
+    assert torch.equal(uint8_tile, expected_tiles[0])
+
+    Image.fromarray(tiles[0, :4]).save(paths[-1])
+    with pytest.raises(ValueError, match="Expected 8-bit images of size"):
+        LoadTilesBatchd('image', as_uint8=True, num_threads=3)(batch)
+
+
+@pytest.mark.parametrize("mode", ['RGB', 'RGBA', 'L'])
+def test_load_non_png_tile_as_rgb(tmp_path: Path, mode: str) -> None:
+    tile = np.random.default_rng(0).integers(0, 256, size=(8, 8, 4), dtype=np.uint8)
+    tile[..., 3] = np.maximum(tile[..., 3], 1)  # lossless WebP may rewrite the colour of fully transparent pixels
+    pil_image = Image.fromarray(tile, mode='RGBA').convert(mode)
+    path = tmp_path / "tile.webp"
+    pil_image.save(path, lossless=True)
+    image = load_pil_image(path)
+    assert isinstance(image, np.ndarray)
+    assert image.shape == (8, 8, 3)
+    assert np.array_equal(image, np.asarray(pil_image.convert('RGB')))
+
+
+class _LinearEncoder(TileEncoder):
+    def _get_encoder(self) -> Tuple[Callable, int]:
+        return torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(int(np.prod(self.input_dim)), 4)), 4
+
+
+def test_encode_uint8_tiles() -> None:
+    encoder = _LinearEncoder(tile_size=8)
+    uint8_tiles = torch.randint(0, 256, size=(5, 3, 8, 8), dtype=torch.uint8)
+    float_tiles = uint8_tiles.float() / 255
+    for chunk_size in [0, 2]:
+        encode_transform = EncodeTilesBatchd('image', encoder, chunk_size=chunk_size)
+        uint8_features = encode_transform({'image': uint8_tiles})['image']
+        float_features = encode_transform({'image': float_tiles})['image']
+        assert uint8_features.dtype == torch.float32
+        assert torch.allclose(uint8_features, float_features)
+
+
+@pytest.mark.parametrize('chunk_size', [0, 2, AUTO_CHUNK_SIZE])
+def test_encode_tiles_in_chunks(chunk_size: int) -> None:
+    encoder = _LinearEncoder(tile_size=8)
+    tiles = torch.rand(5, 3, 8, 8)
+    expected_features = encoder(tiles)
+    num_threads = torch.get_num_threads()
+    encode_transform = EncodeTilesBatchd('image', encoder, chunk_size=chunk_size, num_threads=1)
+    features = encode_transform({'image': tiles})['image']
+    assert torch.get_num_threads() == num_threads
+    assert torch.allclose(features, expected_features, atol=1e-6)
+    # Features encoded in inference mode can be used as the input of a trainable layer, e.g. after caching
+    assert not features.is_inference()
+    torch.nn.Linear(4, 1)(features).sum().backward()
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="No GPU available")
+@pytest.mark.parametrize('chunk_size', [2, AUTO_CHUNK_SIZE])
+def test_encode_tiles_pipelined(chunk_size: int) -> None:
+    encoder = _LinearEncoder(tile_size=8).cuda()
+    tiles = torch.randint(0, 256, size=(9, 3, 8, 8), dtype=torch.uint8)
+    expected_features = EncodeTilesBatchd('image', encoder)({'image': tiles})['image']
+    encode_transform = EncodeTilesBatchd('image', encoder, chunk_size=chunk_size)
+    features = encode_transform({'image': tiles})['image']
+    assert features.is_cuda
+    assert torch.allclose(features, expected_features, atol=1e-6)
+
+
 def _test_cache_and_persistent_datasets(tmp_path: Path,
                                         base_dataset: TorchDataset,
                                         transform: Union[Sequence[Callable], Callable],
@@ -204,6 +310,9 @@ def test_subsample(include_non_indexable: bool, allow_missing_keys: bool) -> Non
         assert len(data[key]) == batch_size  # type: ignore
         assert len(sub_data[key]) == min(max_size, batch_size)  # type: ignore
 
+    # Check that elements are sampled without replacement
+    assert len(set(sub_data['indices'])) == len(sub_data['indices'])  # type: ignore
+
     # Check contents of subsampled elements
     for key in ['tensor_1d', 'tensor_2d', 'array_1d', 'array_2d', 'list']:
         for idx, elem in zip(sub_data['indices'], sub_data[key]):
@@ -0,0 +1,74 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+import PIL
+import pytest
+from monai.data.image_reader import WSIReader
+
+from histopathology.preprocessing import tiling
+from histopathology.preprocessing.create_panda_tiles_dataset import (get_coarse_mask_occupancies, process_slide,
+                                                                     select_tile)
+from testhisto.utils.synthetic_slides import (create_synthetic_mask_array, create_synthetic_slide_array,
+                                              write_pyramidal_tiff)
+
+
+@pytest.mark.parametrize("tile_size", [8, 12, 16])
+@pytest.mark.parametrize("roi_shape", [(40, 64), (37, 61)])
+def test_get_coarse_mask_occupancies(tile_size: int, roi_shape: Tuple[int, int]) -> None:
+    ratio = 4
+    rng = np.random.default_rng(0)
+    height, width = roi_shape
+    coarse_mask = rng.random((height // ratio, width // ratio)) < 0.5
+    # Full-resolution mask consistent with the coarse one, with an uncovered strip beyond its extent
+    full_mask = np.zeros((1, height, width), dtype=bool)
+    full_mask[0, :coarse_mask.shape[0] * ratio, :coarse_mask.shape[1] * ratio] = \
+        np.kron(coarse_mask, np.ones((ratio, ratio), dtype=bool))
+
+    mask_tiles, expected_locations = tiling.tile_array_2d(full_mask, tile_size=tile_size, constant_values=0)
+    _, expected_occupancies = select_tile(mask_tiles, occupancy_threshold=0.)
+
+    tile_locations, occupancies, near_boundary = get_coarse_mask_occupancies(coarse_mask, ratio, roi_shape,
+                                                                             tile_size)
+    assert np.array_equal(tile_locations, expected_locations)
+    assert np.array_equal(occupancies, expected_occupancies)
+    # Tiles overlapping both foreground and background are near a boundary
+    assert np.all(near_boundary[np.array([tile.any() and not tile.all() for tile in mask_tiles[:, 0]])])
+
+
+def _create_panda_sample(slides_dir: Path) -> dict:
+    image = create_synthetic_slide_array(1536, 1024, seed=3)
+    mask = create_synthetic_mask_array(image)
+    write_pyramidal_tiff(slides_dir / "slide.tiff", image)
+    write_pyramidal_tiff(slides_dir / "slide_mask.tiff", mask)
+    return {'image_id': "slide", 'image': str(slides_dir / "slide.tiff"), 'mask': str(slides_dir / "slide_mask.tiff"),
+            'data_provider': "synthetic", 'isup_grade': 1, 'gleason_score': "3+3"}
+
+
+@pytest.mark.parametrize("tile_size", [32, 50])
+def test_process_slide_coarse_mask(tmp_path: Path, tile_size: int) -> None:
+    sample = _create_panda_sample(tmp_path / "slides")
+    kwargs = dict(level=0, margin=0, tile_size=tile_size, occupancy_threshold=0.1, reader=WSIReader('cuCIM'))
+    process_slide(dict(sample), output_dir=tmp_path / "full", **kwargs)  # type: ignore
+    process_slide(dict(sample), output_dir=tmp_path / "coarse", mask_level=2, **kwargs)  # type: ignore
+
+    full_df = pd.read_csv(tmp_path / "full" / "slide" / "dataset.csv")
+    coarse_df = pd.read_csv(tmp_path / "coarse" / "slide" / "dataset.csv")
+    assert len(full_df) > 0
+    pd.testing.assert_frame_equal(coarse_df, full_df)
+    for image_path, mask_path in zip(full_df['image'], full_df['mask']):
+        for path in [image_path, mask_path]:
+            assert np.array_equal(np.asarray(PIL.Image.open(tmp_path / "full" / path)),
+                                  np.asarray(PIL.Image.open(tmp_path / "coarse" / path)))
+
+    process_slide(dict(sample), output_dir=tmp_path / "no_masks", mask_level=2, save_masks=False,
+                  **kwargs)  # type: ignore
+    no_masks_df = pd.read_csv(tmp_path / "no_masks" / "slide" / "dataset.csv")
+    assert no_masks_df['mask'].isna().all()
+    assert not (tmp_path / "no_masks" / "slide" / "train_label_masks").exists()
+    pd.testing.assert_frame_equal(no_masks_df.drop(columns=['mask']), full_df.drop(columns=['mask']))
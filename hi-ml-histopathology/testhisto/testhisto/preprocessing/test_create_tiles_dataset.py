@@ -0,0 +1,261 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from pathlib import Path
+from typing import Any, Iterator, List, Optional, Tuple, Type, Union
+
+import numpy as np
+import pandas as pd
+import PIL
+import pytest
+from health_ml.utils import box_utils
+from monai.data.image_reader import WSIReader
+
+from histopathology.datasets.base_dataset import TilesDataset
+from histopathology.preprocessing.create_tiles_dataset import (AsyncTileWriter, TileCodec, generate_tiles,
+                                                               generate_tiles_preselected, generate_tiles_streaming,
+                                                               get_coarse_occupancies, get_padded_otsu_threshold,
+                                                               process_slide, select_tiles)
+from histopathology.preprocessing import create_tiles_dataset, tiling
+from histopathology.preprocessing.loading import LoadROId, segment_foreground
+from histopathology.preprocessing.packed_tiles import PACKED_TILES_FILENAME, PackedTilesWriter, load_packed_tiles
+from histopathology.utils.naming import SlideKey, TileKey
+from testhisto.utils.synthetic_slides import create_synthetic_pyramidal_tiff
+
+
+@pytest.fixture
+def synthetic_slide_path(tmp_path: Path) -> Path:
+    slide_path = tmp_path / "synthetic_slide.tiff"
+    create_synthetic_pyramidal_tiff(slide_path)
+    return slide_path
+
+
+@pytest.mark.parametrize("tile_size", [32, 50])
+@pytest.mark.parametrize("estimate_threshold", [False, True])
+def test_generate_tiles_matches_padded_tiling(synthetic_slide_path: Path, tile_size: int,
+                                              estimate_threshold: bool) -> None:
+    occupancy_threshold = 0.1
+    sample = LoadROId(WSIReader('cuCIM'), level=1, margin=0)({SlideKey.IMAGE: str(synthetic_slide_path)})
+    image = sample[SlideKey.IMAGE]
+    threshold = None if estimate_threshold else sample[SlideKey.FOREGROUND_THRESHOLD]
+
+    # Reference: pad and tile the whole image, then select tiles
+    all_tiles, all_locations = tiling.tile_array_2d(image, tile_size=tile_size, constant_values=255)
+    foreground_mask, reference_threshold = segment_foreground(all_tiles, threshold)
+    selected, occupancies = select_tiles(foreground_mask, occupancy_threshold)
+    if estimate_threshold:
+        assert get_padded_otsu_threshold(image, tile_size) == reference_threshold
+        assert get_padded_otsu_threshold(image.astype(np.float32), tile_size) == \
+            pytest.approx(segment_foreground(all_tiles.astype(np.float32))[1])
+
+    tiles, locations, tile_occupancies, n_discarded = generate_tiles(image, tile_size, threshold,  # type: ignore
+                                                                     occupancy_threshold)
+    assert np.array_equal(tiles, all_tiles[selected])
+    assert np.array_equal(locations, all_locations[selected])
+    assert np.array_equal(tile_occupancies, occupancies[selected])
+    assert n_discarded == (~selected).sum()
+
+
+@pytest.mark.parametrize("level", [0, 1])
+@pytest.mark.parametrize("tile_size", [32, 50])
+@pytest.mark.parametrize("strip_height", [1, 3])
+def test_generate_tiles_streaming(synthetic_slide_path: Path, level: int, tile_size: int,
+                                  strip_height: int) -> None:
+    occupancy_threshold = 0.1
+    reader = WSIReader('cuCIM')
+    image_obj = reader.read(str(synthetic_slide_path))
+    loader = LoadROId(reader, level=level, margin=0)
+    level0_bbox, threshold = loader.get_roi(image_obj)
+
+    scale = image_obj.resolutions['level_downsamples'][level]
+    scaled_bbox = level0_bbox / scale
+    sample = loader({SlideKey.IMAGE: str(synthetic_slide_path)})
+    expected_tiles, expected_locations, expected_occupancies, expected_n_discarded = \
+        generate_tiles(sample[SlideKey.IMAGE], tile_size, threshold, occupancy_threshold)
+
+    strips = list(generate_tiles_streaming(reader, image_obj, level, level0_bbox, tile_size, threshold,
+                                           occupancy_threshold, strip_height=strip_height))
+    image_obj.close()
+
+    assert len(strips) == int(np.ceil(np.ceil(scaled_bbox.w / tile_size) / strip_height))
+    assert np.array_equal(np.concatenate([strip[0] for strip in strips]), expected_tiles)
+    assert np.array_equal(np.concatenate([strip[1] for strip in strips]), expected_locations)
+    assert np.array_equal(np.concatenate([strip[2] for strip in strips]), expected_occupancies)
+    assert sum(strip[3] for strip in strips) == expected_n_discarded
+
+
+def test_generate_tiles_streaming_invalid_strip_height(synthetic_slide_path: Path) -> None:
+    reader = WSIReader('cuCIM')
+    image_obj = reader.read(str(synthetic_slide_path))
+    level0_bbox, threshold = LoadROId(reader).get_roi(image_obj)
+    with pytest.raises(ValueError):
+        next(generate_tiles_streaming(reader, image_obj, 0, level0_bbox, 32, threshold, 0.1, strip_height=0))
+
+
+@pytest.mark.parametrize("level", [0, 1])
+@pytest.mark.parametrize("tile_size", [32, 50])
+def test_generate_tiles_preselected(synthetic_slide_path: Path, level: int, tile_size: int) -> None:
+    occupancy_threshold = 0.1
+    reader = WSIReader('cuCIM')
+    image_obj = reader.read(str(synthetic_slide_path))
+    loader = LoadROId(reader, level=level, margin=0)
+    coarse_mask, threshold, coarse_scale = loader.get_foreground_mask(image_obj)
+    level0_bbox = loader.get_roi_from_mask(coarse_mask, coarse_scale)
+    assert (level0_bbox, threshold) == loader.get_roi(image_obj)
+
+    sample = loader({SlideKey.IMAGE: str(synthetic_slide_path)})
+    expected_tiles, expected_locations, expected_occupancies, expected_n_discarded = \
+        generate_tiles(sample[SlideKey.IMAGE], tile_size, threshold, occupancy_threshold)
+
+    scale = image_obj.resolutions['level_downsamples'][level]
+    coarse_occupancies = get_coarse_occupancies(coarse_mask, coarse_scale, level0_bbox, scale, tile_size)
+    n_candidates = int((coarse_occupancies > 0).sum())
+    assert n_candidates < coarse_occupancies.size
+
+    rows = list(generate_tiles_preselected(reader, image_obj, level, level0_bbox, tile_size, threshold,
+                                           occupancy_threshold, coarse_mask=coarse_mask, coarse_scale=coarse_scale))
+    image_obj.close()
+
+    assert len(rows) == coarse_occupancies.shape[0]
+    assert np.array_equal(np.concatenate([row[0] for row in rows]), expected_tiles)
+    assert np.array_equal(np.concatenate([row[1] for row in rows]), expected_locations)
+    assert np.array_equal(np.concatenate([row[2] for row in rows]), expected_occupancies)
+    assert sum(row[3] for row in rows) == expected_n_discarded
+
+
+def test_get_coarse_occupancies() -> None:
+    coarse_mask = np.zeros((8, 8), dtype=bool)
+    coarse_mask[2:4, 4:8] = True
+    # ROI covering the whole 128x128 level-0 image, tiled at level 0 (scale 1) with a mask at scale 16
+    level0_bbox = box_utils.Box(x=0, y=0, w=128, h=128)
+    occupancies = get_coarse_occupancies(coarse_mask, coarse_scale=16, level0_bbox=level0_bbox, scale=1,
+                                         tile_size=64, margin=0)
+    assert occupancies.shape == (2, 2)
+    assert np.allclose(occupancies, np.asarray([[0, 0.5], [0, 0]], dtype=float))
+
+    occupancies_with_margin = get_coarse_occupancies(coarse_mask, coarse_scale=16, level0_bbox=level0_bbox,
+                                                     scale=1, tile_size=64, margin=1)
+    assert np.allclose(occupancies_with_margin, np.asarray([[0.125, 0.5], [0.0625, 0.25]], dtype=float))
+
+
+def test_packed_tiles_writer(tmp_path: Path) -> None:
+    tile_shape = (3, 8, 8)
+    tiles = np.random.randint(0, 256, size=(10, *tile_shape), dtype=np.uint8)
+    packed_path = tmp_path / PACKED_TILES_FILENAME
+    with PackedTilesWriter(packed_path, tile_shape) as writer:
+        assert np.array_equal(writer.write(tiles[:4]), np.arange(4))
+        assert np.array_equal(writer.write(tiles[4:]), np.arange(4, 10))
+        with pytest.raises(ValueError):
+            writer.write(np.zeros((1, 3, 4, 4), dtype=np.uint8))
+
+    assert np.array_equal(np.load(packed_path), tiles)
+    assert np.array_equal(load_packed_tiles(packed_path), tiles)
+    indices = [7, 2, 2, 9, 0]
+    assert np.array_equal(load_packed_tiles(packed_path, indices), tiles[indices])
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_process_slide_packed(synthetic_slide_path: Path, tmp_path: Path, streaming: bool) -> None:
+    slide_id = "synthetic"
+    sample = {SlideKey.SLIDE_ID: slide_id, SlideKey.IMAGE: str(synthetic_slide_path),
+              SlideKey.LABEL: 1, SlideKey.METADATA: {}}
+    png_dir, packed_dir = tmp_path / "png", tmp_path / "packed"
+    kwargs = dict(level=1, margin=0, tile_size=32, foreground_threshold=None, occupancy_threshold=0.1,
+                  streaming=streaming)
+    process_slide(dict(sample), output_dir=png_dir, packed=False, **kwargs)  # type: ignore
+    process_slide(dict(sample), output_dir=packed_dir, packed=True, **kwargs)  # type: ignore
+
+    png_df = pd.read_csv(png_dir / slide_id / "dataset.csv")
+    packed_df = pd.read_csv(packed_dir / slide_id / "dataset.csv")
+    assert len(png_df) > 0
+    assert (packed_df[TileKey.IMAGE] == f"{slide_id}/{PACKED_TILES_FILENAME}").all()
+    assert np.array_equal(packed_df[TileKey.TILE_INDEX], np.arange(len(packed_df)))
+    pd.testing.assert_frame_equal(packed_df.drop(columns=[TileKey.IMAGE, TileKey.TILE_INDEX]),
+                                  png_df.drop(columns=[TileKey.IMAGE]))
+
+    packed_tiles = load_packed_tiles(packed_dir / slide_id / PACKED_TILES_FILENAME)
+    png_tiles = np.stack([np.moveaxis(np.asarray(PIL.Image.open(png_dir / path)), -1, 0)
+                          for path in png_df[TileKey.IMAGE]])
+    assert np.array_equal(packed_tiles, png_tiles)
+
+    assert not TilesDataset(png_dir, dataset_df=png_df.assign(split='train')).is_packed
+    assert TilesDataset(packed_dir, dataset_df=packed_df.assign(split='train')).is_packed
+
+
+def test_process_slide_closes_writers_on_error(synthetic_slide_path: Path, tmp_path: Path,
+                                               monkeypatch: pytest.MonkeyPatch) -> None:
+    def failing_generate_tiles_streaming(*args: Any, **kwargs: Any) -> Iterator:
+        yield from generate_tiles_streaming(*args, **kwargs)
+        raise RuntimeError("Failed to read strip")
+
+    closed: List[str] = []
+    writer_cls: Union[Type[AsyncTileWriter], Type[PackedTilesWriter]]
+    for writer_cls in [AsyncTileWriter, PackedTilesWriter]:
+        def close(self: Any, close: Any = writer_cls.close, name: str = writer_cls.__name__) -> None:
+            closed.append(name)
+            close(self)
+        monkeypatch.setattr(writer_cls, 'close', close)
+    monkeypatch.setattr(create_tiles_dataset, 'generate_tiles_streaming', failing_generate_tiles_streaming)
+
+    sample = {SlideKey.SLIDE_ID: "synthetic", SlideKey.IMAGE: str(synthetic_slide_path),
+              SlideKey.LABEL: 1, SlideKey.METADATA: {}}
+    with pytest.warns(UserWarning, match="Failed to read strip"):
+        result = process_slide(sample, level=1, margin=0, tile_size=32, output_dir=tmp_path,  # type: ignore
+                               foreground_threshold=None, occupancy_threshold=0.1, streaming=True,
+                               packed=True, num_writer_threads=2)
+    assert result is None
+    assert sorted(closed) == ['AsyncTileWriter', 'PackedTilesWriter']
+
+
+@pytest.mark.parametrize("codec, quality, lossless", [(TileCodec.PNG, None, True), (TileCodec.PNG, 1, True),
+                                                      (TileCodec.WEBP, None, True), (TileCodec.JPEG, 90, False)])
+@pytest.mark.parametrize("num_threads", [0, 2])
+def test_async_tile_writer(tmp_path: Path, codec: TileCodec, quality: Optional[int], lossless: bool,
+                           num_threads: int) -> None:
+    tiles = np.random.randint(0, 256, size=(10, 3, 16, 16), dtype=np.uint8)
+    completed: List[Tuple[int, Optional[BaseException]]] = []
+    not_a_dir = tmp_path / "not_a_dir"
+    not_a_dir.touch()
+    with AsyncTileWriter(codec, quality=quality, num_threads=num_threads, max_pending=3) as writer:
+        paths = [tmp_path / f"{i}{writer.extension}" for i in range(len(tiles))]
+        for i, (tile, path) in enumerate(zip(tiles, paths)):
+            writer.submit(tile, path, on_done=lambda error, i=i: completed.append((i, error)))  # type: ignore
+        writer.submit(tiles[0], not_a_dir / "invalid.png", on_done=lambda error: completed.append((-1, error)))
+
+    assert [i for i, _ in completed] == [*range(len(tiles)), -1]  # called in submission order
+    assert all(error is None for _, error in completed[:-1])
+    assert completed[-1][1] is not None
+    for tile, path in zip(tiles, paths):
+        loaded_tile = np.moveaxis(np.asarray(PIL.Image.open(path)), -1, 0)
+        if lossless:
+            assert np.array_equal(loaded_tile, tile)
+        else:
+            assert loaded_tile.shape == tile.shape
+
+
+def test_async_tile_writer_invalid_max_pending() -> None:
+    with pytest.raises(ValueError):
+        AsyncTileWriter(max_pending=0)
+
+
+@pytest.mark.parametrize("num_writer_threads", [0, 4])
+def test_process_slide_codecs(synthetic_slide_path: Path, tmp_path: Path, num_writer_threads: int) -> None:
+    slide_id = "synthetic"
+    sample = {SlideKey.SLIDE_ID: slide_id, SlideKey.IMAGE: str(synthetic_slide_path),
+              SlideKey.LABEL: 1, SlideKey.METADATA: {}}
+    kwargs = dict(level=1, margin=0, tile_size=32, foreground_threshold=None, occupancy_threshold=0.1,
+                  num_writer_threads=num_writer_threads)
+    png_dir, webp_dir = tmp_path / "png", tmp_path / "webp"
+    process_slide(dict(sample), output_dir=png_dir, **kwargs)  # type: ignore
+    process_slide(dict(sample), output_dir=webp_dir, tile_codec=TileCodec.WEBP, **kwargs)  # type: ignore
+
+    png_df = pd.read_csv(png_dir / slide_id / "dataset.csv")
+    webp_df = pd.read_csv(webp_dir / slide_id / "dataset.csv")
+    assert len(png_df) > 0
+    assert png_df[TileKey.IMAGE].str.endswith(".png").all()
+    assert webp_df[TileKey.IMAGE].str.endswith(".webp").all()
+    pd.testing.assert_frame_equal(webp_df.drop(columns=[TileKey.IMAGE]), png_df.drop(columns=[TileKey.IMAGE]))
+    for png_path, webp_path in zip(png_df[TileKey.IMAGE], webp_df[TileKey.IMAGE]):
+        assert np.array_equal(np.asarray(PIL.Image.open(png_dir / png_path)),
+                              np.asarray(PIL.Image.open(webp_dir / webp_path)))
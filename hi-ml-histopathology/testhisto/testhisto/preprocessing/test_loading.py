@@ -0,0 +1,71 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from typing import Optional, Tuple
+
+import numpy as np
+import pytest
+import skimage.filters
+
+from histopathology.preprocessing.create_tiles_dataset import select_tiles
+from histopathology.preprocessing.loading import get_channel_sum, get_luminance, segment_foreground
+from testhisto.utils.synthetic_slides import create_synthetic_slide_array
+
+
+def _segment_foreground_float(slide: np.ndarray, threshold: Optional[float] = None) -> Tuple[np.ndarray, float]:
+    luminance = get_luminance(slide.astype(float))
+    if threshold is None:
+        threshold = skimage.filters.threshold_otsu(luminance)
+    return luminance < threshold, threshold
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_get_channel_sum(dtype: type) -> None:
+    slide: np.ndarray = np.full((2, 3, 4, 5), np.iinfo(dtype).max, dtype=dtype)
+    channel_sum = get_channel_sum(slide)
+    assert channel_sum.shape == (2, 4, 5)
+    assert np.array_equal(channel_sum / 3, get_luminance(slide))
+
+
+@pytest.mark.parametrize("threshold", [None, 200., 128.5, 0., 255.])
+def test_segment_foreground_uint8_matches_float(threshold: Optional[float]) -> None:
+    slide = create_synthetic_slide_array(300, 200, seed=1).transpose(2, 0, 1)
+    expected_mask, expected_threshold = _segment_foreground_float(slide, threshold)
+    mask, used_threshold = segment_foreground(slide, threshold)
+    assert used_threshold == expected_threshold
+    assert mask.dtype == bool
+    assert np.array_equal(mask, expected_mask)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_segment_foreground_integer_random(dtype: type) -> None:
+    rng = np.random.default_rng(0)
+    slide: np.ndarray = rng.integers(0, np.iinfo(dtype).max, (4, 3, 16, 16), endpoint=True).astype(dtype)
+    expected_mask, expected_threshold = _segment_foreground_float(slide)
+    mask, threshold = segment_foreground(slide)
+    assert threshold == expected_threshold
+    assert np.array_equal(mask, expected_mask)
+
+    # Uniform image: the threshold is the single luminance value, so all pixels are background
+    mask, threshold = segment_foreground(np.full((3, 8, 8), 100, dtype=dtype))
+    assert threshold == 100 and not mask.any()
+
+
+def test_segment_foreground_otsu_subsample() -> None:
+    slide = create_synthetic_slide_array(300, 200, seed=2).transpose(2, 0, 1)
+    _, threshold = segment_foreground(slide, otsu_subsample=4)
+    _, expected_threshold = _segment_foreground_float(slide[:, ::4, ::4])
+    assert threshold == expected_threshold
+    _, float_threshold = segment_foreground(slide.astype(float), otsu_subsample=4)
+    assert float_threshold == expected_threshold
+
+
+def test_select_tiles_occupancy() -> None:
+    rng = np.random.default_rng(0)
+    foreground_mask = rng.random((5, 8, 8)) < 0.3
+    selected, occupancies = select_tiles(foreground_mask, occupancy_threshold=0.3)
+    assert np.array_equal(occupancies, foreground_mask.mean(axis=(-2, -1)))
+    assert np.array_equal(selected, occupancies > 0.3)
+    selected, occupancy = select_tiles(foreground_mask[0], occupancy_threshold=0.3)
+    assert occupancy == foreground_mask[0].mean()
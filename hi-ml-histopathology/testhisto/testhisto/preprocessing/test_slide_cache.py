@@ -0,0 +1,156 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import os
+from pathlib import Path
+from typing import Any, List
+
+import numpy as np
+import pytest
+from health_ml.utils import box_utils
+from monai.data.image_reader import WSIReader
+
+from histopathology.preprocessing import create_panda_tiles_dataset, create_tiles_dataset
+from histopathology.preprocessing.loading import LoadROId
+from histopathology.preprocessing.slide_cache import SlideMetadata, SlideMetadataCache
+from histopathology.preprocessing.wsi_readers import CuCIMReader
+from histopathology.utils.naming import SlideKey
+from histopathology.utils.viz_utils import get_thumbnail_factor, load_image_dict
+from testhisto.utils.synthetic_slides import (create_synthetic_mask_array, create_synthetic_pyramidal_tiff,
+                                              create_synthetic_slide_array, write_pyramidal_tiff)
+
+
+class LevelRecordingWSIReader(WSIReader):
+    """cuCIM `WSIReader` recording the level of every region read."""
+
+    def __init__(self) -> None:
+        super().__init__('cuCIM')
+        self.levels_read: List[int] = []
+
+    def get_data(self, *args: Any, **kwargs: Any) -> Any:
+        self.levels_read.append(kwargs.get('level', 0))
+        return super().get_data(*args, **kwargs)
+
+
+def test_slide_metadata_cache_roundtrip(tmp_path: Path) -> None:
+    slide_path = tmp_path / "slide.tiff"
+    slide_path.write_bytes(b"slide")
+    cache = SlideMetadataCache(tmp_path / "cache")
+    metadata = SlideMetadata(level_dimensions=[(40, 30), (10, 7)], level_downsamples=[1., 4.],
+                             foreground_threshold=200.5, bbox=box_utils.Box(1, 2, 3, 4),
+                             thumbnail=np.arange(3 * 7 * 10, dtype=np.uint8).reshape(3, 7, 10))
+    n_calls = 0
+
+    def compute() -> SlideMetadata:
+        nonlocal n_calls
+        n_calls += 1
+        return metadata
+
+    for _ in range(2):
+        loaded = cache.get_or_compute([slide_path], compute, margin=0)
+        assert n_calls == 1
+        assert loaded.level_dimensions == metadata.level_dimensions
+        assert loaded.level_downsamples == metadata.level_downsamples
+        assert loaded.foreground_threshold == metadata.foreground_threshold
+        assert loaded.bbox == metadata.bbox
+        assert np.array_equal(loaded.thumbnail, metadata.thumbnail)  # type: ignore
+
+    key = cache.get_key([slide_path], margin=0)
+    assert cache.get_key([slide_path], margin=1) != key
+    assert cache.get_key([[slide_path]], margin=0) == key  # type: ignore
+    stat = slide_path.stat()
+    os.utime(slide_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert cache.get_key([slide_path], margin=0) != key
+
+    # Incomplete entries are treated as missing
+    cache._get_paths(key)[0].write_text("{")
+    assert cache.load(key) is None
+
+
+def test_load_roi_with_metadata_cache(tmp_path: Path) -> None:
+    slide_path = tmp_path / "slide.tiff"
+    create_synthetic_pyramidal_tiff(slide_path, n_levels=3)
+    cache = SlideMetadataCache(tmp_path / "cache")
+    expected = LoadROId(WSIReader('cuCIM'), level=1, margin=8)({SlideKey.IMAGE: str(slide_path)})
+
+    for _ in range(2):
+        reader = LevelRecordingWSIReader()
+        sample = LoadROId(reader, level=1, margin=8, metadata_cache=cache)({SlideKey.IMAGE: str(slide_path)})
+        assert sample.keys() == expected.keys()
+        for key in [SlideKey.ORIGIN, SlideKey.SCALE, SlideKey.FOREGROUND_THRESHOLD]:
+            assert sample[key] == expected[key]
+        assert np.array_equal(sample[SlideKey.IMAGE], expected[SlideKey.IMAGE])
+    # The lowest-resolution image is only read to estimate the ROI on the first call
+    assert reader.levels_read == [1]
+    assert len(list(cache.cache_dir.glob("*.json"))) == 1
+
+
+def test_load_image_dict_with_metadata_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    image = create_synthetic_slide_array(1536, 1024, seed=3)
+    write_pyramidal_tiff(tmp_path / "slide.tiff", image)
+    write_pyramidal_tiff(tmp_path / "slide_mask.tiff", create_synthetic_mask_array(image))
+    sample = {'image_id': "slide", 'image': str(tmp_path / "slide.tiff"), 'mask': str(tmp_path / "slide_mask.tiff")}
+    cache = SlideMetadataCache(tmp_path / "cache")
+    expected = load_image_dict(dict(sample), level=1, margin=0)
+    max_thumbnail_size = 100
+    factor = get_thumbnail_factor(expected[SlideKey.IMAGE].shape[1:], max_thumbnail_size)
+    assert factor > 1
+
+    for _ in range(2):
+        loaded = load_image_dict(dict(sample), level=1, margin=0, metadata_cache=cache,
+                                 max_thumbnail_size=max_thumbnail_size)
+        assert loaded.keys() == {*expected.keys(), SlideKey.THUMBNAIL_FACTOR}
+        assert loaded[SlideKey.THUMBNAIL_FACTOR] == factor
+        for key, value in expected.items():
+            if isinstance(value, np.ndarray):
+                assert max(loaded[key].shape[1:]) <= max_thumbnail_size
+                assert np.array_equal(loaded[key], value[:, ::factor, ::factor])
+            else:
+                assert loaded[key] == value
+
+    # Once cached, the slide files are not opened at all
+    with monkeypatch.context() as m:
+        m.setattr(CuCIMReader, 'read', lambda *args, **kwargs: pytest.fail("Slide was read"))
+        load_image_dict(dict(sample), level=1, margin=0, metadata_cache=cache, max_thumbnail_size=max_thumbnail_size)
+
+
+@pytest.mark.parametrize("streaming, coarse_preselection", [(False, False), (True, False), (False, True)])
+def test_process_slide_with_metadata_cache(tmp_path: Path, streaming: bool, coarse_preselection: bool) -> None:
+    slide_path = tmp_path / "slide.tiff"
+    create_synthetic_pyramidal_tiff(slide_path, n_levels=3)
+    sample = {SlideKey.SLIDE_ID: "slide", SlideKey.IMAGE: str(slide_path), SlideKey.LABEL: 1, SlideKey.METADATA: {}}
+    kwargs = dict(level=1, margin=0, tile_size=32, foreground_threshold=None, occupancy_threshold=0.1,
+                  streaming=streaming, coarse_preselection=coarse_preselection, num_writer_threads=0)
+    create_tiles_dataset.process_slide(dict(sample), output_dir=tmp_path / "uncached", **kwargs)  # type: ignore
+    cache = SlideMetadataCache(tmp_path / "cache")
+
+    for run in range(2):
+        reader = LevelRecordingWSIReader()
+        create_tiles_dataset.process_slide(dict(sample), output_dir=tmp_path / f"cached_{run}", reader=reader,
+                                           metadata_cache=cache, **kwargs)  # type: ignore
+        assert (tmp_path / f"cached_{run}" / "slide" / "dataset.csv").read_text() == \
+            (tmp_path / "uncached" / "slide" / "dataset.csv").read_text()
+        # The lowest-resolution image is only read to estimate the ROI on the first run
+        assert (2 in reader.levels_read) == (run == 0)
+
+
+def test_process_panda_slide_with_metadata_cache(tmp_path: Path) -> None:
+    image = create_synthetic_slide_array(1536, 1024, seed=3)
+    write_pyramidal_tiff(tmp_path / "slide.tiff", image)
+    write_pyramidal_tiff(tmp_path / "slide_mask.tiff", create_synthetic_mask_array(image))
+    sample = {'image_id': "slide", 'image': str(tmp_path / "slide.tiff"), 'mask': str(tmp_path / "slide_mask.tiff"),
+              'data_provider': "synthetic", 'isup_grade': 1, 'gleason_score': "3+3"}
+    kwargs = dict(level=1, margin=0, tile_size=32, occupancy_threshold=0.1)
+    create_panda_tiles_dataset.process_slide(dict(sample), output_dir=tmp_path / "uncached",
+                                             reader=WSIReader('cuCIM'), **kwargs)  # type: ignore
+    cache = SlideMetadataCache(tmp_path / "cache")
+
+    for run in range(2):
+        reader = LevelRecordingWSIReader()
+        create_panda_tiles_dataset.process_slide(dict(sample), output_dir=tmp_path / f"cached_{run}", reader=reader,
+                                                 metadata_cache=cache, **kwargs)  # type: ignore
+        assert (tmp_path / f"cached_{run}" / "slide" / "dataset.csv").read_text() == \
+            (tmp_path / "uncached" / "slide" / "dataset.csv").read_text()
+        # The lowest-resolution mask is only read to estimate the ROI on the first run
+        assert (2 in reader.levels_read) == (run == 0)
@@ -0,0 +1,203 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import os
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from histopathology.datasets.base_dataset import SlidesDataset, TilesDataset
+from histopathology.preprocessing import create_tiles_dataset
+from histopathology.preprocessing.create_tiles_dataset import (get_pending_slides, main, merge_dataset_csv_files,
+                                                               write_dataset_index)
+from histopathology.preprocessing.slide_scheduler import (MANIFEST_FILENAME, SlideManifest, estimate_slide_memory,
+                                                          get_num_workers, get_slide_dimensions, order_largest_first)
+from histopathology.utils.naming import SlideKey
+from testhisto.utils.synthetic_slides import create_synthetic_pyramidal_tiff
+
+
+def test_slide_manifest(tmp_path: Path) -> None:
+    manifest = SlideManifest(tmp_path)
+    assert not manifest.exists()
+    manifest.mark_complete({'slide_id': 'a', 'n_tiles': 3})
+    manifest.mark_complete({'slide_id': 'b', 'n_tiles': 5})
+    assert manifest.exists()
+    assert manifest.is_complete('a') and manifest.is_complete('b')
+
+    # Simulate a record left partially written by an interrupted process
+    with (tmp_path / MANIFEST_FILENAME).open('a') as manifest_file:
+        manifest_file.write('{"slide_id": "c", "n_ti')
+
+    reloaded_manifest = SlideManifest(tmp_path)
+    assert reloaded_manifest.slide_ids == ['a', 'b']
+    assert reloaded_manifest.records['b'] == {'slide_id': 'b', 'n_tiles': 5}
+    assert not reloaded_manifest.is_complete('c')
+
+
+def test_order_largest_first() -> None:
+    samples = [{SlideKey.SLIDE_ID: slide_id} for slide_id in "abcd"]
+    ordered = order_largest_first(samples, sizes=[10, 30, 10, 20])  # type: ignore
+    assert [sample[SlideKey.SLIDE_ID] for sample in ordered] == ['b', 'd', 'a', 'c']
+    with pytest.raises(ValueError):
+        order_largest_first(samples, sizes=[1, 2])  # type: ignore
+
+
+def test_get_num_workers() -> None:
+    assert estimate_slide_memory((100, 200), tile_size=10) == 3 * 3 * 100 * 200
+    assert estimate_slide_memory((100, 200), tile_size=10, strip_height=2) == 3 * 3 * 100 * 20
+
+    assert get_num_workers([100, 200], max_workers=8) == 2  # no more workers than slides
+    assert get_num_workers([100] * 10, max_workers=8) == 8
+    assert get_num_workers([100] * 10, memory_budget=450, max_workers=8) == 4
+    assert get_num_workers([100, 1000], memory_budget=450, max_workers=8) == 1  # at least one worker
+    assert get_num_workers([], max_workers=8) == 1
+
+
+def test_get_pending_slides(tmp_path: Path) -> None:
+    samples = [{SlideKey.SLIDE_ID: slide_id} for slide_id in "abc"]
+    for slide_id in "ab":
+        (tmp_path / slide_id).mkdir()
+
+    # Without a manifest, existing slide directories of a merged legacy dataset are assumed complete
+    (tmp_path / "dataset.csv").touch()
+    manifest = SlideManifest(tmp_path)
+    pending = get_pending_slides(samples, tmp_path, manifest)  # type: ignore
+    assert [sample[SlideKey.SLIDE_ID] for sample in pending] == ['c']
+    assert SlideManifest(tmp_path).slide_ids == ['a', 'b']
+
+    # With a manifest, directories of slides not recorded as complete are deleted
+    (tmp_path / 'c').mkdir()
+    pending = get_pending_slides(samples, tmp_path, manifest)  # type: ignore
+    assert [sample[SlideKey.SLIDE_ID] for sample in pending] == ['c']
+    assert not (tmp_path / 'c').exists()
+    assert (tmp_path / 'a').exists()
+
+
+def test_get_pending_slides_without_merged_dataset(tmp_path: Path) -> None:
+    # Slide directories without a manifest nor a merged dataset were left by a crash before any slide completed
+    samples = [{SlideKey.SLIDE_ID: slide_id} for slide_id in "ab"]
+    (tmp_path / 'a').mkdir()
+    manifest = SlideManifest(tmp_path)
+    pending = get_pending_slides(samples, tmp_path, manifest)  # type: ignore
+    assert [sample[SlideKey.SLIDE_ID] for sample in pending] == ['a', 'b']
+    assert not (tmp_path / 'a').exists()
+    assert SlideManifest(tmp_path).slide_ids == []
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_main_resumes_from_manifest(tmp_path: Path, parallel: bool) -> None:
+    slides_dir = tmp_path / "slides"
+    sizes = {'small': (512, 512), 'large': (1024, 768)}
+    for slide_id, (width, height) in sizes.items():
+        create_synthetic_pyramidal_tiff(slides_dir / f"{slide_id}.tiff", width=width, height=height)
+    assert get_slide_dimensions(slides_dir / "large.tiff", level=1) == (256, 192)
+    slides_df = pd.DataFrame({'slide_id': list(sizes), 'image': [f"{slide_id}.tiff" for slide_id in sizes],
+                              'label': [0, 1]})
+    slides_dataset = SlidesDataset(slides_dir, dataset_df=slides_df)
+
+    output_dir = tmp_path / "tiles"
+    kwargs = dict(slides_dataset=slides_dataset, root_output_dir=output_dir, level=1, tile_size=32, margin=0,
+                  foreground_threshold=None, occupancy_threshold=0.1, parallel=parallel, num_workers=2,
+                  memory_budget_gb=1., metadata_cache_dir=tmp_path / "metadata")
+    main(**kwargs)  # type: ignore
+    assert len(list((tmp_path / "metadata").glob("*.json"))) == len(sizes)
+    manifest = SlideManifest(output_dir)
+    assert sorted(manifest.slide_ids) == sorted(sizes)
+    if not parallel:
+        assert manifest.slide_ids == ['large', 'small']  # largest first
+    expected_csv = (output_dir / "large" / "dataset.csv").read_text()
+    assert manifest.records['large']['n_tiles'] == len(expected_csv.splitlines()) - 1
+
+    # Simulate an interrupted run: 'large' is not recorded as complete and its outputs are partial
+    manifest_path = output_dir / MANIFEST_FILENAME
+    small_record = [line for line in manifest_path.read_text().splitlines() if '"small"' in line][0]
+    manifest_path.write_text(small_record + '\n')
+    (output_dir / "large" / "dataset.csv").write_text("partial")
+    small_csv_mtime = (output_dir / "small" / "dataset.csv").stat().st_mtime
+
+    main(**kwargs)  # type: ignore
+    assert sorted(SlideManifest(output_dir).slide_ids) == sorted(sizes)
+    assert (output_dir / "large" / "dataset.csv").read_text() == expected_csv
+    assert (output_dir / "small" / "dataset.csv").stat().st_mtime == small_csv_mtime  # not reprocessed
+
+
+def test_main_resumes_after_crash_before_first_slide(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    slides_dir = tmp_path / "slides"
+    create_synthetic_pyramidal_tiff(slides_dir / "A.tiff", width=512, height=512)
+    slides_df = pd.DataFrame({'slide_id': ['A'], 'image': ["A.tiff"], 'label': [0]})
+    output_dir = tmp_path / "tiles"
+    kwargs = dict(slides_dataset=SlidesDataset(slides_dir, dataset_df=slides_df), root_output_dir=output_dir,
+                  level=1, tile_size=32, margin=0, foreground_threshold=None, occupancy_threshold=0.1)
+
+    def _crash_after_partial_output(sample: dict, output_dir: Path, **kwargs: Any) -> None:
+        (output_dir / sample[SlideKey.SLIDE_ID]).mkdir()
+        (output_dir / sample[SlideKey.SLIDE_ID] / "dataset.csv").write_text("partial")
+        raise RuntimeError("Crashed")
+
+    monkeypatch.setattr(create_tiles_dataset, 'process_slide', _crash_after_partial_output)
+    with pytest.raises(RuntimeError, match="Crashed"):
+        main(**kwargs)  # type: ignore
+    assert (output_dir / MANIFEST_FILENAME).exists()
+    monkeypatch.undo()
+
+    main(**kwargs)  # type: ignore
+    assert SlideManifest(output_dir).slide_ids == ['A']
+    assert (output_dir / "A" / "dataset.csv").read_text() != "partial"
+
+
+def test_merge_dataset_csv_files_from_manifest(tmp_path: Path) -> None:
+    header = "slide_id,tile_id,image,label,tile_x,tile_y\n"
+    for slide_id in ['a', 'b', 'stale']:
+        (tmp_path / slide_id).mkdir()
+        (tmp_path / slide_id / "dataset.csv").write_text(header + f"{slide_id},{slide_id}.0,{slide_id}/0.png,1,0,32\n")
+    manifest = SlideManifest(tmp_path)
+    for slide_id in ['b', 'a']:
+        manifest.mark_complete({'slide_id': slide_id, 'dataset_csv': f"{slide_id}/dataset.csv"})
+
+    dataset_csv = merge_dataset_csv_files(tmp_path)
+    merged_df = pd.read_csv(dataset_csv)
+    assert merged_df['slide_id'].tolist() == ['b', 'a']  # only completed slides, in order of completion
+
+    index_path = write_dataset_index(dataset_csv)
+    assert index_path == tmp_path / TilesDataset.DEFAULT_INDEX_FILENAME
+    index_df = pd.read_parquet(index_path)
+    assert isinstance(index_df['slide_id'].dtype, pd.CategoricalDtype)
+    assert index_df['tile_x'].dtype == np.int32 and index_df['tile_y'].dtype == np.int32
+    pd.testing.assert_frame_equal(index_df.astype({'slide_id': str, 'tile_x': np.int64, 'tile_y': np.int64}),
+                                  merged_df)
+
+
+def test_datasets_load_parquet_index(tmp_path: Path) -> None:
+    tiles_df = pd.DataFrame({'slide_id': ['a', 'a', 'b'], 'tile_id': ['a.0', 'a.1', 'b.0'],
+                             'image': ['a/0.png', 'a/1.png', 'b/0.png'], 'label': [1, 1, 0], 'split': 'train',
+                             'tile_x': [0, 32, 0], 'tile_y': [0, 0, 32], 'occupancy': [1., .5, .2]})
+    tiles_df.to_csv(tmp_path / TilesDataset.DEFAULT_CSV_FILENAME, index=False)
+    dataset = TilesDataset(tmp_path)
+    assert dataset.dataset_csv == tmp_path / TilesDataset.DEFAULT_CSV_FILENAME
+    assert 'occupancy' in dataset.dataset_df
+
+    write_dataset_index(tmp_path / TilesDataset.DEFAULT_CSV_FILENAME)
+    dataset = TilesDataset(tmp_path, columns=[])
+    assert dataset.dataset_csv == tmp_path / TilesDataset.DEFAULT_INDEX_FILENAME
+    assert 'occupancy' not in dataset.dataset_df  # column projection
+    assert dataset.get_slide_labels().to_dict() == {'a': 1, 'b': 0}
+
+    slides_df = pd.DataFrame({'slide_id': ['a', 'b'], 'image': ['a.tiff', 'b.tiff'], 'label': [1, 0],
+                              'extra': ['x', 'y']})
+    slides_df.to_parquet(tmp_path / SlidesDataset.DEFAULT_INDEX_FILENAME, index=False)
+    slides_dataset = SlidesDataset(tmp_path, columns=[])
+    assert slides_dataset.dataset_csv == tmp_path / SlidesDataset.DEFAULT_INDEX_FILENAME
+    assert list(slides_dataset.dataset_df.columns) == ['image', 'label']
+
+    # The index is ignored once the CSV is edited after it was written
+    csv_path = tmp_path / TilesDataset.DEFAULT_CSV_FILENAME
+    tiles_df[tiles_df['slide_id'] == 'a'].to_csv(csv_path, index=False)
+    index_mtime_ns = (tmp_path / TilesDataset.DEFAULT_INDEX_FILENAME).stat().st_mtime_ns
+    os.utime(csv_path, ns=(index_mtime_ns + 1_000_000_000, index_mtime_ns + 1_000_000_000))
+    dataset = TilesDataset(tmp_path)
+    assert dataset.dataset_csv == csv_path
+    assert set(dataset.dataset_df['slide_id']) == {'a'}
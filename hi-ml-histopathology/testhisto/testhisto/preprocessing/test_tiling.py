@@ -3,10 +3,13 @@
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
 
+from pathlib import Path
+
 import numpy as np
 import pytest
 
-from histopathology.preprocessing.tiling import assemble_tiles_2d, get_1d_padding, \
+from histopathology.preprocessing.tiling import _scatter_tiles_loop, assemble_tiles_2d, \
+    assemble_tiles_2d_out_of_core, extract_tiles_2d, get_1d_padding, get_tile_coords_2d, get_tile_views_2d, \
     pad_for_tiling_2d, tile_array_2d
 
 
@@ -128,3 +131,109 @@ def test_assemble_tiles_2d(width: int, height: int, tile_size: int, channels_fir
         else:
             crop = assembled_array[row:row + tile_size, col:col + tile_size, :]
         assert np.array_equal(crop, tiles[idx])
+
+
+def _assemble_tiles_2d_loop(tiles: np.ndarray, coords: np.ndarray, fill_value: float,
+                            channels_first: bool) -> np.ndarray:
+    tile_size = tiles.shape[2] if channels_first else tiles.shape[1]
+    xs, ys = coords.T
+    height, width = ys.max() - ys.min() + tile_size, xs.max() - xs.min() + tile_size
+    channels = tiles.shape[1] if channels_first else tiles.shape[-1]
+    expected_array = np.full((channels, height, width) if channels_first else (height, width, channels), fill_value)
+    _scatter_tiles_loop(expected_array, tiles, coords, np.array([-xs.min(), -ys.min()]), channels_first)
+    return expected_array
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize("channels_first", [True, False])
+@pytest.mark.parametrize("aligned", [True, False])
+def test_assemble_tiles_2d_matches_loop(channels_first: bool, aligned: bool) -> None:
+    rng = np.random.default_rng(0)
+    tile_size = 4
+    n_tiles = 20
+    tile_shape = (3, tile_size, tile_size) if channels_first else (tile_size, tile_size, 3)
+    tiles = rng.integers(0, 255, (n_tiles, *tile_shape))
+    # Sparse random subset of a grid, with arbitrary negative origin and shuffled order
+    grid_indices = rng.choice(10 * 8, size=n_tiles, replace=False)
+    coords = tile_size * np.stack([grid_indices % 10, grid_indices // 10], axis=-1) - 6
+    if not aligned:
+        coords[0] += 1  # forces the fallback to the tile-by-tile loop
+
+    expected_array = _assemble_tiles_2d_loop(tiles, coords, fill_value=-1, channels_first=channels_first)
+    assembled_array, offset = assemble_tiles_2d(tiles, coords, fill_value=-1, channels_first=channels_first)
+    assert assembled_array.dtype == expected_array.dtype
+    assert np.array_equal(assembled_array, expected_array)
+    assert np.array_equal(offset, -coords.min(axis=0))
+
+
+@pytest.mark.parametrize("channels_first", [True, False])
+@pytest.mark.parametrize("chunk_size", [1, 7, 100])
+def test_assemble_tiles_2d_out_of_core(tmp_path: Path, channels_first: bool, chunk_size: int) -> None:
+    array = _get_2d_meshgrid(13, 10, channels_first)
+    tiles, coords = tile_array_2d(array, tile_size=4, channels_first=channels_first)
+    tiles, coords = tiles[1:], coords[1:]  # leave a gap to be filled
+
+    expected_array, expected_offset = assemble_tiles_2d(tiles, coords, channels_first=channels_first)
+    output_path = tmp_path / "assembled.npy"
+    assembled_array, offset = assemble_tiles_2d_out_of_core(tiles, coords, output_path,
+                                                            channels_first=channels_first, chunk_size=chunk_size)
+    assert isinstance(assembled_array, np.memmap)
+    assert np.array_equal(assembled_array, expected_array, equal_nan=True)
+    assert np.array_equal(offset, expected_offset)
+    assert np.array_equal(np.load(output_path, mmap_mode='r'), expected_array, equal_nan=True)
+
+    uint8_array, _ = assemble_tiles_2d_out_of_core(tiles.astype(np.uint8), coords, tmp_path / "uint8.npy",
+                                                   fill_value=255, channels_first=channels_first, dtype=np.uint8)
+    assert uint8_array.dtype == np.uint8
+    assert np.array_equal(uint8_array, np.nan_to_num(expected_array, nan=255).astype(np.uint8))
+
+    with pytest.raises(ValueError):
+        assemble_tiles_2d_out_of_core(tiles, coords, output_path, chunk_size=0)
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize("width,height", [(8, 6), (3, 10)])
+@pytest.mark.parametrize("tile_size", [3, 4, 5])
+@pytest.mark.parametrize("channels_first", [True, False])
+def test_extract_tiles_2d_matches_tile_array_2d(width: int, height: int, tile_size: int,
+                                                channels_first: bool) -> None:
+    array = _get_2d_meshgrid(width, height, channels_first)
+    expected_tiles, expected_coords = tile_array_2d(array, tile_size, channels_first, constant_values=-1)
+
+    coords = get_tile_coords_2d(height, width, tile_size)
+    assert np.array_equal(coords, expected_coords)
+    tiles = extract_tiles_2d(array, coords, tile_size, channels_first, fill_value=-1)
+    assert np.array_equal(tiles, expected_tiles)
+
+    # Only a subset of tiles is materialized, in the requested order
+    subset = np.arange(len(coords))[::-2]
+    assert np.array_equal(extract_tiles_2d(array, coords[subset], tile_size, channels_first, fill_value=-1),
+                          expected_tiles[subset])
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize("channels_first", [True, False])
+def test_get_tile_views_2d_overlapping(channels_first: bool) -> None:
+    width, height, tile_size, stride = 9, 7, 4, 2
+    array = _get_2d_meshgrid(width, height, channels_first)
+    views = get_tile_views_2d(array, tile_size, stride=stride, channels_first=channels_first)
+    assert views.shape[:2] == (2, 3)
+    assert np.shares_memory(views, array)
+    assert not views.flags.writeable
+    for i in range(views.shape[0]):
+        for j in range(views.shape[1]):
+            row, col = i * stride, j * stride
+            if channels_first:
+                expected_tile = array[:, row:row + tile_size, col:col + tile_size]
+            else:
+                expected_tile = array[row:row + tile_size, col:col + tile_size, :]
+            assert np.array_equal(views[i, j], expected_tile)
+
+    # Overlapping grid covering the whole array, overhanging its edges symmetrically
+    coords = get_tile_coords_2d(height, width, tile_size, stride=stride)
+    xs, ys = np.unique(coords[:, 0]), np.unique(coords[:, 1])
+    assert np.array_equal(np.diff(xs), [stride] * (len(xs) - 1))
+    assert xs[0] <= 0 and xs[-1] + tile_size >= width and xs[0] + xs[-1] + tile_size - width in (0, 1)
+    assert ys[0] <= 0 and ys[-1] + tile_size >= height and ys[0] + ys[-1] + tile_size - height in (0, 1)
+    tiles = extract_tiles_2d(array, coords, tile_size, channels_first, fill_value=-1)
+    assert tiles.shape[0] == len(xs) * len(ys)
@@ -0,0 +1,77 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from pathlib import Path
+
+import numpy as np
+import pytest
+from monai.data.image_reader import WSIReader
+
+from histopathology.preprocessing.loading import LoadROId
+from histopathology.preprocessing.slide_scheduler import get_slide_dimensions
+from histopathology.preprocessing.wsi_readers import SlideReader, WSIBackend, get_slide_reader
+from histopathology.utils.naming import SlideKey
+from testhisto.utils.synthetic_slides import create_synthetic_pyramidal_tiff
+
+
+@pytest.fixture(scope='module')
+def synthetic_slide_path(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    # Level dimensions are not exact multiples of the downsampling factor or of the TIFF tile size
+    path = tmp_path_factory.mktemp("slides") / "slide.tiff"
+    create_synthetic_pyramidal_tiff(path, width=1000, height=700, n_levels=3, seed=4)
+    return path
+
+
+def _get_reader(backend: WSIBackend) -> SlideReader:
+    if backend == WSIBackend.OPENSLIDE:
+        pytest.importorskip("openslide")
+    return get_slide_reader(backend)
+
+
+@pytest.mark.parametrize("backend", list(WSIBackend))
+def test_read_region_matches_monai_reader(synthetic_slide_path: Path, backend: WSIBackend) -> None:
+    monai_reader = WSIReader('cuCIM')
+    reader = _get_reader(backend)
+    expected_obj = monai_reader.read(str(synthetic_slide_path))
+    slide_obj = reader.read(synthetic_slide_path)
+
+    expected_dims = expected_obj.resolutions['level_dimensions']
+    assert reader.get_level_dims(slide_obj) == [tuple(dims) for dims in expected_dims]
+    assert np.allclose(reader.get_level_downsamples(slide_obj), expected_obj.resolutions['level_downsamples'])
+
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        level = int(rng.integers(3))
+        # Regions may extend beyond the slide, with negative or out-of-bounds locations
+        row, col = rng.integers(-200, 1100, size=2)
+        height, width = rng.integers(1, 300, size=2)
+        location, size = (int(row), int(col)), (int(height), int(width))
+        expected, _ = monai_reader.get_data(expected_obj, location=location, size=size, level=level)
+        region = reader.read_region(slide_obj, location=location, size=size, level=level)
+        assert region.dtype == np.uint8
+        assert np.array_equal(region, expected)
+
+    for level in range(3):
+        expected, _ = monai_reader.get_data(expected_obj, size=expected_dims[level][::-1], level=level)
+        region, _ = reader.get_data(slide_obj, level=level)
+        assert np.array_equal(region, expected)
+    slide_obj.close()
+    expected_obj.close()
+
+
+@pytest.mark.parametrize("backend", list(WSIBackend))
+def test_load_roi_with_slide_reader(synthetic_slide_path: Path, backend: WSIBackend) -> None:
+    expected = LoadROId(WSIReader('cuCIM'), level=1, margin=4)({SlideKey.IMAGE: str(synthetic_slide_path)})
+    sample = LoadROId(_get_reader(backend), level=1, margin=4)({SlideKey.IMAGE: str(synthetic_slide_path)})
+    assert sample[SlideKey.ORIGIN] == expected[SlideKey.ORIGIN]
+    assert sample[SlideKey.FOREGROUND_THRESHOLD] == expected[SlideKey.FOREGROUND_THRESHOLD]
+    assert np.array_equal(sample[SlideKey.IMAGE], expected[SlideKey.IMAGE])
+
+
+def test_get_slide_reader(synthetic_slide_path: Path) -> None:
+    assert get_slide_reader('tifffile').backend == WSIBackend.TIFFFILE
+    assert get_slide_reader().backend == WSIBackend.CUCIM
+    with pytest.raises(ValueError):
+        get_slide_reader('unknown')
+    assert get_slide_dimensions(synthetic_slide_path, level=2, wsi_backend=WSIBackend.TIFFFILE) == (63, 44)
@@ -0,0 +1,94 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+import tifffile
+
+
+def create_synthetic_slide_array(width: int, height: int, n_blobs: int = 8, seed: int = 0) -> np.ndarray:
+    """Create a deterministic RGB image resembling a tissue section on a bright background.
+
+    :param width: Image width, in pixels.
+    :param height: Image height, in pixels.
+    :param n_blobs: Number of elliptical tissue-like blobs to draw.
+    :param seed: Seed for the pseudorandom number generator.
+    :return: The image array in (H, W, C) format, with `uint8` values.
+    """
+    rng = np.random.default_rng(seed)
+    image = rng.integers(225, 250, size=(height, width, 3), dtype=np.uint8)
+    ys, xs = np.ogrid[:height, :width]
+    for _ in range(n_blobs):
+        center_x, center_y = rng.uniform(0.2, 0.8) * width, rng.uniform(0.2, 0.8) * height
+        radius_x, radius_y = rng.uniform(0.05, 0.2) * width, rng.uniform(0.05, 0.2) * height
+        inside = ((xs - center_x) / radius_x) ** 2 + ((ys - center_y) / radius_y) ** 2 <= 1
+        colour = rng.integers([120, 40, 100], [200, 120, 180])  # pink/purple H&E-like hues
+        noise = rng.integers(-20, 20, size=(int(inside.sum()), 3))
+        image[inside] = np.clip(colour + noise, 0, 255).astype(np.uint8)
+    return image
+
+
+def create_synthetic_mask_array(image: np.ndarray, threshold: int = 200, resolution: int = 8,
+                                block_size: int = 64) -> np.ndarray:
+    """Create a PANDA-like label mask for a synthetic slide image.
+
+    Like manual annotations, the mask is smooth at the pixel level: tissue is segmented from the average
+    luminance of blocks of `resolution` pixels, and divided into larger blocks with different labels.
+
+    :param image: Image array in (H, W, C) format, as returned by `create_synthetic_slide_array()`.
+    :param threshold: Average luminance below which blocks are labelled as tissue.
+    :param resolution: Size of the square blocks over which luminance is averaged, in pixels.
+    :param block_size: Size of the square blocks into which tissue is divided, each labelled with a class from
+    1 to 5.
+    :return: The mask array in (H, W, C) format, with `uint8` labels in the first channel and zeros elsewhere.
+    """
+    height, width = image.shape[:2]
+    n_blocks_h, n_blocks_w = -(-height // resolution), -(-width // resolution)
+    luminance = np.full((n_blocks_h * resolution, n_blocks_w * resolution), 255.)
+    luminance[:height, :width] = image.mean(axis=-1)
+    block_luminance = luminance.reshape(n_blocks_h, resolution, n_blocks_w, resolution).mean(axis=(1, 3))
+    tissue = np.kron(block_luminance < threshold, np.ones((resolution, resolution), dtype=bool))[:height, :width]
+    ys, xs = np.ogrid[:height, :width]
+    labels = 1 + (ys // block_size + xs // block_size) % 5
+    mask = np.zeros_like(image)
+    mask[..., 0] = np.where(tissue, labels, 0)
+    return mask
+
+
+def write_pyramidal_tiff(path: Path, image: np.ndarray, n_levels: int = 3, downsample: int = 4,
+                         tile_size: int = 128) -> None:
+    """Write an image as a multi-resolution TIFF that can be read by cuCIM, downsampling by subsampling.
+
+    :param path: Output file path.
+    :param image: The level-0 image array in (H, W, C) format.
+    :param n_levels: Number of pyramid levels.
+    :param downsample: Downsampling factor between consecutive levels.
+    :param tile_size: Size of the TIFF storage tiles (must be a multiple of 16).
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tifffile.TiffWriter(path, bigtiff=True) as tiff:
+        for level in range(n_levels):
+            factor = downsample ** level
+            tiff.write(image[::factor, ::factor], tile=(tile_size, tile_size), photometric='rgb',
+                       subfiletype=1 if level > 0 else 0)
+
+
+def create_synthetic_pyramidal_tiff(path: Path, width: int = 1536, height: int = 1024, n_levels: int = 3,
+                                    downsample: int = 4, tile_size: int = 128, seed: int = 0) -> Tuple[int, int]:
+    """Write a deterministic synthetic multi-resolution TIFF that can be read by cuCIM.
+
+    :param path: Output file path.
+    :param width: Width of the level-0 image, in pixels.
+    :param height: Height of the level-0 image, in pixels.
+    :param n_levels: Number of pyramid levels.
+    :param downsample: Downsampling factor between consecutive levels.
+    :param tile_size: Size of the TIFF storage tiles (must be a multiple of 16).
+    :param seed: Seed for the pseudorandom number generator.
+    :return: The level-0 width and height.
+    """
+    image = create_synthetic_slide_array(width, height, seed=seed)
+    write_pyramidal_tiff(path, image, n_levels=n_levels, downsample=downsample, tile_size=tile_size)
+    return width, height
@@ -0,0 +1,75 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import os
+from pathlib import Path
+from typing import Callable, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+from monai.transforms import Compose
+
+from histopathology.models.encoders import TileEncoder
+from histopathology.models.transforms import EncodeTilesBatchd, LoadTilesBatchd
+from histopathology.utils.cache_utils import (evict_least_recently_used, get_dataframe_fingerprint, get_fingerprint,
+                                              touch_cache_entry)
+
+
+class _LinearEncoder(TileEncoder):
+    def _get_encoder(self) -> Tuple[Callable, int]:
+        return torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(int(np.prod(self.input_dim)), 4)), 4
+
+
+def _get_transform(encoder: TileEncoder, **load_kwargs: bool) -> Compose:
+    return Compose([LoadTilesBatchd('image', **load_kwargs), EncodeTilesBatchd('image', encoder)])
+
+
+def test_transform_fingerprint() -> None:
+    torch.manual_seed(0)
+    encoder = _LinearEncoder(tile_size=8)
+    fingerprint = get_fingerprint(_get_transform(encoder))
+    assert get_fingerprint(_get_transform(encoder)) == fingerprint
+    # Parameters not affecting the transformed data are ignored
+    assert get_fingerprint(_get_transform(encoder, progress=True)) == fingerprint
+
+    torch.manual_seed(0)
+    assert get_fingerprint(_get_transform(_LinearEncoder(tile_size=8))) == fingerprint
+    assert get_fingerprint(_get_transform(_LinearEncoder(tile_size=8))) != fingerprint  # different weights
+    assert get_fingerprint(_get_transform(encoder, as_uint8=True)) != fingerprint
+    assert get_fingerprint(Compose([LoadTilesBatchd('image')])) != fingerprint
+
+    with torch.no_grad():
+        encoder.feature_extractor_fn[1].weight[0, 0] += 1  # type: ignore
+    assert get_fingerprint(_get_transform(encoder)) != fingerprint
+
+
+def test_dataframe_fingerprint() -> None:
+    df = pd.DataFrame({'slide_id': ['a', 'a', 'b'], 'image': ['0.png', '1.png', '2.png'], 'label': [0, 0, 1]})
+    fingerprint = get_dataframe_fingerprint(df)
+    assert get_dataframe_fingerprint(df.copy()) == fingerprint
+    assert get_dataframe_fingerprint(df.iloc[:2]) != fingerprint
+    assert get_dataframe_fingerprint(df.set_index('image')) != fingerprint
+    assert get_dataframe_fingerprint(df.assign(label=[0, 1, 1])) != fingerprint
+
+
+def test_evict_least_recently_used(tmp_path: Path) -> None:
+    (tmp_path / "other").write_bytes(bytes(1000))
+    entry_a, entry_b, entry_c = tmp_path / "entry_a", tmp_path / "entry_b", tmp_path / "entry_c.pt"
+    entry_a.mkdir()
+    (entry_a / "data.bin").write_bytes(bytes(100))
+    entry_b.mkdir()
+    (entry_b / "data.bin").write_bytes(bytes(100))
+    entry_c.write_bytes(bytes(100))
+    for age, entry in enumerate([entry_c, entry_b, entry_a]):
+        os.utime(entry, (1000 - age, 1000 - age))
+    touch_cache_entry(entry_a)  # entry_a is now the most recently used
+
+    assert evict_least_recently_used(tmp_path, max_size=300, prefixes=['entry_']) == []
+    # Recently used entries may still be in use by another process
+    assert evict_least_recently_used(tmp_path, max_size=0, prefixes=['entry_'], min_age=3600,
+                                     keep=[entry_b, entry_c]) == []
+    assert evict_least_recently_used(tmp_path, max_size=250, prefixes=['entry_'], keep=[entry_b]) == [entry_c]
+    assert evict_least_recently_used(tmp_path, max_size=150, prefixes=['entry_']) == [entry_b]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["entry_a", "other"]
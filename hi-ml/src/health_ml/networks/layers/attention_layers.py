@@ -13,10 +13,92 @@ import torch.nn.functional as F
 from torch.nn import Module, TransformerEncoderLayer
 
 
+def get_bag_lengths(bag_offsets: Tensor) -> Tensor:
+    """Get the number of instances in each bag of a packed batch.
+
+    :param bag_offsets: Offsets of the bags in the packed instances, of length `B + 1`, starting at 0 and ending at
+    the total number of instances `N`.
+    :return: The lengths of the `B` bags.
+    """
+    return bag_offsets[1:] - bag_offsets[:-1]
+
+
+def _get_bag_indices(bag_offsets: Tensor) -> Tensor:
+    """Get the index of the bag of each instance of a packed batch."""
+    bag_lengths = get_bag_lengths(bag_offsets)
+    return torch.repeat_interleave(torch.arange(len(bag_lengths), device=bag_offsets.device), bag_lengths)
+
+
+def _pack_indices(bag_offsets: Tensor) -> Tuple[Tensor, Tensor, int]:
+    """Get the bag index and the position within its bag of each instance of a packed batch, and the length of the
+    largest bag."""
+    bag_lengths = get_bag_lengths(bag_offsets)
+    bag_indices = _get_bag_indices(bag_offsets)
+    positions = torch.arange(int(bag_offsets[-1]), device=bag_offsets.device) - bag_offsets[bag_indices]
+    return bag_indices, positions, int(bag_lengths.max())
+
+
+def _pad_packed(values: Tensor, bag_offsets: Tensor, fill_value: float) -> Tuple[Tensor, Tensor, Tensor]:
+    """Scatter the packed values of a batch of bags (N x ...) into a padded tensor (B x max(N_b) x ...).
+
+    :return: The padded values, and the bag index and the position within its bag of each packed instance, to
+    gather the packed values back from the padded tensor.
+    """
+    bag_indices, positions, max_length = _pack_indices(bag_offsets)
+    padded = values.new_full((len(bag_offsets) - 1, max_length, *values.shape[1:]), fill_value)
+    padded[bag_indices, positions] = values
+    return padded, bag_indices, positions
+
+
+def segment_softmax(scores: Tensor, bag_offsets: Tensor) -> Tensor:
+    """Softmax over the instances of each bag of a packed batch.
+
+    :param scores: The packed scores of all instances (N x K).
+    :param bag_offsets: Offsets of the bags in the packed instances, of length `B + 1`.
+    :return: The packed softmax weights (N x K), summing to 1 over the instances of each bag.
+    """
+    padded_scores, bag_indices, positions = _pad_packed(scores, bag_offsets, fill_value=-float('inf'))
+    return F.softmax(padded_scores, dim=1)[bag_indices, positions]
+
+
+def _attention_pooling(attention_scores: Tensor, features: Tensor,
+                       bag_offsets: Optional[Tensor]) -> Tuple[Tensor, Tensor]:
+    """Pool the features of one bag (N x L) or of a packed batch of bags with the given attention scores (N x K).
+
+    :return: The attention weights (K x N) and the pooled features, K x L for a single bag or B x K x L for a packed
+    batch.
+    """
+    if bag_offsets is None:
+        attention_weights = transpose(attention_scores, 1, 0)   # K x N
+        attention_weights = F.softmax(attention_weights, dim=1)  # Softmax over N : K x N
+        pooled_features = mm(attention_weights, features)        # Matrix multiplication : K x L
+        return attention_weights, pooled_features
+    packed_weights = segment_softmax(attention_scores, bag_offsets)                      # N x K
+    bag_indices = _get_bag_indices(bag_offsets)
+    weighted_features = packed_weights.unsqueeze(2) * features.unsqueeze(1)              # N x K x L
+    pooled_features = features.new_zeros((len(bag_offsets) - 1, *weighted_features.shape[1:]))
+    pooled_features.index_add_(0, bag_indices, weighted_features)                        # B x K x L
+    return transpose(packed_weights, 1, 0), pooled_features
+
+
 class MeanPoolingLayer(nn.Module):
     """Mean pooling returns uniform weights and the average feature vector over the first axis"""
 
-    def forward(self, features: Tensor) -> Tuple[Tensor, Tensor]:
+    def forward(self, features: Tensor, bag_offsets: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:
+        """
+        :param features: The features of the instances of one bag (N x L), or of a packed batch of bags.
+        :param bag_offsets: If given, offsets of the bags in the packed `features`, of length `B + 1`.
+        :return: The attention weights (1 x N) and the pooled features, 1 x L for a single bag or B x 1 x L for a
+        packed batch.
+        """
+        if bag_offsets is not None:
+            bag_lengths = get_bag_lengths(bag_offsets)
+            bag_indices = _get_bag_indices(bag_offsets)
+            summed_features = features.new_zeros((len(bag_lengths), features.shape[1]))
+            summed_features.index_add_(0, bag_indices, features)
+            pooled_features = summed_features / bag_lengths.unsqueeze(1).to(features.dtype)
+            attention_weights = (1. / bag_lengths.to(features.dtype))[bag_indices]
+            return (attention_weights.view(1, -1), pooled_features.unsqueeze(1))
         num_instances = features.shape[0]
         attention_weights = torch.full((1, num_instances), 1. / num_instances)
         pooled_features = features.mean(dim=0)
@@ -27,8 +109,21 @@ class MeanPoolingLayer(nn.Module):
 class MaxPoolingLayer(nn.Module):
     """Max pooling returns uniform weights and the maximum feature vector over the first axis"""
 
-    def forward(self, features: Tensor) -> Tuple[Tensor, Tensor]:
+    def forward(self, features: Tensor, bag_offsets: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:
+        """
+        :param features: The features of the instances of one bag (N x L), or of a packed batch of bags.
+        :param bag_offsets: If given, offsets of the bags in the packed `features`, of length `B + 1`.
+        :return: The attention weights (1 x N), i.e. the fraction of features for which each instance is the
+        maximum in its bag, and the pooled features, 1 x L for a single bag or B x 1 x L for a packed batch.
+        """
         num_instances = features.shape[0]
+        if bag_offsets is not None:
+            padded_features, _, _ = _pad_packed(features, bag_offsets, fill_value=-float('inf'))
+            pooled_features, indices = padded_features.max(dim=1)                 # B x L
+            packed_indices = indices + bag_offsets[:-1].unsqueeze(1)
+            frequency = torch.bincount(packed_indices.flatten(), minlength=num_instances)
+            attention_weights = (frequency / features.shape[1]).view(1, num_instances)
+            return (attention_weights, pooled_features.unsqueeze(1))
         pooled_features, indices = features.max(dim=0)
         frequency = torch.bincount(indices, minlength=num_instances)
         frequency_norm = frequency / sum(frequency)
@@ -57,13 +152,17 @@ class AttentionLayer(nn.Module):
             nn.Linear(self.hidden_dims, self.attention_dims)
         )
 
-    def forward(self, features: Tensor) -> Tuple[Tensor, Tensor]:
+    def forward(self, features: Tensor, bag_offsets: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:
+        """
+        :param features: The features of the instances of one bag (N x L), or of a packed batch of bags.
+        :param bag_offsets: If given, offsets of the bags in the packed `features`, of length `B + 1`, and the
+        attention weights are normalised over the instances of each bag.
+        :return: The attention weights (K x N) and the pooled features, K x L for a single bag or B x K x L for a
+        packed batch.
+        """
         features = features.view(-1, self.input_dims)            # N x L
         attention_weights = self.attention(features)             # N x K
-        attention_weights = transpose(attention_weights, 1, 0)   # K x N
-        attention_weights = F.softmax(attention_weights, dim=1)  # Softmax over N : K x N
-        pooled_features = mm(attention_weights, features)        # Matrix multiplication : K x L
-        return(attention_weights, pooled_features)
+        return _attention_pooling(attention_weights, features, bag_offsets)
 
 
 class GatedAttentionLayer(nn.Module):
@@ -90,15 +189,23 @@ class GatedAttentionLayer(nn.Module):
         )
         self.attention_weights = nn.Linear(self.hidden_dims, self.attention_dims)
 
-    def forward(self, features: Tensor) -> Tuple[Tensor, Tensor]:
+    def forward(self, features: Tensor, bag_offsets: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:
+        """
+        :param features: The features of the instances of one bag (N x L), or of a packed batch of bags.
+        :param bag_offsets: If given, offsets of the bags in the packed `features`, of length `B + 1`, and the
+        attention weights are normalised over the instances of each bag.
+        :return: The attention weights (K x N) and the pooled features, K x L for a single bag or B x K x L for a
+        packed batch.
+        """
         features = features.view(-1, self.input_dims)            # N x L
         A_V = self.attention_V(features)                         # N x D
         A_U = self.attention_U(features)                         # N x D
         attention_weights = self.attention_weights(A_V * A_U)    # Element-wise multiplication : N x K
-        attention_weights = transpose(attention_weights, 1, 0)   # K x N
-        attention_weights = F.softmax(attention_weights, dim=1)  # Softmax over N : K x N
-        pooled_features = mm(attention_weights, features)        # Matrix multiplication : K x L
-        return(attention_weights, pooled_features)
+        return _attention_pooling(attention_weights, features, bag_offsets)
+
+
+# Pooling layers accepting packed batches of bags, with the `bag_offsets` argument of their `forward()` method
+PACKED_POOLING_LAYERS = (MeanPoolingLayer, MaxPoolingLayer, AttentionLayer, GatedAttentionLayer)
 
 
 class CustomTransformerEncoderLayer(TransformerEncoderLayer):
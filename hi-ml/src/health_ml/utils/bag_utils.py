@@ -1,8 +1,10 @@
-from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Sequence
+import logging
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import torch
 from torch.utils.data import DataLoader, Dataset, Sampler
+from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data._utils.collate import default_collate
 from math import ceil
 
@@ -23,7 +25,7 @@ class BagSampler(Sampler[List[int]]):
     """
 
     def __init__(self,
-                 bag_ids: Sequence,
+                 bag_ids: Union[Sequence, np.ndarray],
                  shuffle_bags: bool = False,
                  shuffle_samples: bool = False,
                  max_bag_size: int = 0,
@@ -41,11 +43,19 @@ class BagSampler(Sampler[List[int]]):
             seed.
         """
         self.unique_bag_ids, self.bag_indices = np.unique(bag_ids, return_inverse=True)
+        self._build_bag_index()
         self.shuffle_bags = shuffle_bags
         self.shuffle_samples = shuffle_samples
         self.max_bag_size = max_bag_size
         self.generator = generator
 
+    def _build_bag_index(self) -> None:
+        # Compressed sparse row (CSR) index: the samples of bag `i`, in increasing order, are
+        # `self.sorted_indices[self.bag_offsets[i]:self.bag_offsets[i + 1]]`
+        self.sorted_indices = np.argsort(self.bag_indices, kind='stable')
+        bag_sizes = np.bincount(self.bag_indices, minlength=len(self.unique_bag_ids))
+        self.bag_offsets = np.concatenate([[0], np.cumsum(bag_sizes)])
+
     def __iter__(self) -> Iterator[List[int]]:
         generator = self.generator or _create_generator()
         n_bags = len(self.unique_bag_ids)
@@ -56,7 +66,7 @@ class BagSampler(Sampler[List[int]]):
 
     def get_bag(self, bag_index: int, generator: Optional[torch.Generator] = None) \
             -> List[int]:
-        bag, = np.where(self.bag_indices == bag_index)
+        bag = self.sorted_indices[self.bag_offsets[bag_index]:self.bag_offsets[bag_index + 1]]
         if self.shuffle_samples:
             if generator is None:
                 generator = self.generator or _create_generator()
@@ -66,6 +76,11 @@ class BagSampler(Sampler[List[int]]):
             bag = bag[:self.max_bag_size]
         return bag.tolist()
 
+    def get_bag_sizes(self) -> np.ndarray:
+        """Get the number of samples returned for each bag, after truncation to `max_bag_size`."""
+        bag_sizes = np.diff(self.bag_offsets)
+        return np.minimum(bag_sizes, self.max_bag_size) if self.max_bag_size > 0 else bag_sizes
+
     def __len__(self) -> int:
         return len(self.unique_bag_ids)
 
@@ -81,6 +96,8 @@ class BagSampler(Sampler[List[int]]):
     def __setstate__(self, d: Dict) -> None:
         # Same here for restoring the torch.Generator state
         self.__dict__ = d
+        if 'bag_offsets' not in d:  # pickled before the bag index was introduced
+            self._build_bag_index()
         generator = None
         if d['generator'] is not None:
             generator = torch.Generator()
@@ -135,6 +152,256 @@ class BagDataset(Dataset):
         return self.collate_fn(bag_samples)
 
 
+class TileBudgetBatchSampler(Sampler[List[int]]):
+    """A batch sampler that groups bags of similar size into batches with a bounded total number of instances
+    (e.g. tiles), instead of a fixed number of bags.
+
+    At every epoch, bags are randomly split into buckets of `bucket_size` bags. Within each bucket, bags are sorted
+    by size and greedily grouped into batches of at most `max_instances_per_batch` instances in total, so that
+    batches contain many small bags or few large ones, and bags of similar sizes are batched together. A bag larger
+    than the budget forms a batch on its own. The order of the batches is then shuffled. It should be passed to a
+    `DataLoader` over a `BagDataset` as the `batch_sampler` argument, for example:
+
+    >>> sampler = TileBudgetBatchSampler([3, 1, 2, 4], max_instances_per_batch=4)
+    >>> list(sampler)
+    [[1, 2], [0], [3]]
+    >>> loader = DataLoader(bag_dataset, batch_sampler=sampler, collate_fn=multibag_collate)
+
+    The number of batches is the same at every epoch (see `get_num_batches()`), as PyTorch Lightning only reads the
+    length of a dataloader once: if the random packing of an epoch yields fewer batches, batches with the most bags
+    are split in two, and if it yields more, the bags are packed again in new random buckets (or, after
+    `NUM_REFERENCE_PACKINGS` attempts, in a single bucket).
+
+    In distributed training, the batches are partitioned across processes (ranks), each of which iterates the same
+    number of batches, repeating batches if needed. The batches only depend on the bag sizes, the seed and the
+    epoch, so they are computed independently and consistently on each rank. As PyTorch Lightning does not call
+    `set_epoch()` on batch samplers, the epoch is incremented automatically after every iteration, and the trainer
+    must be created with `replace_sampler_ddp=False` so that it does not try to replace this sampler.
+
+    The statistics of the batches of the last epoch are logged and available in `last_epoch_statistics` (see
+    `get_batch_statistics()`).
+    """
+
+    NUM_REFERENCE_PACKINGS = 10
+
+    def __init__(self,
+                 bag_sizes: Union[Sequence[int], np.ndarray],
+                 max_instances_per_batch: int,
+                 shuffle: bool = False,
+                 bucket_size: int = 0,
+                 num_replicas: Optional[int] = None,
+                 rank: Optional[int] = None,
+                 seed: int = 0) -> None:
+        """
+        :param bag_sizes: The number of instances in each bag, e.g. from `BagSampler.get_bag_sizes()`.
+        :param max_instances_per_batch: Upper bound on the total number of instances in each batch.
+        :param shuffle: Whether the bags should be assigned to buckets and the batches iterated in random order. If
+            `False`, bags are batched in order of size and the batches are iterated in a fixed order.
+        :param bucket_size: Number of bags in each bucket, trading off randomness (smaller buckets) against the
+            similarity of the sizes of bags in the same batch (larger buckets). If 0 (default), all bags are in a
+            single bucket.
+        :param num_replicas: Number of processes in the distributed group. By default, retrieved from the current
+            process group if distributed training is initialised, otherwise 1.
+        :param rank: Rank of the current process. By default, retrieved from the current process group if distributed
+            training is initialised, otherwise 0.
+        :param seed: Seed of the random shuffling, which must be identical across all processes.
+        """
+        if max_instances_per_batch <= 0:
+            raise ValueError(f"The instance budget of each batch must be positive, got {max_instances_per_batch}")
+        is_distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if is_distributed else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if is_distributed else 0
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"Invalid rank {rank}, rank should be in the interval [0, {num_replicas - 1}]")
+        self.bag_sizes = np.asarray(bag_sizes, dtype=np.int64)
+        self.max_instances_per_batch = max_instances_per_batch
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_batches = self.get_num_batches()
+        self.last_epoch_statistics: Dict[str, float] = {}
+
+    def _get_bag_sequence(self, generator: Optional[torch.Generator]) -> np.ndarray:
+        n_bags = len(self.bag_sizes)
+        return torch.randperm(n_bags, generator=generator).numpy() if generator is not None else np.arange(n_bags)
+
+    def _pack_bags(self, bag_sequence: np.ndarray, bucket_size: int) -> List[List[int]]:
+        batches: List[List[int]] = []
+        for bucket_start in range(0, len(bag_sequence), max(bucket_size, 1)):
+            bucket = bag_sequence[bucket_start:bucket_start + bucket_size]
+            # Sorting is stable, so bags of the same size stay in random order when shuffling
+            bucket = bucket[np.argsort(self.bag_sizes[bucket], kind='stable')]
+            batch: List[int] = []
+            n_batch_instances = 0
+            for bag_index in bucket.tolist():
+                bag_size = int(self.bag_sizes[bag_index])
+                if batch and n_batch_instances + bag_size > self.max_instances_per_batch:
+                    batches.append(batch)
+                    batch, n_batch_instances = [], 0
+                batch.append(bag_index)
+                n_batch_instances += bag_size
+            if batch:
+                batches.append(batch)
+        return batches
+
+    def _get_bucket_size(self) -> int:
+        n_bags = len(self.bag_sizes)
+        return min(self.bucket_size, n_bags) if self.bucket_size > 0 else n_bags
+
+    def get_num_batches(self) -> int:
+        """Compute the total number of batches of every epoch, across all ranks, before padding for distribution.
+
+        When shuffling, this is the largest number of batches among `NUM_REFERENCE_PACKINGS` random packings drawn
+        with the seed and the packing of all bags in a single bucket, so it only depends on the bag sizes and the
+        seed, and is identical across ranks.
+        """
+        bucket_size = self._get_bucket_size()
+        if not self.shuffle:
+            return len(self._pack_bags(self._get_bag_sequence(None), bucket_size))
+        generator = torch.Generator().manual_seed(self.seed)
+        n_batches = [len(self._pack_bags(self._get_bag_sequence(generator), bucket_size))
+                     for _ in range(self.NUM_REFERENCE_PACKINGS)]
+        # The number of batches of a single bucket does not depend on the order of the bags
+        n_batches.append(len(self._pack_bags(self._get_bag_sequence(None), len(self.bag_sizes))))
+        return max(n_batches)
+
+    def _create_batches(self) -> List[List[int]]:
+        generator = torch.Generator().manual_seed(self.seed + self.epoch) if self.shuffle else None
+        bucket_size = self._get_bucket_size()
+        for _ in range(self.NUM_REFERENCE_PACKINGS):
+            bag_sequence = self._get_bag_sequence(generator)
+            batches = self._pack_bags(bag_sequence, bucket_size)
+            if len(batches) <= self.num_batches:
+                break
+        else:
+            # Bags packed in a single bucket always fit within the number of batches
+            batches = self._pack_bags(bag_sequence, len(bag_sequence))
+        # Pad to the same number of batches at every epoch and on every rank, first splitting the batches with the
+        # most bags, which remain within the instance budget, then repeating batches if all have a single bag
+        n_total_batches = ceil(self.num_batches / self.num_replicas) * self.num_replicas
+        while len(batches) < n_total_batches:
+            largest_index = max(range(len(batches)), key=lambda i: len(batches[i]))
+            largest_batch = batches[largest_index]
+            if len(largest_batch) < 2:
+                batches = [batches[i % len(batches)] for i in range(n_total_batches)]
+                break
+            batches[largest_index] = largest_batch[:len(largest_batch) // 2]
+            batches.append(largest_batch[len(largest_batch) // 2:])
+        if generator is not None:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return batches[self.rank::self.num_replicas]
+
+    def get_batch_statistics(self, batches: Sequence[Sequence[int]]) -> Dict[str, float]:
+        """Compute how efficiently a list of batches uses the instance budget.
+
+        :param batches: The bag indices of each batch.
+        :return: A dictionary with the number of batches, the mean number of bags per batch, the packing efficiency,
+            i.e. the fraction of the instance budget of all batches filled with instances, and the padding efficiency,
+            i.e. the fraction of non-padding instances if the bags of each batch were padded to the largest one.
+        """
+        batch_sizes = [self.bag_sizes[list(batch)] for batch in batches]
+        n_instances = sum(int(sizes.sum()) for sizes in batch_sizes)
+        n_padded_instances = sum(len(sizes) * int(sizes.max()) for sizes in batch_sizes if len(sizes) > 0)
+        return {'num_batches': len(batches),
+                'mean_bags_per_batch': float(np.mean([len(batch) for batch in batches])) if batches else 0.0,
+                'packing_efficiency': n_instances / max(len(batches) * self.max_instances_per_batch, 1),
+                'padding_efficiency': n_instances / max(n_padded_instances, 1)}
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch of the next iteration, which determines the random batches when shuffling."""
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self._create_batches()
+        self.epoch += 1
+        self.last_epoch_statistics = self.get_batch_statistics(batches)
+        logging.info(f"Batched {len(self.bag_sizes)} bags into {len(batches)} batches of at most "
+                     f"{self.max_instances_per_batch} instances: "
+                     f"{self.last_epoch_statistics['mean_bags_per_batch']:.1f} bags per batch, packing efficiency "
+                     f"{self.last_epoch_statistics['packing_efficiency']:.1%}, padding efficiency "
+                     f"{self.last_epoch_statistics['padding_efficiency']:.1%}")
+        yield from batches
+
+    def __len__(self) -> int:
+        return ceil(self.num_batches / self.num_replicas)
+
+
+class TileBalancedDistributedSampler(DistributedSampler):
+    """A distributed sampler that partitions bags across processes (ranks) to balance the total number of
+    instances (e.g. tiles) of each rank, rather than only their number of bags.
+
+    As with `DistributedSampler`, every rank is assigned the same number of bags, padding with repeated bags if
+    needed, so that all ranks run the same number of steps. At every epoch, the bags are (optionally) shuffled, sorted
+    by decreasing size, and assigned in rounds of one bag per rank, following a greedy longest-processing-time
+    heuristic: in each round, the largest bag goes to the rank with the fewest instances so far. The rounds are then
+    iterated in a random order shared by all ranks, so that the bags processed by all ranks at the same step also
+    have similar sizes, and no rank waits for another with a much larger bag.
+
+    The assignment only depends on the bag sizes, the seed and the epoch, so it is computed independently and
+    consistently on each rank. Call `set_epoch()` at the start of every epoch to reshuffle the bags (done
+    automatically by PyTorch Lightning).
+    """
+
+    def __init__(self,
+                 dataset: Sequence,
+                 bag_sizes: Union[Sequence[int], np.ndarray],
+                 num_replicas: Optional[int] = None,
+                 rank: Optional[int] = None,
+                 shuffle: bool = True,
+                 seed: int = 0) -> None:
+        """
+        :param dataset: The dataset of bags, e.g. a `BagDataset` or a cached transformed version of it.
+        :param bag_sizes: The number of instances in each bag of the dataset, e.g. from `BagSampler.get_bag_sizes()`.
+        :param num_replicas: Number of processes in the distributed group. By default, retrieved from the current
+            process group.
+        :param rank: Rank of the current process. By default, retrieved from the current process group.
+        :param shuffle: Whether to shuffle the bags of equal size and the order of the rounds at every epoch.
+        :param seed: Seed of the random shuffling, which must be identical across all processes.
+        """
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)  # type: ignore
+        if len(bag_sizes) != len(dataset):
+            raise ValueError(f"Expected {len(dataset)} bag sizes, got {len(bag_sizes)}")
+        self.bag_sizes = np.asarray(bag_sizes, dtype=np.int64)
+
+    def get_assignment(self) -> np.ndarray:
+        """Compute the assignment of bags to ranks for the current epoch.
+
+        :return: An array of shape (num_samples, num_replicas), with the index of the bag processed by each rank at
+            each position of the epoch.
+        """
+        n_bags = len(self.bag_sizes)
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            bag_sequence = torch.randperm(n_bags, generator=generator).numpy()
+        else:
+            bag_sequence = np.arange(n_bags)
+        # Pad with repeated bags so that the bags can be evenly divided across ranks
+        n_padding = self.total_size - n_bags
+        bag_sequence = np.concatenate([bag_sequence, np.resize(bag_sequence, n_padding)])
+        # Sorting is stable, so bags of the same size stay in random order when shuffling
+        bag_sequence = bag_sequence[np.argsort(-self.bag_sizes[bag_sequence], kind='stable')]
+
+        rounds = bag_sequence.reshape(self.num_samples, self.num_replicas)
+        assignment = np.empty_like(rounds)
+        rank_loads = np.zeros(self.num_replicas, dtype=np.int64)
+        for round_index, round_bags in enumerate(rounds):
+            # Bags of the round are in decreasing size, so the largest goes to the least loaded rank
+            ranks = np.argsort(rank_loads, kind='stable')
+            assignment[round_index, ranks] = round_bags
+            rank_loads[ranks] += self.bag_sizes[round_bags]
+        if self.shuffle:
+            assignment = assignment[torch.randperm(self.num_samples, generator=generator).numpy()]
+        return assignment
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.get_assignment()[:, self.rank].tolist())
+
+
 class BatchedDataset(Dataset):
     """ A wrapper class that aggregates multiple bags in a batch"""
     # TODO: Just a stub for now; extend to enable shuffling and/or other batching strategies
@@ -175,6 +442,19 @@ def multibag_collate(batch: List) -> Any:
     return batch  # return other types as a plain list
 
 
+def pack_bags(bags: Sequence[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Pack a batch of bags of different sizes, e.g. the list of images of a batch from `multibag_collate()`, into a
+    single tensor, so they can be processed together without padding.
+
+    :param bags: The instances of each bag, with the same shape except along the first dimension.
+    :return: A tuple with all instances concatenated along the first dimension, and the offsets of the bags in it, of
+    length `len(bags) + 1`, such that the instances of bag `i` are `packed[offsets[i]:offsets[i + 1]]`.
+    """
+    lengths = torch.tensor([len(bag) for bag in bags], device=bags[0].device)
+    offsets = torch.cat([lengths.new_zeros(1), torch.cumsum(lengths, dim=0)])
+    return torch.cat(list(bags)), offsets
+
+
 def create_bag_dataloader(base_dataset: Sequence, bag_ids: Sequence,
                           *,  # make following arguments keyword-only to avoid confusion
                           shuffle_bags: bool, shuffle_samples: bool, max_bag_size: int = 0,
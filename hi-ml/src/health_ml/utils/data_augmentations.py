@@ -2,11 +2,33 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+from typing import Callable, Optional, Sequence
+
 import cv2
 import numpy as np
 import torch
 import torchvision.transforms.functional as TF
 
+# Mean and std per channel of the reference image used for Reinhard stain normalization, in OpenCV's 8-bit LAB scale
+REFERENCE_LAB_MEAN = (148.60, 169.30, 105.97)
+REFERENCE_LAB_STD = (41.56, 9.01, 6.67)
+
+# Reference H&E stain vectors (as columns, in optical density space) and maximum stain concentrations for Macenko
+# stain normalization, from Macenko et al. (2009)
+REFERENCE_HE_STAINS = ((0.5626, 0.2159),
+                       (0.7201, 0.8012),
+                       (0.4062, 0.5581))
+REFERENCE_MAX_HE_CONCENTRATIONS = (1.9705, 1.0308)
+
+# sRGB (D65) to CIE XYZ conversion matrices, as used by OpenCV
+_XYZ_FROM_RGB = ((0.412453, 0.357580, 0.180423),
+                 (0.212671, 0.715160, 0.072169),
+                 (0.019334, 0.119193, 0.950227))
+_RGB_FROM_XYZ = ((3.240479, -1.53715, -0.498535),
+                 (-0.969256, 1.875991, 0.041556),
+                 (0.055648, -0.204043, 1.057311))
+_D65_WHITE_POINT = (0.950456, 1., 1.088754)
+
 
 class HEDJitter(object):
     """
@@ -92,8 +114,8 @@ class StainNormalization(object):
     """
     def __init__(self) -> None:
         # mean and std per channel of a reference image
-        self.reference_mean = np.array([148.60, 169.30, 105.97])
-        self.reference_std = np.array([41.56, 9.01, 6.67])
+        self.reference_mean = np.array(REFERENCE_LAB_MEAN)
+        self.reference_std = np.array(REFERENCE_LAB_STD)
 
     @staticmethod
     def stain_normalize(img: torch.Tensor, reference_mean: np.ndarray, reference_std: np.ndarray) -> torch.Tensor:
@@ -132,6 +154,273 @@ class StainNormalization(object):
         return self.stain_normalize(img, self.reference_mean, self.reference_std)
 
 
+def _apply_color_matrix(img: torch.Tensor, matrix: Sequence[Sequence[float]]) -> torch.Tensor:
+    matrix_tensor = torch.tensor(matrix, dtype=img.dtype, device=img.device)
+    return torch.einsum('ij,njhw->nihw', matrix_tensor, img)
+
+
+def _srgb_to_linear(img: torch.Tensor) -> torch.Tensor:
+    return torch.where(img <= 0.04045, img / 12.92, ((img + 0.055) / 1.055) ** 2.4)
+
+
+def _linear_to_srgb(linear: torch.Tensor) -> torch.Tensor:
+    return torch.where(linear <= 0.0031308, 12.92 * linear, 1.055 * linear ** (1 / 2.4) - 0.055)
+
+
+def _linear_rgb_to_lab(linear: torch.Tensor) -> torch.Tensor:
+    # XYZ normalized by the white point
+    xyz = _apply_color_matrix(linear, [[coef / white for coef in row]
+                                       for row, white in zip(_XYZ_FROM_RGB, _D65_WHITE_POINT)])
+    f_xyz = torch.where(xyz > 0.008856, xyz.clamp(min=0.008856) ** (1 / 3), 7.787 * xyz + 16 / 116)
+    f_x, f_y, f_z = f_xyz.unbind(dim=1)
+    y = xyz[:, 1]
+    lightness = torch.where(y > 0.008856, 116 * f_y - 16, 903.3 * y)
+    return torch.stack([lightness * 255 / 100, 500 * (f_x - f_y) + 128, 200 * (f_y - f_z) + 128], dim=1)
+
+
+def _lab_to_linear_rgb(lab: torch.Tensor) -> torch.Tensor:
+    lightness = lab[:, 0] * 100 / 255
+    a, b = lab[:, 1] - 128, lab[:, 2] - 128
+    y = torch.where(lightness > 903.3 * 0.008856, ((lightness + 16) / 116) ** 3, lightness / 903.3)
+    f_y = torch.where(y > 0.008856, (lightness + 16) / 116, 7.787 * y + 16 / 116)
+    f_xz = torch.stack([f_y + a / 500, f_y - b / 200], dim=1)
+    x, z = torch.where(f_xz > 0.206893, f_xz ** 3, (f_xz - 16 / 116) / 7.787).unbind(dim=1)
+    # XYZ normalized by the white point
+    xyz = torch.stack([x, y, z], dim=1)
+    linear = _apply_color_matrix(xyz, [[coef * white for coef, white in zip(row, _D65_WHITE_POINT)]
+                                       for row in _RGB_FROM_XYZ])
+    return linear.clamp(0, 1)
+
+
+def rgb_to_lab(img: torch.Tensor) -> torch.Tensor:
+    """Convert a batch of sRGB images to CIE LAB, with the same formulas and scaling as OpenCV's 8-bit conversion
+    (`cv2.COLOR_RGB2LAB`), i.e. with L in [0, 255] and a, b offset by 128.
+
+    :param img: Floating-point RGB images in (N, 3, H, W) format, with values in [0, 1].
+    :return: The LAB images in (N, 3, H, W) format, with values in [0, 255].
+    """
+    return _linear_rgb_to_lab(_srgb_to_linear(img))
+
+
+def lab_to_rgb(lab: torch.Tensor) -> torch.Tensor:
+    """Convert a batch of CIE LAB images back to sRGB, inverting `rgb_to_lab()` (cf. `cv2.COLOR_LAB2RGB`).
+
+    :param lab: LAB images in (N, 3, H, W) format, in OpenCV's 8-bit LAB scale.
+    :return: The RGB images in (N, 3, H, W) format, with values clipped to [0, 1].
+    """
+    return _linear_to_srgb(_lab_to_linear_rgb(lab)).clamp(0, 1)
+
+
+def _quantize_image(img: torch.Tensor) -> torch.Tensor:
+    # Truncate to 8 bits, as `StainNormalization` does
+    return img if img.dtype == torch.uint8 else torch.floor(img * 255).clamp(0, 255).to(torch.uint8)
+
+
+def _apply_in_chunks(function: Callable[[torch.Tensor], torch.Tensor], img: torch.Tensor,
+                     chunk_size: Optional[int]) -> torch.Tensor:
+    if img.ndim != 4 or img.shape[1] != 3:
+        raise ValueError(f"Stain normalization expects RGB images in (N, 3, H, W) format, got {tuple(img.shape)}")
+    if chunk_size is None:
+        # Small chunks keep the intermediate tensors in the CPU caches, while GPUs are faster on large batches
+        chunk_size = len(img) if img.is_cuda else 8
+    if len(img) <= chunk_size:
+        return function(img)
+    return torch.cat([function(chunk) for chunk in img.split(chunk_size)])
+
+
+class BatchStainNormalization(object):
+    """Batched Reinhard stain normalization of (N, C, H, W) tensors, equivalent to applying `StainNormalization`
+    to each image separately.
+
+    The RGB to LAB conversion, the per-image statistics over non-white pixels, and the normalization are all computed
+    with vectorized tensor operations, so this runs on whichever device the input is on (CPU or GPU) and is much
+    faster than `StainNormalization` for bags of tiles. Intermediate values are rounded to 8 bits as in
+    `StainNormalization`, and the outputs only differ by a few 1/255 for the few pixels where OpenCV's fixed-point
+    LAB conversion rounds differently.
+
+    Inputs can be floating-point images in [0, 1], or `uint8` images in [0, 255] as produced during preprocessing.
+    The output has the same type and shape as the input. To normalize a bag of tiles loaded by `LoadTilesBatchd` in
+    a dictionary pipeline, wrap it with `transform_dict_adaptor(BatchStainNormalization(), key, key)`.
+
+    Usage example:
+        >>> transform = BatchStainNormalization()
+        >>> tiles = transform(tiles)
+    """
+    def __init__(self, reference_mean: Sequence[float] = REFERENCE_LAB_MEAN,
+                 reference_std: Sequence[float] = REFERENCE_LAB_STD, white_threshold: int = 215,
+                 chunk_size: Optional[int] = None) -> None:
+        """
+        :param reference_mean: Mean per LAB channel of a reference image, in OpenCV's 8-bit LAB scale.
+        :param reference_std: STD per LAB channel of a reference image, in OpenCV's 8-bit LAB scale.
+        :param white_threshold: Pixels with 8-bit grayscale value above this threshold are considered background.
+        They are excluded from the statistics and left unchanged.
+        :param chunk_size: Number of images to normalize at once. By default (`None`), 8 images on CPU, where small
+        chunks are faster, and the whole batch on GPU.
+        """
+        self.reference_mean = tuple(reference_mean)
+        self.reference_std = tuple(reference_std)
+        self.white_threshold = white_threshold
+        self.chunk_size = chunk_size
+
+    def stain_normalize(self, pixels: torch.Tensor) -> torch.Tensor:
+        """
+        Applies stain normalization to a batch of 8-bit images.
+
+        :param pixels: Input RGB images in (N, 3, H, W) format, of type `uint8`.
+        :return: The normalized images, of type `uint8`.
+        """
+        # Same fixed-point grayscale conversion as `cv2.COLOR_RGB2GRAY`
+        red, green, blue = pixels.int().unbind(dim=1)
+        gray = (4899 * red + 9617 * green + 1868 * blue + 8192) >> 14
+        whitemask = (gray > self.white_threshold).unsqueeze(1)  # (N, 1, H, W)
+
+        # sRGB linearization of all 256 possible values, looked up instead of computed for every pixel
+        srgb_to_linear = _srgb_to_linear(torch.arange(256, dtype=torch.float32, device=pixels.device) / 255)
+        # LAB values are rounded to 8 bits as in `cv2.COLOR_RGB2LAB`
+        lab = _linear_rgb_to_lab(srgb_to_linear[pixels.long()]).round_()
+
+        weights = (~whitemask).to(lab.dtype)
+        count = weights.sum(dim=(2, 3), keepdim=True).clamp(min=1)
+        mean = (lab * weights).sum(dim=(2, 3), keepdim=True) / count
+        variance = (((lab - mean) ** 2) * weights).sum(dim=(2, 3), keepdim=True) / count
+        epsilon = 1e-11  # Sometimes STD is near 0, add epsilon to avoid div by 0
+        std = variance.sqrt() + epsilon
+
+        reference_mean = torch.tensor(self.reference_mean, dtype=lab.dtype, device=lab.device).view(1, 3, 1, 1)
+        reference_std = torch.tensor(self.reference_std, dtype=lab.dtype, device=lab.device).view(1, 3, 1, 1)
+        lab = ((lab - mean) / std * reference_std + reference_mean).clamp_(0, 255).floor_()
+
+        normalized = (_linear_to_srgb(_lab_to_linear_rgb(lab)) * 255).round_().clamp_(0, 255).to(torch.uint8)
+        return torch.where(whitemask, pixels, normalized)  # add back white pixels
+
+    def __call__(self, img: torch.Tensor) -> torch.Tensor:
+        normalized = _apply_in_chunks(self.stain_normalize, _quantize_image(img), self.chunk_size)
+        return normalized if img.dtype == torch.uint8 else normalized.to(img.dtype) / 255
+
+
+def _masked_quantile(values: torch.Tensor, mask: torch.Tensor, q: float) -> torch.Tensor:
+    """Compute a quantile of each row of a tensor over its masked entries, with 'nearest' interpolation.
+
+    Unlike `torch.nanquantile()`, this has no limit on the input size.
+
+    :param values: Input tensor of shape (N, P).
+    :param mask: Boolean tensor of shape (N, P), selecting the entries to consider in each row.
+    :param q: Quantile to compute, in [0, 1].
+    :return: The quantile of each row, of shape (N,).
+    """
+    sorted_values, _ = torch.where(mask, values, torch.full_like(values, float('inf'))).sort(dim=1)
+    count = mask.sum(dim=1)
+    index = torch.round(q * (count - 1).clamp(min=0).to(values.dtype)).long()
+    return sorted_values.gather(1, index.unsqueeze(1)).squeeze(1)
+
+
+class BatchMacenkoStainNormalization(object):
+    """Batched Macenko stain normalization of (N, C, H, W) tensors.
+
+    Following Macenko et al. (2009): "A method for normalizing histology slides for quantitative analysis."
+    First, convert each image to optical density (OD) space and mask out transparent (background) pixels.
+    Second, estimate the H&E stain vectors of each image from the extreme angles of its tissue pixels projected on
+    the plane of the two principal OD directions.
+    Third, compute the stain concentrations and rescale them to match the reference maximum concentrations.
+    Fourth, recombine the concentrations with the reference stain vectors.
+
+    All images are processed at once with batched tensor operations, on the device of the input. Images with too few
+    tissue pixels to estimate their stain vectors are returned unchanged. As for `BatchStainNormalization`, inputs can
+    be floating-point images in [0, 1] or `uint8` images, and the output has the same type and shape as the input.
+
+    Usage example:
+        >>> transform = BatchMacenkoStainNormalization()
+        >>> tiles = transform(tiles)
+    """
+    def __init__(self, reference_stains: Sequence[Sequence[float]] = REFERENCE_HE_STAINS,
+                 reference_max_concentrations: Sequence[float] = REFERENCE_MAX_HE_CONCENTRATIONS,
+                 light_intensity: float = 240., alpha: float = 1., beta: float = 0.15,
+                 min_tissue_pixels: int = 100, chunk_size: Optional[int] = None) -> None:
+        """
+        :param reference_stains: H&E stain vectors of a reference image, as the columns of a (3, 2) matrix.
+        :param reference_max_concentrations: Robust maximum (99th percentile) H&E stain concentrations of a reference
+        image.
+        :param light_intensity: Transmitted light intensity, i.e. the intensity of background pixels.
+        :param alpha: Percentile of the projected angles used as extremes to estimate the stain vectors.
+        :param beta: OD threshold below which pixels are considered transparent, in any channel.
+        :param min_tissue_pixels: Minimum number of tissue pixels needed to normalize an image.
+        :param chunk_size: Number of images to normalize at once. By default (`None`), 8 images on CPU, where small
+        chunks are faster, and the whole batch on GPU.
+        """
+        self.reference_stains = tuple(tuple(row) for row in reference_stains)
+        self.reference_max_concentrations = tuple(reference_max_concentrations)
+        self.light_intensity = light_intensity
+        self.alpha = alpha
+        self.beta = beta
+        self.min_tissue_pixels = min_tissue_pixels
+        self.chunk_size = chunk_size
+
+    def get_stain_vectors(self, optical_density: torch.Tensor, tissue_mask: torch.Tensor) -> torch.Tensor:
+        """Estimate the H&E stain vectors of each image.
+
+        :param optical_density: OD of each image, of shape (N, 3, P).
+        :param tissue_mask: Boolean mask of the tissue pixels of each image, of shape (N, P).
+        :return: The stain vectors of each image, as the columns of a tensor of shape (N, 3, 2), hematoxylin first.
+        """
+        weights = tissue_mask.unsqueeze(1).to(optical_density.dtype)
+        count = weights.sum(dim=2, keepdim=True).clamp(min=2)
+        centered = (optical_density - (optical_density * weights).sum(dim=2, keepdim=True) / count) * weights
+        covariance = centered @ centered.transpose(1, 2) / (count - 1)
+        _, eigenvectors = torch.linalg.eigh(covariance)  # eigenvalues in ascending order
+        plane = eigenvectors[:, :, 1:]  # (N, 3, 2), the two principal directions
+        # Eigenvectors are defined up to sign: orient them towards positive OD
+        plane = plane * (1 - 2 * (plane.sum(dim=1, keepdim=True) < 0).to(plane.dtype))
+
+        projection = plane.transpose(1, 2) @ optical_density  # (N, 2, P)
+        angles = torch.atan2(projection[:, 1], projection[:, 0])
+        min_angle = _masked_quantile(angles, tissue_mask, self.alpha / 100)
+        max_angle = _masked_quantile(angles, tissue_mask, 1 - self.alpha / 100)
+        v_min = (plane @ torch.stack([torch.cos(min_angle), torch.sin(min_angle)], dim=1).unsqueeze(2)).squeeze(2)
+        v_max = (plane @ torch.stack([torch.cos(max_angle), torch.sin(max_angle)], dim=1).unsqueeze(2)).squeeze(2)
+        # Hematoxylin has the largest OD in the red channel
+        h_first = (v_min[:, 0] > v_max[:, 0]).view(-1, 1)
+        hematoxylin = torch.where(h_first, v_min, v_max)
+        eosin = torch.where(h_first, v_max, v_min)
+        return torch.stack([hematoxylin, eosin], dim=2)
+
+    def stain_normalize(self, img: torch.Tensor) -> torch.Tensor:
+        """
+        Applies stain normalization to a batch of floating-point images.
+
+        :param img: Input RGB images in (N, 3, H, W) format, with values in [0, 1].
+        :return: The normalized images, with values in [0, 1].
+        """
+        n_images, n_channels, height, width = img.shape
+        intensity = (img * 255).reshape(n_images, n_channels, height * width)
+        optical_density = -torch.log((intensity + 1) / self.light_intensity)
+        tissue_mask = (optical_density > self.beta).all(dim=1)  # (N, P)
+
+        valid = tissue_mask.sum(dim=1) >= self.min_tissue_pixels
+        reference_stains = torch.tensor(self.reference_stains, dtype=img.dtype, device=img.device)
+        # Stain vectors cannot be estimated for invalid images, which are left unchanged anyway
+        stains = torch.where(valid.view(-1, 1, 1), self.get_stain_vectors(optical_density, tissue_mask),
+                             reference_stains)
+        # Least-squares stain concentrations, solving the 2x2 normal equations of each image
+        gram = stains.transpose(1, 2) @ stains
+        concentrations = torch.linalg.solve(gram, stains.transpose(1, 2) @ optical_density)  # (N, 2, P)
+        all_pixels = torch.ones_like(tissue_mask)
+        max_concentrations = torch.stack([_masked_quantile(concentrations[:, i], all_pixels, 0.99)
+                                          for i in range(2)], dim=1)
+        reference_max = torch.tensor(self.reference_max_concentrations, dtype=img.dtype, device=img.device)
+        concentrations = concentrations * (reference_max / max_concentrations).unsqueeze(2)
+
+        normalized = self.light_intensity * torch.exp(-reference_stains @ concentrations)
+        normalized = (normalized.clamp(0, 255) / 255).reshape(img.shape)
+
+        return torch.where(valid.view(-1, 1, 1, 1), normalized, img)
+
+    def __call__(self, img: torch.Tensor) -> torch.Tensor:
+        if img.dtype != torch.uint8:
+            return _apply_in_chunks(self.stain_normalize, img, self.chunk_size)
+        normalized = _apply_in_chunks(self.stain_normalize, img.float() / 255, self.chunk_size)
+        return (normalized * 255).round().to(torch.uint8)
+
+
 class GaussianBlur(object):
     """
     Implements Gaussian blur as described in the SimCLR paper (https://arxiv.org/abs/2002.05709).
@@ -1,11 +1,13 @@
 import pytest
 from typing import Type, Union
 
+import torch
 from torch import nn, rand, sum, allclose, ones_like
 
 from health_ml.networks.layers.attention_layers import (AttentionLayer, GatedAttentionLayer,
                                                         MeanPoolingLayer, TransformerPooling,
-                                                        MaxPoolingLayer)
+                                                        MaxPoolingLayer, segment_softmax)
+from health_ml.utils.bag_utils import pack_bags
 
 
 def _test_attention_layer(attentionlayer: nn.Module, dim_in: int, dim_att: int,
@@ -64,3 +66,28 @@ def test_transformer_pooling(num_layers: int, num_heads: int, dim_in: int, batch
                                              num_heads=num_heads,
                                              dim_representation=dim_in).eval()
     _test_attention_layer(transformer_pooling, dim_in=dim_in, dim_att=1, batch_size=batch_size)
+
+
+@pytest.mark.parametrize('pooling_layer', [AttentionLayer(3, 4, 1), AttentionLayer(3, 4, 2),
+                                           GatedAttentionLayer(3, 4, 2), MeanPoolingLayer(), MaxPoolingLayer()])
+def test_packed_pooling(pooling_layer: nn.Module) -> None:
+    bags = [rand(n_instances, 3) for n_instances in [4, 1, 7]]
+    packed_features, bag_offsets = pack_bags(bags)
+    packed_attn_weights, packed_output_features = pooling_layer(packed_features, bag_offsets)
+    assert packed_attn_weights.shape[1] == len(packed_features)
+    assert packed_output_features.shape[0] == len(bags)
+
+    # Processing a packed batch gives the same outputs as processing each bag separately
+    for bag_index, bag in enumerate(bags):
+        attn_weights, output_features = pooling_layer(bag)
+        start, end = bag_offsets[bag_index], bag_offsets[bag_index + 1]
+        assert allclose(packed_attn_weights[:, start:end], attn_weights, atol=1e-6)
+        assert allclose(packed_output_features[bag_index], output_features, atol=1e-6)
+
+
+def test_segment_softmax() -> None:
+    scores = rand(6, 2)
+    bag_offsets = torch.tensor([0, 1, 4, 6])
+    weights = segment_softmax(scores, bag_offsets)
+    for start, end in zip(bag_offsets[:-1], bag_offsets[1:]):
+        assert allclose(weights[start:end], torch.softmax(scores[start:end], dim=0))
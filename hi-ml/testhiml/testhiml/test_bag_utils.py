@@ -1,14 +1,18 @@
 import os
 import pytest
 from collections import Counter
+from pathlib import Path
 from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Union
 
+import numpy as np
 import torch
 from pytorch_lightning import LightningModule, Trainer
 from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.distributed import DistributedSampler
 
 
-from health_ml.utils.bag_utils import (BagSampler, create_bag_dataloader, multibag_collate)
+from health_ml.utils.bag_utils import (BagSampler, TileBalancedDistributedSampler, TileBudgetBatchSampler,
+                                       create_bag_dataloader, multibag_collate, pack_bags)
 
 # Run GPU tests only if available
 GPUS = [0, -1] if torch.cuda.is_available() else [0]  # type: ignore
@@ -97,6 +101,21 @@ def test_bag_sampler_seeding(shuffle_bags: bool, shuffle_samples: bool,
     assert sampled_bags1 == sampled_bags2
 
 
+@pytest.mark.parametrize('shuffle_samples', [False, True])
+@pytest.mark.parametrize('max_bag_size', [0, 3])
+def test_bag_sampler_bag_index(shuffle_samples: bool, max_bag_size: int) -> None:
+    bag_ids = np.random.default_rng(0).choice(['x', 'b', 'k', 'a'], size=50)
+    sampler = BagSampler(bag_ids, shuffle_samples=shuffle_samples, max_bag_size=max_bag_size)
+    for bag_index, bag_id in enumerate(sampler.unique_bag_ids):
+        expected_bag = np.where(bag_ids == bag_id)[0].tolist()
+        bag = sampler.get_bag(bag_index)
+        if shuffle_samples:
+            assert set(bag) <= set(expected_bag)
+            assert len(bag) == min(len(expected_bag), max_bag_size or len(expected_bag))
+        else:
+            assert bag == expected_bag[:max_bag_size or None]
+
+
 def test_bag_sampler_pickling() -> None:
     import pickle
 
@@ -153,6 +172,175 @@ def test_multibag_collate() -> None:
                    for idx in range(batch_size))
 
 
+@pytest.mark.parametrize('shuffle', [False, True])
+@pytest.mark.parametrize('bucket_size', [0, 7])
+def test_tile_budget_batch_sampler(shuffle: bool, bucket_size: int) -> None:
+    rng = np.random.default_rng(0)
+    bag_sizes = rng.integers(1, 50, size=40)
+    bag_sizes[5] = 150  # larger than the budget
+    max_instances = 100
+    sampler = TileBudgetBatchSampler(bag_sizes, max_instances_per_batch=max_instances, shuffle=shuffle,
+                                     bucket_size=bucket_size, seed=0)
+    n_batches = len(sampler)
+    batches = list(sampler)
+    assert len(batches) == n_batches
+    assert sorted(bag_index for batch in batches for bag_index in batch) == list(range(len(bag_sizes)))
+    for batch in batches:
+        assert bag_sizes[batch].sum() <= max_instances or len(batch) == 1
+    assert [5] in batches
+
+    statistics = sampler.last_epoch_statistics
+    assert statistics['num_batches'] == n_batches
+    assert statistics['packing_efficiency'] > 0
+    assert 0 < statistics['padding_efficiency'] <= 1
+    if not shuffle and bucket_size == 0:
+        # Without bucketing, bags are batched in order of size
+        assert [bag_sizes[batch].tolist() for batch in batches] == \
+            [sorted(bag_sizes[batch].tolist()) for batch in batches]
+        assert list(sampler) == batches
+        assert statistics['padding_efficiency'] > 0.5
+    if shuffle:
+        # Batches differ between epochs
+        assert list(sampler) != batches
+
+
+@pytest.mark.parametrize('bucket_size', [0, 4, 7])
+def test_tile_budget_batch_sampler_fixed_length(bucket_size: int) -> None:
+    rng = np.random.default_rng(0)
+    bag_sizes = rng.lognormal(mean=3, sigma=1, size=50).astype(int) + 1
+    max_instances = 60
+    sampler = TileBudgetBatchSampler(bag_sizes, max_instances_per_batch=max_instances, shuffle=True,
+                                     bucket_size=bucket_size, seed=0)
+    n_batches = len(sampler)
+    epoch_batches = [list(sampler) for _ in range(5)]
+    if bucket_size > 0:
+        # The random packing differs between epochs, but the number of batches is fixed
+        assert len({tuple(sorted(map(tuple, batches))) for batches in epoch_batches}) > 1
+    for batches in epoch_batches:
+        assert len(batches) == n_batches
+        assert sorted(bag_index for batch in batches for bag_index in batch) == list(range(len(bag_sizes)))
+        for batch in batches:
+            assert bag_sizes[batch].sum() <= max_instances or len(batch) == 1
+    # The batches of each epoch only depend on the seed and the epoch
+    sampler.set_epoch(2)
+    assert list(sampler) == epoch_batches[2]
+
+
+@pytest.mark.parametrize('n_bags', [1, 3, 40])
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_tile_budget_batch_sampler_distributed(n_bags: int, shuffle: bool) -> None:
+    rng = np.random.default_rng(0)
+    bag_sizes = rng.integers(1, 50, size=n_bags)
+    num_replicas = 4
+    samplers = [TileBudgetBatchSampler(bag_sizes, max_instances_per_batch=100, shuffle=shuffle, bucket_size=8,
+                                       num_replicas=num_replicas, rank=rank, seed=1)
+                for rank in range(num_replicas)]
+    for _ in range(2):
+        rank_batches = [list(sampler) for sampler in samplers]
+        # Ranks run the same number of steps, and all bags are processed
+        assert all(len(batches) == len(samplers[0]) for batches in rank_batches)
+        rank_bags = [bag_index for batches in rank_batches for batch in batches for bag_index in batch]
+        assert set(rank_bags) == set(range(n_bags))
+        if n_bags >= 10 * num_replicas:
+            # Batches are split rather than repeated, so each bag is processed exactly once
+            assert sorted(rank_bags) == list(range(n_bags))
+
+    with pytest.raises(ValueError, match="Invalid rank 2"):
+        TileBudgetBatchSampler(bag_sizes, max_instances_per_batch=100, num_replicas=2, rank=2)
+
+
+def _get_rank_tile_counts(bag_sizes: np.ndarray, rank_bags: List[List[int]]) -> np.ndarray:
+    return np.array([bag_sizes[bags].sum() for bags in rank_bags])
+
+
+@pytest.mark.parametrize('n_bags', [2, 37, 40])
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_tile_balanced_distributed_sampler(n_bags: int, shuffle: bool) -> None:
+    rng = np.random.default_rng(0)
+    bag_sizes = rng.lognormal(mean=5, sigma=1, size=n_bags).astype(int) + 1
+    num_replicas = 4
+    samplers = [TileBalancedDistributedSampler(range(n_bags), bag_sizes, num_replicas=num_replicas,  # type: ignore
+                                               rank=rank, shuffle=shuffle, seed=1)
+                for rank in range(num_replicas)]
+    rank_bags = [list(sampler) for sampler in samplers]
+
+    # Ranks run the same number of steps, and all bags are processed
+    assert all(len(bags) == len(samplers[0]) == int(np.ceil(n_bags / num_replicas)) for bags in rank_bags)
+    assert set().union(*rank_bags) == set(range(n_bags))
+    if n_bags % num_replicas == 0:
+        assert sorted(sum(rank_bags, [])) == list(range(n_bags))
+
+    if n_bags >= 10 * num_replicas:
+        # Tile counts are better balanced than with the standard sampler splitting bags by count
+        tile_counts = _get_rank_tile_counts(bag_sizes, rank_bags)
+        standard_rank_bags = [list(DistributedSampler(range(n_bags), num_replicas=num_replicas,  # type: ignore
+                                                      rank=rank, shuffle=shuffle, seed=1))
+                              for rank in range(num_replicas)]
+        standard_tile_counts = _get_rank_tile_counts(bag_sizes, standard_rank_bags)
+        assert tile_counts.max() - tile_counts.min() < standard_tile_counts.max() - standard_tile_counts.min()
+        assert tile_counts.max() - tile_counts.min() <= bag_sizes.max()
+
+    # The assignment is reshuffled deterministically at every epoch
+    for sampler in samplers:
+        sampler.set_epoch(1)
+    new_rank_bags = [list(sampler) for sampler in samplers]
+    assert new_rank_bags == [list(sampler) for sampler in samplers]
+    if shuffle and n_bags > num_replicas:
+        assert new_rank_bags != rank_bags
+
+    with pytest.raises(ValueError, match="Expected 2 bag sizes"):
+        TileBalancedDistributedSampler(range(2), [1, 2, 3], num_replicas=2, rank=0)  # type: ignore
+
+
+def _run_distributed_sampler(rank: int, world_size: int, init_file: str, bag_sizes: List[int],
+                             results_file: str) -> None:
+    torch.distributed.init_process_group('gloo', init_method=f"file://{init_file}", rank=rank,
+                                         world_size=world_size)
+    try:
+        # The number of replicas and the rank are retrieved from the process group
+        sampler = TileBalancedDistributedSampler(range(len(bag_sizes)), bag_sizes, shuffle=True,  # type: ignore
+                                                 seed=0)
+        sampler.set_epoch(3)
+        rank_bags: List[Optional[List[int]]] = [None] * world_size
+        torch.distributed.all_gather_object(rank_bags, list(sampler))
+        if rank == 0:
+            torch.save(rank_bags, results_file)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+@pytest.mark.skipif(not torch.distributed.is_available(), reason="Distributed training is not available")
+def test_tile_balanced_distributed_sampler_gloo(tmp_path: Path) -> None:
+    world_size = 2
+    bag_sizes = [5000, 4800, 4700, 50, 40, 30, 20, 10, 10, 5]
+    results_file = tmp_path / "rank_bags.pt"
+    torch.multiprocessing.spawn(_run_distributed_sampler, nprocs=world_size,
+                                args=(world_size, str(tmp_path / "init"), bag_sizes, str(results_file)))
+    rank_bags = torch.load(results_file)
+    assert sorted(sum(rank_bags, [])) == list(range(len(bag_sizes)))
+    # The three large slides are not all assigned to the same rank, as they would be when sharding by count
+    tile_counts = _get_rank_tile_counts(np.array(bag_sizes), rank_bags)
+    assert tile_counts.max() - tile_counts.min() <= max(bag_sizes)
+    assert all(sum(bag_index < 3 for bag_index in bags) >= 1 for bags in rank_bags)
+    # All ranks compute the same assignment as a local sampler
+    expected_rank_bags = []
+    for rank in range(world_size):
+        sampler = TileBalancedDistributedSampler(range(len(bag_sizes)), bag_sizes,  # type: ignore
+                                                 num_replicas=world_size, rank=rank, shuffle=True, seed=0)
+        sampler.set_epoch(3)
+        expected_rank_bags.append(list(sampler))
+    assert rank_bags == expected_rank_bags
+
+
+def test_pack_bags() -> None:
+    bags = [torch.rand(n_instances, 3, 4) for n_instances in [2, 5, 1]]
+    packed, offsets = pack_bags(bags)
+    assert packed.shape == (8, 3, 4)
+    assert offsets.tolist() == [0, 2, 7, 8]
+    for bag_index, bag in enumerate(bags):
+        assert torch.equal(packed[offsets[bag_index]:offsets[bag_index + 1]], bag)
+
+
 @pytest.mark.parametrize('shuffle_bags', [False, True])
 @pytest.mark.parametrize('shuffle_samples', [False, True])
 @pytest.mark.parametrize('seed', [None, 0])
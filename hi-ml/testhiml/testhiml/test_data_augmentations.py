@@ -1,12 +1,15 @@
+import cv2
+import pytest
 import torch
 import numpy as np
 import random
 
 from torch import Tensor
-from typing import Callable
+from typing import Callable, List
 
 from health_ml.utils.data_augmentations import HEDJitter, StainNormalization, GaussianBlur, \
-    RandomRotationByMultiplesOf90
+    RandomRotationByMultiplesOf90, BatchStainNormalization, BatchMacenkoStainNormalization, rgb_to_lab, lab_to_rgb, \
+    REFERENCE_HE_STAINS, REFERENCE_MAX_HE_CONCENTRATIONS
 
 # global dummy image
 dummy_img = torch.Tensor(
@@ -63,6 +66,79 @@ def test_stain_normalization() -> None:
     _test_data_augmentation(data_augmentation, dummy_img, expected_output_img, stochastic=False)
 
 
+def test_rgb_lab_conversion() -> None:
+    rgb = np.random.default_rng(0).integers(0, 256, size=(16, 16, 3), dtype=np.uint8)
+    img = torch.from_numpy(rgb).permute(2, 0, 1).unsqueeze(0) / 255.
+    lab = rgb_to_lab(img)
+    expected_lab = cv2.cvtColor(rgb, cv2.COLOR_RGB2LAB)
+    # OpenCV rounds the LAB values to 8 bits
+    assert np.abs(lab[0].permute(1, 2, 0).numpy() - expected_lab).max() < 1
+    assert torch.allclose(lab_to_rgb(lab), img, atol=1e-4)
+
+
+def test_batch_stain_normalization() -> None:
+    torch.manual_seed(0)
+    imgs = torch.rand(6, 3, 16, 16) * 0.6 + 0.2
+    imgs[1, :, :8] = 1.  # partly white
+    imgs[2] = 1.  # fully white
+
+    normalized = BatchStainNormalization()(imgs)
+    assert normalized.shape == imgs.shape
+    assert normalized.dtype == imgs.dtype
+    assert normalized.min() >= 0. and normalized.max() <= 1.
+    assert torch.equal(normalized[2], imgs[2])
+    expected = torch.cat([StainNormalization()(img.unsqueeze(0)) for img in imgs])
+    # OpenCV's fixed-point LAB conversion rounds a few pixels differently
+    assert torch.allclose(normalized, expected, atol=6 / 255)
+    assert (normalized - expected).abs().mean() < 0.5 / 255
+
+    normalized_uint8 = BatchStainNormalization()((imgs * 255).to(torch.uint8))
+    assert normalized_uint8.dtype == torch.uint8
+    assert (normalized_uint8.float() - normalized * 255).abs().max() <= 1
+
+    assert torch.equal(BatchStainNormalization(chunk_size=4)(imgs), normalized)
+    assert torch.allclose(BatchStainNormalization()(dummy_img), StainNormalization()(dummy_img), atol=6 / 255)
+
+    with pytest.raises(ValueError):
+        BatchStainNormalization()(imgs[0])
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="No GPU available")
+def test_batch_stain_normalization_gpu() -> None:
+    imgs = torch.rand(4, 3, 16, 16)
+    transforms: List[Callable[[Tensor], Tensor]] = [BatchStainNormalization(),
+                                                    BatchMacenkoStainNormalization(min_tissue_pixels=1)]
+    for transform in transforms:
+        normalized = transform(imgs.cuda())
+        assert normalized.is_cuda
+        assert torch.allclose(normalized.cpu(), transform(imgs), atol=1e-3)
+
+
+def test_batch_macenko_stain_normalization() -> None:
+    # Synthesize tiles from the reference stains, including pure hematoxylin and pure eosin pixels
+    torch.manual_seed(0)
+    stains = torch.tensor(REFERENCE_HE_STAINS)
+    max_concentrations = torch.tensor(REFERENCE_MAX_HE_CONCENTRATIONS).view(2, 1)
+    concentrations = torch.rand(2, 4096) * max_concentrations
+    concentrations[1, :1024] = 0
+    concentrations[0, 1024:2048] = 0
+
+    def synthesize(concentrations: Tensor) -> Tensor:
+        return ((240 * torch.exp(-stains @ concentrations) - 1) / 255).reshape(1, 3, 64, 64)
+
+    reference_img = synthesize(concentrations)
+    imgs = torch.cat([reference_img, synthesize(1.5 * concentrations), synthesize(0.7 * concentrations),
+                      torch.ones_like(reference_img)])
+    normalized = BatchMacenkoStainNormalization()(imgs)
+    assert normalized.shape == imgs.shape
+    assert normalized.min() >= 0. and normalized.max() <= 1.
+    # Differently stained tiles are mapped back to the reference staining
+    for i in range(3):
+        assert torch.allclose(normalized[i], reference_img[0], atol=0.02)
+    # Tiles without tissue are left unchanged
+    assert torch.equal(normalized[3], imgs[3])
+
+
 def test_hed_jitter() -> None:
     data_augmentation = HEDJitter(0.05)
     expected_output_img = torch.Tensor(